@@ -35,11 +35,17 @@
 
 """
 from . import DataObject
+from . import StackROIBatch
 import numpy
 import time
 import os
 import sys
 import glob
+try:
+    import h5py
+    HDF5 = True
+except:
+    HDF5 = False
 DEBUG = 0
 PLUGINS_DIR = None
 try:
@@ -104,6 +110,13 @@ def __init__(self):
         self._dynamicLimit = 5.0E6
         self._tryNumpy = True
 
+        # optional cumulative sum of the stack along the spectral axis
+        self._useCumulativeSum = False
+        self._cumulativeSum = None
+        self._cumulativeSumFile = None
+        self._cumulativeSumFileName = None
+        self._cumulativeSumMinMax = False
+
     def setPluginDirectoryList(self, dirlist):
         for directory in dirlist:
             if not os.path.exists(directory):
@@ -342,6 +355,9 @@ def stackUpdated(self):
             self._finiteData = False
             self.handleNonFiniteData()
 
+        if self._useCumulativeSum:
+            self.buildCumulativeSum()
+
         #calculate the ROIs
         self._ROIDict = {'name': "ICR",
                          'type': "CHANNEL",
@@ -353,6 +369,105 @@ def stackUpdated(self):
         for key in self.pluginInstanceDict.keys():
             self.pluginInstanceDict[key].stackUpdated()
 
+    def setCumulativeSum(self, flag=True, filename=None, minmax=False):
+        """
+        Keep a cumulative sum of the stack along the spectral axis.
+
+        ROI sum images are then obtained as the difference of two images of
+        the cumulative sum, whatever the width of the ROI, without reading
+        the stack. If filename is given, the cumulative sum is kept in that
+        HDF5 file instead of memory. The maximum and minimum images require
+        reading the stack and they are only calculated if minmax is True,
+        otherwise they are not part of the ROI images.
+        """
+        self._useCumulativeSum = flag
+        self._cumulativeSumMinMax = minmax
+        if filename != self._cumulativeSumFileName:
+            self._closeCumulativeSum()
+            self._cumulativeSumFileName = filename
+        if not flag:
+            self._closeCumulativeSum()
+        elif self._stackImageData is not None:
+            self.buildCumulativeSum()
+
+    def _closeCumulativeSum(self):
+        self._cumulativeSum = None
+        if self._cumulativeSumFile is not None:
+            try:
+                self._cumulativeSumFile.close()
+            except:
+                print("Error closing cumulative sum file")
+            self._cumulativeSumFile = None
+
+    def buildCumulativeSum(self):
+        """
+        (Re)calculate the cumulative sum of the current stack.
+        """
+        data = self._stack.data
+        shape = data.shape
+        nChannels = shape[self.mcaIndex]
+        imageShape = [shape[i] for i in range(len(shape)) \
+                      if i != self.mcaIndex]
+        # the spectral axis goes first, so every image is contiguous
+        sumShape = tuple([nChannels + 1] + imageShape)
+        if numpy.dtype(data.dtype).kind in ["i", "u", "b"]:
+            dtype = numpy.int64
+        else:
+            dtype = numpy.float64
+        self._closeCumulativeSum()
+        if self._cumulativeSumFileName is None:
+            self._cumulativeSum = numpy.zeros(sumShape, dtype)
+        else:
+            if not HDF5:
+                raise IOError("h5py needed to keep the cumulative sum in file")
+            self._cumulativeSumFile = h5py.File(self._cumulativeSumFileName,
+                                                "w")
+            self._cumulativeSum = self._cumulativeSumFile.create_dataset(\
+                                        "cumulative_sum",
+                                        shape=sumShape,
+                                        dtype=dtype,
+                                        fillvalue=0)
+        if DEBUG:
+            t0 = time.time()
+        # blocks of about 32 MB of data along the first image dimension
+        nRows = imageShape[0]
+        rowSize = nChannels * numpy.dtype(dtype).itemsize
+        for i in imageShape[1:]:
+            rowSize *= i
+        step = max(1, int((32 * 1024 * 1024) // rowSize))
+        for start in range(0, nRows, step):
+            self.updateCumulativeSum(start, min(start + step, nRows))
+        if self._cumulativeSumFile is not None:
+            self._cumulativeSumFile.flush()
+        if DEBUG:
+            print("Cumulative sum elapsed = %f" % (time.time() - t0))
+
+    def updateCumulativeSum(self, start=0, end=None):
+        """
+        Update the cumulative sum for the rows start to end of the images.
+
+        This allows to keep the cumulative sum up to date while a stack is
+        being loaded.
+        """
+        if self._cumulativeSum is None:
+            return
+        data = self._stack.data
+        nDimensions = len(data.shape)
+        if self.mcaIndex == 0:
+            axis = 1
+        else:
+            axis = 0
+        if end is None:
+            end = data.shape[axis]
+        index = [slice(None)] * nDimensions
+        index[axis] = slice(start, end)
+        block = numpy.asarray(data[tuple(index)])
+        cumulativeSum = numpy.cumsum(block,
+                                     axis=self.mcaIndex,
+                                     dtype=self._cumulativeSum.dtype)
+        cumulativeSum = numpy.rollaxis(cumulativeSum, self.mcaIndex, 0)
+        self._cumulativeSum[1:, start:end] = cumulativeSum
+
     def isStackFinite(self):
         """
         Returns True if stack does not contain inf or nans
@@ -449,11 +564,6 @@ def updateROIImages(self, ddict=None):
             self._ROIDict.update(ddict)
 
         roiKeys = ['ROI', 'Maximum', 'Minimum', 'Left', 'Middle', 'Right', 'Background']
-        nImages = len(roiKeys)
-        imageList = [None] * nImages
-        for i in range(nImages):
-            key = roiKeys[i]
-            imageList[i] = self._ROIImageDict[key]
 
         title = "%s" % ddict["name"]
         if ddict["name"] == "ICR":
@@ -479,7 +589,15 @@ def updateROIImages(self, ddict=None):
             imageNames[1] = "%s %s at Max." % (title, cursor)
             imageNames[2] = "%s %s at Min." % (title, cursor)
 
-        self.showROIImageList(imageList, image_names=imageNames)
+        # the extrema are not always calculated
+        imageList = []
+        nameList = []
+        for key, name in zip(roiKeys, imageNames):
+            if key in self._ROIImageDict:
+                imageList.append(self._ROIImageDict[key])
+                nameList.append(name)
+
+        self.showROIImageList(imageList, image_names=nameList)
 
     def showOriginalImage(self):
         if DEBUG:
@@ -728,6 +846,16 @@ def calculateMcaDataObject(self, normalize=False):
         return dataObject
 
     def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
+        """
+        Return a dictionary with the 'ROI', 'Maximum', 'Minimum', 'Left',
+        'Middle', 'Right' and 'Background' images of the channels index1 to
+        index2. The 'Maximum' and 'Minimum' images give the energy at which
+        each spectrum reaches its maximum and minimum within the ROI.
+
+        When the cumulative sum is used without minmax (see setCumulativeSum)
+        the 'Maximum' and 'Minimum' images are not calculated and those keys
+        are not present.
+        """
         if DEBUG:
             print("Calculating ROI images")
         i1 = min(index1, index2)
@@ -748,229 +876,46 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                       'Background': dummy}
             return imageDict
 
-        isUsingSuppliedEnergyAxis = False
-        if self.fileIndex == 0:
-            if self.mcaIndex == 1:
-                leftImage = self._stack.data[:, i1, :]
-                middleImage = self._stack.data[:, imiddle, :]
-                rightImage = self._stack.data[:, i2 - 1, :]
-                dataImage = self._stack.data[:, i1:i2, :]
-                background = 0.5 * (i2 - i1) * (leftImage + rightImage)
-                roiImage = numpy.sum(dataImage, axis=1, dtype=numpy.float)
-                maxImage = energy[(numpy.argmax(dataImage, axis=1) + i1)]
-                minImage = energy[(numpy.argmin(dataImage, axis=1) + i1)]
-                isUsingSuppliedEnergyAxis = True
-            else:
-                if DEBUG:
-                    t0 = time.time()
-                if self._tryNumpy and\
-                   isinstance(self._stack.data, numpy.ndarray):
-                    leftImage = self._stack.data[:, :, i1]
-                    middleImage = self._stack.data[:, :, imiddle]
-                    rightImage = self._stack.data[:, :, i2 - 1]
-                    dataImage = self._stack.data[:, :, i1:i2]
-                    background = 0.5 * (i2 - i1) * (leftImage + rightImage)
-                    roiImage = numpy.sum(dataImage, axis=2, dtype=numpy.float)
-                    maxImage = energy[numpy.argmax(dataImage, axis=2) + i1]
-                    minImage = energy[numpy.argmin(dataImage, axis=2) + i1]
-                    isUsingSuppliedEnergyAxis = True
-                    if DEBUG:
-                        print("Case 1 ROI image calculation elapsed = %f " %\
-                              (time.time() - t0))
-                else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.uint)
-                    minImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.uint)
-                    step = 1
-                    for i in range(shape[0]):
-                        tmpData = self._stack.data[i:i+step,:, i1:i2] * 1
-                        numpy.add(roiImage[i:i+step,:],
-                              numpy.sum(tmpData, axis=2,dtype=numpy.float),
-                              roiImage[i:i+step,:])
-                        
-                        minImage[i:i + step,:] = i1 + numpy.argmin(tmpData, axis=2)
-                        maxImage[i:i + step, :] =  i1 + numpy.argmax(tmpData, axis=2)
-                        leftImage[i:i + step, :] += tmpData[:, :, 0]
-                        middleImage[i:i + step, :] += tmpData[:, :, imiddle - i1]
-                        rightImage[i:i + step, :] += tmpData[:, :, -1]
-                    background = 0.5 * (i2 - i1) * (leftImage + rightImage)
-                    isUsingSuppliedEnergyAxis = True
-                    minImage = energy[minImage]
-                    maxImage = energy[maxImage]
-                    if DEBUG:
-                        print("2 Dynamic ROI image calculation elapsed = %f " %\
-                              (time.time() - t0))
-        elif self.fileIndex == 1:
-            if self.mcaIndex == 0:
-                if DEBUG:
-                    t0 = time.time()
-                if isinstance(self._stack.data, numpy.ndarray) and\
-                   self._tryNumpy:
-                    leftImage = self._stack.data[i1, :, :]
-                    middleImage= self._stack.data[imiddle, :, :]
-                    rightImage = self._stack.data[i2 - 1, :, :]
-                    dataImage = self._stack.data[i1:i2, :, :]
-                    # this calculation is very slow but it is extremely useful
-                    # for XANES studies
-                    if 1:
-                        maxImage = energy[numpy.argmax(dataImage, axis=0) + i1]
-                        minImage = energy[numpy.argmin(dataImage, axis=0) + i1]
-                    else:
-                        # this is slower, but uses less memory
-                        maxImage = numpy.zeros(leftImage.shape, numpy.int32)
-                        minImage = numpy.zeros(leftImage.shape, numpy.int32)
-                        for i in range(i1, i2):
-                            tmpData = self._stack.data[i]
-                            tmpData.shape = leftImage.shape
-                            if i == i1:
-                                minImageData = tmpData * 1.0
-                                maxImageData = tmpData * 1.0
-                                minImage[:,:] = i1
-                                maxImage[:,:] = i1
-                            else:
-                                tmpIndex = numpy.where(tmpData < minImageData)
-                                minImage[tmpIndex] = i
-                                minImageData[tmpIndex] = tmpData[tmpIndex]
-
-                                tmpIndex = numpy.where(tmpData > maxImageData)
-                                maxImage[tmpIndex] = i
-                                maxImageData[tmpIndex] = tmpData[tmpIndex]
-                        minImage = energy[minImage]
-                        maxImage = energy[maxImage]
-                    isUsingSuppliedEnergyAxis = True
-                    background = 0.5 * (i2 - i1) * (leftImage + rightImage)
-                    roiImage = numpy.sum(dataImage, axis=0, dtype=numpy.float)
-                    if DEBUG:
-                        print("Case 3 ROI image calculation elapsed = %f " %\
-                              (time.time() - t0))
-                else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = numpy.zeros(roiImage.shape, numpy.int32)
-                    minImage = numpy.zeros(roiImage.shape, numpy.int32)
-                    istep = 1
-                    for i in range(i1, i2):
-                        tmpData = self._stack.data[i:i + istep]
-                        tmpData.shape = roiImage.shape
-                        if i == i1:
-                            minImageData = tmpData * 1.0
-                            maxImageData = tmpData * 1.0
-                            minImage[:,:] = i1
-                            maxImage[:,:] = i1
-                        else:
-                            tmpIndex = numpy.where(tmpData < minImageData)
-                            minImage[tmpIndex] = i
-                            minImageData[tmpIndex] = tmpData[tmpIndex]
-
-                            tmpIndex = numpy.where(tmpData > maxImageData)
-                            maxImage[tmpIndex] = i
-                            maxImageData[tmpIndex] = tmpData[tmpIndex]
-                        numpy.add(roiImage, tmpData, roiImage)
-                        if (i == i1):
-                            leftImage = tmpData
-                        elif (i == imiddle):
-                            middleImage = tmpData
-                        elif i == (i2 - 1):
-                            rightImage = tmpData
-                    # the used approach is twice slower than argmax, but it
-                    # requires much less memory
-                    isUsingSuppliedEnergyAxis = True
-                    minImage = energy[minImage]
-                    maxImage = energy[maxImage]
-                    if i2 > i1:
-                        background = (leftImage + rightImage) * 0.5 * (i2 - i1)
-                    if DEBUG:
-                        print("Case 4 Dynamic ROI elapsed = %f" %\
-                              (time.time() - t0))
+        if DEBUG:
+            t0 = time.time()
+        if (self._cumulativeSum is not None) and self._finiteData:
+            # non finite values would propagate to all the following channels
+            cumulativeSum = self._cumulativeSum
+            first = numpy.asarray(cumulativeSum[i1])
+            last = numpy.asarray(cumulativeSum[i2])
+            roiImage = (last - first).astype(numpy.float64)
+            leftImage = numpy.asarray(cumulativeSum[i1 + 1]) - first
+            middleImage = numpy.asarray(cumulativeSum[imiddle + 1]) - \
+                          numpy.asarray(cumulativeSum[imiddle])
+            rightImage = last - numpy.asarray(cumulativeSum[i2 - 1])
+            if self._cumulativeSumMinMax:
+                imageDict = StackROIBatch.calculateROIImages(self._stack.data,
+                                                     [(i1, i2, imiddle)],
+                                                     mcaIndex=self.mcaIndex,
+                                                     xAtMinMax=True)[0]
+                maxImage = energy[imageDict['Maximum']]
+                minImage = energy[imageDict['Minimum']]
             else:
-                if DEBUG:
-                    t0 = time.time()
-                if self._tryNumpy and\
-                   isinstance(self._stack.data, numpy.ndarray):
-                    leftImage = self._stack.data[:, :, i1]
-                    middleImage = self._stack.data[:, :, imiddle]
-                    rightImage = self._stack.data[:, :, i2 - 1]
-                    dataImage = self._stack.data[:, :, i1:i2]
-                    background = 0.5 * (i2 - i1) * (leftImage + rightImage)
-                    roiImage = numpy.sum(dataImage, axis=2, dtype=numpy.float)
-                    maxImage = energy[numpy.argmax(dataImage, axis=2) + i1]
-                    minImage = energy[numpy.argmin(dataImage, axis=2) + i1]
-                    isUsingSuppliedEnergyAxis = True
-                    if DEBUG:
-                        print("Case 5 ROI Image elapsed = %f" %\
-                              (time.time() - t0))
-                else:
-                    shape = self._stack.data.shape
-                    roiImage = numpy.zeros(self._stackImageData.shape,
-                                           numpy.float)
-                    background = roiImage * 1
-                    leftImage = roiImage * 1
-                    middleImage = roiImage * 1
-                    rightImage = roiImage * 1
-                    maxImage = roiImage * 1
-                    minImage = roiImage * 1
-                    step = 1
-                    for i in range(shape[0]):
-                        tmpData = self._stack.data[i:i+step,:, i1:i2] * 1
-                        numpy.add(roiImage[i:i+step,:],
-                              numpy.sum(tmpData, axis=2, dtype=numpy.float),
-                              roiImage[i:i+step,:])
-                        numpy.add(minImage[i:i+step,:],
-                                  numpy.min(tmpData, 2),
-                                  minImage[i:i+step,:])
-                        numpy.add(maxImage[i:i+step,:],
-                                  numpy.max(tmpData, 2),
-                                  maxImage[i:i+step,:])
-                        leftImage[i:i+step, :]   += tmpData[:, :, 0]
-                        middleImage[i:i+step, :] += tmpData[:, :, imiddle-i1]
-                        rightImage[i:i+step, :]  += tmpData[:, :,-1]
-                    background = 0.5*(i2-i1)*(leftImage+rightImage)
-                    if DEBUG:
-                        print("Case 6 Dynamic ROI image calculation elapsed = %f" %\
-                                          (time.time() - t0))
+                # not available without reading the stack
+                maxImage = None
+                minImage = None
         else:
-            #self.fileIndex = 2
-            if DEBUG:
-                t0 = time.time()
-            if self.mcaIndex == 0:
-                leftImage = self._stack.data[i1]
-                middleImage = self._stack.data[imiddle]
-                rightImage = self._stack.data[i2 - 1]
-                background = 0.5 * (i2 - i1) * (leftImage + rightImage)
-                dataImage = self._stack.data[i1:i2]
-                roiImage = numpy.sum(dataImage, axis=0, dtype=numpy.float)
-                minImage = energy[numpy.argmin(dataImage, axis=0) + i1]
-                maxImage = energy[numpy.argmax(dataImage, axis=0) + i1]
-                isUsingSuppliedEnergyAxis = True
-                if DEBUG:
-                   print("Case 7 Default ROI image calculation elapsed = %f" %\
-                                          (time.time() - t0))
-            else:
-                leftImage = self._stack.data[:, i1, :]
-                middleImage = self._stack.data[:, imiddle, :]
-                rightImage = self._stack.data[:, i2 - 1, :]
-                background = 0.5 * (i2 - i1) * (leftImage + rightImage)
-                dataImage = self._stack.data[:, i1:i2, :]
-                roiImage = numpy.sum(dataImage, axis=1, dtype=numpy.float)
-                minImage = energy[numpy.argmin(dataImage, axis=1) + i1]
-                maxImage = energy[numpy.argmax(dataImage, axis=1) + i1]
-                isUsingSuppliedEnergyAxis = True
-                if DEBUG:
-                   print("Case 8 Default ROI image calculation elapsed = %f" %\
-                                          (time.time() - t0))
+            # single pass over the channels of the ROI whatever the layout
+            imageDict = StackROIBatch.calculateROIImages(self._stack.data,
+                                                     [(i1, i2, imiddle)],
+                                                     mcaIndex=self.mcaIndex,
+                                                     xAtMinMax=True)[0]
+            roiImage = imageDict['ROI']
+            leftImage = imageDict['Left']
+            middleImage = imageDict['Middle']
+            rightImage = imageDict['Right']
+            maxImage = energy[imageDict['Maximum']]
+            minImage = energy[imageDict['Minimum']]
+        background = 0.5 * (i2 - i1) * \
+                     (leftImage.astype(numpy.float64) + rightImage)
+        isUsingSuppliedEnergyAxis = True
+        if DEBUG:
+            print("ROI image calculation elapsed = %f " % (time.time() - t0))
 
         imageDict = {'ROI': roiImage,
                      'Maximum': maxImage,
@@ -979,6 +924,9 @@ def calculateROIImages(self, index1, index2, imiddle=None, energy=None):
                      'Middle': middleImage,
                      'Right': rightImage,
                      'Background': background}
+        if maxImage is None:
+            del imageDict['Maximum']
+            del imageDict['Minimum']
         self.__ROIImageCalculationIsUsingSuppliedEnergyAxis = isUsingSuppliedEnergyAxis
         if DEBUG:
             print("ROI images calculated")
@@ -40,6 +40,96 @@
 
 DEBUG = 0
 
+# default amount of stack data read at once
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def calculateROIImages(data, roiList, mcaIndex=-1, xAtMinMax=True,
+                       blocksize=None):
+    """
+    Calculate the images associated to a set of ROIs reading the data once.
+
+    :param data: Sliceable object (numpy array, h5py dataset, ...)
+    :param roiList: List of (iFrom, iTo) or (iFrom, iTo, iMiddle) channel
+                    indices. iTo is excluded from the ROI.
+    :param mcaIndex: Index of the dimension containing the spectra
+    :param xAtMinMax: If True, calculate the indices of maximum and minimum
+    :param blocksize: Approximate amount of bytes read at once
+    :return: A list with one dictionnary of images per ROI with the keys
+             'ROI', 'Left', 'Middle', 'Right' and, if requested, 'Maximum'
+             and 'Minimum'. The sums are calculated in double precision
+             while the other images keep the data type.
+    """
+    shape = data.shape
+    nDimensions = len(shape)
+    if mcaIndex < 0:
+        mcaIndex = nDimensions + mcaIndex
+    if (mcaIndex < 0) or (mcaIndex >= nDimensions) or (nDimensions < 2):
+        raise IndexError("Invalid spectra index %d" % mcaIndex)
+    if blocksize is None:
+        blocksize = BLOCK_SIZE
+    rois = []
+    for roi in roiList:
+        iFrom = max(0, int(roi[0]))
+        iTo = min(shape[mcaIndex], int(roi[1]))
+        if iTo <= iFrom:
+            raise ValueError("Empty ROI %d to %d" % (roi[0], roi[1]))
+        if (len(roi) > 2) and (roi[2] is not None):
+            iMiddle = min(max(int(roi[2]), iFrom), iTo - 1)
+        else:
+            iMiddle = int(0.5 * (iFrom + iTo))
+        rois.append((iFrom, iTo, iMiddle))
+    imageShape = tuple([shape[i] for i in range(nDimensions) \
+                        if i != mcaIndex])
+    dtype = getattr(data, "dtype", numpy.float64)
+    results = []
+    for iFrom, iTo, iMiddle in rois:
+        ddict = {}
+        ddict['ROI'] = numpy.zeros(imageShape, numpy.float64)
+        for key in ['Left', 'Middle', 'Right']:
+            ddict[key] = numpy.zeros(imageShape, dtype)
+        if xAtMinMax:
+            ddict['Maximum'] = numpy.zeros(imageShape, numpy.int32)
+            ddict['Minimum'] = numpy.zeros(imageShape, numpy.int32)
+        results.append(ddict)
+    if not len(rois):
+        return results
+
+    # only the channels covered by the ROIs are read
+    chMin = min([roi[0] for roi in rois])
+    chMax = max([roi[1] for roi in rois])
+
+    # the blocks are taken along the first non spectral dimension, that
+    # always corresponds to the first dimension of the images
+    axis = 1 if mcaIndex == 0 else 0
+    sliceSize = (chMax - chMin) * numpy.dtype(dtype).itemsize
+    for i in range(nDimensions):
+        if i not in [axis, mcaIndex]:
+            sliceSize *= shape[i]
+    step = max(1, int(blocksize // max(1, sliceSize)))
+    for start in range(0, shape[axis], step):
+        end = min(start + step, shape[axis])
+        index = [slice(None)] * nDimensions
+        index[axis] = slice(start, end)
+        index[mcaIndex] = slice(chMin, chMax)
+        block = numpy.asarray(data[tuple(index)])
+        for (iFrom, iTo, iMiddle), ddict in zip(rois, results):
+            index = [slice(None)] * nDimensions
+            index[mcaIndex] = slice(iFrom - chMin, iTo - chMin)
+            roiData = block[tuple(index)]
+            ddict['ROI'][start:end] = roiData.sum(axis=mcaIndex,
+                                                  dtype=numpy.float64)
+            for key, channel in [('Left', iFrom),
+                                 ('Middle', iMiddle),
+                                 ('Right', iTo - 1)]:
+                index[mcaIndex] = channel - chMin
+                ddict[key][start:end] = block[tuple(index)]
+            if xAtMinMax:
+                ddict['Maximum'][start:end] = \
+                            roiData.argmax(axis=mcaIndex) + iFrom
+                ddict['Minimum'][start:end] = \
+                            roiData.argmin(axis=mcaIndex) + iFrom
+    return results
+
 class StackROIBatch(object):
     def __init__(self):
         self._config = {}
@@ -126,94 +216,56 @@ def batchROIMultipleSpectra(self, x=None, y=None,
         for roi in roiList0:
             if roi.upper() == "ICR":
                 roiList.append(roi)
+                continue
             roiType = config["ROI"]["roidict"][roi]["type"]
             if xLabel is None:
                 roiList.append(roi)
             elif xLabel.lower() == roiType.lower():
                 roiList.append(roi)
 
-        # only usual spectra case supported
-        if index != (len(data.shape) - 1):
-            raise IndexError("Only stacks of spectra supported")
-
-        if len(data.shape) != 3:
-            txt  = "For the time being only "
-            txt += "three dimensional arrays supported"
-            raise NotImplemented(txt)
-
-        if len(data.shape) != 3:
-            txt  = "For the time being only "
-            txt += "three dimensional arrays supported"
-            raise NotImplemented(txt)
-        totalSpectra = 1
-        for i in range(len(data.shape)):
-            if i != index:
-                totalSpectra *= data.shape[i]
-
         if x.size != data.shape[index]:
-            raise NotImplemented("All the spectra should share same X axis")
+            raise NotImplementedError("All the spectra should share same X axis")
 
-        jStep = min(1000, data.shape[1])
         nRois = len(roiList)
-        iXMinList = [None] * nRois
-        iXMaxList = [None] * nRois
-        nRows = data.shape[0]
-        nColumns = data.shape[1]
+        channelList = []
         if xAtMinMax:
-            results = numpy.zeros((nRois * 4, nRows, nColumns), numpy.float)
             names = [None] * 4 * nRois
         else:
-            results = numpy.zeros((nRois * 2, nRows, nColumns), numpy.float)
             names = [None] * 2 * nRois
-        for i in range(0, data.shape[0]):
-            #print(i)
-            #chunks of nColumns spectra
-            if i == 0:
-                chunk = numpy.zeros((jStep,
-                                     data.shape[index]),
-                                     numpy.float)
-                xData = x
-            jStart = 0
-            while jStart < data.shape[1]:
-                jEnd = min(jStart + jStep, data.shape[1])
-                chunk[:(jEnd - jStart)] = data[i, jStart: jEnd]
-                for j, roi in enumerate(roiList):
-                    if i == 0:
-                        roiType = config["ROI"]["roidict"][roi]["type"]
-                        roiLine = roi
-                        roiFrom = config["ROI"]["roidict"][roi]["from"]
-                        roiTo = config["ROI"]["roidict"][roi]["to"]
-                        if roiLine == "ICR":
-                            iXMinList[j] = 0
-                            iXMaxList[j] = data.shape[index]
-                        else:
-                            iXMinList[j] = numpy.nonzero(x <= roiFrom)[0][-1]
-                            iXMaxList[j] = numpy.nonzero(x >= roiTo)[0][0] + 1
-                        names[j] = "ROI " + roiLine
-                        names[j + nRois] = "ROI "+ roiLine + " Net"
-                        if xAtMinMax:
-                            names[j + 2 * nRois] = "ROI "+ roiLine + (" %s at Max." % roiType)
-                            names[j + 3 * nRois] = "ROI "+ roiLine + (" %s at Min." % roiType)
-                    iXMin = iXMinList[j]
-                    iXMax = iXMaxList[j]
-                    #if i == 0:
-                    #    print roi, " iXMin = ", iXMin, "iXMax = ", iXMax  
-                    tmpArray = chunk[:(jEnd - jStart), iXMin : iXMax]
-                    left = tmpArray[:, 0]
-                    right = tmpArray[:, -1]
-                    rawSum = tmpArray.sum(axis=-1, dtype=numpy.float)
-                    netSum = rawSum - (0.5 * (left + right) * (iXMax - iXMin + 1))
-                    results[j][i,:(jEnd - jStart)] = rawSum
-                    results[j + nRois][i,:(jEnd - jStart)] = netSum
-                    if xAtMinMax:
-                        # maxImage
-                        results[j + 2 * nRois][i, :(jEnd - jStart)] = \
-                                 numpy.argmax(tmpArray, axis=1) + iXMin                        
-                        # minImage
-                        results[j + 3 * nRois][i, :(jEnd - jStart)] = \
-                                 numpy.argmin(tmpArray, axis=1) + iXMin                            
-                    
-                jStart = jEnd
+        for j, roi in enumerate(roiList):
+            roiType = config["ROI"]["roidict"][roi]["type"]
+            roiLine = roi
+            roiFrom = config["ROI"]["roidict"][roi]["from"]
+            roiTo = config["ROI"]["roidict"][roi]["to"]
+            if roiLine == "ICR":
+                iXMin = 0
+                iXMax = data.shape[index]
+            else:
+                iXMin = numpy.nonzero(x <= roiFrom)[0][-1]
+                iXMax = numpy.nonzero(x >= roiTo)[0][0] + 1
+            channelList.append((iXMin, iXMax))
+            names[j] = "ROI " + roiLine
+            names[j + nRois] = "ROI "+ roiLine + " Net"
+            if xAtMinMax:
+                names[j + 2 * nRois] = "ROI "+ roiLine + (" %s at Max." % roiType)
+                names[j + 3 * nRois] = "ROI "+ roiLine + (" %s at Min." % roiType)
+
+        # all the ROIs are calculated reading the data only once
+        imageList = calculateROIImages(data, channelList, mcaIndex=index,
+                                       xAtMinMax=xAtMinMax)
+        imageShape = [data.shape[i] for i in range(len(data.shape)) \
+                      if i != index]
+        results = numpy.zeros([len(names)] + imageShape, numpy.float64)
+        for j, ddict in enumerate(imageList):
+            iXMin, iXMax = channelList[j]
+            results[j] = ddict['ROI']
+            results[j + nRois] = ddict['ROI'] - 0.5 * (iXMax - iXMin + 1) * \
+                        (ddict['Left'].astype(numpy.float64) + ddict['Right'])
+            if xAtMinMax:
+                results[j + 2 * nRois] = ddict['Maximum']
+                results[j + 3 * nRois] = ddict['Minimum']
+        if DEBUG:
+            print("ROI images calculated in %f seconds" % (time.time() - t0))
         outputDict = {'images':results,
                       'names':names}
         return outputDict
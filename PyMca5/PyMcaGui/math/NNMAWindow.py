@@ -50,7 +50,7 @@ def __init__(self, parent = None, options=[1, 2, 3, 4, 5, 10]):
         self.methodOptions = qt.QGroupBox(self)
         self.methodOptions.setTitle('NNMA Method to use')
         self.methods = ['RRI', 'NNSC', 'NMF', 'SNMF', 'NMFKL',
-                        'FNMAI', 'ALS', 'FastHALS', 'GDCLS']
+                        'FNMAI', 'ALS', 'FastHALS', 'GDCLS', 'MiniBatch']
         self.methodOptions.mainLayout = qt.QGridLayout(self.methodOptions)
         self.methodOptions.mainLayout.setContentsMargins(0, 0, 0, 0)
         self.methodOptions.mainLayout.setSpacing(2)
@@ -237,7 +237,8 @@ def getParameters(self):
         ddict['binning'] =  int(self.binningCombo.currentText())
         ddict['npc']     = self.nPC.value()
         ddict['kw']   = {'eps':eps,
-                         'maxcount':maxcount}
+                         'maxcount':maxcount,
+                         'function':self.methods[i]}
         return ddict
 
 class NNMAWindow(PCAWindow.PCAWindow):
@@ -1256,7 +1256,7 @@ def __init__(self, parent, configfile, filelist=None, outputdir = None,
                      filestep=1, mcastep=1, concentrations=0,
                      fitfiles=0, filebeginoffset=0, fileendoffset=0,
                      mcaoffset=0, chunk=None,
-                     selection=None, lock=None):
+                     selection=None, lock=None, nworkers=1):
         McaAdvancedFitBatch.McaAdvancedFitBatch.__init__(self, configfile, filelist, outputdir,
                                                          roifit=roifit, roiwidth=roiwidth,
                                                          overwrite=overwrite, filestep=filestep,
@@ -1268,7 +1268,8 @@ def __init__(self, parent, configfile, filelist=None, outputdir = None,
                                                          mcaoffset  = mcaoffset,
                                                          chunk=chunk,
                                                          selection=selection,
-                                                         lock=lock)
+                                                         lock=lock,
+                                                         nworkers=nworkers)
         qt.QThread.__init__(self)
         self.parent = parent
         self.pleasePause = 0
@@ -1729,7 +1730,8 @@ def main():
                    'overwrite=', 'filestep=', 'mcastep=', 'html=','htmlindex=',
                    'listfile=','cfglistfile=', 'concentrations=', 'table=', 'fitfiles=',
                    'filebeginoffset=','fileendoffset=','mcaoffset=', 'chunk=',
-                   'nativefiledialogs=','selection=', 'exitonend=']
+                   'nativefiledialogs=','selection=', 'exitonend=',
+                   'nworkers=']
     filelist = None
     outdir   = None
     cfg      = None
@@ -1751,6 +1753,7 @@ def main():
     mcaoffset = 0
     chunk = None
     exitonend = False
+    nworkers = 1
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -1805,6 +1808,8 @@ def main():
                 PyMcaDirs.nativeFileDialogs = False
         elif opt in ('--exitonend'):
             exitonend = int(arg)
+        elif opt in ('--nworkers'):
+            nworkers = int(arg)
 
     if listfile is None:
         filelist=[]
@@ -1855,7 +1860,8 @@ def main():
                      overwrite = overwrite, filestep=filestep, mcastep=mcastep,
                       concentrations=concentrations, fitfiles=fitfiles,
                       filebeginoffset=filebeginoffset,fileendoffset=fileendoffset,
-                      mcaoffset=mcaoffset, chunk=chunk, selection=selection)
+                      mcaoffset=mcaoffset, chunk=chunk, selection=selection,
+                      nworkers=nworkers)
         except:
             if exitonend:
                 print("Error: " % sys.exc_info()[1])
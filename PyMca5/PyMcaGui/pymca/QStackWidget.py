@@ -574,8 +574,14 @@ def _pluginClicked(self):
             text = QString("Toggle DEBUG mode ON")
         menu.addAction(text)
         actionList.append(text)
+        if self._useCumulativeSum:
+            text = QString("Disable fast ROI imaging")
+        else:
+            text = QString("Enable fast ROI imaging (no Max. and Min. images)")
+        menu.addAction(text)
+        actionList.append(text)
         menu.addSeparator()
-        callableKeys = ["Dummy0", "Dummy1", "Dummy2"]
+        callableKeys = ["Dummy0", "Dummy1", "Dummy2", "Dummy3"]
         additionalItems = []
         SORTED = True
         for m in self.pluginList:
@@ -633,6 +639,9 @@ def _pluginClicked(self):
                 DEBUG = 1
             StackBase.DEBUG = DEBUG
             return
+        if idx == 3:
+            self._toggleCumulativeSum()
+            return
         key = callableKeys[idx]
         methods = self.pluginInstanceDict[key].getMethods()
         if len(methods) == 1:
@@ -677,6 +686,21 @@ def _pluginClicked(self):
             if DEBUG:
                 raise
 
+    def _toggleCumulativeSum(self):
+        try:
+            self.setCumulativeSum(not self._useCumulativeSum)
+        except:
+            self.setCumulativeSum(False)
+            msg = qt.QMessageBox(self)
+            msg.setIcon(qt.QMessageBox.Critical)
+            msg.setWindowTitle("Fast ROI imaging error")
+            msg.setText("Cannot calculate the cumulative sum of the stack:")
+            msg.setInformativeText(qt.safe_str(sys.exc_info()[1]))
+            msg.exec_()
+            return
+        if self._stackImageData is not None:
+            self.updateROIImages()
+
     def _actionHovered(self, action):
         tip = action.toolTip()
         if qt.safe_str(tip) != qt.safe_str(action.text()):
@@ -1083,7 +1107,7 @@ def test():
     longoptions = ["fileindex=","old",
                    "filepattern=", "begin=", "end=", "increment=",
                    "nativefiledialogs=", "imagestack=", "image=",
-                   "backend="]
+                   "backend=", "cumulativesum=", "memmap="]
     try:
         opts, args = getopt.getopt(
                      sys.argv[1:],
@@ -1099,6 +1123,8 @@ def test():
     imagestack=None
     increment=None
     backend=None
+    cumulativesum = 0
+    memmap = False
     PyMcaDirs.nativeFileDialogs=True
     for opt, arg in opts:
         if opt in '--begin':
@@ -1130,6 +1156,10 @@ def test():
                 PyMcaDirs.nativeFileDialogs=False
         elif opt in '--backend':
             backend = arg
+        elif opt in '--cumulativesum':
+            cumulativesum = int(arg)
+        elif opt in '--memmap':
+            memmap = bool(int(arg))
         #elif opt in '--old':
         #    import QEDFStackWidget
         #    sys.exit(QEDFStackWidget.runAsMain())
@@ -1148,7 +1178,11 @@ def test():
         except:
             print("WARNING: Cannot set backend to %s" % backend)
     widget = QStackWidget()
-    w = StackSelector.StackSelector(widget)
+    if cumulativesum:
+        widget.setCumulativeSum(True)
+    w = StackSelector.StackSelector(widget, memmap=memmap)
+    # used by the stacks loaded afterwards too
+    widget.stackSelector = w
     if filepattern is not None:
         #ignore the args even if present
         stack = w.getStackFromPattern(filepattern, begin, end, increment=increment,
@@ -60,8 +60,13 @@
 
 
 class StackSelector(object):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, memmap=False):
+        """
+        If memmap is True, stacks of uncompressed single image EDF files
+        are memory mapped instead of being read into memory.
+        """
         self.parent = parent
+        self.memmap = memmap
 
     def getStack(self, filelist=None, imagestack=None):
         if filelist in [None, []]:
@@ -129,16 +134,16 @@ def getStack(self, filelist=None, imagestack=None):
                 if imagestack is None:
                     imagestack = True
                 fileindex = 0
-                stack = QStack(imagestack=imagestack)
+                stack = QStack(imagestack=imagestack, memmap=self.memmap)
             elif line[0] == "{":
                 if filelist[0].upper().endswith("RAW"):
                     if imagestack is None:
                         imagestack=True
-                stack = QStack(imagestack=imagestack)
+                stack = QStack(imagestack=imagestack, memmap=self.memmap)
             elif line[0:2] in ["II", "MM"]:
                 if imagestack is None:
                     imagestack = True
-                stack = QStack(imagestack=imagestack)
+                stack = QStack(imagestack=imagestack, memmap=self.memmap)
             elif line.startswith('Spectral'):
                 stack = OmnicMap.OmnicMap(filelist[0])
                 omnicfile = True
@@ -154,7 +159,7 @@ def getStack(self, filelist=None, imagestack=None):
                  filelist[0].upper().endswith(".CBF"):
                 if imagestack is None:
                     imagestack = True
-                stack = QStack(imagestack=imagestack)
+                stack = QStack(imagestack=imagestack, memmap=self.memmap)
             elif filelist[0].upper().endswith(".RTX"):
                 stack = RTXMap.RTXMap(filelist[0])
                 omnicfile = True
@@ -168,7 +173,7 @@ def getStack(self, filelist=None, imagestack=None):
                  (line[0] not in ['$', '#']):
                 #Roper Scientific format
                 #handle it as MarCCD stack
-                stack = QStack(imagestack=True)
+                stack = QStack(imagestack=True, memmap=self.memmap)
             elif MRCMap.isMRCFile(filelist[0]):
                 stack = MRCMap.MRCMap(filelist[0])
                 omnicfile = True
@@ -263,7 +268,7 @@ def getStackFromPattern(self, filepattern, begin, end, increment=None,
                 #(because of no redimensioning attempt)
                 if False and (len(begin) != 1):
                     raise IOError("EDF stack redimensioning not supported yet")
-            stack = QStack(imagestack=imagestack)
+            stack = QStack(imagestack=imagestack, memmap=self.memmap)
         elif line.startswith('Spectral'):
             stack = OmnicMap.OmnicMap(args[0])
         elif line.startswith('#\tDate:'):
@@ -285,7 +290,7 @@ def getStackFromPattern(self, filepattern, begin, end, increment=None,
              args[0].upper().endswith("CCD.BZ2"):
             if imagestack is None:
                 imagestack = True
-            stack = QStack(imagestack=imagestack)
+            stack = QStack(imagestack=imagestack, memmap=self.memmap)
         else:
             if HDF5:
                 if h5py.is_hdf5(args[0]):
@@ -55,8 +55,75 @@
 Y_AXIS=1
 Z_AXIS=2
 
+class VirtualEdfStack(object):
+    """
+    Read-only array-like object presenting a list of single image EDF
+    files as a (nFiles, rows, columns) stack without reading them.
+
+    The images are memory mapped on access, so only the requested
+    region of each file is read.
+    """
+    def __init__(self, views, dtype=None):
+        """
+        views is a list of (filename, offset, dtype, shape) tuples as
+        obtained from the numpy.memmap returned by EdfFile.GetDataView.
+        """
+        self._views = views
+        imageShape = views[0][3]
+        self.shape = (len(views), imageShape[0], imageShape[1])
+        if dtype is None:
+            dtype = views[0][2].newbyteorder("=")
+        self.dtype = numpy.dtype(dtype)
+        self.ndim = 3
+        self.size = self.shape[0] * self.shape[1] * self.shape[2]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def _getImage(self, index, key):
+        filename, offset, dtype, shape = self._views[index]
+        image = numpy.memmap(filename, dtype=dtype, mode="r",
+                             offset=offset, shape=shape)
+        data = numpy.array(image[key], dtype=self.dtype)
+        del image
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+        if len(key) > 3:
+            raise IndexError("Too many indices for a 3D stack")
+        key = key + (slice(None),) * (3 - len(key))
+        fileKey = key[0]
+        imageKey = key[1:]
+        if isinstance(fileKey, slice):
+            fileList = range(*fileKey.indices(len(self._views)))
+        elif hasattr(fileKey, "__len__"):
+            fileList = numpy.arange(len(self._views))[fileKey]
+        else:
+            return self._getImage(range(len(self._views))[fileKey], imageKey)
+        if not len(fileList):
+            region = numpy.zeros(self.shape[1:], numpy.bool_)[imageKey]
+            return numpy.zeros((0,) + region.shape, self.dtype)
+        return numpy.array([self._getImage(i, imageKey) for i in fileList],
+                           dtype=self.dtype)
+
 class EDFStack(DataObject.DataObject):
-    def __init__(self, filelist = None, imagestack=None, dtype=None):
+    def __init__(self, filelist = None, imagestack=None, dtype=None,
+                 memmap=False):
+        """
+        If memmap is True, uncompressed files with one image each are
+        presented as a VirtualEdfStack instead of being read into memory.
+        """
         DataObject.DataObject.__init__(self)
         self.incrProgressBar=0
         self.__keyList = []
@@ -65,6 +132,7 @@ def __init__(self, filelist = None, imagestack=None, dtype=None):
         else:
             self.__imageStack = imagestack
         self.__dtype = dtype
+        self.__memmap = memmap
         if filelist is not None:
             if type(filelist) != type([]):
                 filelist = [filelist]
@@ -108,6 +176,31 @@ def loadFileList(self, filelist, fileindex=0):
         if self.__dtype is None:
             self.__dtype = arrRet.dtype
 
+        if self.__memmap and (nImages == 1) and (fileindex != 1) and \
+           (len(arrRet.shape) == 2) and ("_sample_" not in filelist[0]):
+            # ID24 maps need to be corrected and cannot be mapped
+            imageStack = (fileindex == 2) or bool(self.__imageStack)
+            data = self._getVirtualStack(filelist)
+            if data is not None:
+                self.__imageStack = imageStack
+                self.data = data
+                self.__nFiles = self.nbFiles
+                self.__nImagesPerFile = 1
+                shape = self.data.shape
+                for i in range(len(shape)):
+                    key = 'Dim_%d' % (i+1,)
+                    self.info[key] = shape[i]
+                self.info["SourceType"] = SOURCE_TYPE
+                if imageStack:
+                    self.info["McaIndex"] = 0
+                    self.info["FileIndex"] = 1
+                else:
+                    self.info["FileIndex"] = fileindex
+                self.info["SourceName"] = self.sourceName
+                self.info["NumberOfFiles"] = self.__nFiles * 1
+                self.info["Size"] = self.__nFiles * self.__nImagesPerFile
+                return
+
         self.onBegin(self.nbFiles)
         singleImageShape = arrRet.shape
         actualImageStack = False
@@ -487,6 +580,33 @@ def loadFileList(self, filelist, fileindex=0):
             self.info["Size"] = self.__nFiles * self.__nImagesPerFile
 
 
+    def _getVirtualStack(self, filelist):
+        """
+        Return a VirtualEdfStack over the files or None if any of them
+        cannot be memory mapped or its shape does not match the first one.
+        """
+        self.onBegin(self.nbFiles)
+        views = []
+        try:
+            for tempEdfFileName in filelist:
+                tempEdf = EdfFile.EdfFile(tempEdfFileName, 'rb')
+                if tempEdf.GetNumImages() != 1:
+                    return None
+                view = tempEdf.GetDataView(0)
+                if not isinstance(view, numpy.memmap):
+                    return None
+                if len(views) and (view.shape != views[0][3]):
+                    return None
+                views.append((tempEdfFileName, view.offset,
+                              view.dtype, view.shape))
+                del view
+                self.onProgress(len(views))
+        finally:
+            self.onEnd()
+        if DEBUG:
+            print("EDFStack: %d files memory mapped" % len(views))
+        return VirtualEdfStack(views, dtype=self.__dtype)
+
     def onBegin(self, n):
         pass
 
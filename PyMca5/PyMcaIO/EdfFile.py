@@ -755,6 +755,42 @@ def _GetData(self, Index, DataType="", Pos=None, Size=None):
             Data = self.__SetDataType__ (Data, DataType)
         return Data
 
+    def GetDataView(self, Index):
+        """ Returns a read-only numpy.memmap of the image data
+            Index:          The zero-based index of the image in the file
+
+            The data are not read from disk until accessed. The view keeps
+            the byte order of the file. Images that cannot be mapped
+            (compressed files, file objects and the wrapped ADSC, MarCCD,
+            TIFF, Pilatus CBF and SPE formats) are read with GetData.
+        """
+        if Index < 0 or Index >= self.NumImages:
+            raise ValueError("EdfFile: Index out of limit")
+        if (not self.__ownedOpen) or self.ADSC or self.MARCCD or \
+           self.TIFF or self.PILATUS_CBF or self.SPE:
+            return self.GetData(Index)
+        image = self.Images[Index]
+        if image.NumDim == 3:
+            shape = (image.Dim3, image.Dim2, image.Dim1)
+        elif image.NumDim == 2:
+            shape = (image.Dim2, image.Dim1)
+        else:
+            shape = (image.Dim1,)
+        datatype = numpy.dtype(self.__GetDefaultNumpyType__(image.DataType,
+                                                            index=Index))
+        if image.ByteOrder.upper() == "HIGHBYTEFIRST":
+            datatype = datatype.newbyteorder(">")
+        else:
+            datatype = datatype.newbyteorder("<")
+        try:
+            return numpy.memmap(self.FileName, dtype=datatype, mode="r",
+                                offset=image.DataPosition, shape=shape)
+        except (ValueError, IOError, OSError):
+            # truncated file or mapping not supported
+            if DEBUG:
+                print("EdfFile: Cannot map image %d, reading it" % Index)
+            return self.GetData(Index)
+
 
 
     def GetPixel(self, Index, Position):
@@ -45,7 +45,7 @@
 #include <windows.h>
 #include <io.h>
 #define SF_OPENFLAG   O_RDONLY | O_BINARY
-#define SF_WRITEFLAG  O_CREAT | O_WRONLY
+#define SF_WRITEFLAG  O_CREAT | O_WRONLY | O_BINARY
 #define SF_UMASK      0666
 #else   /* if not windows */
 #define SF_OPENFLAG   O_RDONLY
@@ -103,6 +103,8 @@
 #ifdef WIN32
 #include <stdio.h>
 #include <stdlib.h>
+#include <process.h>
+#define getpid _getpid
 #else
 #include <unistd.h>
 #endif
@@ -119,6 +121,8 @@
 #define COMMENT      2
 
 #define SF_ISFX      ".sfI"
+#define SF_IDXENV    "SPECFILE_INDEX_DIR"
+#define SF_IDXHEAD   64
 
 #define SF_INIT      0
 #define SF_READY     1
@@ -135,11 +139,30 @@ DllExport short      SfUpdate ( SpecFile *sf, int *error);
 DllExport char     * SfError  ( int error);
 
 
-#ifdef linux
-char SF_SIGNATURE[] =  "Linux 2ruru Sf2.0";
-#else
-char SF_SIGNATURE[] =  "2ruru Sf2.0";
-#endif
+char SF_SIGNATURE[] =  "PyMca SfIndex 3.0";
+
+/*
+ * Index file layout ( native byte order, read only by the same build ):
+ *
+ *   SF_SIGNATURE
+ *   long      sizeof(long), sizeof(SfCursor), sizeof(SpecScan)
+ *   long      size and modification time of the SPEC file
+ *   long      number of bytes in head
+ *   char      head[SF_IDXHEAD] : first bytes of the last block
+ *   long      number of scans
+ *   SfCursor  cursor at the end of the file
+ *   long      number of list entries
+ *   SpecScan  list entries ( offsets, sizes, scan numbers and orders )
+ */
+typedef struct _SfIndexHeader {
+    long  sizes[3];
+    long  filesize;
+    long  mtime;
+    long  headlen;
+    char  head[SF_IDXHEAD];
+    long  no_scans;
+    long  entries;
+} SfIndexHeader;
 
 /*
  * Internal functions
@@ -150,14 +173,14 @@ static void  sfNewLine     ( SpecFile *sf, SfCursor *cursor, char c0,char c1,int
 static void  sfHeaderLine  ( SpecFile *sf, SfCursor *cursor, char c,int *error);
 static void  sfNewBlock    ( SpecFile *sf, SfCursor *cursor, short how,int *error);
 static void  sfSaveScan    ( SpecFile *sf, SfCursor *cursor, int *error);
-static void  sfAssignScanNumbers (SpecFile *sf);
+static void  sfAssignScanNumbers (SpecFile *sf, ObjectList *from);
 static void  sfReadFile    ( SpecFile *sf, SfCursor *cursor, int *error);
 static void  sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error);
-#ifdef SPECFILE_USE_INDEX_FILE
-static short sfOpenIndex   ( SpecFile *sf, SfCursor *cursor, int *error);
-static short sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error);
-static void  sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, int *error);
-#endif
+static char *sfIndexName   ( SpecFile *sf );
+static long  sfReadHead    ( SpecFile *sf, long offset, char *head );
+static short sfOpenIndex   ( SpecFile *sf, SfCursor *cursor, long filesize, int *error);
+static short sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, long filesize, int *error);
+static void  sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, long filesize, int *error);
 
 /*
  * errors
@@ -250,6 +273,7 @@ SfOpen2(int fd, char *name,int *error) {
    SpecFile   *sf;
    short       idxret;
    SfCursor      cursor;
+   ObjectList   *from;
    struct stat mystat;
 
    if ( fd == -1 ) {
@@ -304,20 +328,22 @@ SfOpen2(int fd, char *name,int *error) {
    cursor.what         = 0;
    cursor.data         = 0;
    cursor.file_header  = 0;
+   cursor.fileh_size   = 0;
 
-
-#ifdef SPECFILE_USE_INDEX_FILE
   /*
    * Check if index file
    *   open it and continue from there
    */
-   idxret = sfOpenIndex(sf,&cursor,error);
-#else
-   idxret = SF_INIT;
-#endif
+   idxret = sfOpenIndex(sf,&cursor,(long) mystat.st_size,error);
 
+   from = (ObjectList *)NULL;
    switch(idxret) {
       case SF_MODIFIED:
+          /*
+           * the file has grown, only the last block and the
+           * appended bytes are read
+           */
+          from = sf->list.last;
           sfResumeRead(sf,&cursor,error);
           sfReadFile(sf,&cursor,error);
           break;
@@ -338,11 +364,10 @@ SfOpen2(int fd, char *name,int *error) {
   /*
    * Once is all done assign scan numbers and orders
    */
-   sfAssignScanNumbers(sf);
-
-#ifdef SPECFILE_USE_INDEX_FILE
-   if (idxret != SF_READY) sfWriteIndex(sf,&cursor,error);
-#endif
+   if (idxret != SF_READY) {
+       sfAssignScanNumbers(sf, from);
+       sfWriteIndex(sf,&cursor,(long) mystat.st_size,error);
+   }
    return(sf);
 }
 
@@ -421,6 +446,7 @@ SfUpdate ( SpecFile *sf, int *error )
 {
     struct stat mystat;
     long   mtime;
+    ObjectList *from;
    /*printf("In SfUpdate\n");
    __asm("int3");*/
     stat(sf->sfname,&mystat);
@@ -428,14 +454,13 @@ SfUpdate ( SpecFile *sf, int *error )
     mtime = mystat.st_mtime;
 
     if (sf->m_time != mtime)  {
+       from = sf->list.last;
        sfResumeRead (sf,&(sf->cursor),error);
        sfReadFile   (sf,&(sf->cursor),error);
 
        sf->m_time = mtime;
-       sfAssignScanNumbers(sf);
-#ifdef SPECFILE_USE_INDEX_FILE
-       sfWriteIndex (sf,&(sf->cursor),error);
-#endif
+       sfAssignScanNumbers(sf, from);
+       sfWriteIndex (sf,&(sf->cursor),(long) mystat.st_size,error);
        return(1);
     }else{
        return(0);
@@ -529,116 +554,256 @@ sfReadFile(SpecFile *sf,SfCursor *cursor,int *error) {
 static void
 sfResumeRead  ( SpecFile *sf, SfCursor *cursor, int *error) {
     cursor->bytecnt      = cursor->cursor;
-    cursor->what         = 0;
     cursor->hdafoffset   = -1;
     cursor->dataoffset   = -1;
     cursor->mcaspectra   = 0;
     cursor->data         = 0;
-    cursor->scanno--;
-    sf->updating = 1;
+   /*
+    * the last list entry is read again and replaced. It only
+    * counts as a scan if the last block was a scan.
+    */
+    if (cursor->what == SCAN)
+        cursor->scanno--;
+    cursor->what         = 0;
+    sf->updating = (sf->list.last != (ObjectList *)NULL);
     lseek(sf->fd,cursor->bytecnt,SEEK_SET);
     return;
 }
 
 
-#ifdef SPECFILE_USE_INDEX_FILE
+/*
+ * Index file
+ *
+ *   The index is only used when the environment variable
+ *   SPECFILE_INDEX_DIR points to a directory. It is keyed on the
+ *   size and modification time of the SPEC file. If the file has
+ *   only grown, the index is extended reading the appended bytes.
+ */
+static char *
+sfIndexName ( SpecFile *sf ) {
+    char          *idxdir;
+    char          *idxname;
+    char          *fullname;
+    char          *basename;
+    char          *ptr;
+    unsigned long  hash;
+
+    idxdir = getenv(SF_IDXENV);
+    if (idxdir == NULL || idxdir[0] == '\0')
+        return((char *)NULL);
+
+#ifdef _WINDOWS
+    fullname = _fullpath(NULL, sf->sfname, 0);
+#else
+    fullname = realpath(sf->sfname, NULL);
+#endif
+    if (fullname == NULL)
+        fullname = strdup(sf->sfname);
+    if (fullname == NULL)
+        return((char *)NULL);
+
+   /*
+    * FNV-1a hash of the full path to tell apart files with the same name
+    */
+    hash = 2166136261UL;
+    for (ptr = fullname; *ptr; ptr++) {
+        hash ^= (unsigned char) *ptr;
+        hash  = (hash * 16777619UL) & 0xffffffffUL;
+    }
+
+    basename = fullname;
+    for (ptr = fullname; *ptr; ptr++) {
+        if (*ptr == '/' || *ptr == '\\' || *ptr == ':')
+            basename = ptr + 1;
+    }
+
+    idxname = (char *)malloc(strlen(idxdir) + strlen(basename) +
+                             strlen(SF_ISFX) + 16);
+    if (idxname != NULL)
+        sprintf(idxname,"%s/%s_%08lx%s",idxdir,basename,hash,SF_ISFX);
+    free(fullname);
+    return(idxname);
+}
+
+
+static long
+sfReadHead ( SpecFile *sf, long offset, char *head ) {
+    long  bytesread;
+
+    memset(head, 0, SF_IDXHEAD);
+    if (lseek(sf->fd,offset,SEEK_SET) == -1)
+        return(-1);
+    bytesread = read(sf->fd,head,SF_IDXHEAD);
+    lseek(sf->fd,0,SEEK_SET);
+    return(bytesread);
+}
+
+
 static short
-sfOpenIndex ( SpecFile *sf, SfCursor *cursor, int *error) {
+sfOpenIndex ( SpecFile *sf, SfCursor *cursor, long filesize, int *error) {
     char *idxname;
-    short namelength;
     int   sfi;
+    short ret;
 
-    namelength = strlen(sf->sfname) + strlen(SF_ISFX) + 1;
-
-    idxname = (char *)malloc(sizeof(char) * namelength);
-
-    sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    if ((idxname = sfIndexName(sf)) == NULL)
+        return(SF_INIT);
 
     if ((sfi = open(idxname,SF_OPENFLAG)) == -1) {
         free(idxname);
         return(SF_INIT);
-    } else {
-        free(idxname);
-        return(sfReadIndex(sfi,sf,cursor,error));
     }
+    free(idxname);
+    ret = sfReadIndex(sfi,sf,cursor,filesize,error);
+    close(sfi);
+    return(ret);
 }
 
-
+
 static short
-sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, int *error) {
-    SfCursor   filecurs;
-    char       buffer[200];
-    long       bytesread,i=0;
-    SpecScan   scan;
-    short      modif = 0;
-    long       mtime;
+sfReadIndex   ( int sfi, SpecFile *sf, SfCursor *cursor, long filesize, int *error) {
+    SfCursor       filecurs;
+    SfIndexHeader  header;
+    char           buffer[sizeof(SF_SIGNATURE)];
+    char           head[SF_IDXHEAD];
+    SpecScan      *scans;
+    long           i;
 
    /*
     * read signature
     */
-    bytesread = read(sfi,buffer,sizeof(SF_SIGNATURE));
-    if (strcmp(buffer,SF_SIGNATURE) || bytesread == 0 ) {
+    if (read(sfi,buffer,sizeof(SF_SIGNATURE)) != sizeof(SF_SIGNATURE) ||
+                    memcmp(buffer,SF_SIGNATURE,sizeof(SF_SIGNATURE))) {
         return(SF_INIT);
     }
 
    /*
     * read cursor and specfile structure
     */
-    if ( read(sfi,&mtime,   sizeof(long)) == 0)   return(SF_INIT);
-    if ( read(sfi,&filecurs, sizeof(SfCursor)) == 0) return(SF_INIT);
+    if (read(sfi,&header,sizeof(SfIndexHeader)) != sizeof(SfIndexHeader))
+        return(SF_INIT);
+    if (header.sizes[0] != sizeof(long) ||
+        header.sizes[1] != sizeof(SfCursor) ||
+        header.sizes[2] != sizeof(SpecScan) ||
+        header.entries < 0 || header.headlen < 0 ||
+        header.headlen > SF_IDXHEAD)
+        return(SF_INIT);
+    if (read(sfi,&filecurs,sizeof(SfCursor)) != sizeof(SfCursor))
+        return(SF_INIT);
 
-    if (sf->m_time != mtime)  modif = 1;
+   /*
+    * a file that shrank or was rewritten with the same size
+    * has to be read again
+    */
+    if (filesize < header.filesize)
+        return(SF_INIT);
+    if (filesize == header.filesize && sf->m_time != header.mtime)
+        return(SF_INIT);
 
-    while(read(sfi,&scan, sizeof(SpecScan))) {
-        addToList(&(sf->list), (void *)&scan, (long)sizeof(SpecScan));
-        i++;
+   /*
+    * the start of the last block has to be unchanged
+    */
+    if (sfReadHead(sf,filecurs.cursor,head) < header.headlen ||
+                    memcmp(head,header.head,header.headlen))
+        return(SF_INIT);
+
+    if (header.entries) {
+        scans = (SpecScan *) malloc(header.entries * sizeof(SpecScan));
+        if (scans == (SpecScan *)NULL)
+            return(SF_INIT);
+        if (read(sfi,scans,header.entries * sizeof(SpecScan)) !=
+                                (long) (header.entries * sizeof(SpecScan))) {
+            free(scans);
+            return(SF_INIT);
+        }
+        for (i = 0; i < header.entries; i++) {
+            if (addToList(&(sf->list),(void *)&scans[i],
+                                      (long)sizeof(SpecScan))) {
+                free(scans);
+                *error = SF_ERR_MEMORY_ALLOC;
+                return(SF_READY);
+            }
+        }
+        free(scans);
     }
-    sf->no_scans = i;
+    sf->no_scans = header.no_scans;
 
     memcpy(cursor,&filecurs,sizeof(SfCursor));
 
-    if (modif) return(SF_MODIFIED);
+    if (filesize != header.filesize) return(SF_MODIFIED);
 
     return(SF_READY);
 }
 
-
-static void
-sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, int *error) {
 
-    int         fdi;
-    char       *idxname;
-    short       namelength;
-    ObjectList *obj;
-    long        mtime;
+static void
+sfWriteIndex  ( SpecFile *sf, SfCursor *cursor, long filesize, int *error) {
 
-    namelength = strlen(sf->sfname) + strlen(SF_ISFX) + 1;
+    int            fdi;
+    char          *idxname;
+    char          *tmpname;
+    ObjectList    *obj;
+    SfIndexHeader  header;
+    long           written;
 
-    idxname = (char *)malloc(sizeof(char) * namelength);
+    if ((idxname = sfIndexName(sf)) == NULL)
+        return;
 
-    sprintf(idxname,"%s%s",sf->sfname,SF_ISFX);
+    memset(&header, 0, sizeof(SfIndexHeader));
+    header.sizes[0] = sizeof(long);
+    header.sizes[1] = sizeof(SfCursor);
+    header.sizes[2] = sizeof(SpecScan);
+    header.filesize = filesize;
+    header.mtime    = sf->m_time;
+    header.headlen  = sfReadHead(sf,cursor->cursor,header.head);
+    header.no_scans = sf->no_scans;
+    header.entries  = 0;
+    for( obj = sf->list.first; obj ; obj = obj->next)
+        header.entries++;
+    if (header.headlen < 0) {
+        free(idxname);
+        return;
+    }
 
-    /* if ((fdi = open(idxname,SF_WRITEFLAG,SF_UMASK)) == -1) { */
-    if ((fdi = open(idxname,O_CREAT | O_WRONLY,SF_UMASK)) == -1) {
-        printf("    - cannot open. Error: (%d)\n",errno);
+   /*
+    * write to a temporary file and rename it to keep readers
+    * from seeing a partial index. The process id makes the name
+    * unique when several processes index the same file.
+    */
+    tmpname = (char *)malloc(strlen(idxname) + 30);
+    if (tmpname == NULL) {
         free(idxname);
         return;
-    } else {
-        mtime = sf->m_time;
-        write(fdi,SF_SIGNATURE,sizeof(SF_SIGNATURE));
- /*
-  * Swap bytes for linux
-  */
-        write(fdi, (void *) &mtime, sizeof(long));
-        write(fdi, (void *) cursor, sizeof(SfCursor));
-        for( obj = sf->list.first; obj ; obj = obj->next)
-           write(fdi,(void *) obj->contents, sizeof(SpecScan));
-        close(fdi);
+    }
+    sprintf(tmpname,"%s.%ld.tmp",idxname,(long) getpid());
+
+    if ((fdi = open(tmpname,SF_WRITEFLAG | O_TRUNC,SF_UMASK)) == -1) {
+        free(tmpname);
         free(idxname);
         return;
     }
-}
+    written  = (write(fdi,SF_SIGNATURE,sizeof(SF_SIGNATURE)) ==
+                                        sizeof(SF_SIGNATURE));
+    written &= (write(fdi,(void *) &header,sizeof(SfIndexHeader)) ==
+                                        sizeof(SfIndexHeader));
+    written &= (write(fdi,(void *) cursor,sizeof(SfCursor)) ==
+                                        sizeof(SfCursor));
+    for( obj = sf->list.first; obj && written ; obj = obj->next)
+        written &= (write(fdi,(void *) obj->contents,sizeof(SpecScan)) ==
+                                        sizeof(SpecScan));
+    close(fdi);
+    if (written) {
+#ifdef _WINDOWS
+        remove(idxname);
 #endif
+        if (rename(tmpname,idxname))
+            remove(tmpname);
+    } else {
+        remove(tmpname);
+    }
+    free(tmpname);
+    free(idxname);
+    return;
+}
 
 
 /*****************************************************************************
@@ -783,7 +948,7 @@ sfSaveScan(SpecFile *sf, SfCursor *cursor,int *error) {
 
 
 static void
-sfAssignScanNumbers(SpecFile *sf) {
+sfAssignScanNumbers(SpecFile *sf, ObjectList *from) {
 
   int                    size,i;
   char                  *buffer,*ptr;
@@ -798,14 +963,20 @@ sfAssignScanNumbers(SpecFile *sf) {
   size = 50;
   buffer = (char *) malloc(size);
 
-  for ( object = (sf->list).first; object; object=object->next) {
+  /*
+   * only the entries from "from" on are new or changed
+   */
+  if (from == (ObjectList *)NULL)
+        from = (sf->list).first;
+
+  for ( object = from; object; object=object->next) {
         scan = (SpecScan *) object->contents;
 
         lseek(sf->fd,scan->offset,SEEK_SET);
         read(sf->fd,buffer,size);
         buffer[49] = '\0';
 
-        for ( ptr = buffer+3,i=0; *ptr != ' ';ptr++,i++) buffer2[i] = *ptr;
+        for ( ptr = buffer+3,i=0; *ptr && *ptr != ' ';ptr++,i++) buffer2[i] = *ptr;
 
         buffer2[i] = '\0';
 
@@ -816,6 +987,7 @@ sfAssignScanNumbers(SpecFile *sf) {
             if (scan2->scan_no == scan->scan_no) scan->order++;
         }
   }
+  free(buffer);
 }
 
 void
@@ -35,8 +35,10 @@
 __doc__ = "This is a python module to measure image offsets"
 
 import os, time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy
-from numpy.fft import fft2, ifft2, fftshift, ifftshift
+from numpy.fft import fft2, ifft2, fftshift, ifftshift, rfft2, irfft2
 PYMCA = False
 SCIPY = False
 try:
@@ -200,6 +202,184 @@ def measure_offset_from_ffts(img0_fft2, img1_fft2, withLog=False):
     else:
         return offset
 
+def measure_offsets_from_ffts(img0_fft2, imgs_fft2, shape=None):
+    """
+    Batch version of measure_offset_from_ffts.
+
+    :param img0_fft2: ndarray, FFT of the reference image
+    :param imgs_fft2: ndarray of shape (nimages,) + img0_fft2.shape with the FFTs of the images
+    :param shape: shape of the images when the FFTs are real FFTs (numpy.fft.rfft2)
+    :return: ndarray of shape (nimages, 2) with the offsets of each image respect to the reference
+    """
+    if shape is None:
+        shape = img0_fft2.shape
+        inverseFunction = ifft2
+    else:
+        inverseFunction = lambda x: irfft2(x, s=shape)
+    nImages = imgs_fft2.shape[0]
+    absf0 = abs(img0_fft2)
+    absf0[absf0 < 1.0e-20] = 1.0
+    absf1 = abs(imgs_fft2)
+    absf1[absf1 < 1.0e-20] = 1.0
+    absf1 *= absf0
+    res = imgs_fft2.conjugate()
+    res *= img0_fft2
+    res /= absf1
+    absf1 = None
+    res = abs(inverseFunction(res))
+    # work on the unshifted correlation, the index i of the
+    # fftshifted array corresponds to (i - shape // 2) % shape
+    peaks = numpy.argmax(res.reshape(nImages, -1), axis=1)
+    resmax = res.reshape(nImages, -1)[numpy.arange(nImages), peaks]
+    a0, a1 = numpy.unravel_index(peaks, shape)
+    a0 = (a0 + shape[0] // 2) % shape[0]
+    a1 = (a1 + shape[1] // 2) % shape[1]
+    # refine a bit the position using the same window of
+    # measure_offset_from_ffts clipped at the image borders
+    w = 3
+    delta = numpy.arange(-w, w + 1)
+    i = a0.reshape(-1, 1) + delta
+    j = a1.reshape(-1, 1) + delta
+    valid = ((i >= 0) & (i < shape[0]))[:, :, None] & \
+            ((j >= 0) & (j < shape[1]))[:, None, :]
+    tmp = res[numpy.arange(nImages)[:, None, None],
+              ((i - shape[0] // 2) % shape[0])[:, :, None],
+              ((j - shape[1] // 2) % shape[1])[:, None, :]]
+    tmp[~valid] = 0.0
+    tmp[tmp <= 0.1 * resmax.reshape(-1, 1, 1)] = 0.0
+    total = tmp.sum(axis=(1, 2))
+    offsets = numpy.zeros((nImages, 2), numpy.float64)
+    offsets[:, 0] = shape[0] // 2 - (tmp.sum(axis=2) * i).sum(axis=1) / total
+    offsets[:, 1] = shape[1] // 2 - (tmp.sum(axis=1) * j).sum(axis=1) / total
+    return offsets
+
+class FFTRegistration(object):
+    """
+    Measure the offsets of sets of images respect to a reference image.
+
+    The real FFT of the windowed reference is calculated once. The images
+    are processed in groups of framesPerTask frames distributed among
+    nthreads threads. The offsets are those of measure_offset_from_ffts.
+    """
+    def __init__(self, reference, window=None, nthreads=None,
+                 framesPerTask=16):
+        self.shape = reference.shape
+        if window is None:
+            self.window = None
+            self.referenceFFT = rfft2(reference)
+        else:
+            self.window = numpy.asarray(window, dtype=numpy.float32)
+            self.referenceFFT = rfft2(self.window * reference)
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        self.nThreads = nthreads
+        self.framesPerTask = framesPerTask
+
+    def measureOffsets(self, images):
+        """
+        :param images: ndarray of shape (nimages,) + reference shape
+        :return: ndarray of shape (nimages, 2) with the offsets of each image
+        """
+        nImages = images.shape[0]
+        offsets = numpy.zeros((nImages, 2), numpy.float64)
+
+        def measure(start):
+            end = min(start + self.framesPerTask, nImages)
+            if self.window is None:
+                imagesFFT = rfft2(images[start:end])
+            else:
+                imagesFFT = rfft2(images[start:end] * self.window)
+            offsets[start:end] = measure_offsets_from_ffts(self.referenceFFT,
+                                                           imagesFFT,
+                                                           shape=self.shape)
+
+        tasks = range(0, nImages, self.framesPerTask)
+        if (self.nThreads < 2) or (len(tasks) < 2):
+            for start in tasks:
+                measure(start)
+        else:
+            pool = ThreadPool(min(self.nThreads, len(tasks)))
+            try:
+                pool.map(measure, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return offsets
+
+def shiftBilinearMultiple(images, shifts, output=None, window=None,
+                          nthreads=None, dummy=-1.0):
+    """
+    Shift a set of images as shiftBilinear does for a single image.
+
+    :param images: 3d numpy array of shape (nimages, d0, d1)
+    :param shifts: array of shape (nimages, 2)
+    :param output: optional array of the same shape to store the result
+    :param window: optional 2d array multiplying each shifted image
+    :param nthreads: number of threads. The default is one per CPU.
+    :param dummy: value given to the points outside the original image
+    :return: array with the shifted images
+    """
+    if output is None:
+        output = numpy.zeros(images.shape, numpy.float64)
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+
+    def shiftOne(index):
+        result = _shiftBilinearArray(images[index], shifts[index], dummy)
+        if window is not None:
+            result *= window
+        output[index] = result
+
+    if (nthreads < 2) or (images.shape[0] < 2):
+        for index in range(images.shape[0]):
+            shiftOne(index)
+    else:
+        pool = ThreadPool(min(nthreads, images.shape[0]))
+        try:
+            pool.map(shiftOne, range(images.shape[0]))
+        finally:
+            pool.close()
+            pool.join()
+    return output
+
+def _shiftBilinearArray(img, shift, dummy=-1.0):
+    """
+    Numpy implementation of shiftBilinear. The output value at (i, j) is
+    the bilinear interpolation of the input at (i + shift[0], j + shift[1])
+    """
+    img = numpy.asarray(img, dtype=numpy.float64)
+    d0, d1 = img.shape
+    shifted = numpy.zeros((d0, d1), numpy.float64)
+    shifted[:] = dummy
+    # the valid output indices
+    i0 = max(0, int(numpy.ceil(-shift[0])))
+    i1 = min(d0, int(numpy.floor(d0 - 1 - shift[0])) + 1)
+    j0 = max(0, int(numpy.ceil(-shift[1])))
+    j1 = min(d1, int(numpy.floor(d1 - 1 - shift[1])) + 1)
+    if (i1 <= i0) or (j1 <= j0):
+        return shifted
+    # pad one row and one column to read beyond the last point
+    # with a null weight
+    padded = numpy.zeros((d0 + 1, d1 + 1), numpy.float64)
+    padded[:d0, :d1] = img
+    padded[d0, :d1] = img[-1]
+    padded[:, d1] = padded[:, d1 - 1]
+    # the shift is the same for all the points
+    s0 = int(numpy.floor(shift[0]))
+    f0 = shift[0] - s0
+    s1 = int(numpy.floor(shift[1]))
+    f1 = shift[1] - s1
+    r0 = i0 + s0
+    c0 = j0 + s1
+    n0 = i1 - i0
+    n1 = j1 - j0
+    shifted[i0:i1, j0:j1] = \
+          padded[r0:r0 + n0, c0:c0 + n1] * ((1.0 - f0) * (1.0 - f1)) + \
+          padded[r0:r0 + n0, c0 + 1:c0 + n1 + 1] * ((1.0 - f0) * f1) + \
+          padded[r0 + 1:r0 + n0 + 1, c0:c0 + n1] * (f0 * (1.0 - f1)) + \
+          padded[r0 + 1:r0 + n0 + 1, c0 + 1:c0 + n1 + 1] * (f0 * f1)
+    return shifted
+
 def get_crop_indices(shape, shifts0, shifts1):
     """
     Get the indices of the valid region to be used when aligning a set of images
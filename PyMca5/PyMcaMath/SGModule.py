@@ -35,6 +35,7 @@
 __license__ = "MIT"
 import numpy
 from numpy.linalg import solve
+from PyMca5.PyMcaMath import StackFilterTools
 
 ODD_SIGN = 1.0
 __LAST_COEFF = None
@@ -65,10 +66,9 @@ def calc_coeff(num_points, pol_degree, diff_order=0):
             if pol_degree == __LAST_POL_DEGREE:
                 if diff_order == __LAST_DIFF_ORDER:
                     return __LAST_COEFF
-    else:
-        __LAST_NUM_POINTS = num_points
-        __LAST_POL_DEGREE = pol_degree
-        __LAST_DIFF_ORDER = diff_order
+    __LAST_NUM_POINTS = num_points
+    __LAST_POL_DEGREE = pol_degree
+    __LAST_DIFF_ORDER = diff_order
 
 
     # setup interpolation matrix
@@ -115,40 +115,64 @@ def getSavitzkyGolay(spectrum, npoints=3, degree=1, order=0):
     result[N:-N] = numpy.convolve(spectrum, coeff, mode='valid')
     return result
 
-def replaceStackWithSavitzkyGolay(stack, npoints=3, degree=1, order=0):
+def getSavitzkyGolayMultiple(spectra, npoints=3, degree=1, order=0):
+    """ applies the filter to each row of a 2D array of spectra """
     coeff = calc_coeff(npoints, degree, order)
-    N = numpy.size(coeff-1) // 2
+    return _smoothMultiple(spectra, coeff, order)
+
+def _smoothMultiple(spectra, coeff, order):
+    N = numpy.size(coeff - 1) // 2
     convolve = numpy.convolve
+    if order < 1:
+        result = numpy.array(spectra, dtype=numpy.float64)
+    else:
+        result = numpy.zeros(spectra.shape, numpy.float64)
+    for i in range(spectra.shape[0]):
+        result[i, N:-N] = convolve(spectra[i], coeff, mode='valid')
+    if order > 0:
+        result[:, :N] = result[:, N:N+1]
+        result[:, -N:] = result[:, -(N+1):-N]
+    return result
+
+def replaceStackWithSavitzkyGolay(stack, npoints=3, degree=1, order=0,
+                                  output=None, nthreads=None):
+    """ applies the filter to all the spectra of a stack
+
+        The stack can be any sliceable object (numpy array, h5py dataset,
+        ...). It is processed in blocks by nthreads threads and the result
+        is written into output if given, otherwise the stack is modified
+        in place.
+    """
     mcaIndex = -1
     if hasattr(stack, "info") and hasattr(stack, "data"):
-        actualData = stack.data
+        data = stack.data
         mcaIndex = stack.info.get('McaIndex', -1)
     else:
-        actualData = stack
-    if not isinstance(actualData, numpy.ndarray):
-        raise TypeError("This Plugin only supports numpy arrays")
-    # take a view
-    data = actualData[:]
-    oldShape = data.shape
-    if mcaIndex in [-1, len(data.shape)-1]:
-        data.shape = -1, oldShape[-1]
-        for i in range(data.shape[0]):
-            data[i,N:-N] = convolve(data[i,:],coeff, mode='valid')
-            if order > 0:
-                data[i, :N]  = data[i, N]
-                data[i, -N:] = data[i,-(N+1)]
-        data.shape = oldShape
-    elif mcaIndex == 0:
-        data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[N:-N, i] = convolve(data[:, i],coeff, mode='valid')
-            if order > 0:
-                data[:N, i] = data[N, i]
-                data[-N:, i] = data[-(N+1), i]
-        data.shape = oldShape
+        data = stack
+    nDimensions = len(data.shape)
+    if mcaIndex < 0:
+        mcaIndex = nDimensions + mcaIndex
+    if mcaIndex == (nDimensions - 1):
+        axis = 0
+    elif (mcaIndex == 0) and (nDimensions > 1):
+        axis = 1
     else:
         raise ValueError("Invalid 1D index %d" % mcaIndex)
-    return
+    nChannels = data.shape[mcaIndex]
+    coeff = calc_coeff(npoints, degree, order)
+
+    def function(block):
+        if mcaIndex == 0:
+            block = numpy.rollaxis(block, 0, block.ndim)
+        shape = block.shape
+        result = _smoothMultiple(block.reshape(-1, nChannels), coeff, order)
+        result.shape = shape
+        if mcaIndex == 0:
+            result = numpy.rollaxis(result, -1, 0)
+        return result
+
+    StackFilterTools.filterStackInBlocks(data, function, axis=axis,
+                                         output=output, nthreads=nthreads)
 
 if getSavitzkyGolay(10*numpy.arange(10.), npoints=3, degree=1,order=1)[5] < 0:
     ODD_SIGN = -1
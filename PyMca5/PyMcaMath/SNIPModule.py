@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import numpy
 from PyMca5 import SpecfitFuns
+from PyMca5.PyMcaMath import StackFilterTools
 
 snip1d = SpecfitFuns.snip1d
 snip2d = SpecfitFuns.snip2d
@@ -48,75 +49,80 @@ def getSpectrumBackground(spectrum, width, roi_min=None, roi_max=None, smoothing
 
 getSnip1DBackground = getSpectrumBackground
 
-def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1):
-    if roi_min is None:
-        roi_min = 0
-    if roi_max is None:
-        roi_max = len(spectrum)
+def _getStackData(stack):
     mcaIndex = -1
     if hasattr(stack, "info") and hasattr(stack, "data"):
         data = stack.data
         mcaIndex = stack.info.get('McaIndex', -1)
     else:
         data = stack
-    if not isinstance(data, numpy.ndarray):
-        raise TypeError("This Plugin only supports numpy arrays")
-    oldShape = data.shape
-    if mcaIndex in [-1, len(data.shape)-1]:
-        data.shape = -1, oldShape[-1]
-        if roi_min > 0:
-            data[:, 0:roi_min] = 0
-        if roi_max < oldShape[-1]:
-            data[:, roi_max:] = 0
-        for i in range(data.shape[0]):
-            data[i,roi_min:roi_max] -= snip1d(data[i,roi_min:roi_max],
-                                              width, smoothing)
-        data.shape = oldShape
-
-    elif mcaIndex == 0:
-        data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[roi_min:roi_max, i] -= snip1d(data[roi_min:roi_max, i],
-                                               width, smoothing)
-        data.shape = oldShape
+    return data, mcaIndex
+
+def _filterSnip1DStack(stack, width, roi_min, roi_max, smoothing,
+                       subtract, output, nthreads):
+    data, mcaIndex = _getStackData(stack)
+    nDimensions = len(data.shape)
+    if mcaIndex < 0:
+        mcaIndex = nDimensions + mcaIndex
+    if mcaIndex == (nDimensions - 1):
+        # the spectra are contiguous, the blocks are taken along the first
+        # axis
+        axis = 0
+    elif (mcaIndex == 0) and (nDimensions > 1):
+        axis = 1
     else:
         raise ValueError("Invalid 1D index %d" % mcaIndex)
-    return
-
-def replaceStackWithSnip1DBackground(stack, width, roi_min=None, roi_max=None,  smoothing=1):
+    nChannels = data.shape[mcaIndex]
     if roi_min is None:
         roi_min = 0
     if roi_max is None:
-        roi_max = len(spectrum)
-    mcaIndex = -1
-    if hasattr(stack, "info") and hasattr(stack, "data"):
-        data = stack.data
-        mcaIndex = stack.info.get('McaIndex', -1)
-    else:
-        data = stack
-    if not isinstance(data, numpy.ndarray):
-        raise TypeError("This Plugin only supports numpy arrays")
-    oldShape = data.shape
-    if mcaIndex in [-1, len(data.shape)-1]:
-        data.shape = -1, oldShape[-1]
-        if roi_min > 0:
-            data[:, 0:roi_min] = 0
-        if roi_max < oldShape[-1]:
-            data[:, roi_max:] = 0
-        for i in range(data.shape[0]):
-            data[i,roi_min:roi_max] = snip1d(data[i,roi_min:roi_max],
-                                              width, smoothing)
-        data.shape = oldShape
-
-    elif mcaIndex == 0:
-        data.shape = oldShape[0], -1
-        for i in range(data.shape[-1]):
-            data[roi_min:roi_max, i] = snip1d(data[roi_min:roi_max, i],
-                                               width, smoothing)
-        data.shape = oldShape
-    else:
-        raise ValueError("Invalid 1D index %d" % mcaIndex)
-    return
+        roi_max = nChannels
+
+    def function(block):
+        if mcaIndex == 0:
+            block = numpy.rollaxis(block, 0, block.ndim)
+        shape = block.shape
+        spectra = block.reshape(-1, nChannels)
+        result = numpy.zeros(spectra.shape, numpy.float64)
+        if roi_max > roi_min:
+            # snip1d works on all the spectra of the block at once
+            background = snip1d(spectra[:, roi_min:roi_max],
+                                width, smoothing)
+            if subtract:
+                result[:, roi_min:roi_max] = spectra[:, roi_min:roi_max]
+                result[:, roi_min:roi_max] -= background
+            else:
+                result[:, roi_min:roi_max] = background
+        result.shape = shape
+        if mcaIndex == 0:
+            result = numpy.rollaxis(result, -1, 0)
+        return result
+
+    StackFilterTools.filterStackInBlocks(data, function, axis=axis,
+                                         output=output, nthreads=nthreads)
+
+def subtractSnip1DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,
+                                      smoothing=1, output=None, nthreads=None):
+    """
+    Subtract the SNIP background from each spectrum of the stack.
+
+    The stack can be any sliceable object (numpy array, h5py dataset, ...).
+    It is processed in blocks by nthreads threads and the result is
+    written into output if given, otherwise the stack is modified in place.
+    Channels outside [roi_min, roi_max) are set to zero.
+    """
+    _filterSnip1DStack(stack, width, roi_min, roi_max, smoothing,
+                       True, output, nthreads)
+
+def replaceStackWithSnip1DBackground(stack, width, roi_min=None, roi_max=None,
+                                     smoothing=1, output=None, nthreads=None):
+    """
+    Replace each spectrum of the stack by its SNIP background.
+
+    Same arguments as subtractSnip1DBackgroundFromStack.
+    """
+    _filterSnip1DStack(stack, width, roi_min, roi_max, smoothing,
+                       False, output, nthreads)
 
 
 def getImageBackground(image, width, roi_min=None, roi_max=None, smoothing=1):
@@ -133,14 +139,16 @@ def getImageBackground(image, width, roi_min=None, roi_max=None, smoothing=1):
 
 getSnip2DBackground = getImageBackground
 
-def subtractSnip2DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,  smoothing=1, index=None):
+def subtractSnip2DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,
+                                      smoothing=1, index=None, output=None,
+                                      nthreads=None):
     """
-    index is the dimension used to index the images
+    Subtract the SNIP background from each image of the stack.
+
+    index is the dimension used to index the images. The stack is processed
+    in blocks of images as in subtractSnip1DBackgroundFromStack and the
+    pixels outside the region of interest are set to zero.
     """
-    if roi_min is None:
-        roi_min = (0, 0)
-    if roi_max is None:
-        roi_max = image.shape
     if hasattr(stack, "info") and hasattr(stack, "data"):
         data = stack.data
         if index is None:
@@ -149,51 +157,23 @@ def subtractSnip2DBackgroundFromStack(stack, width, roi_min=None, roi_max=None,
         data = stack
     if index is None:
         index = 2
-    if not isinstance(data, numpy.ndarray):
-        raise TypeError("This Plugin only supports numpy arrays")
-    shape = data.shape
-    if index == 0:
-        if (roi_min[0] > 0) or (roi_min[1] > 0):
-            data[:, 0:roi_min[0], 0:roi_min[1]] = 0
-        if roi_max[0] < (shape[1]-1):
-            if roi_max[1] < (shape[2]-1):
-                data[:, roi_max[0]:, roi_max[1]:] = 0
-            else:
-                data[:, roi_max[0]:, :] = 0
-        else:
-            if roi_max[1] < (shape[2]-1):
-                data[:, :, roi_max[1]:] = 0
-        for i in range(shape[index]):
-            data[i,roi_min[0]:roi_max[0],roi_min[1]:roi_max[1]] -=\
-                snip2d(data[i,roi_min[0]:roi_max[0],roi_min[1]:roi_max[1]], width, smoothing)
-        return
-    if index == 1:
-        if (roi_min[0] > 0) or (roi_min[1] > 0):
-            data[0:roi_min[0], :, 0:roi_min[1]] = 0
-        if roi_max[0] < (shape[0]-1):
-            if roi_max[1] < (shape[2]-1):
-                data[roi_max[0]:, :, roi_max[1]:] = 0
-            else:
-                data[roi_max[0]:, :, :] = 0
-        else:
-            if roi_max[1] < (shape[2]-1):
-                data[:, :, roi_max[1]:] = 0
-        for i in range(shape[index]):
-            data[roi_min[0]:roi_max[0], i, roi_min[1]:roi_max[1]] -=\
-                snip2d(data[roi_min[0]:roi_max[0], i, roi_min[1]:roi_max[1]], width, smoothing)
-        return
-    if index == 2:
-        if (roi_min[0] > 0) or (roi_min[1] > 0):
-            data[0:roi_min[0], 0:roi_min[1],:] = 0
-        if roi_max[0] < (shape[0]-1):
-            if roi_max[1] < (shape[1]-1):
-                data[roi_max[0]:, roi_max[1]:, :] = 0
-            else:
-                data[roi_max[0]:, :, :] = 0
-        else:
-            if roi_max[1] < (shape[2]-1):
-                data[:, roi_max[1]:, :] = 0
-        for i in range(shape[index]):
-            data[roi_min[0]:roi_max[0],roi_min[1]:roi_max[1], i] -=\
-                snip2d(data[roi_min[0]:roi_max[0],roi_min[1]:roi_max[1], i], width, smoothing)
-        return
+    if index not in [0, 1, 2]:
+        raise ValueError("Invalid image index %d" % index)
+    imageShape = [data.shape[i] for i in range(3) if i != index]
+    if roi_min is None:
+        roi_min = (0, 0)
+    if roi_max is None:
+        roi_max = imageShape
+    r0, c0 = roi_min[0], roi_min[1]
+    r1, c1 = roi_max[0], roi_max[1]
+
+    def function(block):
+        images = numpy.rollaxis(block, index, 0)
+        result = numpy.zeros(images.shape, numpy.float64)
+        for i in range(images.shape[0]):
+            image = images[i, r0:r1, c0:c1]
+            result[i, r0:r1, c0:c1] = image - snip2d(image, width, smoothing)
+        return numpy.rollaxis(result, 0, index + 1)
+
+    StackFilterTools.filterStackInBlocks(data, function, axis=index,
+                                         output=output, nthreads=nthreads)
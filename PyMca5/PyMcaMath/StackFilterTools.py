@@ -0,0 +1,98 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+"""
+Helpers to apply filters to stacks that do not necessarily fit in memory.
+
+The stack can be any sliceable object (numpy array, numpy memmap, h5py
+dataset, ...). It is read in blocks along one axis, the blocks are
+processed by a pool of threads and the result is written either back into
+the stack or into the supplied output dataset.
+"""
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy
+
+DEBUG = 0
+
+# default amount of data read at once by each thread
+BLOCK_SIZE = 32 * 1024 * 1024
+
+def getBlockSlices(shape, axis, itemsize=8, blocksize=None):
+    """
+    Return the list of index tuples splitting an array of the given shape
+    in blocks along the given axis.
+    """
+    if blocksize is None:
+        blocksize = BLOCK_SIZE
+    n = shape[axis]
+    sliceSize = itemsize
+    for i in range(len(shape)):
+        if i != axis:
+            sliceSize *= shape[i]
+    step = max(1, min(n, int(blocksize // max(1, sliceSize))))
+    head = (slice(None),) * axis
+    return [head + (slice(i, min(i + step, n)),) for i in range(0, n, step)]
+
+def filterStackInBlocks(data, function, axis=0, output=None,
+                        nthreads=None, blocksize=None):
+    """
+    Apply function to the data in blocks along the given axis.
+
+    function receives a numpy array with one block of data and has to
+    return an array of the same shape. The result is written into output,
+    or into data itself when output is None. Blocks are processed by
+    nthreads threads, by default as many as CPUs.
+    """
+    if output is None:
+        output = data
+    if tuple(output.shape) != tuple(data.shape):
+        raise ValueError("Output shape does not match input shape")
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    blocks = getBlockSlices(data.shape, axis, blocksize=blocksize)
+
+    def processBlock(index):
+        if DEBUG:
+            print("Processing block %s" % (index,))
+        output[index] = function(numpy.asarray(data[index]))
+
+    if (nthreads < 2) or (len(blocks) < 2):
+        for index in blocks:
+            processBlock(index)
+        return
+    pool = ThreadPool(min(nthreads, len(blocks)))
+    try:
+        pool.map(processBlock, blocks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -31,7 +31,7 @@
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import numpy
-from numpy.linalg import inv
+from numpy.linalg import inv, solve
 import time
 # codes understood by the routine
 CFREE       = 0
@@ -257,7 +257,7 @@ def LinearLeastSquaresFit(model0,parameters0,data0,maxiter,
                                                  x,y,weight,constrains,model_deriv=model_deriv,
                                                  linear=1)
         nr, nc = alpha0.shape
-        fittedpar = numpy.dot(beta, inv(alpha0))
+        fittedpar = solve(alpha0, beta.T).T
         #check respect of constraints (only positive is handled -force parameter to 0 and fix it-)
         error = 0
         for i in range(n_free):
@@ -268,8 +268,7 @@ def LinearLeastSquaresFit(model0,parameters0,data0,maxiter,
                     constrains[0][free_index[i]] = CFIXED
                     error = 1
         if error:continue
-        for i in range(n_free):
-            newpar[free_index[i]] = fittedpar[0,i]
+        newpar[free_index] = fittedpar[0]
         newpar=numpy.array(getparameters(newpar,constrains))
         iiter=-1
     yfit = model(newpar,x)
@@ -394,8 +393,10 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
         while flag == 0:
             newpar = parameters.__copy__()
             if(1):
-                alpha = alpha0 + flambda * numpy.identity(nr) * alpha0
-                deltapar = numpy.dot(beta, inv(alpha))
+                alpha = alpha0.copy()
+                alpha.flat[::nr + 1] += flambda * numpy.diag(alpha0)
+                # alpha is symmetric, this is beta * inv(alpha)
+                deltapar = solve(alpha, beta.T).T
             else:
                 #an attempt to increase accuracy
                 #(it was unsuccessful)
@@ -410,32 +411,8 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
                     for j in range(npar):
                         narray[i,j] = narray[i,j]/(alphadiag[i]*alphadiag[j])
                 deltapar = numpy.dot(beta, narray)
-            pwork = numpy.zeros(deltapar.shape, numpy.float)
-            for i in range(n_free):
-                if constrains [0] [free_index[i]] == CFREE:
-                    pwork [0] [i] = fitparam [i] + deltapar [0] [i]
-                elif constrains [0] [free_index[i]] == CPOSITIVE:
-                    #abs method
-                    pwork [0] [i] = fitparam [i] + deltapar [0] [i]
-                    #square method
-                    #pwork [0] [i] = (numpy.sqrt(fitparam [i]) + deltapar [0] [i]) * \
-                    #                (numpy.sqrt(fitparam [i]) + deltapar [0] [i])
-                elif constrains [0] [free_index[i]] == CQUOTED:
-                    pmax=max(constrains[1] [free_index[i]],
-                            constrains[2] [free_index[i]])
-                    pmin=min(constrains[1] [free_index[i]],
-                            constrains[2] [free_index[i]])
-                    A = 0.5 * (pmax + pmin)
-                    B = 0.5 * (pmax - pmin)
-                    if (B != 0):
-                        pwork [0] [i] = A + \
-                                    B * numpy.sin(numpy.arcsin((fitparam[i] - A)/B)+ \
-                                    deltapar [0] [i])
-                    else:
-                        print("Error processing constrained fit")
-                        print("Parameter limits are",pmin,' and ',pmax)
-                        print("A = ",A,"B = ",B)
-                newpar [free_index[i]] = pwork [0] [i]
+            newpar [free_index] = getfreeparameters(fitparam, deltapar[0],
+                                                    free_index, constrains)
             newpar=numpy.array(getparameters(newpar,constrains))
             workpar = numpy.take(newpar,noigno)
             #yfit = model(workpar.tolist(), x)
@@ -463,162 +440,404 @@ def RestreinedLeastSquaresFit(model0,parameters0,data0,maxiter,
     else:
         return fittedpar.tolist(), chisq/(len(yfit)-len(sigma0)), sigmapar.tolist(),niter,lastdeltachi
 
+def BatchLeastSquaresFit(model, parameters0, xdata=None, ydata=None,
+                         sigmadata=None, maxiter=100, constrains=None,
+                         weightflag=0, model_deriv=None, deltachi=None,
+                         fulloutput=0):
+    """
+    Typical use:
+
+    BatchLeastSquaresFit(model_function, parameters, xdata=xvalues, ydata=yvalues)
+
+    Levenberg-Marquardt fit of K independent data sets sharing the same model,
+    the same x values and the same parameter layout. All the fits are advanced
+    in lockstep and the fits that have converged are removed from the batch.
+
+        model_function - it has the form model_function(parameters, x) where parameters is a 2D array
+                         of shape (k, n_parameters) containing k sets of parameters and x is the array of
+                         values in which the function is to be evaluated. It has to return an array of
+                         shape (k, npoints). k is not always K because finished fits are not evaluated.
+
+        parameters - sequence with the n_parameters initial values common to all the fits or array
+                     of shape (K, n_parameters) with the initial values of each fit
+
+        xdata - array with the npoints x axis data points
+
+        ydata - array of shape (K, npoints) with the y axis data points of each fit
+
+    Additional keywords:
+
+        sigmadata - array of shape (K, npoints) with the uncertainties associated to ydata
+                    (default is sqrt(y))
+
+        weightflag - 0 Means no weighted fit 1 means weighted fit
+
+        constrains - as in LeastSquaresFit, common to all the fits. Quoted parameters outside their
+                     limits are brought to the closest limit.
+
+        model_deriv - function providing the derivatives of the fitting function respect to the
+                      fitted parameters. It will be called as model_deriv(parameters, index, x) with
+                      parameters of shape (k, n_parameters) and it has to return an array of shape
+                      (k, npoints).
+
+        maxiter - Maximum number of iterations of each fit (default is 100)
+
+    Output:
+
+        fitted_parameters (K, n_parameters), reduced_chi_square (K,), uncertainties (K, n_parameters)
+
+        With fulloutput, the number of iterations (K,) and the last relative chi square
+        change (K,) of each fit are also returned.
+        The fits whose normal matrix is singular are stopped and their uncertainties set to NaN.
+    """
+    if deltachi is None:
+        deltachi = 0.01
+    y = numpy.array(ydata, dtype=numpy.float, copy=False)
+    if len(y.shape) == 1:
+        y = y.reshape(1, -1)
+    nfits, npoints = y.shape
+    x = xdata
+    if x is None:
+        x = numpy.arange(npoints).astype(numpy.float)
+    parameters = numpy.array(parameters0, dtype=numpy.float)
+    if len(parameters.shape) == 1:
+        parameters = numpy.outer(numpy.ones(nfits), parameters)
+    n_param = parameters.shape[1]
+    constrains = _getConstraintCodes(constrains, n_param)
+    codes = numpy.array(constrains[0])
+    weight = numpy.ones(y.shape, numpy.float)
+    if weightflag == 1:
+        if sigmadata is not None:
+            dummy = abs(numpy.array(sigmadata, dtype=numpy.float)).reshape(y.shape)
+            weight = 1.0 / (dummy + numpy.equal(dummy, 0))
+            weight = weight * weight
+        else:
+            weight = 1.0 / (abs(y) + numpy.equal(abs(y), 0))
+
+    # the free parameters are the same for all the fits
+    free = (codes == CFREE) | (codes == CPOSITIVE)
+    quoted = numpy.nonzero(codes == CQUOTED)[0]
+    if len(quoted):
+        pmax, pmin = _getQuotedLimits(constrains, quoted)
+        valid = (pmax - pmin) > 0
+        quoted = quoted[valid]
+        parameters[:, quoted] = numpy.clip(parameters[:, quoted],
+                                           pmin[valid], pmax[valid])
+        free[quoted] = True
+    free_index = numpy.nonzero(free)[0]
+    noigno = numpy.nonzero(codes != CIGNORED)[0]
+    n_free = len(free_index)
+    if n_free == 0:
+        raise ValueError("No free parameters to fit")
+    parameters = getparameters(parameters, constrains)
+
+    flambda = numpy.zeros(nfits, numpy.float) + 0.001
+    niter = numpy.zeros(nfits, numpy.int32)
+    iiter = numpy.zeros(nfits, numpy.int32) + maxiter
+    lastdeltachi = numpy.zeros(nfits, numpy.float)
+    chisq0 = numpy.zeros(nfits, numpy.float)
+    alpha0 = numpy.zeros((nfits, n_free, n_free), numpy.float)
+    beta0 = numpy.zeros((nfits, n_free), numpy.float)
+    singular = numpy.zeros(nfits, numpy.bool_)
+    active = numpy.ones(nfits, numpy.bool_)
+    update = numpy.ones(nfits, numpy.bool_)
+    diagonal = numpy.arange(n_free)
+    while active.any():
+        # normal equations of the fits whose last step was accepted
+        idx = numpy.nonzero(active & update)[0]
+        if len(idx):
+            chisq0[idx], alpha0[idx], beta0[idx] = _getBatchChisqAlphaBeta(
+                                        model, parameters[idx], x,
+                                        y[idx], weight[idx], constrains,
+                                        free_index, noigno,
+                                        model_deriv=model_deriv)
+            niter[idx] += 1
+            lastdeltachi[idx] = chisq0[idx]
+        idx = numpy.nonzero(active)[0]
+        alpha = alpha0[idx]
+        alpha[:, diagonal, diagonal] *= (1.0 + flambda[idx])[:, None]
+        deltapar, solved = _batchSolve(alpha, beta0[idx])
+        if not solved.all():
+            singular[idx[~solved]] = True
+            active[idx[~solved]] = False
+            idx = idx[solved]
+            deltapar = deltapar[solved]
+            if not len(idx):
+                break
+        newpar = parameters[idx]
+        newpar[:, free_index] = getfreeparameters(newpar[:, free_index],
+                                                  deltapar, free_index,
+                                                  constrains)
+        newpar = getparameters(newpar, constrains)
+        yfit = model(newpar[:, noigno], x)
+        chisq = (weight[idx] * pow(y[idx] - yfit, 2)).sum(axis=1)
+        accepted = chisq <= chisq0[idx]
+        # rejected steps are retried with a larger lambda
+        rejected = idx[~accepted]
+        flambda[rejected] *= 10.0
+        active[rejected[flambda[rejected] > 1000]] = False
+        # accepted steps
+        jdx = idx[accepted]
+        parameters[jdx] = newpar[accepted]
+        lastdeltachi[jdx] = (chisq0[jdx] - chisq[accepted]) / \
+                            (chisq0[jdx] + (chisq0[jdx] == 0))
+        active[jdx[lastdeltachi[jdx] < deltachi]] = False
+        chisq0[jdx] = chisq[accepted]
+        flambda[jdx] /= 10.0
+        update[:] = False
+        update[jdx] = True
+        iiter[idx] -= 1
+        active[idx[iiter[idx] <= 0]] = False
+    sigma0 = numpy.sqrt(abs(numpy.diagonal(_batchInverse(alpha0),
+                                           axis1=1, axis2=2)))
+    sigma0[singular] = numpy.nan
+    sigmapar = _getBatchSigmaParameters(parameters, sigma0, constrains,
+                                        free_index)
+    chisq = chisq0 / (npoints - n_free)
+    if not fulloutput:
+        return parameters, chisq, sigmapar
+    else:
+        return parameters, chisq, sigmapar, niter, lastdeltachi
+
+CONSTRAINT_CODES = {"FREE": CFREE,
+                    "POSITIVE": CPOSITIVE,
+                    "QUOTED": CQUOTED,
+                    "FIXED": CFIXED,
+                    "FACTOR": CFACTOR,
+                    "DELTA": CDELTA,
+                    "SUM": CSUM,
+                    "IGNORED": CIGNORED,
+                    "IGNORE": CIGNORED}
+
+def _getConstraintCodes(constrains0, n_param):
+    # numeric copy of the constraints
+    constrains = [[], [], []]
+    for i in range(n_param):
+        if (constrains0 is None) or (len(constrains0) == 0):
+            code, value1, value2 = CFREE, 0, 0
+        else:
+            code = constrains0[0][i]
+            value1 = constrains0[1][i]
+            value2 = constrains0[2][i]
+        if type(code) == type('string'):
+            if code not in CONSTRAINT_CODES:
+                raise ValueError("Unknown constraint %s" % code)
+            code = CONSTRAINT_CODES[code]
+            if code in [CFACTOR, CDELTA, CSUM]:
+                value1 = int(value1)
+        constrains[0].append(code)
+        constrains[1].append(value1)
+        constrains[2].append(value2)
+    return constrains
+
+def _getBatchChisqAlphaBeta(model, parameters, x, y, weight, constrains,
+                            free_index, noigno, model_deriv=None):
+    """
+    Chi square (k,), alpha (k, n_free, n_free) and beta (k, n_free) of a
+    stack of k fits.
+    """
+    nfits = parameters.shape[0]
+    n_free = len(free_index)
+    codes = numpy.take(numpy.array(constrains[0]), free_index)
+    fitparam = parameters[:, free_index]
+    derivfactor = numpy.ones(fitparam.shape, numpy.float)
+    quoted = numpy.nonzero(codes == CQUOTED)[0]
+    if len(quoted):
+        pmax, pmin = _getQuotedLimits(constrains, free_index[quoted])
+        A = 0.5 * (pmax + pmin)
+        B = 0.5 * (pmax - pmin)
+        derivfactor[:, quoted] = B * numpy.cos(\
+                        numpy.arcsin((fitparam[:, quoted] - A) / B))
+    delta = (fitparam + numpy.equal(fitparam, 0.0)) * 0.00001
+    pwork = parameters.copy()
+    deriv = numpy.empty((nfits, n_free, y.shape[1]), numpy.float)
+    for i in range(n_free):
+        if model_deriv is None:
+            pwork[:, free_index[i]] = fitparam[:, i] + delta[:, i]
+            f1 = model(getparameters(pwork, constrains)[:, noigno], x)
+            pwork[:, free_index[i]] = fitparam[:, i] - delta[:, i]
+            f2 = model(getparameters(pwork, constrains)[:, noigno], x)
+            pwork[:, free_index[i]] = fitparam[:, i]
+            help0 = (f1 - f2) / (2.0 * delta[:, i:i + 1])
+        else:
+            help0 = model_deriv(pwork, int(free_index[i]), x)
+        deriv[:, i, :] = help0 * derivfactor[:, i:i + 1]
+    yfit = model(getparameters(pwork, constrains)[:, noigno], x)
+    deltay = y - yfit
+    help0 = weight * deltay
+    alpha = numpy.matmul(deriv * weight[:, None, :], deriv.transpose(0, 2, 1))
+    beta = numpy.matmul(deriv, help0[:, :, None])[:, :, 0]
+    chisq = (help0 * deltay).sum(axis=1)
+    return chisq, alpha, beta
+
+def _batchSolve(alpha, beta):
+    # alpha is symmetric, this is beta * inv(alpha) for each fit
+    solved = numpy.ones(alpha.shape[0], numpy.bool_)
+    try:
+        deltapar = numpy.linalg.solve(alpha, beta[:, :, None])[:, :, 0]
+    except numpy.linalg.LinAlgError:
+        deltapar = numpy.zeros(beta.shape, numpy.float)
+        for i in range(alpha.shape[0]):
+            try:
+                deltapar[i] = solve(alpha[i], beta[i])
+            except numpy.linalg.LinAlgError:
+                solved[i] = False
+    return deltapar, solved
+
+def _batchInverse(alpha):
+    try:
+        return numpy.linalg.inv(alpha)
+    except numpy.linalg.LinAlgError:
+        result = numpy.zeros(alpha.shape, numpy.float) + numpy.nan
+        for i in range(alpha.shape[0]):
+            try:
+                result[i] = inv(alpha[i])
+            except numpy.linalg.LinAlgError:
+                pass
+        return result
+
+def _getBatchSigmaParameters(parameters, sigma0, constrains, free_index):
+    # same conventions as getsigmaparameters
+    codes = numpy.array(constrains[0])
+    sigma_par = numpy.zeros(parameters.shape, numpy.float)
+    fixed = (abs(codes) == CFIXED) | (codes == CQUOTED)
+    sigma_par[:, fixed] = parameters[:, fixed]
+    sigma_par[:, free_index] = sigma0
+    quoted = numpy.nonzero(numpy.take(codes, free_index) == CQUOTED)[0]
+    if len(quoted):
+        pmax, pmin = _getQuotedLimits(constrains, free_index[quoted])
+        B = 0.5 * (pmax - pmin)
+        sigma_par[:, free_index[quoted]] = abs(B * \
+                numpy.cos(parameters[:, free_index[quoted]]) * sigma0[:, quoted])
+    for i in range(len(codes)):
+        if codes[i] == CFACTOR:
+            sigma_par[:, i] = constrains[2][i]*sigma_par[:, int(constrains[1][i])]
+        elif codes[i] in [CDELTA, CSUM]:
+            sigma_par[:, i] = sigma_par[:, int(constrains[1][i])]
+    return sigma_par
+
 def ChisqAlphaBeta(model0, parameters, x,y,weight, constrains,model_deriv=None,linear=None):
     if linear is None:linear=0
     model = model0
     #nr0, nc = data.shape
+    parameters = numpy.array(parameters, dtype=numpy.float)
+    codes = numpy.array(constrains[0])
     n_param = len(parameters)
-    n_free = 0
-    fitparam=[]
-    free_index=[]
-    noigno = []
-    derivfactor = []
-    for i in range(n_param):
-        if constrains[0] [i] != CIGNORED:
-            noigno.append(i)
-        if constrains[0] [i] == CFREE:
-            fitparam.append(parameters [i])
-            derivfactor.append(1.0)
-            free_index.append(i)
-            n_free += 1
-        elif constrains[0] [i] == CPOSITIVE:
-            fitparam.append(abs(parameters[i]))
-            derivfactor.append(1.0)
-            #fitparam.append(numpy.sqrt(abs(parameters[i])))
-            #derivfactor.append(2.0*numpy.sqrt(abs(parameters[i])))
-            free_index.append(i)
-            n_free += 1
-        elif constrains[0] [i] == CQUOTED:
-            pmax=max(constrains[1] [i],constrains[2] [i])
-            pmin=min(constrains[1] [i],constrains[2] [i])
-            if ((pmax-pmin) > 0) & \
-               (parameters[i] <= pmax) & \
-               (parameters[i] >= pmin):
-                A = 0.5 * (pmax + pmin)
-                B = 0.5 * (pmax - pmin)
-                if 1:
-                    fitparam.append(parameters[i])
-                    derivfactor.append(B*numpy.cos(numpy.arcsin((parameters[i] - A)/B)))
-                else:
-                    help0 = numpy.arcsin((parameters[i] - A)/B)
-                    fitparam.append(help0)
-                    derivfactor.append(B*numpy.cos(help0))
-                free_index.append(i)
-                n_free += 1
-            elif (pmax-pmin) > 0:
-                print("WARNING: Quoted parameter outside boundaries")
-                print("Initial value = %f" % parameters[i])
-                print("Limits are %f and %f" % (pmin, pmax))
-                print("Parameter will be kept at its starting value")
-    fitparam = numpy.array(fitparam, numpy.float)
-    alpha = numpy.zeros((n_free, n_free),numpy.float)
-    beta = numpy.zeros((1,n_free),numpy.float)
+    noigno = numpy.nonzero(codes != CIGNORED)[0]
+    free = (codes == CFREE) | (codes == CPOSITIVE)
+    derivfactor = numpy.ones(n_param, numpy.float)
+    quoted = numpy.nonzero(codes == CQUOTED)[0]
+    if len(quoted):
+        pmax, pmin = _getQuotedLimits(constrains, quoted)
+        pquoted = parameters[quoted]
+        inside = ((pmax - pmin) > 0) & (pquoted <= pmax) & (pquoted >= pmin)
+        for i in numpy.nonzero(((pmax - pmin) > 0) & (~inside))[0]:
+            print("WARNING: Quoted parameter outside boundaries")
+            print("Initial value = %f" % pquoted[i])
+            print("Limits are %f and %f" % (pmin[i], pmax[i]))
+            print("Parameter will be kept at its starting value")
+        A = 0.5 * (pmax[inside] + pmin[inside])
+        B = 0.5 * (pmax[inside] - pmin[inside])
+        derivfactor[quoted[inside]] = \
+                    B * numpy.cos(numpy.arcsin((pquoted[inside] - A) / B))
+        free[quoted[inside]] = True
+    free_index = numpy.nonzero(free)[0]
+    n_free = len(free_index)
+    if n_free == 0:
+        raise ValueError("No free parameters to fit")
+    fitparam = parameters[free_index]
+    positive = codes[free_index] == CPOSITIVE
+    fitparam[positive] = abs(fitparam[positive])
+    derivfactor = derivfactor[free_index]
     delta = (fitparam + numpy.equal(fitparam,0.0)) * 0.00001
     nr  = x.shape[0]
     ##############
     # Prior to each call to the function one has to re-calculate the
     # parameters
-    pwork = parameters.__copy__()
-    for i in range(n_free):
-        pwork [free_index[i]] = fitparam [i]
-    newpar = getparameters(pwork.tolist(),constrains)
-    newpar = numpy.take(newpar,noigno)
-    if n_free == 0:
-        raise ValueError("No free parameters to fit")
+    pwork = parameters
+    pwork[free_index] = fitparam
+    # the derivatives are stored as the rows of the jacobian
+    deriv = numpy.empty((n_free, nr), numpy.float)
     for i in range(n_free):
         if model_deriv is None:
-            #pwork = parameters.__copy__()
             pwork [free_index[i]] = fitparam [i] + delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
+            newpar = getparameters(pwork,constrains)[noigno]
             f1 = model(newpar, x)
             pwork [free_index[i]] = fitparam [i] - delta [i]
-            newpar = getparameters(pwork.tolist(),constrains)
-            newpar=numpy.take(newpar,noigno)
+            newpar = getparameters(pwork,constrains)[noigno]
             f2 = model(newpar, x)
             help0 = (f1-f2) / (2.0 * delta [i])
-            help0 = help0 * derivfactor[i]
             pwork [free_index[i]] = fitparam [i]
-            #removed I resize outside the loop:
-            #help0 = numpy.resize(help0,(1,nr))
         else:
-            help0=model_deriv(pwork,free_index[i],x)
-            help0 = help0 * derivfactor[i]
-
-        if i == 0 :
-            deriv = help0
-        else:
-            deriv = numpy.concatenate((deriv,help0), 0)
-    #line added to resize outside the loop
-    deriv=numpy.resize(deriv,(n_free,nr))
-    if linear:
-        pseudobetahelp = weight * y
-    else:
-        newpar = getparameters(pwork.tolist(),constrains)
-        newpar = numpy.take(newpar,noigno)
-        yfit = model(newpar, x)
-        deltay = y - yfit
-        help0 = weight * deltay
-    for i in range(n_free):
-        derivi = numpy.resize(deriv [i,:], (1,nr))
-        if linear:
-            if i==0:
-                beta = numpy.resize(numpy.sum((pseudobetahelp * derivi),1),(1,1))
-            else:
-                beta = numpy.concatenate((beta, numpy.resize(numpy.sum((pseudobetahelp * derivi),1),(1,1))), 1)
-        else:
-            help1 = numpy.resize(numpy.sum((help0 * derivi),1),(1,1))
-            if i == 0:
-                beta = help1
-            else:
-                beta = numpy.concatenate((beta, help1), 1)
-        help1 = numpy.inner(deriv,weight*derivi)
-        if i == 0:
-            alpha = help1
-        else:
-            alpha = numpy.concatenate((alpha, help1),1)
+            help0=model_deriv(pwork,int(free_index[i]),x)
+        deriv[i] = numpy.ravel(help0 * derivfactor[i])
+    weight = numpy.ravel(weight)
+    # alpha = J W J^T and beta = J W (y - yfit) (or J W y if linear)
+    alpha = numpy.dot(deriv * weight, deriv.T)
     if linear:
+        beta = numpy.dot(deriv, weight * numpy.ravel(y))
         #not used
         chisq = 0.0
     else:
+        newpar = getparameters(pwork,constrains)[noigno]
+        yfit = model(newpar, x)
+        deltay = numpy.ravel(y - yfit)
+        help0 = weight * deltay
+        beta = numpy.dot(deriv, help0)
         chisq = (help0 * deltay).sum()
+    beta.shape = 1, n_free
     return chisq, alpha, beta, \
            n_free, free_index, noigno, fitparam, derivfactor
 
+def getfreeparameters(fitparam, deltapar, free_index, constrains):
+    """
+    Apply the increments deltapar to the free parameters fitparam taking
+    into account their constraints. The free parameters are given along the
+    last axis.
+    """
+    codes = numpy.take(numpy.array(constrains[0]), free_index)
+    pwork = fitparam + deltapar
+    #square method for the positive ones would be
+    #(numpy.sqrt(fitparam) + deltapar) * (numpy.sqrt(fitparam) + deltapar)
+    quoted = numpy.nonzero(codes == CQUOTED)[0]
+    if len(quoted):
+        pmax, pmin = _getQuotedLimits(constrains, free_index[quoted])
+        A = 0.5 * (pmax + pmin)
+        B = 0.5 * (pmax - pmin)
+        pwork[..., quoted] = A + B * numpy.sin(\
+            numpy.arcsin((fitparam[..., quoted] - A) / B) + \
+            deltapar[..., quoted])
+    return pwork
+
+def _getQuotedLimits(constrains, index):
+    limits1 = numpy.take(numpy.array(constrains[1], dtype=numpy.float), index)
+    limits2 = numpy.take(numpy.array(constrains[2], dtype=numpy.float), index)
+    return numpy.maximum(limits1, limits2), numpy.minimum(limits1, limits2)
+
 def getparameters(parameters,constrains):
     # 0 = Free       1 = Positive     2 = Quoted
     # 3 = Fixed      4 = Factor       5 = Delta
-    newparam=[]
+    codes = numpy.array(constrains[0])
+    newparam = numpy.array(parameters, dtype=numpy.float)
     #first I make the free parameters
     #because the quoted ones put troubles
-    for i in range(len(constrains [0])):
-        if constrains[0][i] == CFREE:
-            newparam.append(parameters[i])
-        elif constrains[0][i] == CPOSITIVE:
-            #newparam.append(parameters[i] * parameters[i])
-            newparam.append(abs(parameters[i]))
-        elif constrains[0][i] == CQUOTED:
-            if 1:
-                newparam.append(parameters[i])
-            else:
-                pmax=max(constrains[1] [i],constrains[2] [i])
-                pmin=min(constrains[1] [i],constrains[2] [i])
-                A = 0.5 * (pmax + pmin)
-                B = 0.5 * (pmax - pmin)
-                newparam.append(A + B * numpy.sin(parameters[i]))
-        elif abs(constrains[0][i]) == CFIXED:
-            newparam.append(parameters[i])
-        else:
-            newparam.append(parameters[i])
-    for i in range(len(constrains [0])):
-        if constrains[0][i] == CFACTOR:
-            newparam[i] = constrains[2][i]*newparam[int(constrains[1][i])]
-        elif constrains[0][i] == CDELTA:
-            newparam[i] = constrains[2][i]+newparam[int(constrains[1][i])]
-        elif constrains[0][i] == CIGNORED:
-            newparam[i] = 0
-        elif constrains[0][i] == CSUM:
-            newparam[i] = constrains[2][i]-newparam[int(constrains[1][i])]
+    # (several sets of parameters can be given along the first axis)
+    positive = codes == CPOSITIVE
+    newparam[..., positive] = abs(newparam[..., positive])
+    # the related ones are resolved in order as they can be chained
+    for i in numpy.nonzero((codes == CFACTOR) | (codes == CDELTA) | \
+                           (codes == CIGNORED) | (codes == CSUM))[0]:
+        if codes[i] == CFACTOR:
+            newparam[..., i] = constrains[2][i] * \
+                               newparam[..., int(constrains[1][i])]
+        elif codes[i] == CDELTA:
+            newparam[..., i] = constrains[2][i] + \
+                               newparam[..., int(constrains[1][i])]
+        elif codes[i] == CIGNORED:
+            newparam[..., i] = 0
+        elif codes[i] == CSUM:
+            newparam[..., i] = constrains[2][i] - \
+                               newparam[..., int(constrains[1][i])]
     return newparam
 
 def getsigmaparameters(parameters,sigma0,constrains):
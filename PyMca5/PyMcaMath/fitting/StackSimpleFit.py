@@ -32,6 +32,7 @@
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
 import os
+import multiprocessing
 import numpy
 from PyMca5.PyMcaIO import ConfigDict
 from . import SimpleFitModule
@@ -39,12 +40,25 @@
 from PyMca5 import PyMcaDirs
 
 DEBUG = 0
+# a neighbor is not used as starting point if its reduced chi square
+# exceeds this factor times the one of the fit started from the estimation
+SEED_CHISQ_THRESHOLD = 2.0
 
 class StackSimpleFit(object):
-    def __init__(self, fit=None):
+    def __init__(self, fit=None, nworkers=1, seedfromneighbors=None):
+        """
+        If seedfromneighbors is True and the estimation policy is not
+        "Estimate always", the fit of each pixel starts from the fitted
+        values of its left or upper neighbor. If None, it is only done
+        when fitting with more than one worker process.
+        """
         if fit is None:
             fit = SimpleFitModule.SimpleFit()
         self.fit = fit
+        # number of worker processes used to fit the pixels
+        self.nWorkers = max(1, int(nworkers))
+        self.seedFromNeighbors = seedfromneighbors
+        self._maxPixelsPerTask = 1024
         self.stack_y = None
         self.outputDir = PyMcaDirs.outputDir
         self.outputFile = None
@@ -166,10 +180,23 @@ def processStack(self, mask=None):
 
         # initialize control variables
         self._parameters = None
+        self._estimation = None
+        self._maxSeedChisq = None
+        self._fittedValues = {}
         self._row = 0
         self._column = -1
         self._progress = 0
         self._status = "Fitting"
+        usePool = (self.nWorkers > 1) and self.fixedLenghtOutput
+        if self.seedFromNeighbors is None:
+            self._seedFromNeighbors = usePool
+        else:
+            self._seedFromNeighbors = bool(self.seedFromNeighbors)
+        if self.__ALWAYS_ESTIMATE:
+            self._seedFromNeighbors = False
+        if usePool:
+            self._processStackInPool(nPixels)
+            return
         for i in range(nPixels):
             self._progress = (i * 100.)/ nPixels
             if (self._column+1) == self._nColumns:
@@ -202,10 +229,86 @@ def processStackData(self, i):
             if DEBUG:
                 print("Estimation due to settings")
             self.fit.estimate()
+        elif self._seedFromNeighbors and (self._estimation is not None):
+            # start from the result of an already fitted neighbor
+            _seedFit(self.fit, self._fittedValues, self._row, self._column,
+                     self._estimation, self._maxSeedChisq)
         self.estimateFinished()
+        if self._seedFromNeighbors:
+            if self._estimation is None:
+                self._estimation = _getEstimation(self.fit)
+            # a failed fit must not be used as starting point
+            _storeFittedValues(self._fittedValues, self._row, self._column,
+                               None)
         values, chisq, sigma, niter, lastdeltachi = self.fit.startFit()
+        if self._seedFromNeighbors:
+            if self._maxSeedChisq is None:
+                self._maxSeedChisq = _getMaxSeedChisq(chisq)
+            _storeFittedValues(self._fittedValues, self._row, self._column,
+                               (values, chisq))
         self.fitFinished()
 
+    def _processStackInPool(self, nPixels):
+        nWorkers = self.nWorkers
+        configuration = self.fit.getConfiguration()
+        # the functions are imported again by each worker
+        configuration['fit']['functions'] = []
+        pool = multiprocessing.Pool(nWorkers,
+                                    initializer=_initWorker,
+                                    initargs=(configuration,))
+        try:
+            # blocks of consecutive rows in order to seed the fits of a row
+            # with the results of the previous one
+            rowsPerTask = int(numpy.ceil(self._nRows / (4. * nWorkers)))
+            rowsPerTask = max(1, min(rowsPerTask,
+                                     self._maxPixelsPerTask // self._nColumns))
+            pending = []
+            for firstRow in range(0, self._nRows, rowsPerTask):
+                lastRow = min(firstRow + rowsPerTask, self._nRows)
+                pixels = []
+                for row in range(firstRow, lastRow):
+                    for column in range(self._nColumns):
+                        if not self.mask[row, column]:
+                            continue
+                        self._row = row
+                        self._column = column
+                        x, y, sigma, xmin, xmax = \
+                            self.getFitInputValues(row * self._nColumns + \
+                                                   column)
+                        pixels.append((row, column, x, y, sigma))
+                pending.append((lastRow,
+                                pool.apply_async(_fitPixelsInWorker,
+                                                 (pixels, self.xMin, self.xMax,
+                                                  self.__ALWAYS_ESTIMATE,
+                                                  self._seedFromNeighbors))))
+                # limit the amount of data waiting to be fitted
+                while len(pending) > (2 * nWorkers):
+                    self._collectPoolResults(pending.pop(0), nPixels)
+            while len(pending):
+                self._collectPoolResults(pending.pop(0), nPixels)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.onProcessStackFinished()
+        self._status = "Ready"
+        if self.progressCallback is not None:
+            self.progressCallback(nPixels, nPixels)
+
+    def _collectPoolResults(self, task, nPixels):
+        lastRow, result = task
+        for row, column, output, error in result.get():
+            self._row = row
+            self._column = column
+            if error is not None:
+                print("Error %s processing row = %d column = %d" % \
+                      (error, row, column))
+            else:
+                self._storePixelResult(output)
+        nDone = lastRow * self._nColumns
+        self._progress = (nDone * 100.) / nPixels
+        if self.progressCallback is not None:
+            self.progressCallback(nDone, nPixels)
+
     def getFitInputValues(self, index):
         """
         Returns the fit parameters x, y, sigma, xmin, xmax
@@ -325,7 +428,17 @@ def fitFinished(self):
             print("result not valid for row %d, column %d" % (row, column))
             return
 
-        if self.fixedLenghtOutput and (self._parameters is None):
+        if self.fixedLenghtOutput:
+            self._storePixelResult(result)
+        else:
+            #specfile output always available
+            specfile = self.getOutputFileNames()['specfile']
+            self._appendOneResultToSpecfile(specfile, result=fitOutput)
+
+    def _storePixelResult(self, result):
+        row= self._row
+        column = self._column
+        if self._parameters is None:
             #If it is the first fit, initialize results array
             imgdir = os.path.join(self.outputDir, "IMAGES")
             if not os.path.exists(imgdir):
@@ -349,19 +462,14 @@ def fitFinished(self):
                                                        self._nColumns),
                                                        numpy.float32)
 
-        if self.fixedLenghtOutput:
-            i = 0
-            for parameter in self._parameters:
-                self._images[parameter] [row, column] =\
-                                        result['fittedvalues'][i]
-                self._sigmas[parameter] [row, column] =\
-                                        result['sigma_values'][i]
-                i += 1
-            self._images['chisq'][row, column] = result['chisq']
-        else:
-            #specfile output always available
-            specfile = self.getOutputFileNames()['specfile']
-            self._appendOneResultToSpecfile(specfile, result=fitOutput)
+        i = 0
+        for parameter in self._parameters:
+            self._images[parameter] [row, column] =\
+                                    result['fittedvalues'][i]
+            self._sigmas[parameter] [row, column] =\
+                                    result['sigma_values'][i]
+            i += 1
+        self._images['chisq'][row, column] = result['chisq']
 
     def _appendOneResultToSpecfile(self, filename, result=None):
         if result is None:
@@ -431,6 +539,77 @@ def onProcessStackFinished(self):
                                            labels = labels,
                                            dtype=numpy.float32)
 
+def _getEstimation(fit):
+    return [param['estimation'] for param in fit.paramlist]
+
+def _getMaxSeedChisq(chisq):
+    return SEED_CHISQ_THRESHOLD * max(chisq, 1.0)
+
+def _seedFit(fit, fittedValues, row, column, default, maxchisq):
+    # use the values of the already fitted left neighbor or, if not
+    # available, of the pixel above as starting point of the fit unless
+    # that fit failed or is bad
+    values = default
+    for neighborRow, neighborColumn in [(row, column - 1), (row - 1, column)]:
+        if neighborColumn not in fittedValues.get(neighborRow, {}):
+            continue
+        seed = fittedValues[neighborRow][neighborColumn]
+        if seed is not None:
+            if (maxchisq is None) or (seed[1] <= maxchisq):
+                values = seed[0]
+        break
+    for param, value in zip(fit.paramlist, values):
+        param['estimation'] = value
+
+def _storeFittedValues(fittedValues, row, column, values):
+    # only the current and the previous rows are needed
+    if row not in fittedValues:
+        for key in list(fittedValues.keys()):
+            if key < (row - 1):
+                del fittedValues[key]
+        fittedValues[row] = {}
+    fittedValues[row][column] = values
+
+# state of each worker process
+_WORKER_STATE = {}
+
+def _initWorker(configuration):
+    fit = SimpleFitModule.SimpleFit()
+    fit.setConfiguration(configuration, try_import=True)
+    _WORKER_STATE['fit'] = fit
+
+def _fitPixelsInWorker(pixels, xmin, xmax, alwaysEstimate, seedFromNeighbors):
+    fit = _WORKER_STATE['fit']
+    estimation = None
+    maxChisq = None
+    fittedValues = {}
+    output = []
+    for row, column, x, y, sigma in pixels:
+        try:
+            _storeFittedValues(fittedValues, row, column, None)
+            fit.setData(x, y, sigma=sigma, xmin=xmin, xmax=xmax)
+            if alwaysEstimate or (estimation is None):
+                fit.estimate()
+                if estimation is None:
+                    estimation = _getEstimation(fit)
+            elif seedFromNeighbors:
+                _seedFit(fit, fittedValues, row, column, estimation, maxChisq)
+            else:
+                _seedFit(fit, {}, row, column, estimation, maxChisq)
+            values, chisq, sigmas, niter, lastdeltachi = fit.startFit()
+            if maxChisq is None:
+                maxChisq = _getMaxSeedChisq(chisq)
+            _storeFittedValues(fittedValues, row, column, (values, chisq))
+            result = fit.getResult(configuration=False)['result']
+            pixelResult = {}
+            for key in ['parameters', 'fittedvalues', 'sigma_values',
+                        'chisq']:
+                pixelResult[key] = result[key]
+            output.append((row, column, pixelResult, None))
+        except:
+            output.append((row, column, None, "%s" % sys.exc_info()[1]))
+    return output
+
 def test():
     import numpy
     from PyMca5.PyMcaMath.fitting import SpecfitFuns
@@ -113,6 +113,8 @@ SpecfitFuns_snip1d(PyObject *self, PyObject *args)
 
     width = (int )width0;
 
+    /* the returned array is a private copy, other threads can run */
+    Py_BEGIN_ALLOW_THREADS
     for (n = 0; n < n_spectra; n++)
     {
         for (i=0; i<smooth_iterations; i++)
@@ -138,6 +140,7 @@ SpecfitFuns_snip1d(PyObject *self, PyObject *args)
             lls_inv(&(doublePointer[n*n_channels]), n_channels);
         }
     }
+    Py_END_ALLOW_THREADS
 
     return PyArray_Return(ret);
 }
@@ -173,6 +176,8 @@ SpecfitFuns_snip2d(PyObject *self, PyObject *args)
 
     width = (int )width0;
 
+    /* the returned array is a private copy, other threads can run */
+    Py_BEGIN_ALLOW_THREADS
     for (i=0; i<smooth_iterations; i++)
     {
         smooth2d((double *) PyArray_DATA(ret), nrows, ncolumns);
@@ -189,6 +194,7 @@ SpecfitFuns_snip2d(PyObject *self, PyObject *args)
     {
         lls_inv((double *) PyArray_DATA(ret), size);
     }
+    Py_END_ALLOW_THREADS
 
     return PyArray_Return(ret);
 }
@@ -4054,6 +4060,7 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
     PyObject *input;
     PyArrayObject *ret;
     int n, npoints;
+    int k, n_spectra;
     double dpoints = 5.;
     double coeff[MAX_SAVITSKY_GOLAY_WIDTH];
     int i, j, m;
@@ -4065,7 +4072,7 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
         return NULL;
 
     ret = (PyArrayObject *)
-             PyArray_FROMANY(input, NPY_DOUBLE, 1, 1, NPY_ARRAY_ENSURECOPY);
+             PyArray_FROMANY(input, NPY_DOUBLE, 1, 2, NPY_ARRAY_ENSURECOPY);
 
     if (ret == NULL){
         printf("Cannot create 1D array from input\n");
@@ -4074,9 +4081,20 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
     npoints = (int )  dpoints;
     if (!(npoints % 2)) npoints +=1;
 
-    n = (int) PyArray_DIMS(ret)[0];
+    /* a 2D input is treated as a set of spectra, one per row */
+    if(PyArray_NDIM(ret) == 1)
+    {
+        n_spectra = 1;
+        n = (int) PyArray_DIMS(ret)[0];
+    }
+    else
+    {
+        n_spectra = (int) PyArray_DIMS(ret)[0];
+        n = (int) PyArray_DIMS(ret)[1];
+    }
 
-    if((npoints < MIN_SAVITSKY_GOLAY_WIDTH) ||  (n < npoints))
+    if((npoints < MIN_SAVITSKY_GOLAY_WIDTH) ||  (n < npoints) || \
+       (npoints > MAX_SAVITSKY_GOLAY_WIDTH) || (n_spectra < 1))
     {
         /* do not smooth data */
         return PyArray_Return(ret);
@@ -4090,35 +4108,46 @@ SpecfitFuns_SavitskyGolay(PyObject *self, PyObject *args)
         coeff[m-i] = coeff[m+i];
     }
 
-    /* do the job */
-    output = (double *) PyArray_DATA(ret);
-
-    /* simple smoothing at the beginning */
-    for (j=0; j<=(int)(npoints/3); j++)
+    /*one does not need the whole spectrum buffer, but code is clearer */
+    data = (double *) malloc(n * sizeof(double));
+    if (data == NULL)
     {
-        smooth1d(output, m);
+        Py_DECREF(ret);
+        return PyErr_NoMemory();
     }
 
-    /* simple smoothing at the end */
-    for (j=0; j<=(int)(npoints/3); j++)
+    /* do the job, the returned array is a private copy */
+    Py_BEGIN_ALLOW_THREADS
+    for (k = 0; k < n_spectra; k++)
     {
-        smooth1d((output+n-m-1), m);
-    }
+        output = ((double *) PyArray_DATA(ret)) + k * n;
 
-    /*one does not need the whole spectrum buffer, but code is clearer */
-    data = (double *) malloc(n * sizeof(double));
-    memcpy(data, output, n * sizeof(double));
+        /* simple smoothing at the beginning */
+        for (j=0; j<=(int)(npoints/3); j++)
+        {
+            smooth1d(output, m);
+        }
 
-    /* the actual SG smoothing in the middle */
-    for (i=m; i<(n-m); i++){
-        dhelp = 0;
-        for (j=-m;j<=m;j++) {
-            dhelp += coeff[m+j] * (*(data+i+j));
+        /* simple smoothing at the end */
+        for (j=0; j<=(int)(npoints/3); j++)
+        {
+            smooth1d((output+n-m-1), m);
         }
-        if(dhelp > 0.0){
-            *(output+i) = dhelp / den;
+
+        memcpy(data, output, n * sizeof(double));
+
+        /* the actual SG smoothing in the middle */
+        for (i=m; i<(n-m); i++){
+            dhelp = 0;
+            for (j=-m;j<=m;j++) {
+                dhelp += coeff[m+j] * (*(data+i+j));
+            }
+            if(dhelp > 0.0){
+                *(output+i) = dhelp / den;
+            }
         }
     }
+    Py_END_ALLOW_THREADS
     free(data);
     return PyArray_Return(ret);
 
@@ -44,6 +44,11 @@
 Similar function to the scipy.stats linregress function handling uncertainties on
 the input values.
 
+LinearLeastSquaresSolver
+
+Class solving repeatedly `a x = b` for a fixed model matrix `a`. The
+pseudo-inverse of the model matrix is calculated only once.
+
 """
 
 # fit to a straight line
@@ -290,7 +295,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
 
         # and get the parameters
         s.shape = -1
-        dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
+        dummy = V.T * (1./s)
         parameters = numpy.dot(dummy, numpy.dot(U.T, b))
         parameters.shape = n, b.shape[1]
         if uncertainties or covariances:
@@ -348,7 +353,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
 
         # and get the parameters
         s.shape = -1
-        dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
+        dummy = V.T * (1./s)
         parameters = numpy.dot(dummy, numpy.dot(U.T, b))
         parameters.shape = n, b.shape[1]
         if uncertainties or covariances:
@@ -374,7 +379,7 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
                     s_cutoff = rcond * s[0]
                 s[s < s_cutoff] = numpy.inf
                 s.shape = -1
-                dummy = numpy.dot(V.T, numpy.eye(n)*(1./s))
+                dummy = V.T * (1./s)
                 parameters[:, i:i+1] = numpy.dot(dummy, numpy.dot(U.T, tmpData))
                 if uncertainties or covariances:
                     # get the uncertainties
@@ -458,6 +463,99 @@ def lstsq(a, b, rcond=None, sigma_b=None, weight=False,
         return result
 
 
+class LinearLeastSquaresSolver(object):
+    """
+    Least-squares solver of `a x = b` for a fixed model matrix `a`.
+
+    The pseudo-inverse of the (weighted) model matrix and the uncertainties
+    on the parameters are calculated once at instantiation. Solving for a
+    set of `K` right-hand sides is then a single matrix product.
+
+    Only the cases in which the uncertainties on the parameters do not
+    depend on the `b` values are supported: unweighted fits and fits using
+    the same experimental uncertainties for every right-hand side.
+
+    Parameters
+    ----------
+    a : array_like, shape (M, N)
+        "Model" matrix.
+    sigma_b : uncertainties on the b values or None. It must have shape (M,)
+              or (M, 1) because it is shared by all the right-hand sides.
+    weight: 0 - No data weighting.
+                Uncertainty of 1 for each data point.
+            1 - Weighted fit using the supplied sigma_b uncertainties.
+    rcond: Cut-off ratio for small singular values of the model matrix.
+    """
+    def __init__(self, a, sigma_b=None, weight=False, rcond=None):
+        a = numpy.array(a, dtype=numpy.float, copy=False)
+        if len(a.shape) != 2:
+            raise ValueError("Model matrix must be two dimensional")
+        m, n = a.shape
+        if weight:
+            if sigma_b is None:
+                raise ValueError(\
+                    "Statistical weights depend on the data, use lstsq")
+            w = numpy.abs(numpy.array(sigma_b, dtype=numpy.float, copy=False))
+            w = w + numpy.equal(w, 0)
+            if w.size != m:
+                raise ValueError(\
+                    "Uncertainties must be the same for all the data sets")
+            w = w.reshape(m, 1)
+            A = a / w
+        else:
+            w = None
+            A = a
+        U, s, V = numpy.linalg.svd(A, full_matrices=False)
+        if rcond is None:
+            s_cutoff = n * numpy.finfo(numpy.float).eps
+        else:
+            s_cutoff = rcond * s[0]
+        s[s < s_cutoff] = numpy.inf
+        dummy = V.T * (1./s)
+        self.svd = (U, s, V)
+        self.pseudoInverse = numpy.dot(dummy, U.T)
+        if w is not None:
+            # the weights are included in the pseudo-inverse
+            self.pseudoInverse /= w.T
+        # the uncertainties are independent of the b values
+        self.sigmapar = numpy.sqrt((dummy * dummy).sum(axis=1))
+        self._pseudoInverse32 = None
+
+    def solve(self, b, uncertainties=False):
+        """
+        Return the least-squares solution for the b values.
+
+        Parameters
+        ----------
+        b : array_like, shape (M,) or (M, K)
+            Float32 arrays are used without conversion, the product being
+            calculated in single precision.
+
+        uncertainties: If True, the uncertainties on the parameters are also
+            returned with the same shape as the parameters.
+
+        Returns
+        -------
+        x : ndarray, shape (N,) or (N, K)
+            Least-squares solution.
+        """
+        if getattr(b, "dtype", None) == numpy.float32:
+            if self._pseudoInverse32 is None:
+                self._pseudoInverse32 = \
+                        self.pseudoInverse.astype(numpy.float32)
+            parameters = numpy.dot(self._pseudoInverse32, b)
+        else:
+            parameters = numpy.dot(self.pseudoInverse,
+                        numpy.array(b, dtype=numpy.float, copy=False))
+        if not uncertainties:
+            return parameters
+        sigmapar = numpy.empty(parameters.shape, parameters.dtype)
+        if len(parameters.shape) == 1:
+            sigmapar[:] = self.sigmapar
+        else:
+            sigmapar[:] = self.sigmapar[:, None]
+        return parameters, sigmapar
+
 def getModelMatrixFromFunction(model_function, dummy_parameters, xdata, derivative=None):
     nPoints = xdata.size
     nParameters = len(dummy_parameters)
@@ -198,6 +198,9 @@
 from . import py_nnma
 DEBUG = 0
 
+# default size in bytes of the blocks of spectra used by miniBatchNNMA
+BLOCK_SIZE = 32 * 1024 * 1024
+
 function_list = ['FNMAI', 'ALS', 'FastHALS', 'GDCLS']
 function_dict = {"NNSC": py_nnma.NNSC,
                  "FNMAI_SPARSE": py_nnma.FNMAI_SPARSE,
@@ -212,9 +215,22 @@
                  "SNMF": py_nnma.SNMF,
                  }
 def nnma(stack, ncomponents, binning=None,
-         function=None, eps=5e-5, verbose=DEBUG, maxcount=1000, kmeans=False):
+         function=None, eps=5e-5, verbose=DEBUG, maxcount=1000, kmeans=False,
+         blocksize=None):
+    """
+    Non negative matrix approximation of a stack of spectra.
+
+    function is one of the keys of function_dict or "MiniBatch". The latter
+    does not load the stack in memory. It reads blocks of about blocksize
+    bytes of spectra, updating the spectral components after each block,
+    and calculates the images in a last reading of the stack.
+    """
     if kmeans and (not MDP):
         raise ValueError("K Means not supported")
+    if function == "MiniBatch":
+        return miniBatchNNMA(stack, ncomponents, binning=binning, eps=eps,
+                             verbose=verbose, maxcount=maxcount,
+                             kmeans=kmeans, blocksize=blocksize)
     #I take the defaults for the other parameters
     param = dict(alpha=.1, tau=2, regul=1e-2, sparse_par=1e-1, psi=1e-3)
     if function is None:
@@ -310,6 +326,171 @@ def nnma(stack, ncomponents, binning=None,
         images.shape = ncomponents, r, c
         return images, numpy.ones((ncomponents), numpy.float32),X
 
+    #original data intensity
+    original_intensity = numpy.sum(data)
+    new_images, values, new_vectors = _sortComponents(images, X,
+                                                      original_intensity,
+                                                      kmeans=kmeans)
+    new_images.shape = new_images.shape[0], r, c
+    if kmeans:
+        classifier = mdp.nodes.KMeansClassifier(ncomponents)
+        for i in range(ncomponents):
+            classifier.train(new_vectors[i:i+1])
+        k = 0
+        for i in range(r):
+            for j in range(c):
+                spectrum = data[k:k+1,:]
+                new_images[-1, i,j] = classifier.label(spectrum)[0]
+                k += 1
+    return new_images, values, new_vectors
+
+def miniBatchNNMA(stack, ncomponents, binning=None, eps=5e-5,
+                  verbose=DEBUG, maxcount=1000, kmeans=False,
+                  blocksize=None, passes=20, tau=5):
+    """
+    Online NNMA with the memory footprint bounded by the block size.
+
+    Each block of spectra is approximated with the current spectral
+    components by a non negative least squares fit (HALS iterations).
+    The sufficient statistics A.T * A and A.T * Y of every block replace
+    the ones of the previous reading of the same block, and the spectral
+    components are updated tau times per block. The stack is read at most
+    passes times or till the relative change of the objective function
+    is below eps. A last reading calculates the images.
+    """
+    if kmeans and (not MDP):
+        raise ValueError("K Means not supported")
+    if binning is None:
+        binning = 1
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+    if len(data.shape) == 3:
+        r, c, N = data.shape
+    else:
+        r, N = data.shape
+        c = 1
+    N = int(N / binning)
+    if (ncomponents < 1) or (ncomponents > N) or (ncomponents > r * c):
+        raise ValueError("number of components is invalid")
+    if blocksize is None:
+        blocksize = BLOCK_SIZE
+    # blocks of complete rows
+    step = max(1, int(blocksize // (c * N * binning * 8)))
+    blocks = [(i, min(i + step, r)) for i in range(0, r, step)]
+
+    def readBlock(i0, i1):
+        block = numpy.array(data[i0:i1], dtype=numpy.float64)
+        block.shape = -1, block.shape[-1]
+        if binning > 1:
+            block = block[:, :N * binning].reshape(-1, N, binning)
+            block = block.sum(axis=-1)
+        return block
+
+    # start with random positive spectra of the magnitude of the data
+    block = readBlock(*blocks[0])
+    X = numpy.random.rand(ncomponents, N) * \
+        (block.mean(axis=0) + block.mean() * 1.0e-3)
+    block = None
+    blockStatistics = [None] * len(blocks)
+    AA = numpy.zeros((ncomponents, ncomponents), numpy.float64)
+    AY = numpy.zeros((ncomponents, N), numpy.float64)
+    original_intensity = 0.0
+    obj_old = None
+    converged = False
+    for count in range(min(passes, maxcount)):
+        obj = 0.0
+        nrm_Y = 0.0
+        for blockIndex, (i0, i1) in enumerate(blocks):
+            block = readBlock(i0, i1)
+            if count == 0:
+                original_intensity += block.sum()
+            squares = (block * block).sum()
+            nrm_Y += squares
+            # several updates per block reduce the number of readings
+            for iteration in range(tau):
+                A = _nonNegativeLeastSquares(block, X)
+                blockAA = numpy.dot(A.T, A)
+                blockAY = numpy.dot(A.T, block)
+                if iteration == 0:
+                    # residual from the already calculated products
+                    obj += squares - 2 * (blockAY * X).sum() + \
+                           (blockAA * numpy.dot(X, X.T)).sum()
+                if blockStatistics[blockIndex] is not None:
+                    AA -= blockStatistics[blockIndex][0]
+                    AY -= blockStatistics[blockIndex][1]
+                AA += blockAA
+                AY += blockAY
+                blockStatistics[blockIndex] = blockAA, blockAY
+                X = _updateComponents(AA, AY, X)
+            block = None
+        obj = numpy.sqrt(max(obj, 0.0) / nrm_Y)
+        if verbose:
+            print("pass=%6d obj=%E" % (count + 1, obj))
+        if (obj_old is not None) and (abs(obj_old - obj) < eps):
+            converged = True
+            break
+        obj_old = obj
+    if not converged:
+        print("WARNING: Possible problems converging")
+    blockStatistics = None
+
+    # the images with the final components
+    images = numpy.zeros((ncomponents, r * c), numpy.float64)
+    for i0, i1 in blocks:
+        images[:, i0 * c:i1 * c] = _nonNegativeLeastSquares(readBlock(i0, i1),
+                                                            X).T
+    new_images, values, new_vectors = _sortComponents(images, X,
+                                                      original_intensity,
+                                                      kmeans=kmeans)
+    images = None
+    if kmeans:
+        classifier = mdp.nodes.KMeansClassifier(ncomponents)
+        for i in range(ncomponents):
+            classifier.train(new_vectors[i:i+1])
+        for i0, i1 in blocks:
+            new_images[-1, i0 * c:i1 * c] = \
+                           classifier.label(readBlock(i0, i1))
+    new_images.shape = new_images.shape[0], r, c
+    return new_images, values, new_vectors
+
+def _nonNegativeLeastSquares(Y, X, iterations=10):
+    """
+    Non negative A minimizing || Y - A X || by HALS iterations started
+    from the unconstrained solution.
+    """
+    XX = numpy.dot(X, X.T)
+    YX = numpy.dot(Y, X.T)
+    A = numpy.dot(YX, numpy.linalg.pinv(XX))
+    numpy.clip(A, 0.0, None, out=A)
+    for iteration in range(iterations):
+        for j in range(X.shape[0]):
+            if XX[j, j] > 0:
+                A[:, j] += (YX[:, j] - numpy.dot(A, XX[:, j])) / XX[j, j]
+                numpy.clip(A[:, j], 0.0, None, out=A[:, j])
+    return A
+
+def _updateComponents(AA, AY, X, iterations=2):
+    """
+    HALS update of the spectral components X given the sufficient
+    statistics A.T * A and A.T * Y.
+    """
+    X = X.copy()
+    for iteration in range(iterations):
+        for j in range(X.shape[0]):
+            if AA[j, j] > 0:
+                X[j] += (AY[j] - numpy.dot(AA[j], X)) / AA[j, j]
+                numpy.clip(X[j], 1.0e-12, None, out=X[j])
+    return X
+
+def _sortComponents(images, X, original_intensity, kmeans=False):
+    """
+    Normalize the images to a maximum of one, sort the components by
+    decreasing intensity and return the images, the percentage of intensity
+    of each component and the spectral components.
+    """
+    ncomponents = images.shape[0]
     #order and scale images according to Gerd Wellenreuthers' recipe
     #normalize all maps to be in the range [0, 1]
     for i in range(ncomponents):
@@ -327,41 +508,20 @@ def nnma(stack, ncomponents, binning=None,
     sorted_idx = [item[1] for item in sorted(total_nnma_intensity)]
     sorted_idx.reverse()
 
-    #original data intensity
-    original_intensity = numpy.sum(data)
-
     #final values
     if kmeans:
         n_more = 1
     else:
         n_more = 0
-    new_images  = numpy.zeros((ncomponents + n_more, r*c), numpy.float32)
+    new_images  = numpy.zeros((ncomponents + n_more, images.shape[1]),
+                              numpy.float32)
     new_vectors = numpy.zeros((X.shape[0]+n_more, X.shape[1]), numpy.float32)
     values      = numpy.zeros((ncomponents+n_more,), numpy.float32)
     for i in range(ncomponents):
         idx = sorted_idx[i]
-        if 1:
-            new_images[i, :] = images[idx, :]
-        else:
-            #imaging the projected sum gives same results
-            Atmp = images[idx, :]
-            Atmp.shape = -r*c, 1
-            Xtmp = X[idx,:]
-            Xtmp.shape = 1, -1
-            new_images[i, :] = numpy.sum(numpy.dot(Atmp, Xtmp), axis=1)
+        new_images[i, :] = images[idx, :]
         new_vectors[i,:] = X[idx,:]
         values[i] = 100.*total_nnma_intensity[idx][0]/original_intensity
-    new_images.shape = ncomponents + n_more, r, c
-    if kmeans:
-        classifier = mdp.nodes.KMeansClassifier(ncomponents)
-        for i in range(ncomponents):
-            classifier.train(new_vectors[i:i+1])
-        k = 0
-        for i in range(r):
-            for j in range(c):
-                spectrum = data[k:k+1,:]
-                new_images[-1, i,j] = classifier.label(spectrum)[0]
-                k += 1
     return new_images, values, new_vectors
 
 if __name__ == "__main__":
@@ -52,6 +52,9 @@
 from . import PCATools
 DEBUG = 0
 
+# maximum size in bytes of the data blocks read by randomizedPCA
+BLOCK_SIZE = 32 * 1024 * 1024
+
 # Make these functions accept arguments not relevant to
 # them in order to simplify having a common graphical interface
 def lanczosPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
@@ -482,6 +485,169 @@ def numpyPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
                              legacy=legacy,
                              **kw)
 
+def randomizedPCA(stack, ncomponents=10, binning=None, legacy=True, **kw):
+    """
+    Randomized subspace iteration PCA.
+
+    The centered covariance eigenvectors are obtained without building
+    the covariance matrix and without loading the whole stack in memory.
+    The data are read in blocks of pixels in iterations + 2 passes, what
+    makes the method suitable for big HDF5 datasets.
+
+    Besides the arguments common to the other methods, the keywords mask
+    (spatial mask), spectral_mask (weights), center, index, iterations
+    (default 2) and oversampling (default 10) are understood.
+    """
+    if DEBUG:
+        print("PCAModule.randomizedPCA called")
+        t0 = time.time()
+    if hasattr(stack, "info") and hasattr(stack, "data"):
+        data = stack.data
+    else:
+        data = stack
+    if hasattr(stack, "info"):
+        index = stack.info.get('McaIndex', -1)
+    else:
+        index = kw.get("index", -1)
+    oldShape = data.shape
+    if index not in [0, -1, len(oldShape) - 1]:
+        raise IndexError("1D index must be one of 0, -1 or %d, got %d" %\
+                             (len(oldShape) - 1, index))
+    if index < 0:
+        actualIndex = len(oldShape) + index
+    else:
+        actualIndex = index
+    if binning is None:
+        binning = 1
+    nChannels = oldShape[actualIndex]
+    nPixels = 1
+    for i in range(len(oldShape)):
+        if i != actualIndex:
+            nPixels *= oldShape[i]
+    N = int(nChannels / binning)
+    if ncomponents > N:
+        msg = "Requested %d components for a maximum of %d" % (ncomponents, N)
+        raise ValueError(msg)
+    center = kw.get("center", True)
+    iterations = kw.get("iterations", 2)
+    nVectors = min(ncomponents + kw.get("oversampling", 10), N)
+
+    mask = kw.get("mask", None)
+    if mask is not None:
+        mask = numpy.array(mask[:]).reshape(-1) > 0
+        usedPixels = int(mask.sum())
+    else:
+        usedPixels = nPixels
+    if usedPixels < 2:
+        raise ValueError("At least two pixels are needed")
+    weights = kw.get("spectral_mask", None)
+    if weights is not None:
+        weights = numpy.array(weights[:], dtype=numpy.float64).reshape(-1)
+        if weights.size != N:
+            weights = weights[::binning][:N]
+
+    def dataBlocks():
+        # pixel blocks as (first pixel, weighted and sampled 2D block)
+        for start, block in _getPCAPixelBlocks(data, actualIndex,
+                                               nPixels, N, binning):
+            end = start + block.shape[0]
+            if mask is not None:
+                block[~mask[start:end]] = 0.0
+            if weights is not None:
+                block *= weights
+            yield start, block
+
+    # first pass: sum spectrum, total variance and first product
+    # the centering is applied afterwards, so no previous pass is needed
+    random = numpy.random.RandomState(kw.get("seed", None))
+    q = random.standard_normal((N, nVectors))
+    q, r = numpy.linalg.qr(q)
+    sumSpectrum = numpy.zeros((N,), numpy.float64)
+    sumSquares = 0.0
+    y = numpy.zeros((N, nVectors), numpy.float64)
+    for start, block in dataBlocks():
+        sumSpectrum += block.sum(axis=0)
+        sumSquares += (block * block).sum()
+        y += dotblas.dot(block.T, dotblas.dot(block, q))
+    average = sumSpectrum / usedPixels
+    if center:
+        y -= usedPixels * numpy.outer(average, dotblas.dot(average, q))
+        totalVariance = sumSquares - usedPixels * dotblas.dot(average, average)
+    else:
+        totalVariance = sumSquares
+    totalVariance /= (usedPixels - 1)
+
+    # subspace iterations
+    for i in range(iterations):
+        q, r = numpy.linalg.qr(y)
+        y[:] = 0.0
+        for start, block in dataBlocks():
+            y += dotblas.dot(block.T, dotblas.dot(block, q))
+        if center:
+            y -= usedPixels * numpy.outer(average, dotblas.dot(average, q))
+
+    # Rayleigh-Ritz on the last subspace
+    evalues, evectors = numpy.linalg.eigh(dotblas.dot(q.T, y))
+    idx = numpy.argsort(evalues)[::-1][:ncomponents]
+    eigenvalues = (evalues[idx] / (usedPixels - 1)).astype(numpy.float32)
+    eigenvectors = dotblas.dot(q, evectors[:, idx]).T.astype(numpy.float32)
+
+    # last pass: the projections of the data as in numpyPCA
+    images = numpy.zeros((ncomponents, nPixels), numpy.float32)
+    for start, block in _getPCAPixelBlocks(data, actualIndex,
+                                           nPixels, N, binning):
+        images[:, start:start + block.shape[0]] = \
+                  dotblas.dot(eigenvectors, block.T)
+    if len(oldShape) == 3:
+        if actualIndex == 0:
+            images.shape = ncomponents, oldShape[1], oldShape[2]
+        else:
+            images.shape = ncomponents, oldShape[0], oldShape[1]
+    if DEBUG:
+        print("randomizedPCA elapsed = ", time.time() - t0)
+    if legacy:
+        return images, eigenvalues, eigenvectors
+    else:
+        return {"scores": images,
+                "eigenvalues": eigenvalues,
+                "eigenvectors": eigenvectors,
+                "average": average,
+                "pixels": usedPixels,
+                "variance": totalVariance}
+
+
+def _getPCAPixelBlocks(data, actualIndex, nPixels, N, binning,
+                       blocksize=None):
+    """
+    Generator of (first pixel, block) tuples, where block is a float64
+    array of shape (number of pixels, N) with the spectra sampled by
+    binning. Only one block is kept in memory at a time. The blocks are
+    sized on the spectra as read, before sampling.
+    """
+    if blocksize is None:
+        blocksize = BLOCK_SIZE
+    if actualIndex == 0:
+        axis = 1
+        nChannels = data.shape[0]
+    else:
+        axis = 0
+        nChannels = data.shape[-1]
+    rowPixels = nPixels // data.shape[axis]
+    step = max(1, int(blocksize // (rowPixels * nChannels * 8)))
+    channels = slice(0, N * binning, binning)
+    for start in range(0, data.shape[axis], step):
+        end = min(start + step, data.shape[axis])
+        if actualIndex == 0:
+            block = numpy.array(data[channels, start:end], dtype=numpy.float64)
+            block = block.reshape(N, -1).T.copy()
+        else:
+            block = numpy.array(data[start:end], dtype=numpy.float64)
+            block = block.reshape(-1, data.shape[-1])[:, channels]
+            if binning > 1:
+                block = block.copy()
+        yield start * rowPixels, block
+
+
 def mdpPCASVDFloat32(stack, ncomponents=10, binning=None,
                      mask=None, spectral_mask=None, legacy=True, **kw):
     return mdpPCA(stack, ncomponents, binning=binning, dtype='float32',
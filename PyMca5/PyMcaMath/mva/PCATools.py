@@ -31,6 +31,8 @@
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import sys
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy
 import numpy.linalg
 try:
@@ -43,6 +45,9 @@
 
 DEBUG = 0
 
+# maximum size in bytes of the blocks of spectra multiplied at once
+BLOCK_SIZE = 32 * 1024 * 1024
+
 def getCovarianceMatrix(stack,
                         index=None,
                         binning=None,
@@ -50,7 +55,8 @@ def getCovarianceMatrix(stack,
                         force=True,
                         center=True,
                         weights=None,
-                        spatial_mask=None):
+                        spatial_mask=None,
+                        nthreads=None):
     """
     Calculate the covariance matrix of input data (stack) array. The input array is to be
     understood as a set of observables (spectra) taken at different instances (for instance
@@ -80,6 +86,9 @@ def getCovarianceMatrix(stack,
     :spatial_mask: Array of size n where n is the number of measurement instances. In mapping
     experiments, n would be equal to the number of pixels.
     :type spatial_mask: Numpy array of unsigned bytes (numpy.uint8) or None (default).
+    :param nthreads: Number of threads used by the progressive calculation when the observables
+    are in the last dimension. Each thread accumulates its own partial product.
+    :type nthreads: Positive integer (default is the number of CPUs)
     :returns: The covMatrix, the average spectrum and the number of used pixels.
     """
     #the 1D mask = weights should correspond to the values, before or after
@@ -136,7 +145,7 @@ def getCovarianceMatrix(stack,
     if spatial_mask is not None:
         cleanMask = spatial_mask[:].reshape(nPixels)
         usedPixels = cleanMask.sum()
-        badMask = numpy.array(spatial_mask < 1, dtype=cleanMask.dtype)
+        badMask = numpy.array(spatial_mask[:] < 1, dtype=numpy.bool_)
         badMask.shape = nPixels
     else:
         cleanMask = None
@@ -402,128 +411,18 @@ def getCovarianceMatrix(stack,
         #if someone had the bad idea to store the data in HDF5 with a chunk
         #size based on the pixels and not on the spectra a loop based on
         #reading spectrum per spectrum can be very slow
-        step = 0
-        divider = 10
-        while step < 1:
-            step = int(nPixels / divider)
-            divider -= 1
-            if divider <= 0:
-                step = nPixels
-                break
-        step = nPixels
-        if DEBUG:
-            print("Reading chunks of %d spectra" % step)
-
-        cleanWeights.shape = 1, -1
-        if len(data.shape) == 2:
-            if cleanMask is not None:
-                badMask.shape = -1
-            tmpData = numpy.zeros((step, nChannels), numpy.float64)
-            k = 0
-            while k < nPixels:
-                kToRead = min(step, nPixels - k)
-                tmpData[0:kToRead] = data[k: k + kToRead, ::binning]
-                if cleanMask is not None:
-                    tmpData[badMask[k: k + kToRead]] = 0
-                a = tmpData[0:kToRead] * cleanWeights
-                sumSpectrum += a.sum(axis=0)
-                covMatrix += dotblas.dot(a.T, a)
-                a = None
-                k += kToRead
-            tmpData = None
-        elif len(data.shape) == 3:
-            if oldShape[0] == 1:
-                #close to the previous case
-                tmpData = numpy.zeros((step, nChannels), numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                for i in range(oldShape[0]):
-                    k = 0
-                    while k < oldShape[1]:
-                        kToRead = min(step, oldShape[1] - k)
-                        tmpData[0:kToRead] = data[i, k:k + kToRead, ::binning]\
-                                             * cleanWeights
-                        if cleanMask is not None:
-                            tmpData[0:kToRead][badMask[i, k: k + kToRead]] = 0
-                        a = tmpData[0:kToRead]
-                        sumSpectrum += a.sum(axis=0)
-                        covMatrix += dotblas.dot(a.T, a)
-                        a = None
-                        k += kToRead
-                tmpData = None
-            elif oldShape[1] == 1:
-                #almost identical to the previous case
-                tmpData = numpy.zeros((step, nChannels), numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                for i in range(oldShape[1]):
-                    k = 0
-                    while k < oldShape[0]:
-                        kToRead = min(step, oldShape[0] - k)
-                        tmpData[0:kToRead] = data[k: k + kToRead, i, ::binning]\
-                                             * cleanWeights
-                        if cleanMask is not None:
-                            tmpData[0:kToRead][badMask[k: k + kToRead, i]] = 0
-                        a = tmpData[0:kToRead]
-                        sumSpectrum += a.sum(axis=0)
-                        covMatrix += dotblas.dot(a.T, a)
-                        a = None
-                        k += kToRead
-                tmpData = None
-            elif oldShape[0] < 21:
-                if step > oldShape[1]:
-                    step = oldShape[1]
-                tmpData = numpy.zeros((step, nChannels), numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                for i in range(oldShape[0]):
-                    k = 0
-                    while k < oldShape[1]:
-                        kToRead = min(step, oldShape[1] - k)
-                        tmpData[0:kToRead] = data[i, k: k + kToRead, ::binning]\
-                                             * cleanWeights
-                        if cleanMask is not None:
-                            tmpData[0:kToRead][badMask[i, k: k + kToRead]] = 0
-                        a = tmpData[0:kToRead]
-                        sumSpectrum += a.sum(axis=0)
-                        covMatrix += dotblas.dot(a.T, a)
-                        a = None
-                        k += kToRead
-                tmpData = None
-            else:
-                #I should choose the sizes in terms of the size
-                #of the dataset
-                if oldShape[0] < 41:
-                    #divide by 10
-                    deltaRow = 4
-                elif oldShape[0] < 101:
-                    #divide by 10
-                    deltaRow = 10
-                else:
-                    #take pieces of one tenth
-                    deltaRow = int(oldShape[0] / 10)
-                deltaCol = oldShape[1]
-                tmpData = numpy.zeros((deltaRow, deltaCol, nChannels),
-                                      numpy.float64)
-                if cleanMask is not None:
-                    badMask.shape = data.shape[0], data.shape[1]
-                i = 0
-                while i < oldShape[0]:
-                    iToRead = min(deltaRow, oldShape[0] - i)
-                    kToRead = iToRead * oldShape[1]
-                    tmpData[:iToRead] = data[i:(i + iToRead), :, ::binning]
-                    if cleanMask is not None:
-                        tmpData[0:kToRead][badMask[i:(i + iToRead), :]] = 0
-                    a = tmpData[:iToRead]
-                    a.shape = kToRead, nChannels
-                    a *= cleanWeights
-                    if 0:
-                        #weight each spectrum
-                        a /= (a.sum(axis=1).reshape(-1, 1))
-                    sumSpectrum += a.sum(axis=0)
-                    covMatrix += dotblas.dot(a.T, a)
-                    a = None
-                    i += iToRead
+        if cleanMask is not None:
+            badMask.shape = data.shape[:-1]
+        gramMatrix, sumSpectrum = _getGramMatrix(data,
+                                    slice(0, nChannels * binning, binning),
+                                    nChannels,
+                                    weights=cleanWeights,
+                                    badMask=badMask if cleanMask is not None \
+                                            else None,
+                                    dtype=dtype,
+                                    nthreads=nthreads)
+        covMatrix += gramMatrix
+        gramMatrix = None
         #should one divide by N or by N-1 ??
         covMatrix /= usedPixels - 1
         if center:
@@ -535,6 +434,99 @@ def getCovarianceMatrix(stack,
     return covMatrix, sumSpectrum / usedPixels, usedPixels
 
 
+def _getGramMatrix(data, channels, nChannels, weights=None, badMask=None,
+                   dtype=numpy.float64, nthreads=None, blocksize=None):
+    """
+    Calculate data.T * data and the sum spectrum of an array of spectra
+    stored along its last dimension.
+
+    The spectra are read in blocks of pixels into scratch buffers that
+    are reused. The blocks are distributed among nthreads threads, each
+    one accumulating a partial product, and the partial products are
+    added at the end. The products are calculated in float32 if dtype is
+    numpy.float32 and in float64 otherwise.
+
+    :param data: 2D or 3D array with the spectra along the last dimension
+    :param channels: slice of the last dimension to be used
+    :param nChannels: number of channels selected by that slice
+    :param weights: array of nChannels weights or None
+    :param badMask: boolean array of data.shape[:-1] set to True on the
+    pixels to be ignored, or None
+    :returns: The product matrix and the sum spectrum (float64)
+    """
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    if blocksize is None:
+        blocksize = BLOCK_SIZE
+    if numpy.dtype(dtype) == numpy.float32:
+        scratchType = numpy.float32
+    else:
+        scratchType = numpy.float64
+    itemsize = numpy.dtype(scratchType).itemsize
+    if weights is not None:
+        weights = numpy.asarray(weights, dtype=scratchType).reshape(-1)
+        weights = weights[:nChannels].reshape(1, -1)
+
+    # split in blocks of complete rows, or of part of a row when a
+    # single row of a 3D array does not fit in a block
+    spectrumSize = nChannels * itemsize
+    blocks = []
+    if len(data.shape) == 3 and \
+       (data.shape[1] * spectrumSize) <= blocksize:
+        step = int(blocksize // (data.shape[1] * spectrumSize))
+        for i in range(0, data.shape[0], step):
+            blocks.append((slice(i, min(i + step, data.shape[0])),
+                           slice(None)))
+        blockPixels = step * data.shape[1]
+    else:
+        step = max(1, int(blocksize // spectrumSize))
+        if len(data.shape) == 3:
+            for i in range(data.shape[0]):
+                for k in range(0, data.shape[1], step):
+                    blocks.append((i, slice(k, min(k + step, data.shape[1]))))
+        else:
+            for k in range(0, data.shape[0], step):
+                blocks.append((slice(k, min(k + step, data.shape[0])),))
+        blockPixels = step
+    nthreads = max(1, min(nthreads, len(blocks)))
+
+    def accumulate(threadIndex):
+        # every thread owns its scratch buffers and its partial product
+        gramMatrix = numpy.zeros((nChannels, nChannels), scratchType)
+        product = numpy.zeros((nChannels, nChannels), scratchType)
+        sumSpectrum = numpy.zeros((nChannels,), numpy.float64)
+        scratch = numpy.zeros((blockPixels * nChannels,), scratchType)
+        for index in blocks[threadIndex::nthreads]:
+            block = data[index + (channels,)]
+            a = scratch[:block.size]
+            a.shape = block.shape
+            a[:] = block
+            block = None
+            if badMask is not None:
+                a[badMask[index]] = 0
+            a.shape = -1, nChannels
+            if weights is not None:
+                a *= weights
+            sumSpectrum += a.sum(axis=0, dtype=numpy.float64)
+            dotblas.dot(a.T, a, out=product)
+            gramMatrix += product
+        return gramMatrix, sumSpectrum
+
+    if nthreads < 2:
+        return accumulate(0)
+    pool = ThreadPool(nthreads)
+    try:
+        results = pool.map(accumulate, range(nthreads), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    gramMatrix, sumSpectrum = results[0]
+    for partialMatrix, partialSum in results[1:]:
+        gramMatrix += partialMatrix
+        sumSpectrum += partialSum
+    return gramMatrix, sumSpectrum
+
+
 def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
                 center=True, scale=True, mask=None, spectral_mask=None, legacy=True, **kw):
     if DEBUG:
@@ -603,7 +595,8 @@ def numpyPCA(stack, index=-1, ncomponents=10, binning=None,
                                                              force=force,
                                                              center=center,
                                                              spatial_mask=mask,
-                                                             weights=spectral_mask)
+                                                             weights=spectral_mask,
+                                                             nthreads=kw.get("nthreads", None))
 
     #the total variance is the sum of the elements of the diagonal
     totalVariance = numpy.diag(cov)
@@ -41,6 +41,7 @@
 import time
 from PyMca5.PyMca import XASNormalization
 from PyMca5.PyMca import linalg
+from PyMca5.PyMcaMath import SGModule
 try:
     from PyMca5.PyMca import _xas
     _XAS = True
@@ -739,6 +740,344 @@ def getFT(k, exafs, npoints=2048, rrange=(0.0, 7.0),
     ddict["FTImaginary"] = f13
     return ddict
 
+def getFTWindowWeightsMultiple(tk, window="Gaussian", windpar=0.2,
+                               xmin=None, xmax=None):
+    r"""
+        getFTWindowWeightsMultiple(tk, window="Gaussian", windpar=0.2,
+                                   xmin=None, xmax=None)
+
+      PURPOSE:
+        Calculate the window weights of a set of spectra at once.
+
+      INPUTS:
+        tk: numpy.array(nspectra, npoints) the abscissas of each spectrum
+
+      KEYWORD PARAMETERS:
+        window, windpar: as in getFTWindowWeights
+        xmin, xmax: numpy.array(nspectra) the limits of the window of each
+                    spectrum. If not given, the minimum and maximum values
+                    of the abscissas of each spectrum are taken.
+
+      OUTPUT:
+        numpy.array(nspectra, npoints) with the values of the weights. Each
+        row is equal to the output of getFTWindowWeights applied to the
+        corresponding row of tk.
+    """
+    names = ['Gaussian', 'Hanning', 'Box','Parzen','Welch',
+             'Hamming', 'Tukey', 'Papul', 'Kaiser']
+    if hasattr(window, "lower"):
+        window = window[0].upper() + window[1:].lower()
+    else:
+        window = names[window]
+    if DEBUG:
+        print("Using window ", window)
+
+    if xmin is None:
+        xmin = tk.min(axis=1)
+    if xmax is None:
+        xmax = tk.max(axis=1)
+    xmin = numpy.zeros((tk.shape[0], 1), numpy.float64) + \
+           numpy.reshape(xmin, (-1, 1))
+    xmax = numpy.zeros((tk.shape[0], 1), numpy.float64) + \
+           numpy.reshape(xmax, (-1, 1))
+
+    xp = (xmax + xmin) / 2.
+    xm = xmax - xmin
+    apo1 = xmin + windpar
+    apo2 = xmax - windpar
+
+    wind = numpy.ones(tk.shape, dtype=numpy.float64)
+    # values to be used below apo1 and above apo2
+    low = None
+    high = None
+    if window in ["Gaussian", "Gauss"]:
+        wind = numpy.power((tk - xp)/xm, 2)
+        wind = numpy.exp(-wind * 9.2)
+    elif window == "Hanning":
+        low = 0.5*(1.0-numpy.cos(numpy.pi*(tk-xmin)/windpar))
+        high = 0.5*(1.0+numpy.cos(numpy.pi*(tk-apo2)/windpar))
+    elif window == "Box":
+        low = 0.0 * tk
+        high = low
+    elif window in ["Parzen", "Triangle", "Triangular"]:
+        low = (tk-xmin)/windpar
+        high = 1 - (tk-apo2)/windpar
+    elif window == "Welch":
+        low = 1.0 - numpy.power( ( (tk-apo1) / windpar), 2)
+        high = 1.0 - numpy.power( (tk-apo2) / windpar, 2 )
+    elif window == "Hamming":
+        low = 1.08 - (.54+0.46*numpy.cos(numpy.pi*(tk-xmin)/windpar))
+        high = 1.08 - (.54-0.46*numpy.cos(numpy.pi*(tk-apo2)/windpar))
+    elif window == "Tukey":
+        low = 1.0 - numpy.power(numpy.cos(0.5*numpy.pi*(tk-xmin)/windpar),2)
+        high = numpy.power(numpy.cos(-0.5*numpy.pi*(tk-apo2)/windpar),2)
+    elif window == "Papul":
+        a = (1./numpy.pi)*numpy.sin(numpy.pi*(tk-xmin)/windpar) + \
+            (1.-(tk-xmin)/windpar)*numpy.cos(numpy.pi*(tk-xmin)/windpar)
+        low = 1.0 - a
+        high = (1./numpy.pi)*numpy.sin(numpy.pi*(tk-apo2)/windpar) + \
+               (1.-(tk-apo2)/windpar)*numpy.cos(numpy.pi*(tk-apo2)/windpar)
+    elif _XAS and window in ["Kaiser", "Kasel"]:
+        arg = windpar * numpy.sqrt(1. - 4.0 * pow((tk-xp)/xm, 2))
+        wind = (_xas.j0(numpy.ravel(arg)).reshape(tk.shape) - 1.0) / \
+               (_xas.j0(numpy.array([windpar], numpy.float64))[0] - 1.0)
+    else:
+        raise ValueError("Window <%s> not implemented" % window)
+    if low is not None:
+        # same precedence as the loops of getFTWindowWeights
+        wind = numpy.where(tk <= apo1, low, wind)
+        wind = numpy.where(tk >= apo2, high, wind)
+    return wind
+
+def getFTMultiple(k, exafs, kmin, kmax, npoints=2048, rrange=(0.0, 7.0),
+                  kstep=0.02, kweight=0, window="gaussian", apodization=0.2):
+    r"""
+        getFTMultiple(k, exafs, kmin, kmax, npoints=2048, rrange=(0.0, 7.0),
+                      kstep=0.02, kweight=0, window="gaussian",
+                      apodization=0.2)
+
+     PURPOSE:
+        Fourier transform of a set of EXAFS spectra at once.
+
+     INPUTS:
+        k: numpy.array(nspectra, npoints) increasing k values of each spectrum
+        exafs: numpy.array(nspectra, npoints) the EXAFS signals
+        kmin, kmax: scalars or numpy.array(nspectra) with the k range
+                    of each spectrum
+
+     OUTPUTS:
+        A dictionary with the same keys as the one returned by getFT. The
+        radius and the interpolated k values are common to all the spectra,
+        the rest of the values have the number of spectra as first dimension.
+    """
+    nSpectra, nPoints = k.shape
+    kmin = numpy.zeros((nSpectra,), numpy.float64) + kmin
+    kmax = numpy.zeros((nSpectra,), numpy.float64) + kmax
+    selection = (k >= kmin[:, None]) & (k <= kmax[:, None])
+    wweights = getFTWindowWeightsMultiple(k,
+                                          window=window,
+                                          windpar=apodization,
+                                          xmin=kmin,
+                                          xmax=kmax)
+    signal = numpy.where(selection, wweights * exafs * pow(k, kweight), 0.0)
+
+    # ;
+    # ; creates the input interpolated values
+    # ;
+    # k is increasing on each row, therefore the selected points of each
+    # spectrum are contiguous
+    valid = selection.any(axis=1)
+    first = numpy.argmax(selection, axis=1)
+    last = nPoints - 1 - numpy.argmax(selection[:, ::-1], axis=1)
+    rows = numpy.arange(nSpectra)[:, None]
+    interpolatedDataX = numpy.linspace(0.0, npoints-1, npoints) * kstep
+
+    # locate the grid points in all the spectra with a single search by
+    # shifting each row of k beyond the previous one
+    kShifted = k - k[:, :1]
+    offset = numpy.arange(nSpectra)[:, None] * (kShifted[:, -1].max() + 1.0)
+    target = interpolatedDataX[None, :] - k[:, :1] + offset
+    j = numpy.searchsorted(numpy.ravel(kShifted + offset),
+                           numpy.ravel(target), side="right")
+    j = j.reshape(nSpectra, npoints) - 1 - rows * nPoints
+    j = numpy.clip(j, first[:, None], numpy.maximum(last - 1, first)[:, None])
+    j1 = numpy.minimum(j + 1, last[:, None])
+    x0 = k[rows, j]
+    y0 = signal[rows, j]
+    dx = k[rows, j1] - x0
+    slope = numpy.where(dx > 0, (signal[rows, j1] - y0) / numpy.where(dx > 0, dx, 1.0), 0.0)
+    interpolatedDataY = y0 + slope * (interpolatedDataX[None, :] - x0)
+    inside = (interpolatedDataX[None, :] >= k[rows[:, 0], first][:, None]) & \
+             (interpolatedDataX[None, :] <= k[rows[:, 0], last][:, None]) & \
+             valid[:, None]
+    interpolatedDataY[~inside] = 0.0
+
+    # ; calculates the fft and generates the conjugated variable (rr)
+    ff = numpy.fft.ifft(interpolatedDataY, axis=1)
+    rstep = numpy.pi / npoints / kstep
+    rr = numpy.linspace(0.0, npoints-1, npoints) * rstep
+
+    # ;
+    # ; prepare the results and cut them to the selected interval in r
+    # ;
+    coef = npoints * kstep / numpy.sqrt(numpy.pi) * numpy.sqrt(2.)
+    goodi = (rr  >= rrange[0]) & (rr  <= rrange[1])
+    f12 = coef*numpy.real(ff[:, goodi])             # real part of fft
+    f13 = coef*numpy.imag(ff[:, goodi])*(-1.)       # imaginary part of fft
+    f10 = rr[goodi]
+    f11 = numpy.sqrt( f12*f12 + f13*f13)
+
+    ddict = {}
+    ddict["InterpolatedK"] = interpolatedDataX
+    ddict["InterpolatedSignal"] = interpolatedDataY
+    ddict["KWeight"] = kweight
+    ddict["K"] = k
+    ddict["WindowWeight"] = wweights
+    ddict["FTRadius"] = f10
+    ddict["FTIntensity"] = f11
+    ddict["FTReal"] = f12
+    ddict["FTImaginary"] = f13
+    return ddict
+
+def postEdgeMultiple(k, mu, kmin, kmax, polDegree=[3,3,3], knots=None,
+                     full=False):
+    r"""
+        postEdgeMultiple(k, mu, kmin, kmax, polDegree=[3,3,3], knots=None,
+                         full=False)
+
+     PURPOSE:
+        Post edge fit of a set of xafs spectra at once.
+
+     INPUTS:
+        k: numpy.array(nspectra, npoints) increasing k values of each spectrum
+        mu: numpy.array(nspectra, npoints) the signals to be fitted
+        kmin, kmax: scalars or numpy.array(nspectra) with the limits of the
+                    fit of each spectrum
+
+     KEYWORD PARAMETERS:
+        polDegree, knots: as in postEdge
+
+     OUTPUTS:
+        numpy.array(nspectra, npoints) with the fit. If full is True, the
+        positions and the values at the knots are returned too.
+
+     PROCEDURE:
+        The same polynomial spline as polspl is fitted, but the linear
+        systems of all the spectra are built from the moments of the data
+        in each range and solved in a single call.
+    """
+    nSpectra, nPoints = k.shape
+    if len(polDegree) > 10:
+        print("Error: Maximum number of intervals is 10")
+        print("       Number of intervals forced to 10")
+        polDegree = polDegree[0:9]
+    nr = len(polDegree)
+    nc = [int(degree) + 1 for degree in polDegree]
+    kmin = numpy.zeros((nSpectra,), numpy.float64) + kmin
+    kmax = numpy.zeros((nSpectra,), numpy.float64) + kmax
+
+    # knots[:, 0] and knots[:, nr] delimit the fitted region
+    knotsX = numpy.zeros((nSpectra, nr + 1), numpy.float64)
+    knotsX[:, 0] = kmin
+    knotsX[:, nr] = kmax
+    step = (kmax - kmin) / float(nr)
+    for i in range(1, nr):
+        knotsX[:, i] = knotsX[:, i - 1] + step
+    if knots not in [None, []]:
+        knots = list(knots)
+        if len(knots) == nr:
+            prepend = knots[0] > kmin
+            append = (~prepend) & (knots[-1] < kmax)
+            good = prepend | append
+        elif len(knots) == (nr - 1):
+            prepend = knots[0] > kmin
+            append = knots[-1] < kmax
+            good = prepend & append
+        else:
+            prepend = numpy.zeros((nSpectra,), dtype=bool)
+            append = prepend
+            good = numpy.zeros((nSpectra,), dtype=bool) + \
+                   (len(knots) == (nr + 1))
+        if not good.all():
+            print("Error: dimension of knots must be dimension of polDegree+1")
+            print("       Forced automatic (equidistant) knot definition.")
+        if good.any():
+            given = numpy.array(knots, dtype=numpy.float64)
+            last = len(knots) - 1
+            for i in range(nr + 1):
+                if i == 0:
+                    value = numpy.where(prepend, kmin, given[0])
+                elif i == nr:
+                    value = numpy.where(append, kmax, given[min(i, last)])
+                else:
+                    value = numpy.where(prepend, given[i - 1],
+                                        given[min(i, last)])
+                knotsX[:, i] = numpy.where(good, value, knotsX[:, i])
+
+    # select only points in selected interval
+    goodi = (k >= knotsX[:, :1]) & (k <= knotsX[:, nr:])
+
+    xl = numpy.minimum(knotsX[:, :-1], knotsX[:, 1:])
+    xh = numpy.maximum(knotsX[:, :-1], knotsX[:, 1:])
+    xk = numpy.where(xl[:, :-1] > xl[:, 1:],
+                     0.5 * (xl[:, :-1] + xh[:, 1:]),
+                     0.5 * (xh[:, :-1] + xl[:, 1:]))
+
+    # the polynomials are fitted in k / kScale to improve the conditioning
+    kScale = numpy.abs(knotsX).max(axis=1).reshape(-1, 1)
+    kScale[kScale == 0] = 1.0
+    x = k / kScale
+    xk = xk / kScale
+
+    # moments of the data within each range
+    maxPower = 2 * max(nc) - 1
+    powers = numpy.ones((maxPower, nSpectra, nPoints), numpy.float64)
+    for q in range(1, maxPower):
+        powers[q] = powers[q - 1] * x
+    weightedMu = numpy.where(goodi, mu, 0.0)
+    nCoefficients = sum(nc)
+    n = nCoefficients + 2 * (nr - 1)
+    a = numpy.zeros((nSpectra, n, n), numpy.float64)
+    b = numpy.zeros((nSpectra, n), numpy.float64)
+    start = [0]
+    for r in range(nr):
+        start.append(start[-1] + nc[r])
+        mask = goodi & (k >= xl[:, r:r+1]) & (k <= xh[:, r:r+1])
+        s = (powers[:2 * nc[r] - 1] * mask).sum(axis=2)
+        t = (powers[:nc[r]] * (mask * weightedMu)).sum(axis=2)
+        for p in range(nc[r]):
+            b[:, start[r] + p] = t[p]
+            for q in range(nc[r]):
+                a[:, start[r] + p, start[r] + q] = s[p + q]
+
+    # value and first derivative continuity at the knots
+    for ik in range(nr - 1):
+        value = nCoefficients + 2 * ik
+        derivative = value + 1
+        for side, r in [(-1.0, ik), (1.0, ik + 1)]:
+            for p in range(nc[r]):
+                i = start[r] + p
+                a[:, i, value] = side * pow(xk[:, ik], p)
+                if p > 0:
+                    a[:, i, derivative] = side * p * pow(xk[:, ik], p - 1)
+                a[:, value, i] = a[:, i, value]
+                a[:, derivative, i] = a[:, i, derivative]
+    try:
+        c = numpy.linalg.solve(a, b[:, :, None])[:, :, 0]
+    except numpy.linalg.LinAlgError:
+        # at least one of the systems is singular
+        c = numpy.zeros((nSpectra, n), numpy.float64)
+        for i in range(nSpectra):
+            c[i] = numpy.dot(numpy.linalg.pinv(a[i]), b[i])
+
+    def evaluate(r, kValues):
+        x = kValues / kScale
+        y = c[:, start[r] + nc[r] - 1].reshape(-1, 1) * numpy.ones(x.shape)
+        for p in range(nc[r] - 2, -1, -1):
+            y = y * x + c[:, start[r] + p].reshape(-1, 1)
+        return y
+
+    # change the limits to extrapolate the fit
+    xlEval = xl.copy()
+    xhEval = xh.copy()
+    xlEval[:, 0] = k.min(axis=1)
+    xhEval[:, -1] = k.max(axis=1)
+    fit = numpy.zeros(k.shape, numpy.float64)
+    for r in range(nr):
+        idx = (k > xlEval[:, r:r+1]) & (k <= xhEval[:, r:r+1])
+        fit = numpy.where(idx, evaluate(r, k), fit)
+    fit[:, 0] = evaluate(0, k[:, :1])[:, 0]
+
+    if full:
+        xNodes = numpy.zeros((nSpectra, nr - 1), dtype=numpy.float32)
+        yNodes = numpy.zeros((nSpectra, nr - 1), dtype=numpy.float32)
+        for r in range(nr - 1):
+            xNodes[:, r] = xh[:, r]
+            yNodes[:, r] = evaluate(r, xh[:, r:r+1])[:, 0]
+        return fit, xNodes, yNodes
+    else:
+        return fit
+
 def getBackFT(fourier,npoint=4096,krange=[2.0,12.0],rstep=None,rmin=None,rmax=None):
     r"""
         fastbftr(fourier,npoint=4096,krange=[2.0,12.0],rstep=None,rmin=None,rmax=None)
@@ -1143,6 +1482,119 @@ def processSpectrum(self):
         return ddict
 
 
+    def processMultipleSpectra(self, energy, mu, units=None, backend=None):
+        """
+        Process a set of spectra sharing the same energy axis.
+
+        :param energy: 1D array with the energies common to all the spectra
+        :param mu: 2D array with the spectra as [nspectra, nenergies]
+        :param units: "eV" or "keV". If not given, it is deduced from energy.
+        :return: A dictionnary with the same keys as the one of processSpectrum
+
+        The results are equivalent to those obtained calling setSpectrum and
+        processSpectrum on each spectrum, but all the spectra are treated
+        with array operations. The energy and the FT radius are common to all
+        the spectra, the rest of the values have the number of spectra as
+        first dimension.
+        """
+        if backend not in [None, "Default", "DefaultBackend"]:
+            raise ValueError("Only default backend implemented")
+        else:
+            backend = "DefaultBackend"
+        energy0 = numpy.array(energy, dtype=numpy.float64, copy=True)
+        energy0.shape = -1
+        mu0 = numpy.array(mu, dtype=numpy.float64, copy=False)
+        mu0 = mu0.reshape(-1, energy0.size)
+
+        # same sanitizing as setSpectrum
+        idx = energy0.argsort(kind='mergesort')
+        energy = numpy.take(energy0, idx)
+        mu = numpy.take(mu0, idx, axis=1)
+        delta = energy[1:] - energy[:-1]
+        dmin = delta.min()
+        dmax = delta.max()
+        if dmin <= 1.0e-10:
+            idx = numpy.nonzero(delta>0)[0]
+            energy = numpy.take(energy, idx)
+            mu = numpy.take(mu, idx, axis=1)
+        equidistant = (dmin == dmax)
+        if units is None:
+            if (energy[-1] - energy[0]) < 10:
+                units = "keV"
+            else:
+                units = "eV"
+        if units.lower() not in ["kev", "ev"]:
+            raise ValueError("Unhandled units %s" % units)
+        elif units.lower() == "kev":
+            energy *= 1000.
+
+        config = self._configuration[backend]
+        e0 = self._calculateMultipleE0(energy, mu, equidistant,
+                                       config["Normalization"])
+        ddict = self._normalizeMultiple(energy, mu, e0,
+                                        config["Normalization"])
+        ddict["Energy"] = energy
+        ddict["Mu"] = mu
+        cleanMu = mu - ddict["NormalizedBackground"]
+        kValues = e2k(energy[None, :] - e0[:, None])
+
+        # post-edge
+        exafsConfig = config["EXAFS"]
+        kMin = exafsConfig["KMin"]
+        kMax = exafsConfig["KMax"]
+        kWeight = exafsConfig["KWeight"]
+        if kMin is None:
+            kMin = 2
+        if kMax is None:
+            kMax = kValues.max(axis=1)
+        else:
+            kMax = numpy.minimum(kValues.max(axis=1), kMax)
+        number = exafsConfig["Knots"].get("Number", 0)
+        orders = exafsConfig["Knots"]["Orders"]
+        if not hasattr(orders, "__len__"):
+            orders = [orders]
+        if number == 0:
+            knots = None
+        else:
+            knots = exafsConfig["Knots"]["Values"]
+            if not hasattr(knots, "__len__"):
+                knots = [knots]
+        background, xNodes, yNodes = postEdgeMultiple(kValues, cleanMu,
+                                                      kMin, kMax, orders,
+                                                      knots=knots, full=True)
+        ddict["PostEdgeK"] = kValues
+        ddict["PostEdgeB"] = background
+        ddict["KnotsX"] = xNodes
+        ddict["KnotsY"] = yNodes
+        ddict["KMin"] = kMin
+        ddict["KMax"] = kMax
+        ddict["KWeight"] = kWeight
+
+        # normalization
+        exafs = (cleanMu - background) / background
+        ddict["EXAFSEnergy"] = k2e(kValues)
+        ddict["EXAFSKValues"] = kValues
+        ddict["EXAFSSignal"] = cleanMu
+        if kWeight:
+            exafs *= pow(kValues, kWeight)
+        ddict["EXAFSNormalized"] = exafs
+
+        # FT
+        ftConfig = config["FT"]
+        kRange = ftConfig["WindowRange"]
+        if kRange in [None, "None"]:
+            kRange = [kMin, kMax]
+        else:
+            kRange = [numpy.maximum(kRange[0], kMin),
+                      numpy.minimum(kRange[1], kMax)]
+        ddict["FT"] = getFTMultiple(kValues, exafs, kRange[0], kRange[1],
+                            npoints=ftConfig["Points"],
+                            window=ftConfig.get("Window", "Gaussian"),
+                            apodization=ftConfig.get("WindowApodization", 0.02),
+                            rrange=ftConfig["Range"],
+                            kstep=ftConfig["KStep"])
+        return ddict
+
     def fourierTransform(self, k, mu, kMin=None, kMax=None, backend=None):
         if backend not in [None, "Default", "DefaultBackend"]:
             raise ValueError("Only default backend implemented")
@@ -1428,6 +1880,189 @@ def normalize(self, energy=None, mu=None, backend=None):
                 "NormalizedPlotMin": plotMin,
                 "NormalizedPlotMax":plotMax}
 
+    def _calculateMultipleE0(self, energy, mu, equidistant, config):
+        method = config["E0Method"]
+        methodLower = method.lower()
+        e0 = config["E0Value"]
+        nSpectra = mu.shape[0]
+        if methodLower.endswith("manual"):
+            if e0 is None:
+                raise ValueError("Edge energy not set")
+            return numpy.zeros((nSpectra,), numpy.float64) + e0
+        elif methodLower.endswith("no smooth"):
+            npoints = 0
+        elif methodLower.endswith("3pt sg"):
+            npoints = 3
+        elif methodLower.endswith("5pt sg"):
+            npoints = 5
+        elif methodLower.endswith("7pt sg"):
+            npoints = 7
+        elif methodLower.endswith("9pt sg"):
+            npoints = 9
+        else:
+            raise ValueError("Method <%s> not implemented" % method)
+        if equidistant:
+            # data do not need to be interpolated
+            eWork = energy
+        else:
+            # the interpolation is common to all the spectra
+            nWorkingPoints = 10 * energy.size
+            eWork = numpy.linspace(energy[1], energy[-2], nWorkingPoints)
+            j = numpy.searchsorted(energy, eWork, side="right") - 1
+            j = numpy.clip(j, 0, energy.size - 2)
+            # same arithmetic as numpy.interp in order to get the same
+            # derivative maximum as getE0SavitzkyGolay
+            deltaE = eWork - energy[j]
+            energyStep = energy[1:] - energy[:-1]
+        nWork = eWork.size
+        if npoints:
+            # Savitzky-Golay first derivative as in getE0SavitzkyGolay
+            coeff = SGModule.calc_coeff(npoints, 2, 1)
+            N = numpy.size(coeff - 1) // 2
+        edge = numpy.zeros((nSpectra,), numpy.float64)
+
+        # the interpolated spectra are handled by blocks small enough
+        # to stay in cache
+        blockSize = max(1, 32 * 1024 // nWork)
+        for start in range(0, nSpectra, blockSize):
+            end = min(start + blockSize, nSpectra)
+            if equidistant:
+                muWork = mu[start:end]
+            else:
+                slope = (mu[start:end, 1:] - mu[start:end, :-1]) / energyStep
+                muWork = numpy.take(slope, j, axis=1) * deltaE
+                muWork += numpy.take(mu[start:end], j, axis=1)
+            if not npoints:
+                idx = numpy.gradient(muWork, axis=1).argmax(axis=1)
+                edge[start:end] = eWork[idx]
+                continue
+            # the derivative has plateaus where the data are interpolated,
+            # the same convolution as getSavitzkyGolay is needed in order
+            # to break the ties of the maximum in the same way
+            yPrime = numpy.zeros(muWork.shape, numpy.float64)
+            for i in range(muWork.shape[0]):
+                yPrime[i, N:-N] = numpy.convolve(muWork[i], coeff,
+                                                 mode='valid')
+            iMax = numpy.argmax(yPrime, axis=1)
+
+            # center of mass around the maximum
+            w = npoints
+            inside = (iMax >= w) & (iMax + w < nWork)
+            for i in numpy.nonzero(~inside)[0]:
+                selection = yPrime[i, iMax[i]-w:iMax[i]+w+1]
+                edge[start + i] = \
+                        (selection * eWork[iMax[i]-w:iMax[i]+w+1]).sum() / \
+                        selection.sum()
+            if inside.any():
+                rows = numpy.nonzero(inside)[0]
+                window = iMax[rows][:, None] + numpy.arange(-w, w + 1)[None, :]
+                selection = yPrime[rows[:, None], window]
+                edge[start + rows] = (selection * eWork[window]).sum(axis=1) / \
+                                     selection.sum(axis=1)
+        return edge
+
+    def _normalizeMultiple(self, energy, mu, e0, config):
+        eMin = energy.min()
+        eMax = energy.max()
+        nSpectra = mu.shape[0]
+
+        # same model matrices as normalize
+        def basis(x, methodLower):
+            if methodLower == "victoreen":
+                columns = [pow(x, -3), pow(x, -4)]
+            elif methodLower == "modif. victoreen":
+                columns = [pow(x, -3), numpy.ones(x.shape)]
+            else:
+                degree = {"constant": 0,
+                          "linear": 1,
+                          "parabolic": 2,
+                          "cubic": 3}[methodLower]
+                columns = [pow(x, i) for i in range(degree + 1)]
+            return numpy.concatenate([column[..., None] \
+                                      for column in columns], axis=-1)
+
+        data = {}
+        edgeValues = {}
+        for key in ["PreEdge", "PostEdge"]:
+            regions = config [key] ["Regions"]
+            edgeMethod = config[key]["Method"]
+            if edgeMethod.lower() != "polynomial":
+                raise ValueError("Only normalization with polynomials implemented")
+            method = config[key]["Polynomial"]
+            methodLower = method.lower()
+            if methodLower not in ["constant", "linear", "parabolic", "cubic",
+                                   "victoreen", "modif. victoreen"]:
+                raise ValueError("Unhandled %s polynomial <%s> " % \
+                                 (key, config[key]["Polynomial"]))
+            if regions is None:
+                if key == "PreEdge":
+                    regions = [-1000., -40.]
+                else:
+                    regions = [20., 1000.]
+            # points of each region are counted as many times as in
+            # _getRegionsData
+            weights = numpy.zeros(mu.shape, numpy.float64)
+            if key == "PreEdge":
+                plotMin = numpy.zeros((nSpectra,), numpy.float64) + eMax
+                for i in range(0, len(regions), 2):
+                    vMin = e0 + regions[2 * i]
+                    vMax = e0 + regions[2 * i + 1]
+                    vMin[vMin < eMin] = eMin
+                    vMax = numpy.where(vMax < eMin, 0.5 * (eMin + e0), vMax)
+                    plotMin = numpy.minimum(plotMin, vMin)
+                    weights += (energy[None, :] >= vMin[:, None]) & \
+                               (energy[None, :] <= vMax[:, None])
+            else:
+                plotMax = numpy.zeros((nSpectra,), numpy.float64) + eMin
+                for i in range(0, len(regions), 2):
+                    vMin = e0 + regions[2 * i]
+                    vMax = e0 + regions[2 * i + 1]
+                    vMin = numpy.where(vMin > eMax, 0.5 * (e0 + eMax), vMin)
+                    vMax[vMax < eMin] = eMax
+                    plotMax = numpy.maximum(plotMax, vMax)
+                    weights += (energy[None, :] >= vMin[:, None]) & \
+                               (energy[None, :] <= vMax[:, None])
+            # stacked SVD with the singular value cutoff of linalg.lstsq
+            # in order to give the same parameters as normalize
+            modelMatrix = basis(energy, methodLower)
+            weights = numpy.sqrt(weights)
+            U, s, V = numpy.linalg.svd(weights[:, :, None] * modelMatrix,
+                                       full_matrices=False)
+            s[s < modelMatrix.shape[1] * numpy.finfo(numpy.float64).eps] = \
+                                                                    numpy.inf
+            parameters = (U * (weights * mu)[:, :, None]).sum(axis=1) / s
+            parameters = (V * parameters[:, :, None]).sum(axis=1)
+            data[key] = numpy.dot(parameters, modelMatrix.T)
+            edgeValues[key] = (basis(e0, methodLower) * parameters).sum(axis=1)
+        jump = edgeValues["PostEdge"] - edgeValues["PreEdge"]
+        jumpMethod = config.get("JumpNormalizationMethod", "Flattened")
+        normalizedSpectrum = (mu - data["PreEdge"]) / jump[:, None]
+        if jumpMethod in [0, "Constant", "constant"]:
+            jumpMethod = "Constant"
+        else:
+            if jumpMethod not in [1, "Flattened", "flattened",
+                                  "Flatten", "flatten"]:
+                print("WARNING: Undefined jump normalization method. Assume Flattened")
+            jumpMethod = "Flattened"
+            # first point not below the edge as numpy.argmin(energy < e0)
+            i = numpy.searchsorted(energy, e0, side="left")
+            i[i >= energy.size] = 0
+            flatten = numpy.arange(energy.size)[None, :] >= i[:, None]
+            normalizedSpectrum = numpy.where(flatten,
+                        normalizedSpectrum * jump[:, None] / \
+                        (data["PostEdge"] - data["PreEdge"]),
+                        normalizedSpectrum)
+
+        return {"Jump": jump,
+                "JumpNormalizationMethod":jumpMethod,
+                "Edge":e0,
+                "NormalizedEnergy": energy,
+                "NormalizedMu":normalizedSpectrum,
+                "NormalizedBackground": data["PreEdge"],
+                "NormalizedSignal":data["PostEdge"],
+                "NormalizedPlotMin": plotMin,
+                "NormalizedPlotMax":plotMax}
+
 if __name__ == "__main__":
     import os
     import sys
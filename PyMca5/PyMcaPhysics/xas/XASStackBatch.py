@@ -44,6 +44,61 @@
 
 DEBUG = 0
 
+# upper limit of the size of the HDF5 chunks and of the memory used to
+# buffer each output dataset
+CHUNK_SIZE = 4 * 1024 * 1024
+BUFFER_SIZE = 32 * 1024 * 1024
+
+def _getRowChunks(shape, itemsize, chunksize=None):
+    """
+    Chunk shape covering one image row of a [nrows, ncolumns, ...] dataset.
+    The number of columns is reduced if the row exceeds chunksize bytes.
+    """
+    if chunksize is None:
+        chunksize = CHUNK_SIZE
+    pixelSize = itemsize
+    for n in shape[2:]:
+        pixelSize *= n
+    nColumns = max(1, min(shape[1], int(chunksize // max(1, pixelSize))))
+    return tuple([1, nColumns] + list(shape[2:]))
+
+class _RowBuffer(object):
+    """
+    Accumulate complete image rows of a [nrows, ncolumns, ...] HDF5
+    dataset in memory and write them as a single hyperslab.
+
+    Rows have to be filled in increasing order. Pixels that are not set
+    are written as zeros.
+    """
+    def __init__(self, dataset, buffersize=None):
+        if buffersize is None:
+            buffersize = BUFFER_SIZE
+        self._dataset = dataset
+        shape = dataset.shape
+        rowSize = numpy.dtype(dataset.dtype).itemsize
+        for n in shape[1:]:
+            rowSize *= n
+        nRows = max(1, min(shape[0], int(buffersize // max(1, rowSize))))
+        self._buffer = numpy.zeros([nRows] + list(shape[1:]),
+                                   dtype=dataset.dtype)
+        self._first = 0
+        self._last = 0
+
+    def __setitem__(self, key, value):
+        i, j = key
+        if i >= self._first + self._buffer.shape[0]:
+            self.flush()
+            self._first = i
+        self._buffer[i - self._first, j] = value
+        self._last = max(self._last, i + 1)
+
+    def flush(self):
+        n = self._last - self._first
+        if n > 0:
+            self._dataset[self._first:self._last] = self._buffer[:n]
+            self._buffer[:n] = 0
+        self._first = self._last
+
 class XASStackBatch(object):
     def __init__(self, analyzer=None):
         if analyzer is None:
@@ -72,13 +127,15 @@ def processMultipleSpectra(self, x, y,
                                mask=None,
                                directory=None,
                                name=None,
-                               entry=None):
+                               entry=None,
+                               compression=None):
         """
         This method performs the actual work.
 
         :param x: 1D array containing the x axis (usually the channels) of the spectra.
         :param y: 3D array containing the spectra as [nrows, ncolumns, nchannels]
         :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights (slow)
+        :param compression: HDF5 compression filter of the output datasets (default None)
         :return: A dictionnary with the results as keys.
         """
 
@@ -192,65 +249,45 @@ def processMultipleSpectra(self, x, y,
 
         iXMin = 0
         iXMax = data.shape[-1] - 1
-        e0 = out.require_dataset(e0Path,
-                                 shape=data.shape[:-1],
-                                 dtype=numpy.float32,
-                                 chunks=None,
-                                 compression=None)
-        jump = out.require_dataset(jumpPath,
-                                   shape=data.shape[:-1],
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        shape = list(data.shape[:-1]) + [usedEnergy.size]
+        # the images are kept in memory and written at the end
+        e0 = numpy.zeros(data.shape[:-1], dtype=numpy.float32)
+        jump = numpy.zeros(data.shape[:-1], dtype=numpy.float32)
         spectrumX = out.require_dataset(spectrumXPath,
                                    shape=[usedEnergy.size],
                                    dtype=numpy.float32,
                                    chunks=None,
                                    compression=None)
-        spectrumY = out.require_dataset(spectrumYPath,
-                                   shape=shape,
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        shape = list(data.shape[:-1]) + [normalizedSpectrumX.size]
         normalizedX = out.require_dataset(normalizedXPath,
                                    shape=[normalizedSpectrumX.size],
                                    dtype=numpy.float32,
                                    chunks=None,
                                    compression=None)
-        normalizedY = out.require_dataset(normalizedYPath,
-                                   shape=shape,
-                                   dtype=numpy.float32,
-                                   chunks=None,
-                                   compression=None)
-        shape = list(data.shape[:-1]) + [exafsSpectrumX.size]
         exafsX = out.require_dataset(exafsXPath,
                                      shape=[exafsSpectrumX.size],
                                      dtype=numpy.float32,
                                      chunks=None,
                                      compression=None)
-        exafsY = out.require_dataset(exafsYPath,
-                                     shape=shape,
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
-        shape = list(data.shape[:-1]) + [xFT.size]
         ftX = out.require_dataset(ftXPath,
                                      shape=[xFT.size],
                                      dtype=numpy.float32,
                                      chunks=None,
                                      compression=None)
-        ftY = out.require_dataset(ftYPath,
-                                     shape=shape,
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
-        ftImaginary = out.require_dataset(ftImaginaryPath,
-                                     shape=shape,
-                                     dtype=numpy.float32,
-                                     chunks=None,
-                                     compression=None)
+        # the spectra are written by rows into chunked datasets
+        buffers = []
+        for path, size in [(spectrumYPath, usedEnergy.size),
+                           (normalizedYPath, normalizedSpectrumX.size),
+                           (exafsYPath, exafsSpectrumX.size),
+                           (ftYPath, xFT.size),
+                           (ftImaginaryPath, xFT.size)]:
+            shape = list(data.shape[:-1]) + [size]
+            dataset = out.require_dataset(path,
+                                shape=shape,
+                                dtype=numpy.float32,
+                                chunks=_getRowChunks(shape,
+                                    numpy.dtype(numpy.float32).itemsize),
+                                compression=compression)
+            buffers.append(_RowBuffer(dataset))
+        spectrumY, normalizedY, exafsY, ftY, ftImaginary = buffers
         spectrumX[:] = ddict["Energy"]
         normalizedX[:] = ddict["NormalizedEnergy"][normalizedIdx]
         exafsX[:] = ddict["EXAFSKValues"][exafsIdx]
@@ -258,56 +295,40 @@ def processMultipleSpectra(self, x, y,
 
         t0 = time.time()
         totalSpectra = data.shape[0] * data.shape[1]
-        jStep = min(100, data.shape[1])
-        if weightPolicy == 2:
-            SVD = False
-            sigma_b = None
-        elif weightPolicy == 1:
-            # the +1 is to prevent misbehavior due to weights less than 1.0
-            sigma_b = 1 + numpy.sqrt(dummySpectrum)/nPixels
-            SVD = True
-        else:
-            SVD = True
-            sigma_b = None
-        last_svd = None
-        #for i in range(10):
+        # the spectra of each block are processed at once
+        jStep = min(500, data.shape[1])
         for i in range(0, data.shape[0]):
-            #print(i)
-            #chunks of nColumns spectra
-            if i == 0:
-                chunk = numpy.zeros((jStep,
-                                     iXMax-iXMin+1),
-                                     numpy.float)
             jStart = 0
-            j = 0
             while jStart < data.shape[1]:
                 jEnd = min(jStart + jStep, data.shape[1])
-                #chunk[:,:(jEnd - jStart)] = data[i, jStart:jEnd, iXMin:iXMax+1].T
                 spectra  = data[i, jStart:jEnd, iXMin:iXMax+1]
-                nSpectra = spectra.shape[0]
-                for spectrumNumber in range(nSpectra):
-                    if mask is not None:
-                        if mask[i, j] == 0:
-                            continue
-                    self._analyzer.setSpectrum(x, spectra[spectrumNumber])
-                    ddict = self._analyzer.processSpectrum()
-                    spectrumY[i, j] = ddict["Mu"]
-                    e0[i, j] = ddict["Edge"]
-                    jump[i, j] = ddict["Jump"]
-                    #normalizedX[i, j] = ddict["NormalizedEnergy"][normalizedIdx]
-                    normalizedY[i, j] = ddict["NormalizedMu"][normalizedIdx]
-                    #exafsX[i, j] = ddict["EXAFSKValues"][exafsIdx]
-                    exafsY[i, j] = ddict["EXAFSNormalized"][exafsIdx]
-                    #ftX[i, j] = ddict["FT"]["FTRadius"]
-                    ftY[i, j] = ddict["FT"]["FTIntensity"]
-                    ftImaginary[i, j] = ddict["FT"]["FTImaginary"]
-                    j +=1
+                columns = numpy.arange(jStart, jEnd)
+                if mask is not None:
+                    good = mask[i, jStart:jEnd] != 0
+                    if not good.all():
+                        spectra = spectra[good]
+                        columns = columns[good]
+                if not columns.size:
+                    jStart = jEnd
+                    continue
+                ddict = self._analyzer.processMultipleSpectra(x, spectra)
+                spectrumY[i, columns] = ddict["Mu"]
+                e0[i, columns] = ddict["Edge"]
+                jump[i, columns] = ddict["Jump"]
+                normalizedY[i, columns] = ddict["NormalizedMu"][:, normalizedIdx]
+                exafsY[i, columns] = ddict["EXAFSNormalized"][:, exafsIdx]
+                ftY[i, columns] = ddict["FT"]["FTIntensity"]
+                ftImaginary[i, columns] = ddict["FT"]["FTImaginary"]
                 jStart = jEnd
+        for buffer_ in buffers:
+            buffer_.flush()
+        out[e0Path] = e0
+        out[jumpPath] = jump
         outputDict = {}
         outputDict["names"] = ["Jump", "Edge"]
         output = numpy.zeros((2, e0.shape[0], e0.shape[1]), dtype = e0.dtype)
-        output[0, :] = jump.value
-        output[1, :] = e0.value
+        output[0, :] = jump
+        output[1, :] = e0
         outputDict["images"] = output
         out.flush()
         out.close()
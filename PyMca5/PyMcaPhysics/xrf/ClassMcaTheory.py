@@ -34,6 +34,12 @@
 import sys
 import numpy
 import copy
+import hashlib
+import weakref
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from .Strategies import STRATEGIES
 from . import ConcentrationsTool
 FISX = ConcentrationsTool.FISX
@@ -43,14 +49,145 @@
 from PyMca5.PyMcaMath.fitting import SpecfitFuns
 from PyMca5.PyMcaIO import ConfigDict
 from PyMca5.PyMcaMath.fitting import Gefit
+import PyMca5
 from PyMca5 import PyMcaDataDir
 DEBUG = 0
 #"python ClassMcaTheory.py -s1.1 --file=03novs060sum.mca --pkm=McaTheory.dat --continuum=0 --strip=1 --sumflag=1 --maxiter=4"
 CONTINUUM_LIST = [None,'Constant','Linear','Parabolic','Linear Polynomial','Exp. Polynomial']
 OLDESCAPE = 0
+# Windowed evaluation: half width of the peak support in sigma units (the
+# tabulated hypermet already neglects the gaussian beyond that distance)
+# and low energy extent of the tails in slope units
+PEAK_WINDOW = 14.2
+TAIL_WINDOW = 36.0
 MAX_ATTENUATION = 1.0E-300
+# Maximum number of configured states kept in memory
+CONFIGURATION_CACHE_SIZE = 10
+_CONFIGURATION_CACHE = {}
+_CONFIGURATION_CACHE_KEYS = []
+_CONFIGURATION_CACHE_DIR = None
+# To be increased when the cached state changes
+_CONFIGURATION_CACHE_VERSION = 1
+
+class DigestedResult(dict):
+    """
+    Dictionary returned by McaTheory.digestresult.
+
+    The values of some keys are only calculated the first time they are
+    accessed. All the keys are always present and the object behaves as
+    any other dictionary. Copies and pickles are ordinary dictionaries.
+    """
+    def __init__(self, *var, **kw):
+        dict.__init__(self, *var, **kw)
+        self._pending = {}
+
+    def setLazy(self, keys, loader):
+        """
+        Add the given keys. Their values are taken from the dictionary
+        returned by loader(), only called on first access to one of them.
+        """
+        for key in keys:
+            dict.__setitem__(self, key, None)
+            self._pending[key] = loader
+
+    def isLazy(self, key):
+        return key in self._pending
+
+    def evaluate(self):
+        """
+        Calculate all the values not calculated yet.
+        """
+        for key in list(self._pending.keys()):
+            self.__load(key)
+        for value in dict.values(self):
+            if isinstance(value, DigestedResult):
+                value.evaluate()
+
+    def __load(self, key):
+        loader = self._pending.get(key, None)
+        if loader is None:
+            return
+        values = loader()
+        for k in list(self._pending.keys()):
+            if self._pending[k] is loader:
+                del self._pending[k]
+                dict.__setitem__(self, k, values[k])
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            self.__load(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._pending.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def __iter__(self):
+        # prevents dict(self) and {}.update(self) from reading the storage
+        return dict.__iter__(self)
+
+    def __eq__(self, other):
+        self.evaluate()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        self.evaluate()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def copy(self):
+        return dict(self.items())
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key = list(self.keys())[-1]
+        return key, self.pop(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *var, **kw):
+        for key, value in dict(*var, **kw).items():
+            self[key] = value
+
+    def clear(self):
+        self._pending.clear()
+        dict.clear(self)
+
 class McaTheory(object):
     def __init__(self, initdict=None, filelist=None, **kw):
+        # digested results with values still to be calculated
+        self.__digestedResults = []
         self.ydata0  = None
         self.xdata0  = None
         self.sigmay0 = None
@@ -103,6 +240,7 @@ def __init__(self, initdict=None, filelist=None, **kw):
         self.laststripanchorsflag = None
         self.laststripanchorslist = None
         self.disableOptimizedLinearFit()
+        self.disableWindowedEvaluation()
         self.__configure()
         self.startFit = self.startfit
         #incompatible with multiple energies
@@ -115,6 +253,18 @@ def disableOptimizedLinearFit(self):
         self._batchFlag = False
         self.linearMatrix = None
 
+    def enableWindowedEvaluation(self):
+        """
+        Evaluate each group of peaks only on the region of the spectrum
+        where it gives a non negligible contribution.
+        """
+        self._windowedFlag = True
+        self.linearMatrix = None
+
+    def disableWindowedEvaluation(self):
+        self._windowedFlag = False
+        self.linearMatrix = None
+
     def setConfiguration(self, ddict):
         """
         The current fit configuration dictionary is updated, but not replaced,
@@ -156,6 +306,8 @@ def _updateCallback(self):
         #self.__configure()
 
     def __configure(self):
+        # results not fully evaluated yet depend on the old configuration
+        self.__evaluateDigestedResults()
         self.linearMatrix = None
         #multilayer key
         self.config['multilayer'] = self.config.get('multilayer',{})
@@ -165,6 +317,87 @@ def __configure(self):
             Elements.Material[material] = copy.deepcopy(self.config['materials'][material])
         #that was it
 
+        #the peak tables only depend on the configuration
+        state = None
+        key = None
+        if CONFIGURATION_CACHE_SIZE > 0:
+            key = getConfigurationHash(self.config, self.attflag)
+            state = _getCachedConfiguration(key)
+        if state is None:
+            maxenergy = self.__buildConfiguration()
+            if key is not None:
+                _setCachedConfiguration(key,
+                                        self.__getConfiguredState(maxenergy))
+        else:
+            if DEBUG:
+                print("Using cached configuration %s" % key)
+            self.__setConfiguredState(state)
+        self.__buildEscapeIndex()
+        self.FASTER     = 1
+        self.ESCAPE     = self.config['fit']['escapeflag']
+        self.__SUM        = self.config['fit']['sumflag']
+        self.__CONTINUUM     = self.config['fit']['continuum']
+        self.MAXITER    = self.config['fit']['maxiter']
+        self.STRIP      = self.config['fit']['stripflag']
+        #if self.laststrip is not None:
+        self.__mycounter = 0
+        calculateStrip = False
+        if (self.STRIP != self.laststrip) or \
+           (self.config['fit']['stripalgorithm'] != self.laststripalgorithm) or \
+           (self.config['fit']['stripfilterwidth'] != self.laststripfilterwidth) or \
+           (self.config['fit']['stripanchorsflag'] != self.laststripanchorsflag) or \
+           (self.config['fit']['stripanchorslist'] != self.laststripanchorslist):
+            calculateStrip = True
+        if not calculateStrip:
+            if self.config['fit']['stripalgorithm'] == 1:
+                #checking if needed to calculate SNIP
+                if (self.config['fit']['snipwidth'] != self.lastsnipwidth):
+                    calculateStrip = True
+            else:
+                #checking if needed to calculate strip
+                if (self.config['fit']['stripiterations'] != self.laststripiterations) or \
+                   (self.config['fit']['stripwidth'] != self.laststripwidth) or \
+                   (self.config['fit']['stripconstant'] != self.laststripconstant):
+                    calculateStrip = True
+        if (self.lastxmin != self.config['fit']['xmin']) or\
+           (self.lastxmax != self.config['fit']['xmax']):
+            if self.ydata0 is not None:
+                if DEBUG:
+                    print("Limits changed")
+                self.setData(x=self.xdata0,
+                             y=self.ydata0,
+                             sigmay=self.sigmay0,
+                             xmin = self.config['fit']['xmin'],
+                             xmax = self.config['fit']['xmax'],
+                             time = self.__lastTime)
+                return
+
+        if hasattr(self, "xdata"):
+            if self.STRIP:
+                if calculateStrip:
+                    if DEBUG:
+                        print("Calling to calculate non analytical background in config")
+                    self.__getselfzz()
+                else:
+                    if DEBUG:
+                        print("Using previous non analytical background in config")
+                self.datatofit = numpy.concatenate((self.xdata,
+                                self.ydata-self.zz, self.sigmay),1)
+                self.laststrip = 1
+            else:
+                if DEBUG:
+                    print("Using previous data")
+                self.datatofit = numpy.concatenate((self.xdata,
+                                self.ydata, self.sigmay),1)
+                self.laststrip = 0
+
+    def __buildConfiguration(self):
+        """
+        Calculate the fluorescence rates, escape peaks and peak tables
+        of the current configuration. It returns the maximum excitation
+        energy.
+        """
+
         #default peak shape parameters for pseudo-voigt function
         self.config['peakshape']['eta_factor'] = self.config['peakshape'].get('eta_factor', 0.02)
         self.config['peakshape']['fixedeta_factor'] = self.config['peakshape'].get('fixedeta_factor',
@@ -886,66 +1119,151 @@ def __configure(self):
         #    print self.PEAKS0ESCAPE[i]
         self.PEAKS0NAMES= PEAKS0NAMES
         self.PEAKSW     = PEAKSW
-        self.FASTER     = 1
         self.__HYPERMET   = HYPERMET
         self.NGLOBAL    = NGLOBAL
         self.PARAMETERS = PARAMETERS
-        self.ESCAPE     = self.config['fit']['escapeflag']
-        self.__SUM        = self.config['fit']['sumflag']
-        self.__CONTINUUM     = CONTINUUM
-        self.MAXITER    = self.config['fit']['maxiter']
-        self.STRIP      = self.config['fit']['stripflag']
-        #if self.laststrip is not None:
-        self.__mycounter = 0
-        calculateStrip = False
-        if (self.STRIP != self.laststrip) or \
-           (self.config['fit']['stripalgorithm'] != self.laststripalgorithm) or \
-           (self.config['fit']['stripfilterwidth'] != self.laststripfilterwidth) or \
-           (self.config['fit']['stripanchorsflag'] != self.laststripanchorsflag) or \
-           (self.config['fit']['stripanchorslist'] != self.laststripanchorslist):
-            calculateStrip = True
-        if not calculateStrip:
-            if self.config['fit']['stripalgorithm'] == 1:
-                #checking if needed to calculate SNIP
-                if (self.config['fit']['snipwidth'] != self.lastsnipwidth):
-                    calculateStrip = True
-            else:
-                #checking if needed to calculate strip
-                if (self.config['fit']['stripiterations'] != self.laststripiterations) or \
-                   (self.config['fit']['stripwidth'] != self.laststripwidth) or \
-                   (self.config['fit']['stripconstant'] != self.laststripconstant):
-                    calculateStrip = True
-        if (self.lastxmin != self.config['fit']['xmin']) or\
-           (self.lastxmax != self.config['fit']['xmax']):
-            if self.ydata0 is not None:
-                if DEBUG:
-                    print("Limits changed")
-                self.setData(x=self.xdata0,
-                             y=self.ydata0,
-                             sigmay=self.sigmay0,
-                             xmin = self.config['fit']['xmin'],
-                             xmax = self.config['fit']['xmax'],
-                             time = self.__lastTime)
-                return
+        return maxenergy
+
+    def __getConfiguredState(self, maxenergy):
+        state = {}
+        state['config'] = self.config
+        state['maxenergy'] = maxenergy
+        state['fluoRates'] = self._fluoRates
+        state['PEAKS0'] = self.PEAKS0
+        state['PEAKS0ESCAPE'] = self.PEAKS0ESCAPE
+        state['PEAKS0NAMES'] = self.PEAKS0NAMES
+        state['PEAKSW'] = self.PEAKSW
+        state['HYPERMET'] = self.__HYPERMET
+        state['NGLOBAL'] = self.NGLOBAL
+        state['PARAMETERS'] = self.PARAMETERS
+        # the instance keeps modifying some of them (PEAKSW is a work buffer)
+        return copy.deepcopy(state)
+
+    def __setConfiguredState(self, state):
+        state = copy.deepcopy(state)
+        self.config.clear()
+        dict.update(self.config, state['config'])
+        # keep the side effects of a full configuration on Elements
+        maxenergy = state['maxenergy']
+        for element in self.config['peaks'].keys():
+            ele = element[0:1].upper()+element[1:2].lower()
+            if maxenergy != Elements.Element[ele]['buildparameters']['energy']:
+                Elements.updateDict(energy=maxenergy)
+        self._fluoRates = state['fluoRates']
+        self.PEAKS0     = state['PEAKS0']
+        self.PEAKS0ESCAPE = state['PEAKS0ESCAPE']
+        self.PEAKS0NAMES= state['PEAKS0NAMES']
+        self.PEAKSW     = state['PEAKSW']
+        self.__HYPERMET   = state['HYPERMET']
+        self.NGLOBAL    = state['NGLOBAL']
+        self.PARAMETERS = state['PARAMETERS']
+
+    def __buildEscapeIndex(self):
+        # For each group keep the index of the parent line, the rate and the
+        # energy of every escape line in the order used by the PEAKSW buffers
+        self._escapeIndex = []
+        for escapeGroups in self.PEAKS0ESCAPE:
+            index = []
+            rate = []
+            energy = []
+            for ii, esc_group in enumerate(escapeGroups):
+                for esc_line in esc_group:
+                    index.append(ii)
+                    energy.append(esc_line[0] * 1.0)
+                    rate.append(esc_line[1])
+            self._escapeIndex.append((numpy.array(index, numpy.int32),
+                                      numpy.array(rate, numpy.float64),
+                                      numpy.array(energy, numpy.float64)))
+
+    def __fillEscapeRows(self, buffer, i, r, noise, fano):
+        """
+        Fill the escape rows of the peak buffer of group i from its first r
+        (fluorescence) rows.
+        """
+        index, rate, energy = self._escapeIndex[i]
+        buffer[r:, 0] = buffer[index, 0] * rate
+        buffer[r:, 1] = energy
+        buffer[r:, 2] = numpy.sqrt(noise + (energy > 0) * energy * fano)
 
-        if hasattr(self, "xdata"):
-            if self.STRIP:
-                if calculateStrip:
-                    if DEBUG:
-                        print("Calling to calculate non analytical background in config")
-                    self.__getselfzz()
+    def _getPeakWindows(self, peaks, energy, hypermet):
+        """
+        Split the given peaks in clusters of nearby peaks and return a list
+        of (rows, start, stop) with the rows of each cluster and the
+        first and last + 1 indices of the (increasing) energy array outside
+        of which the cluster has a negligible contribution.
+        rows is None when all the peaks have to be evaluated together.
+        """
+        npoints = energy.shape[0]
+        if not npoints:
+            return []
+        energy = numpy.ravel(energy)
+        if (energy.size != npoints) or numpy.any(energy[1:] < energy[:-1]):
+            return [(None, 0, npoints)]
+        if not hypermet:
+            # the lorentzian term of the pseudo-Voigt is not local
+            if numpy.any(peaks[:, 3] != 0.0):
+                return [(None, 0, npoints)]
+        position = peaks[:, 1]
+        width = PEAK_WINDOW * peaks[:, 2] / 2.3548
+        low = position - width
+        high = position + width
+        if hypermet:
+            if ((hypermet >> 3) & 1) and numpy.any(peaks[:, 7] != 0.0):
+                # the step extends down to the lowest energy
+                low[:] = energy[0]
+            else:
+                for flag, area, slope in [(2, 3, 4), (4, 5, 6)]:
+                    if not (hypermet & flag):
+                        continue
+                    tails = (peaks[:, area] != 0.0) & (peaks[:, slope] != 0.0)
+                    low[tails] = numpy.minimum(low[tails],
+                        position[tails] - TAIL_WINDOW * abs(peaks[tails, slope]))
+        start = numpy.searchsorted(energy, low, side="left")
+        stop = numpy.searchsorted(energy, high, side="right")
+        # peaks outside the energy range are ignored
+        rows = numpy.nonzero(stop > start)[0]
+        if not len(rows):
+            return []
+        rows = rows[numpy.argsort(start[rows], kind="mergesort")]
+        start = start[rows]
+        stop = stop[rows]
+        # group the peaks starting within the typical window width of each
+        # other, larger clusters waste evaluations, smaller ones add calls
+        start_bin = start // max(int(numpy.median(stop - start)), 1)
+        first = numpy.append(0, numpy.nonzero(numpy.diff(start_bin))[0] + 1)
+        last = numpy.append(first[1:], len(rows))
+        stop = numpy.maximum.reduceat(stop, first)
+        if (len(first) == 1) and (len(rows) == peaks.shape[0]):
+            return [(None, int(start[0]), int(stop[0]))]
+        return [(rows[i0:i1], int(start[i0]), int(stop[k])) \
+                for k, (i0, i1) in enumerate(zip(first, last))]
+
+    def _addPeakContribution(self, output, peaks, energy, hypermet,
+                             faster=True):
+        """
+        Add to output the contribution of the given peaks evaluated at energy.
+        In windowed mode only the support of the peaks is calculated.
+        """
+        if self._windowedFlag:
+            windows = self._getPeakWindows(peaks, energy, hypermet)
+        else:
+            windows = [(None, 0, energy.shape[0])]
+        for rows, start, stop in windows:
+            if rows is None:
+                cluster = peaks
+            else:
+                cluster = peaks[rows]
+            if hypermet:
+                if faster:
+                    output[start:stop] += SpecfitFuns.fastahypermet(cluster,
+                                                  energy[start:stop], hypermet)
                 else:
-                    if DEBUG:
-                        print("Using previous non analytical background in config")
-                self.datatofit = numpy.concatenate((self.xdata,
-                                self.ydata-self.zz, self.sigmay),1)
-                self.laststrip = 1
+                    output[start:stop] += SpecfitFuns.ahypermet(cluster,
+                                                  energy[start:stop], hypermet)
             else:
-                if DEBUG:
-                    print("Using previous data")
-                self.datatofit = numpy.concatenate((self.xdata,
-                                self.ydata, self.sigmay),1)
-                self.laststrip = 0
+                output[start:stop] += SpecfitFuns.apvoigt(cluster,
+                                                          energy[start:stop])
+        return output
 
     def setdata(self, *var, **kw):
         print("ClassMcaTheory.setdata deprecated, please use setData")
@@ -1235,14 +1553,10 @@ def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
         fano = param[3] * 2.3548*2.3548*0.00385
         #t=time.time()
         PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
         PEAKSW = self.PEAKSW
         PARAMETERS = self.PARAMETERS
-        FASTER = 0
         for i in range(len(param[self.NGLOBAL:])):
-            result = 0 * energy
             if self.ESCAPE:
-                #area = param[NGLOBAL+i]
                 (r,c) = (PEAKS0[i]).shape
                 PEAKSW[i][0:r,0] = PEAKS0[i][:,0] * 1 * gain
                 PEAKSW[i][0:r,1] = PEAKS0[i][:,1] * 1.0
@@ -1254,32 +1568,7 @@ def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
                     PEAKSW[i][r:,2] = numpy.sqrt(noise + \
                                         (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
                 else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                (rw,cw) = (PEAKSW[i]).shape
-                if 0 and self.PARAMETERS[self.NGLOBAL+i] =='Fe K':
-                  for ii in range(rw):
-                    if ii < r:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAK ",ii,PEAKSW[i][ii])
-                    else:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAKesc ",ii,PEAKSW[i][ii])
-                #print PARAMETERS[self.NGLOBAL+i]
-                #print PEAKSW[i][:,1]
-                #print PEAKS0ESCAPE[i]
-                #for j in range(PEAKSW[i].shape[0]):
-                #    print "H = ", PEAKSW[i][j*r,0],"E = ",PEAKSW[i][j*r,1]
-
-                #if HYPERMET:
+                    self.__fillEscapeRows(PEAKSW[i], i, r, noise, fano)
                 if hypermet:
                     PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
                     PEAKSW[i] [:,4] = param[PARAMETERS.index('ST SlopeR')]
@@ -1290,20 +1579,10 @@ def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
                     PEAKSW[i] [r:,3] = 0.0
                     PEAKSW[i] [r:,5] = 0.0
                     PEAKSW[i] [r:,7] = 0.0
-                if not FASTER:
-                    #if HYPERMET:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
+                else:
+                    PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
             else:
-                PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
+                PEAKSW[i][:,0] = PEAKS0[i][:,0] * 1 * gain
                 PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
                 PEAKSW[i][:,2] = numpy.sqrt(noise + PEAKS0[i][:,1] * fano)
                 if hypermet:
@@ -1315,20 +1594,12 @@ def getPeakMatrixContribution(self,param0,t0=None,hypermet=None,
                 else:
                     #pseudo voigt
                     PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-            #print "shape = ",result.shape
-            #print "matrix = ",matrix.shape
-            matrix[:,i] = result[:,0]
+            # in windowed mode only the band where the group contributes
+            # is evaluated, the rest of the column is left to zero
+            result = numpy.zeros(energy.shape, numpy.float)
+            self._addPeakContribution(result, PEAKSW[i], energy, hypermet,
+                                      faster=False)
+            matrix[:,i] = numpy.ravel(result)
         return matrix
 
     def linearMcaTheory(self, param0, t0, hypermet=None, continuum=None, summing=None):
@@ -1372,7 +1643,6 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
         fano = param[3] * 2.3548*2.3548*0.00385
         #t=time.time()
         PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
         PEAKSW = self.PEAKSW
         PARAMETERS = self.PARAMETERS
         FASTER = self.FASTER
@@ -1390,31 +1660,7 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
                     PEAKSW[i][r:,2] = numpy.sqrt(noise + \
                                         (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
                 else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
-                (rw,cw) = (PEAKSW[i]).shape
-                if 0 and self.PARAMETERS[self.NGLOBAL+i] =='Fe K':
-                  for ii in range(rw):
-                    if ii < r:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAK ",ii,PEAKSW[i][ii])
-                    else:
-                        print(self.PARAMETERS[self.NGLOBAL+i],"PEAKesc ",ii,PEAKSW[i][ii])
-                #print PARAMETERS[self.NGLOBAL+i]
-                #print PEAKSW[i][:,1]
-                #print PEAKS0ESCAPE[i]
-                #for j in range(PEAKSW[i].shape[0]):
-                #    print "H = ", PEAKSW[i][j*r,0],"E = ",PEAKSW[i][j*r,1]
-
+                    self.__fillEscapeRows(PEAKSW[i], i, r, noise, fano)
                 #if HYPERMET:
                 if hypermet:
                     PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
@@ -1428,19 +1674,6 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
                     PEAKSW[i] [r:,7] = 0.0
                 else:
                     PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    print("not FASTER")
-                    #if HYPERMET:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
             else:
                 PEAKSW[i][:,0] = PEAKS0[i][:,0] * param[self.NGLOBAL+i] * gain
                 PEAKSW[i][:,1] = PEAKS0[i][:,1] * 1.0
@@ -1453,35 +1686,29 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
                     PEAKSW[i] [:,7] = param[PARAMETERS.index('STEP HeightR')]
                 else:
                     PEAKSW[i] [:,3] = param[PARAMETERS.index('Eta Factor')]
-                if not FASTER:
-                    if hypermet:
-                        if i == 0:
-                            result = SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                        else:
-                            result += SpecfitFuns.ahypermet(PEAKSW[i],energy,hypermet)
-                    else:
-                        if i == 0:
-                            result = SpecfitFuns.apvoigt(PEAKSW[i],energy)
-                        else:
-                            result += SpecfitFuns.apvoigt(PEAKSW[i],energy)
-        #print PARAMETERS[self.NGLOBAL+4]
-        #print self.PEAKS0NAMES[4]
-        #print PEAKSW[4]
-        #print "loop takes ",time.time()-t
         #loop takes 0.006 seconds
         #t=time.time()
-        if FASTER:
-            if len(PEAKSW[:]):
-                a=numpy.concatenate(PEAKSW[:])
-                #t=time.time()
-                #result = SpecfitFuns.agauss(a,energy)
-                #if HYPERMET:
-                if hypermet:
-                    result = SpecfitFuns.fastahypermet(a,energy,hypermet)
-                else:
-                    result = SpecfitFuns.apvoigt(a,energy)
+        if not FASTER:
+            result = numpy.zeros(energy.shape, numpy.float)
+            for i in range(len(PEAKSW)):
+                self._addPeakContribution(result, PEAKSW[i], energy,
+                                          hypermet, faster=FASTER)
+        elif len(PEAKSW[:]) and self._windowedFlag:
+            # peaks are evaluated in clusters restricted to their support
+            result = numpy.zeros(energy.shape, numpy.float)
+            self._addPeakContribution(result, numpy.concatenate(PEAKSW[:]),
+                                      energy, hypermet)
+        elif len(PEAKSW[:]):
+            a=numpy.concatenate(PEAKSW[:])
+            #t=time.time()
+            #result = SpecfitFuns.agauss(a,energy)
+            #if HYPERMET:
+            if hypermet:
+                result = SpecfitFuns.fastahypermet(a,energy,hypermet)
             else:
-                result = 0.0 * x
+                result = SpecfitFuns.apvoigt(a,energy)
+        else:
+            result = 0.0 * x
             #print "eval = ",time.time()-t
         #evaluation takes 0.058 seconds
         #with less peaks 0.036
@@ -1489,15 +1716,6 @@ def mcatheory(self,param0,t0,hypermet=None,continuum=None,summing=None):
         if continuum:
             result += self.continuum(param,x)
         if summing:
-          if 0:
-            pileup = numpy.arange(3*len(x))*0.0
-            sumfactor = param[4]
-            xmin=int(x[0])
-            offset = zero / gain
-            for i in range(len(result)):
-                pileup[i+xmin-offset:i+len(result)+xmin-i-offset] += sumfactor * result[i] *result[0:len(result)-i]
-            return result+pileup[0:len(result)]
-          else:
             #summing takes 0.0047 seconds
             xmin=int(x[0])
             return result+param[4]*SpecfitFuns.pileup(result, xmin, zero, gain)
@@ -1626,17 +1844,7 @@ def analyticalDerivative(self, param0, index, t0):
                 dummy[0:r,0] = PEAKS0[i][:,0] * gain
                 dummy[0:r,1] = PEAKS0[i][:,1] * 1.0
                 dummy[0:r,2] = numpy.sqrt(noise+ PEAKS0[i][:,1] * fano)
-                ii=0
-                j=0
-                for esc_group in self.PEAKS0ESCAPE[i]:
-                    for esc_line in esc_group:
-                        esc_ene  = esc_line[0] * 1.0
-                        esc_rate = esc_line[1]
-                        dummy[j+r, 0] =  dummy[ii,0] * esc_rate
-                        dummy[j+r, 1] =  esc_ene
-                        j = j + 1
-                    ii = ii + 1
-                dummy[r:, 2] = numpy.sqrt(noise + (dummy[r:,1]>0) * dummy[r:,1] * fano)
+                self.__fillEscapeRows(dummy, i, r, noise, fano)
                 #for jj in range(r+n_escape_lines):
                 #    print index, dummy[jj, 1], dummy[jj, 0], dummy[jj, 2]
          else:
@@ -1659,16 +1867,10 @@ def analyticalDerivative(self, param0, index, t0):
                 dummy[r:,7]  = 0.0
          else:
                 dummy[0:,3] = param[PARAMETERS.index('Eta Factor')]
-         if self.FASTER:
-            if HYPERMET:
-                return SpecfitFuns.fastahypermet(dummy,energy,HYPERMET)
-            else:
-                return SpecfitFuns.apvoigt(dummy,energy)
-         else:
-            if HYPERMET:
-                return SpecfitFuns.ahypermet(dummy,energy,HYPERMET)
-            else:
-                return SpecfitFuns.apvoigt(dummy,energy)
+         return self._addPeakContribution(numpy.zeros(energy.shape,
+                                                      numpy.float),
+                                          dummy, energy, HYPERMET,
+                                          faster=self.FASTER)
 
         elif HYPERMET and  (PARAMETERS[index] == 'ST AreaR'):
           param=numpy.array(param0)
@@ -1956,20 +2158,10 @@ def specfitestimate(self,x,y,z,xscaling=1.0,yscaling=1.0):
                 #print "n escape lines = ",self.PEAKSW[i].shape[0] - len(rates)
                 #get the number of escape lines to get a proper buffer
                 n_escape_lines = self.PEAKSW[i].shape[0] - len(rates)
-                peak_buffer    = numpy.zeros((n_escape_lines, 3)).astype(numpy.float)
-                ii=0
-                jj=0
-                for esc_group in self.PEAKS0ESCAPE[i]:
-                    for esc_line in esc_group:
-                        esc_ene  = esc_line[0] * 1.0
-                        esc_rate = esc_line[1]
-                        peak_buffer[jj,0] =  self.PEAKS0[i][ii,0] * esc_rate
-                        peak_buffer[jj,1] =  esc_ene
-                        jj = jj + 1
-                    ii = ii + 1
-                peak_buffer[:, 2] = numpy.sqrt(noise + \
-                                    (peak_buffer[:,1]>0) * peak_buffer[:,1] * \
-                                     fano)
+                peak_buffer    = numpy.zeros((len(rates) + n_escape_lines, 3)).astype(numpy.float)
+                peak_buffer[:len(rates), 0] = self.PEAKS0[i][:,0]
+                self.__fillEscapeRows(peak_buffer, i, len(rates), noise, fano)
+                peak_buffer = peak_buffer[len(rates):]
                 rates     =  peak_buffer[:,0]
                 positions = (peak_buffer[:,1] - zero)/gain
                 i1 = numpy.nonzero((positions >= x[0]) & (positions <= x[-1]))[0]
@@ -2025,20 +2217,10 @@ def specfitestimate(self,x,y,z,xscaling=1.0,yscaling=1.0):
                     #get the number of escape lines to get a proper buffer
                     rates     =  self.PEAKS0[i][:,0]
                     n_escape_lines = self.PEAKSW[i].shape[0] - len(rates)
-                    peak_buffer    = numpy.zeros((n_escape_lines, 3)).astype(numpy.float)
-                    ii=0
-                    jj=0
-                    for esc_group in self.PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            peak_buffer[jj,0] =  self.PEAKS0[i][ii,0] * esc_rate
-                            peak_buffer[jj,1] =  esc_ene
-                            jj = jj + 1
-                        ii = ii + 1
-                    peak_buffer[:, 2] = numpy.sqrt(noise + \
-                                        (peak_buffer[:,1]>0) * peak_buffer[:,1] * \
-                                         fano)
+                    peak_buffer    = numpy.zeros((len(rates) + n_escape_lines, 3)).astype(numpy.float)
+                    peak_buffer[:len(rates), 0] = self.PEAKS0[i][:,0]
+                    self.__fillEscapeRows(peak_buffer, i, len(rates), noise, fano)
+                    peak_buffer = peak_buffer[len(rates):]
                     rates     =  peak_buffer[:,0]
                     positions = (peak_buffer[:,1] - zero)/gain
                     i1 = numpy.nonzero((positions >= x[0]) & (positions <= x[-1]))[0]
@@ -2144,7 +2326,7 @@ def startfit(self,digest=0, linear=None, currentIteration=None):
             if strategyKey not in self.strategyInstances:
                 self.strategyInstances[strategyKey] = STRATEGIES[strategyKey]()
             strategyInstance = self.strategyInstances[strategyKey]
-            # digestresult takes about 0.1 seconds per iteration
+            # the strategy only needs the group areas of the digested result
             import time
             t0 = time.time()
             newConfig, iteration = strategyInstance.applyStrategy( \
@@ -2217,8 +2399,26 @@ def imagingDigestResult(self):
             i += 1
         return result
 
+    def __evaluateDigestedResults(self):
+        for reference in self.__digestedResults:
+            result = reference()
+            if result is not None:
+                result.evaluate()
+        self.__digestedResults = []
+
     def digestresult(self,outfile=None, info=None):
-        param = self.fittedpar
+        """
+        Return a DigestedResult describing the last fit.
+
+        The fitted curves and the details of the lines of each group are
+        only calculated when accessed (peaks, fitarea, sigmaarea and
+        escapepeaks of each group are always available). The pending values
+        are calculated before the configuration is changed. If outfile is
+        given, the complete result is written to it.
+        """
+        # the pending values have to use the state of this fit
+        param = numpy.array(self.fittedpar, dtype=numpy.float)
+        sigmapar = numpy.array(self.sigmapar, dtype=numpy.float)
         xw    = numpy.ravel(self.xdata)
         if self.STRIP:
             yw    = numpy.ravel(self.ydata-self.zz)
@@ -2227,42 +2427,60 @@ def digestresult(self,outfile=None, info=None):
         #print "delta yw actual data = ",numpy.sum(self.datatofit[:,1] - yw)
         sy    = numpy.ravel(self.sigmay)
         zzw   = numpy.ravel(self.zz)
+        ydata = numpy.ravel(self.ydata)
         zero = param[0]
         gain = param[1]
         energyw=zero + gain * xw
-        #print energy
-        yfitw = self.mcatheory(param,xw,summing=0)
-        pileup= param[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
-        yfitw += pileup
-        # + numpy.ravel(self.zz)
-        #reduced chi square
-        weightw =  1.0 / (sy + numpy.equal(sy,0))
-        weightw = weightw * weightw
         nfree_par = numpy.sum(self.codes[0,:] < 3)
-        prechisq = weightw * (yw - yfitw) *(yw - yfitw)/ (len(yw) - nfree_par)
-        #print "CHISQ = ",numpy.sum(prechisq)
-
+        strip = self.STRIP
+        continuum = self.__CONTINUUM
+        hypermet = self.__HYPERMET
+
+        # the fitted spectrum is shared by the curves and the groups
+        model = {}
+        def getModel():
+            if not len(model):
+                #print energy
+                yfitw = self.mcatheory(param,xw,summing=0)
+                pileup= param[4]*SpecfitFuns.pileup(yfitw,int(xw[0]), zero, gain)
+                yfitw += pileup
+                # + numpy.ravel(self.zz)
+                #reduced chi square
+                weightw =  1.0 / (sy + numpy.equal(sy,0))
+                weightw = weightw * weightw
+                model['yfit'] = yfitw
+                model['pileup'] = pileup
+                model['prechisq'] = weightw * (yw - yfitw) *(yw - yfitw)/ \
+                                    (len(yw) - nfree_par)
+                #print "CHISQ = ",numpy.sum(prechisq)
+            return model
+
+        def getCurves():
+            yfitw = getModel()['yfit']
+            ddict = {}
+            if strip:
+                ddict['yfit']     = yfitw + zzw
+            else:
+                ddict['yfit']     = yfitw
+            if continuum:
+                if strip:
+                    ddict['continuum']= self.continuum(param,xw) + zzw
+                else:
+                    ddict['continuum']= self.continuum(param,xw) * 1.0
+            elif strip:
+                    ddict['continuum']= zzw
+            else:
+                    ddict['continuum']= 0.0 * xw
+            ddict['pileup']       = getModel()['pileup']
+            return ddict
 
         n = self.NGLOBAL
         gain = self.fittedpar[self.PARAMETERS.index('Gain')]
-        result={}
+        result = DigestedResult()
         result['xdata']    = xw
         result['energy']   = energyw
-        result['ydata']    = numpy.ravel(self.ydata)
-        if self.STRIP:
-            result['yfit']     = yfitw + zzw
-        else:
-            result['yfit']     = yfitw
-        if self.__CONTINUUM:
-            if self.STRIP:
-                result['continuum']= self.continuum(param,xw) + zzw
-            else:
-                result['continuum']= self.continuum(param,xw) * 1.0
-        elif self.STRIP:
-                result['continuum']= zzw
-        else:
-                result['continuum']= 0.0 * xw
-        result['pileup']       = pileup
+        result['ydata']    = ydata
+        result.setLazy(['yfit', 'continuum', 'pileup'], getCurves)
         result['parameters']= self.PARAMETERS
         #result['parameters']= self.parameters
         result['fittedpar'] = self.fittedpar
@@ -2274,6 +2492,9 @@ def digestresult(self,outfile=None, info=None):
         result['groups'] = []
 
         PEAKSW = copy.deepcopy(self.getpeaksw(self.fittedpar))
+        PEAKS0 = self.PEAKS0
+        PEAKS0ESCAPE = self.PEAKS0ESCAPE
+        escape = self.ESCAPE
 
         """
         #EVALUATION:
@@ -2287,38 +2508,30 @@ def digestresult(self,outfile=None, info=None):
             else:
                 result = SpecfitFuns.fastagauss(a,energy)
         """
-        i = 0
-        for group in self.PARAMETERS[n:]:
-            fitarea   = self.fittedpar[n+i]
-            sigmaarea = self.sigmapar[n+i]
-            [ele, group0] = group.split()
-            result['groups'].append(group)
-            result[group]     = {}
-            result[group]['peaks']    = self.PEAKS0NAMES[i]
-            if self.__HYPERMET:
-                result[group]['fitarea']  = self.fittedpar[n+i] * \
-                                    (1.0 + self.fittedpar[self.PARAMETERS.index('ST AreaR')])
-            else:
-                result[group]['fitarea']  = self.fittedpar[n+i]
-            result[group]['sigmaarea'] = sigmaarea
-            result[group]['statistics'] = 0
+        def getGroupDetails(i, peaks, groupfitarea):
+            # the details of the lines of the group
+            fitarea   = param[n+i]
+            sigmaarea = sigmapar[n+i]
+            prechisq = getModel()['prechisq']
+            ddict = {}
+            ddict['statistics'] = 0
             j = 0
             p =  PEAKSW[i][:,:]
-            if self.__HYPERMET:
-                contrib = SpecfitFuns.fastahypermet(p, energyw,self.__HYPERMET)
+            if hypermet:
+                contrib = SpecfitFuns.fastahypermet(p, energyw,hypermet)
             else:
                 contrib = SpecfitFuns.apvoigt(p, energyw)
             index = []
-            for peak in result[group]['peaks']:
-                result[group][peak] = {}
-                result[group][peak]['ratio']     = self.PEAKS0[i][j,0]
-                result[group][peak]['energy']    = PEAKSW[i][j,1]
-                result[group][peak]['fwhm']      = PEAKSW[i][j,2]
-                result[group][peak]['statistics']= 0
+            for peak in peaks:
+                ddict[peak] = {}
+                ddict[peak]['ratio']     = PEAKS0[i][j,0]
+                ddict[peak]['energy']    = PEAKSW[i][j,1]
+                ddict[peak]['fwhm']      = PEAKSW[i][j,2]
+                ddict[peak]['statistics']= 0
 
                 #detailed parameters
-                peakpos = result[group][peak]['energy']
-                sigma   = result[group][peak]['fwhm']/2.3548
+                peakpos = ddict[peak]['energy']
+                sigma   = ddict[peak]['fwhm']/2.3548
                 index0   = numpy.nonzero(((peakpos-3*sigma)<energyw) & (energyw<(peakpos+3*sigma)))[0]
                 if len(index0):
                     chisq = numpy.sum(numpy.take(prechisq,index0))*len(yw)/len(index0)
@@ -2327,115 +2540,108 @@ def digestresult(self,outfile=None, info=None):
                 for ind in index0:
                     if ind not in index:
                         index.append(ind)
-                result[group][peak]['chisq']     = chisq
+                ddict[peak]['chisq']     = chisq
                 if fitarea == 0:
-                    result[group][peak]['fitarea']   = 0.0
-                    result[group][peak]['sigmaarea'] = 0.0
-                elif self.__HYPERMET:
-                    result[group][peak]['fitarea']   = PEAKSW[i][j,0] * (1.0 + PEAKSW[i] [j,3]) / gain
-                    result[group][peak]['sigmaarea'] = result[group][peak]['fitarea']* \
+                    ddict[peak]['fitarea']   = 0.0
+                    ddict[peak]['sigmaarea'] = 0.0
+                elif hypermet:
+                    ddict[peak]['fitarea']   = PEAKSW[i][j,0] * (1.0 + PEAKSW[i] [j,3]) / gain
+                    ddict[peak]['sigmaarea'] = ddict[peak]['fitarea']* \
                                                         abs(sigmaarea/fitarea)
                 else:
-                    result[group][peak]['fitarea']   = PEAKSW[i][j,0] / gain
-                    result[group][peak]['sigmaarea'] = result[group][peak]['fitarea'] * abs(sigmaarea/fitarea)
+                    ddict[peak]['fitarea']   = PEAKSW[i][j,0] / gain
+                    ddict[peak]['sigmaarea'] = ddict[peak]['fitarea'] * abs(sigmaarea/fitarea)
 
                 if len(index0):
-                    if result[group][peak]['fitarea'] > 0:
-                        result[group][peak]['statistics'] = numpy.take(self.ydata, index0).sum()
+                    if ddict[peak]['fitarea'] > 0:
+                        ddict[peak]['statistics'] = numpy.take(ydata, index0).sum()
                         pseudoArea = numpy.take(contrib, index0).sum()
-                        result[group]['statistics'] += result[group][peak]['ratio']*\
-                                                   abs(result[group][peak]['statistics']-pseudoArea)
+                        ddict['statistics'] += ddict[peak]['ratio']*\
+                                                   abs(ddict[peak]['statistics']-pseudoArea)
                 j += 1
-            result[group]['escapepeaks'] = []
-            if self.ESCAPE:
+            if escape:
                 if OLDESCAPE:
-                    result[group]['escapepeaks'] = self.PEAKS0NAMES[i]
                     j = 0
-                    for peak0 in result[group]['peaks']:
-                        (r,c) = (self.PEAKS0[i]).shape
+                    for peak0 in peaks:
+                        (r,c) = (PEAKS0[i]).shape
                         peak = peak0+"esc"
-                        result[group][peak] = {}
-                        result[group][peak]['energy']    = PEAKSW[i][j+r,1]
-                        result[group][peak]['fwhm']      = PEAKSW[i][j+r,2]
-                        result[group][peak]['ratio']     = self.PEAKS0[i][j,3]
+                        ddict[peak] = {}
+                        ddict[peak]['energy']    = PEAKSW[i][j+r,1]
+                        ddict[peak]['fwhm']      = PEAKSW[i][j+r,2]
+                        ddict[peak]['ratio']     = PEAKS0[i][j,3]
                         chisq     = 0.0
-                        if result[group][peak]['ratio'] > 0:
-                            peakpos = result[group][peak]['energy']
-                            sigma   = result[group][peak]['fwhm']/2.3548
+                        if ddict[peak]['ratio'] > 0:
+                            peakpos = ddict[peak]['energy']
+                            sigma   = ddict[peak]['fwhm']/2.3548
                             index0   = numpy.nonzero(((peakpos-4*sigma)<energyw) & (energyw<(peakpos+4*sigma)))[0]
                             if len(index0):
                                 chisq = numpy.sum(numpy.take(prechisq,index0))*len(yw)/len(index0)
                             else:
                                 #chisq = -1
                                 chisq = 0.000
-                        result[group][peak]['chisq']     = chisq
+                        ddict[peak]['chisq']     = chisq
                         if 1:
                             """
-                            if self.__HYPERMET:
-                                result[group][peak]['fitarea']   = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3])
-                                result[group][peak]['sigmaarea'] = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3]) * \
+                            if hypermet:
+                                ddict[peak]['fitarea']   = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3])
+                                ddict[peak]['sigmaarea'] = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3]) * \
                                                                     abs(sigmaarea/fitarea)
                             else:
                             """
                             if fitarea != 0.0:
-                               result[group][peak]['fitarea']   = PEAKSW[i][j+r,0] /gain
-                               result[group][peak]['sigmaarea'] = result[group][peak]['fitarea']  * abs(sigmaarea/fitarea)
+                               ddict[peak]['fitarea']   = PEAKSW[i][j+r,0] /gain
+                               ddict[peak]['sigmaarea'] = ddict[peak]['fitarea']  * abs(sigmaarea/fitarea)
                             else:
-                               result[group][peak]['fitarea']   = 0.0
-                               result[group][peak]['sigmaarea'] = 0.0
+                               ddict[peak]['fitarea']   = 0.0
+                               ddict[peak]['sigmaarea'] = 0.0
                         j += 1
                 else:
-                    result[group]['escapepeaks'] = []
                     j  = 0
                     ii = 0
-                    (r,c) = (self.PEAKS0[i]).shape
-                    #result[group]['escapepeaks'] = self.PEAKS0NAMES[i]
-                    for _esc_group in self.PEAKS0ESCAPE[i]:
-                        peak0 = result[group]['peaks'][ii]
+                    (r,c) = (PEAKS0[i]).shape
+                    for _esc_group in PEAKS0ESCAPE[i]:
+                        peak0 = peaks[ii]
                         #if group == 'Fe K':print "_esc_group = ",_esc_group
                         for esc_line in _esc_group:
-                            _name_root_ = peak0+" "+esc_line[2].replace(' ','_')
-                            peak = _name_root_+"esc"
-                            if _name_root_ not in result[group]['escapepeaks']:
-                                result[group]['escapepeaks']+=[peak0+" "+esc_line[2].replace(' ','_')]
-                            result[group][peak] = {}
+                            peak = peak0+" "+esc_line[2].replace(' ','_')+"esc"
+                            ddict[peak] = {}
                             (rw,cw) = (PEAKSW[i]).shape
-                            result[group][peak]['energy']    = PEAKSW[i][j+r,1]
-                            result[group][peak]['fwhm']      = PEAKSW[i][j+r,2]
-                            result[group][peak]['ratio']     = esc_line[1]
-                            result[group][peak]['statistics']= 0
+                            ddict[peak]['energy']    = PEAKSW[i][j+r,1]
+                            ddict[peak]['fwhm']      = PEAKSW[i][j+r,2]
+                            ddict[peak]['ratio']     = esc_line[1]
+                            ddict[peak]['statistics']= 0
                             #if group == 'Fe K':print "peak =",peak," energy = ",PEAKSW[i][j+r,1]
                             chisq     = 0.0
-                            if result[group][peak]['ratio'] > 0:
-                                peakpos = result[group][peak]['energy']
-                                sigma   = result[group][peak]['fwhm']/2.3548
+                            if ddict[peak]['ratio'] > 0:
+                                peakpos = ddict[peak]['energy']
+                                sigma   = ddict[peak]['fwhm']/2.3548
                                 index0   = numpy.nonzero(((peakpos-3*sigma)<energyw) & (energyw<(peakpos+3*sigma)))[0]
                                 if len(index0):
                                     chisq = numpy.sum(numpy.take(prechisq,index0))*len(yw)/len(index0)
                                 else:
                                     #chisq = -1
                                     chisq = 0.000
-                            result[group][peak]['chisq']     = chisq
+                            ddict[peak]['chisq']     = chisq
                             if 1:
                                 """
-                                if self.__HYPERMET:
-                                    result[group][peak]['fitarea']   = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3])
-                                    result[group][peak]['sigmaarea'] = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3]) * \
+                                if hypermet:
+                                    ddict[peak]['fitarea']   = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3])
+                                    ddict[peak]['sigmaarea'] = PEAKSW[r][j,0] * (1.0 + PEAKSW[r] [j,3]) * \
                                                                         abs(sigmaarea/fitarea)
                                 else:
                                 """
                                 if fitarea != 0.0:
-                                   result[group][peak]['fitarea']   = PEAKSW[i][j+r,0] /gain
-                                   result[group][peak]['sigmaarea'] = result[group][peak]['fitarea']  * abs(sigmaarea/fitarea)
+                                   ddict[peak]['fitarea']   = PEAKSW[i][j+r,0] /gain
+                                   ddict[peak]['sigmaarea'] = ddict[peak]['fitarea']  * abs(sigmaarea/fitarea)
                                 else:
-                                   result[group][peak]['fitarea']   = 0.0
-                                   result[group][peak]['sigmaarea'] = 0.0
+                                   ddict[peak]['fitarea']   = 0.0
+                                   ddict[peak]['sigmaarea'] = 0.0
                                 if len(index0):
-                                    if result[group][peak]['fitarea'] > 0:
-                                        result[group][peak]['statistics'] = numpy.take(self.ydata, index0).sum()
+                                    if ddict[peak]['fitarea'] > 0:
+                                        ddict[peak]['statistics'] = numpy.take(ydata, index0).sum()
                                         pseudoArea = numpy.take(contrib, index0).sum()
-                                        result[group]['statistics'] += result[group][peak]['ratio']*\
-                                                            abs(result[group][peak]['statistics']-pseudoArea)
+                                        ddict['statistics'] += ddict[peak]['ratio']*\
+                                                            abs(ddict[peak]['statistics']-pseudoArea)
                             j = j + 1
                         ii=ii+1
             #areaenergies.sort()
@@ -2443,12 +2649,12 @@ def digestresult(self,outfile=None, info=None):
             #print "areaenergies",areaenergies[0],areaenergies[-1]
             #index = numpy.nonzero((energyw>=areaenergies[0]) & (energyw <=areaenergies[-1]))
             energy = numpy.take(energyw     ,index)
-            yfit  = numpy.take(yfitw  ,index)
+            yfit  = numpy.take(getModel()['yfit']  ,index)
             if 0:
                 #this takes into account summing ...
                 buff = self.PEAKS0[i][:,0] * 1.0
                 self.PEAKS0[i][:,0] = 0.0
-                yconw = self.mcatheory(self.fittedpar,xw)
+                yconw = self.mcatheory(param,xw)
                 self.PEAKS0[i][:,0] = buff * 1.0
                 ycon   = numpy.take(yconw     ,index)
             else:
@@ -2456,8 +2662,8 @@ def digestresult(self,outfile=None, info=None):
                 #p =  PEAKSW[i][0:r,:]
                 if 0:
                     p =  PEAKSW[i][:,:]
-                    if self.__HYPERMET:
-                        contrib = SpecfitFuns.fastahypermet(p,energy,self.__HYPERMET)
+                    if hypermet:
+                        contrib = SpecfitFuns.fastahypermet(p,energy,hypermet)
                     else:
                         contrib = SpecfitFuns.apvoigt(p,energy)
                 else:
@@ -2466,11 +2672,35 @@ def digestresult(self,outfile=None, info=None):
             y   = numpy.take(yw     ,index)
             #pmcaarea      = numpy.sum(y-(yfit-contrib))
             pmcaarea      = numpy.sum(y-ycon)
-            result[group]['mcaarea']    = pmcaarea
-            result[group]['statistics'] = max(pmcaarea, result[group]['fitarea']) +\
-                                          result[group]['statistics']
+            ddict['mcaarea']    = pmcaarea
+            ddict['statistics'] = max(pmcaarea, groupfitarea) +\
+                                          ddict['statistics']
             #pmcasigmaarea = numpy.sqrt(numpy.sum(numpy.where(y<0, -y, y)))
-            #result[group]['mcasigmaarea'] = pmcasigmaarea
+            #ddict['mcasigmaarea'] = pmcasigmaarea
+            return ddict
+
+        i = 0
+        for group in self.PARAMETERS[n:]:
+            sigmaarea = self.sigmapar[n+i]
+            [ele, group0] = group.split()
+            result['groups'].append(group)
+            result[group]     = DigestedResult()
+            result[group]['peaks']    = self.PEAKS0NAMES[i]
+            if self.__HYPERMET:
+                result[group]['fitarea']  = self.fittedpar[n+i] * \
+                                    (1.0 + self.fittedpar[self.PARAMETERS.index('ST AreaR')])
+            else:
+                result[group]['fitarea']  = self.fittedpar[n+i]
+            result[group]['sigmaarea'] = sigmaarea
+            # the loader must not refer to the result
+            loader = lambda i=i, peaks=result[group]['peaks'], \
+                            groupfitarea=result[group]['fitarea']: \
+                            getGroupDetails(i, peaks, groupfitarea)
+            result[group].setLazy(['statistics'] + result[group]['peaks'],
+                                  loader)
+            escapepeaks, escapekeys = self.__getEscapePeaks(i)
+            result[group]['escapepeaks'] = escapepeaks
+            result[group].setLazy(escapekeys + ['mcaarea'], loader)
             i+=1
         result['niter']        = self.__niter * 1
         result['lastdeltachi'] = self.__lastdeltachi * 1.0
@@ -2484,8 +2714,32 @@ def digestresult(self,outfile=None, info=None):
             else:
                 d=ConfigDict.ConfigDict({'result':result})
             d.write(outfile)
+        self.__digestedResults = [reference for reference in \
+                                  self.__digestedResults \
+                                  if reference() is not None]
+        self.__digestedResults.append(weakref.ref(result))
         return result
 
+    def __getEscapePeaks(self, i):
+        """
+        Return the escape peaks of group i as given by digestresult and the
+        keys of their details.
+        """
+        if not self.ESCAPE:
+            return [], []
+        peaks = self.PEAKS0NAMES[i]
+        if OLDESCAPE:
+            return peaks, [peak + "esc" for peak in peaks]
+        escapepeaks = []
+        keys = []
+        for ii, _esc_group in enumerate(self.PEAKS0ESCAPE[i]):
+            for esc_line in _esc_group:
+                name = peaks[ii] + " " + esc_line[2].replace(' ', '_')
+                if name not in escapepeaks:
+                    escapepeaks.append(name)
+                keys.append(name + "esc")
+        return escapepeaks, keys
+
     def getpeaksw(self,param,hypermet=None,continuum=None):
         if continuum is None:
             continuum = self.__CONTINUUM
@@ -2499,7 +2753,6 @@ def getpeaksw(self,param,hypermet=None,continuum=None):
         fano = param[3] * 2.3548*2.3548*0.00385
         #t=time.time()
         PEAKS0 = self.PEAKS0
-        PEAKS0ESCAPE = self.PEAKS0ESCAPE
         PEAKSW = self.PEAKSW
         PARAMETERS = self.PARAMETERS
         for i in range(len(param[self.NGLOBAL:])):
@@ -2515,18 +2768,7 @@ def getpeaksw(self,param,hypermet=None,continuum=None):
                     PEAKSW[i][r:,1] = PEAKS0[i][:,1] - self.config['detector']['detene']
                     PEAKSW[i][r:,2] = numpy.sqrt(noise + (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
                 else:
-                    ii=0
-                    j=0
-                    for esc_group in PEAKS0ESCAPE[i]:
-                        for esc_line in esc_group:
-                            esc_ene  = esc_line[0] * 1.0
-                            esc_rate = esc_line[1]
-                            PEAKSW[i][j+r,0] =  PEAKSW[i][ii,0] * esc_rate
-                            PEAKSW[i][j+r,1] =  esc_ene
-                            j = j + 1
-                        ii = ii + 1
-                    PEAKSW[i][r:, 2] = numpy.sqrt(noise + \
-                                    (PEAKSW[i][r:,1]>0) * PEAKSW[i][r:,1] * fano)
+                    self.__fillEscapeRows(PEAKSW[i], i, r, noise, fano)
                 #if HYPERMET:
                 if hypermet:
                     PEAKSW[i] [0:r,3] = param[PARAMETERS.index('ST AreaR')]
@@ -2759,6 +3001,141 @@ def estimateexppol(self,x,y,z,xscaling=1.0,yscaling=1.0):
         fittedpar[0] = numpy.exp(fittedpar[0])
         return fittedpar,numpy.zeros((3,len(fittedpar)),numpy.float)
 
+def setConfigurationCacheDirectory(directory=None):
+    """
+    Keep a copy of the configured states in the given directory in order
+    to reuse them among different sessions or processes.
+    Use None to restrict the cache to memory.
+    """
+    global _CONFIGURATION_CACHE_DIR
+    if directory is not None:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    _CONFIGURATION_CACHE_DIR = directory
+
+def getConfigurationCacheDirectory():
+    return _CONFIGURATION_CACHE_DIR
+
+def clearConfigurationCache():
+    """
+    Empty the in-memory cache of configured states.
+    """
+    _CONFIGURATION_CACHE.clear()
+    del _CONFIGURATION_CACHE_KEYS[:]
+
+def getConfigurationHash(config, attenuatorsflag=1):
+    """
+    Return a hash of the fit configuration that does not depend on the
+    order of the keys nor on the types used to store lists and numbers.
+
+    The definitions found in Elements.Material of the materials used by
+    the configuration are part of the hash, even if they are not in the
+    materials section. Other changes to the Elements data are not taken
+    into account: call clearConfigurationCache after them.
+    """
+    materials = {}
+    _getReferencedMaterials(config, materials)
+    text = "%d|%s|%d|%s|%s" % (_CONFIGURATION_CACHE_VERSION,
+                               PyMca5.version(),
+                               int(attenuatorsflag),
+                               _getCanonicalText(config),
+                               _getCanonicalText(materials))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _getReferencedMaterials(obj, materials):
+    """
+    Fill the materials dictionary with the definitions of the materials
+    of Elements.Material named in obj, including the materials they are
+    made of.
+    """
+    if isinstance(obj, dict):
+        for key in obj:
+            _getReferencedMaterials(key, materials)
+            _getReferencedMaterials(obj[key], materials)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _getReferencedMaterials(item, materials)
+    else:
+        try:
+            isMaterial = (obj in Elements.Material) and \
+                         (obj not in materials)
+        except TypeError:
+            # unhashable, it cannot be a material name
+            isMaterial = False
+        if isMaterial:
+            materials[obj] = Elements.Material[obj]
+            _getReferencedMaterials(Elements.Material[obj].get("CompoundList",
+                                                               []),
+                                    materials)
+
+def _getCanonicalText(obj):
+    if isinstance(obj, dict):
+        keys = sorted(obj.keys(), key=lambda x: _getCanonicalText(x))
+        return "{" + ",".join([_getCanonicalText(key) + ":" + \
+                               _getCanonicalText(obj[key]) for key in keys]) + "}"
+    elif isinstance(obj, (list, tuple)):
+        return "[" + ",".join([_getCanonicalText(x) for x in obj]) + "]"
+    elif isinstance(obj, numpy.ndarray):
+        return _getCanonicalText(obj.tolist())
+    elif isinstance(obj, numpy.generic):
+        return _getCanonicalText(obj.item())
+    elif isinstance(obj, float):
+        return repr(obj)
+    elif sys.version < '3.0':
+        if isinstance(obj, unicode):
+            return repr(obj.encode("utf-8"))
+    return repr(obj)
+
+def _getCachedConfiguration(key):
+    if key in _CONFIGURATION_CACHE:
+        # most recently used at the end
+        _CONFIGURATION_CACHE_KEYS.remove(key)
+        _CONFIGURATION_CACHE_KEYS.append(key)
+        return _CONFIGURATION_CACHE[key]
+    if _CONFIGURATION_CACHE_DIR is None:
+        return None
+    fname = os.path.join(_CONFIGURATION_CACHE_DIR, key + ".pkl")
+    if not os.path.exists(fname):
+        return None
+    try:
+        f = open(fname, "rb")
+        try:
+            state = pickle.load(f)
+        finally:
+            f.close()
+    except:
+        if DEBUG:
+            print("Cannot read cached configuration %s" % fname)
+            print(sys.exc_info())
+        return None
+    _setCachedConfiguration(key, state, save=False)
+    return state
+
+def _setCachedConfiguration(key, state, save=True):
+    if key in _CONFIGURATION_CACHE:
+        _CONFIGURATION_CACHE_KEYS.remove(key)
+    _CONFIGURATION_CACHE[key] = state
+    _CONFIGURATION_CACHE_KEYS.append(key)
+    while len(_CONFIGURATION_CACHE_KEYS) > CONFIGURATION_CACHE_SIZE:
+        del _CONFIGURATION_CACHE[_CONFIGURATION_CACHE_KEYS.pop(0)]
+    if save and (_CONFIGURATION_CACHE_DIR is not None):
+        fname = os.path.join(_CONFIGURATION_CACHE_DIR, key + ".pkl")
+        # write to a temporary file first in case of concurrent access
+        tmpname = "%s.%d" % (fname, os.getpid())
+        try:
+            f = open(tmpname, "wb")
+            try:
+                pickle.dump(state, f, 2)
+            finally:
+                f.close()
+            if os.path.exists(fname):
+                os.remove(fname)
+            os.rename(tmpname, fname)
+        except:
+            if DEBUG:
+                print("Cannot write cached configuration %s" % fname)
+                print(sys.exc_info())
+
 class ClassMcaTheory(McaTheory):
     pass
 
@@ -37,6 +37,7 @@
 import re
 import weakref
 import types
+import hashlib
 from PyMca5.PyMcaIO import ConfigDict
 from . import CoherentScattering
 from . import IncoherentScattering
@@ -55,6 +56,10 @@
 """
 MINENERGY = 0.175
 AVOGADRO_NUMBER = 6.02214179E23
+# Maximum number of (element, energies) interpolated cross sections kept
+CROSS_SECTIONS_CACHE_SIZE = 200
+_CROSS_SECTIONS_CACHE = {}
+_CROSS_SECTIONS_CACHE_KEYS = []
 #
 #   Symbol  Atomic Number   x y ( positions on table )
 #       name,  mass, density
@@ -2225,73 +2230,28 @@ def getmassattcoef(compound, energy=None):
                     energy.append(ene)
         energy.sort()
 
-    for ele in elts:
-        xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if not hasattr(energy, "__len__"):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                ddict['energy'].append(ene)
-                ddict['coherent'].append(cohe *fraction[eltindex])
-                ddict['compton'].append(comp *fraction[eltindex])
-                ddict['photo'].append(photo *fraction[eltindex])
-                ddict['pair'].append(pair*fraction[eltindex])
-                ddict['total'].append((cohe+comp+photo+pair)*fraction[eltindex])
-            else:
-                ddict['coherent'][eneindex] += cohe  *fraction[eltindex]
-                ddict['compton'] [eneindex] += comp  *fraction[eltindex]
-                ddict['photo']   [eneindex] += photo *fraction[eltindex]
-                ddict['pair']    [eneindex] += pair  *fraction[eltindex]
-                ddict['total']   [eneindex] += (cohe+comp+photo+pair) * fraction[eltindex]
-            eneindex += 1
-        eltindex += 1
+    if not hasattr(energy, "__len__"):
+        energy =[energy]
+    energyArray = numpy.array(energy, dtype=numpy.float64).reshape(-1)
+    coherent = numpy.zeros(energyArray.shape, numpy.float64)
+    compton = numpy.zeros(energyArray.shape, numpy.float64)
+    photo = numpy.zeros(energyArray.shape, numpy.float64)
+    pair = numpy.zeros(energyArray.shape, numpy.float64)
+    total = numpy.zeros(energyArray.shape, numpy.float64)
+    for eltindex in range(len(elts)):
+        cohe, comp, phot, pai = _getElementCrossSections(elts[eltindex],
+                                                         energyArray)
+        coherent += cohe * fraction[eltindex]
+        compton += comp * fraction[eltindex]
+        photo += phot * fraction[eltindex]
+        pair += pai * fraction[eltindex]
+        total += (cohe + comp + phot + pai) * fraction[eltindex]
+    ddict['energy'] = list(energy)
+    ddict['coherent'] = coherent.tolist()
+    ddict['compton'] = compton.tolist()
+    ddict['photo'] = photo.tolist()
+    ddict['pair'] = pair.tolist()
+    ddict['total'] = total.tolist()
     return ddict
 
 def __materialInCompoundList(lst):
@@ -2459,77 +2419,28 @@ def getMaterialMassAttenuationCoefficients(compoundList0, fractionList0, energy0
     dict['photo']    = []
     dict['pair']     = []
     dict['total']    = []
-    eltindex = 0
+    if (type(energy) != type([])):
+        energy =[energy]
+    energyArray = numpy.array(energy, dtype=numpy.float64).reshape(-1)
+    coherent = numpy.zeros(energyArray.shape, numpy.float64)
+    compton = numpy.zeros(energyArray.shape, numpy.float64)
+    photo = numpy.zeros(energyArray.shape, numpy.float64)
+    pair = numpy.zeros(energyArray.shape, numpy.float64)
+    total = numpy.zeros(energyArray.shape, numpy.float64)
     for ele in materialElements.keys():
-        if 'xcom' in Element[ele]:
-            xcom_data = Element[ele]['xcom']
-        else:
-            xcom_data = getelementmassattcoef(ele,None)
-        #now I have to interpolate at the different energies
-        if (type(energy) != type([])):
-            energy =[energy]
-        eneindex = 0
-        for ene in energy:
-            if ene < 1.0:
-                if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                    #make sure the binding energies are those used by this module and not EADL ones
-                    PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                          Element[ele]['binding'])
-                tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-                cohe  = tmpDict['coherent'][0]
-                comp  = tmpDict['compton'][0]
-                photo = tmpDict['photo'][0]
-                pair  = 0.0
-            else:
-                i0=max(numpy.nonzero(xcom_data['energy'] <= ene)[0])
-                i1=min(numpy.nonzero(xcom_data['energy'] >= ene)[0])
-                if (i1 == i0) or (i0>i1):
-                    cohe=xcom_data['coherent'][i1]
-                    comp=xcom_data['compton'][i1]
-                    photo=xcom_data['photo'][i1]
-                    pair=xcom_data['pair'][i1]
-                else:
-                    if LOGLOG:
-                        A=xcom_data['energylog10'][i0]
-                        B=xcom_data['energylog10'][i1]
-                        logene = numpy.log10(ene)
-                        c2=(logene-A)/(B-A)
-                        c1=(B-logene)/(B-A)
-                    else:
-                        A=xcom_data['energy'][i0]
-                        B=xcom_data['energy'][i1]
-                        c2=(ene-A)/(B-A)
-                        c1=(B-ene)/(B-A)
-                    cohe= pow(10.0,c2*xcom_data['coherentlog10'][i1]+\
-                                   c1*xcom_data['coherentlog10'][i0])
-                    comp= pow(10.0,c2*xcom_data['comptonlog10'][i1]+\
-                                   c1*xcom_data['comptonlog10'][i0])
-                    photo=pow(10.0,c2*xcom_data['photolog10'][i1]+\
-                                   c1*xcom_data['photolog10'][i0])
-                    if xcom_data['pair'][i1] > 0.0:
-                        c2 = c2*numpy.log10(xcom_data['pair'][i1])
-                        if xcom_data['pair'][i0] > 0.0:
-                            c1 = c1*numpy.log10(xcom_data['pair'][i0])
-                            pair = pow(10.0,c1+c2)
-                        else:
-                            pair =0.0
-                    else:
-                        pair =0.0
-            if eltindex == 0:
-                dict['energy'].append(ene)
-                dict['coherent'].append(cohe * materialElements[ele])
-                dict['compton'].append(comp * materialElements[ele])
-                dict['photo'].append(photo * materialElements[ele])
-                dict['pair'].append(pair* materialElements[ele])
-                dict['total'].append((cohe+comp+photo+pair)* materialElements[ele])
-            else:
-                dict['coherent'][eneindex] += cohe  * materialElements[ele]
-                dict['compton'] [eneindex] += comp  * materialElements[ele]
-                dict['photo']   [eneindex] += photo * materialElements[ele]
-                dict['pair']    [eneindex] += pair  * materialElements[ele]
-                dict['total']   [eneindex] += (cohe+comp+photo+pair) *  materialElements[ele]
-            eneindex += 1
-        eltindex += 1
+        cohe, comp, phot, pai = _getElementCrossSections(ele, energyArray)
+        coherent += cohe * materialElements[ele]
+        compton += comp * materialElements[ele]
+        photo += phot * materialElements[ele]
+        pair += pai * materialElements[ele]
+        total += (cohe + comp + phot + pai) * materialElements[ele]
+    if len(materialElements):
+        dict['energy'] = list(energy)
+        dict['coherent'] = coherent.tolist()
+        dict['compton'] = compton.tolist()
+        dict['photo'] = photo.tolist()
+        dict['pair'] = pair.tolist()
+        dict['total'] = total.tolist()
     return dict
 
 
@@ -2737,69 +2648,104 @@ def getelementmassattcoef(ele,energy=None):
     if energy is None:
         return  Element[ele]['xcom']
     ddict={}
-    ddict['energy']   = []
-    ddict['coherent'] = []
-    ddict['compton']  = []
-    ddict['photo']    = []
-    ddict['pair']     = []
-    ddict['total']    = []
     if not hasattr(energy, "__len__"):
         energy =[energy]
-    for ene in energy:
-        if ene < 1.0:
-            if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
-                #make sure the binding energies are those used by this module and not EADL ones
-                PyMcaEPDL97.setElementBindingEnergies(ele,
-                                                      Element[ele]['binding'])
-            tmpDict = PyMcaEPDL97.getElementCrossSections(ele, ene)
-            cohe  = tmpDict['coherent'][0]
-            comp  = tmpDict['compton'][0]
-            photo = tmpDict['photo'][0]
-            pair  = 0.0
-        else:
-            i0=max(numpy.nonzero(Element[ele]['xcom']['energy'] <= ene)[0])
-            i1=min(numpy.nonzero(Element[ele]['xcom']['energy'] >= ene)[0])
-            if i1 <= i0:
-                cohe=Element[ele]['xcom']['coherent'][i1]
-                comp=Element[ele]['xcom']['compton'][i1]
-                photo=Element[ele]['xcom']['photo'][i1]
-                pair=Element[ele]['xcom']['pair'][i1]
-            else:
-                if LOGLOG:
-                    A=Element[ele]['xcom']['energylog10'][i0]
-                    B=Element[ele]['xcom']['energylog10'][i1]
-                    logene = numpy.log10(ene)
-                    c2=(logene-A)/(B-A)
-                    c1=(B-logene)/(B-A)
-                else:
-                    A=Element[ele]['xcom']['energy'][i0]
-                    B=Element[ele]['xcom']['energy'][i1]
-                    c2=(ene-A)/(B-A)
-                    c1=(B-ene)/(B-A)
-
-                cohe= pow(10.0,c2*Element[ele]['xcom']['coherentlog10'][i1]+\
-                               c1*Element[ele]['xcom']['coherentlog10'][i0])
-                comp= pow(10.0,c2*Element[ele]['xcom']['comptonlog10'][i1]+\
-                               c1*Element[ele]['xcom']['comptonlog10'][i0])
-                photo=pow(10.0,c2*Element[ele]['xcom']['photolog10'][i1]+\
-                               c1*Element[ele]['xcom']['photolog10'][i0])
-                if Element[ele]['xcom']['pair'][i1] > 0.0:
-                    c2 = c2*numpy.log10(Element[ele]['xcom']['pair'][i1])
-                    if Element[ele]['xcom']['pair'][i0] > 0.0:
-                        c1 = c1*numpy.log10(Element[ele]['xcom']['pair'][i0])
-                        pair = pow(10.0,c1+c2)
-                    else:
-                        pair =0.0
-                else:
-                    pair =0.0
-        ddict['energy'].append(ene)
-        ddict['coherent'].append(cohe)
-        ddict['compton'].append(comp)
-        ddict['photo'].append(photo)
-        ddict['pair'].append(pair)
-        ddict['total'].append(cohe+comp+photo+pair)
+    cohe, comp, photo, pair = _getElementCrossSections(ele,
+                            numpy.array(energy, dtype=numpy.float64).reshape(-1))
+    ddict['energy']   = list(energy)
+    ddict['coherent'] = cohe.tolist()
+    ddict['compton']  = comp.tolist()
+    ddict['photo']    = photo.tolist()
+    ddict['pair']     = pair.tolist()
+    ddict['total']    = (cohe + comp + photo + pair).tolist()
     return ddict
 
+def _getElementCrossSections(ele, energy):
+    """
+    Interpolate the mass attenuation coefficients of the element at the
+    given one dimensional array of energies in keV.
+
+    The XCOM data are interpolated in log-log scale (unless LOGLOG is
+    False) and the EPDL97 data are used below 1 keV.
+    It returns the coherent, compton, photo and pair arrays. The arrays
+    are shared by the cache of recent calls and must not be modified.
+    """
+    key = (ele, LOGLOG, energy.size, hashlib.sha1(energy).hexdigest())
+    if key in _CROSS_SECTIONS_CACHE:
+        # most recently used at the end
+        _CROSS_SECTIONS_CACHE_KEYS.remove(key)
+        _CROSS_SECTIONS_CACHE_KEYS.append(key)
+        return _CROSS_SECTIONS_CACHE[key]
+    xcom_data = getelementmassattcoef(ele, None)
+    xcom_energy = xcom_data['energy']
+    cohe = numpy.zeros(energy.shape, numpy.float64)
+    comp = numpy.zeros(energy.shape, numpy.float64)
+    photo = numpy.zeros(energy.shape, numpy.float64)
+    pair = numpy.zeros(energy.shape, numpy.float64)
+
+    low = energy < 1.0
+    if low.any():
+        if PyMcaEPDL97.EPDL97_DICT[ele]['original']:
+            #make sure the binding energies are those used by this module and not EADL ones
+            PyMcaEPDL97.setElementBindingEnergies(ele,
+                                                  Element[ele]['binding'])
+        tmpDict = PyMcaEPDL97.getElementCrossSections(ele, energy[low])
+        cohe[low] = tmpDict['coherent']
+        comp[low] = tmpDict['compton']
+        photo[low] = tmpDict['photo']
+
+    high = ~low
+    ene = energy[high]
+    if ene.size:
+        # last point at or below and first point at or above each energy
+        i0 = numpy.searchsorted(xcom_energy, ene, side='right') - 1
+        i1 = numpy.searchsorted(xcom_energy, ene, side='left')
+        if (i0.min() < 0) or (i1.max() >= xcom_energy.size):
+            raise ValueError("Energy outside the %s XCOM data range" % ele)
+        same = i1 <= i0
+        i0 = i0[~same]
+        i1i = i1[~same]
+        values = []
+        for name in ['coherent', 'compton', 'photo', 'pair']:
+            values.append(numpy.take(xcom_data[name], i1))
+        if i1i.size:
+            e = ene[~same]
+            if LOGLOG:
+                A = xcom_data['energylog10'][i0]
+                B = xcom_data['energylog10'][i1i]
+                logene = numpy.log10(e)
+                c2 = (logene - A) / (B - A)
+                c1 = (B - logene) / (B - A)
+            else:
+                A = xcom_energy[i0]
+                B = xcom_energy[i1i]
+                c2 = (e - A) / (B - A)
+                c1 = (B - e) / (B - A)
+            for i, name in enumerate(['coherentlog10', 'comptonlog10',
+                                      'photolog10']):
+                values[i][~same] = numpy.power(10.0,
+                                c2 * xcom_data[name][i1i] + \
+                                c1 * xcom_data[name][i0])
+            pair0 = xcom_data['pair'][i0]
+            pair1 = xcom_data['pair'][i1i]
+            valid = (pair0 > 0.0) & (pair1 > 0.0)
+            interpolated = numpy.zeros(e.shape, numpy.float64)
+            if valid.any():
+                interpolated[valid] = numpy.power(10.0,
+                                c1[valid] * numpy.log10(pair0[valid]) + \
+                                c2[valid] * numpy.log10(pair1[valid]))
+            values[3][~same] = interpolated
+        cohe[high], comp[high], photo[high], pair[high] = values
+
+    output = (cohe, comp, photo, pair)
+    for array in output:
+        array.setflags(write=False)
+    _CROSS_SECTIONS_CACHE[key] = output
+    _CROSS_SECTIONS_CACHE_KEYS.append(key)
+    while len(_CROSS_SECTIONS_CACHE_KEYS) > CROSS_SECTIONS_CACHE_SIZE:
+        del _CROSS_SECTIONS_CACHE[_CROSS_SECTIONS_CACHE_KEYS.pop(0)]
+    return output
+
 def getElementLShellRates(symbol,energy=None,photoweights = None):
     """
     getElementLShellRates(symbol,energy=None, photoweights = None)
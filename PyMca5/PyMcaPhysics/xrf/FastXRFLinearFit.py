@@ -34,17 +34,240 @@
 Module to perform a fast linear fit on a stack of fluorescence spectra.
 """
 import os
+import sys
 import numpy
-from PyMca5.PyMcaMath.linalg import lstsq
+import threading
+from PyMca5.PyMcaMath.linalg import lstsq, LinearLeastSquaresSolver
 from . import ClassMcaTheory
 from PyMca5.PyMcaMath.fitting import Gefit
 from . import ConcentrationsTool
 from PyMca5.PyMcaMath.fitting import SpecfitFuns
 from PyMca5.PyMcaIO import ConfigDict
 import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+if sys.version < '3.0':
+    import Queue as queue
+else:
+    import queue
 
 DEBUG = 0
 
+# default maximum size in bytes of the blocks read in streaming mode
+BLOCK_BYTES = 256 * 1024 * 1024
+
+# fit context shared by the spectra fitted in a worker process
+_WORKER_CONTEXT = None
+
+def getMultipleSpectraBackground(spectra, snipwidth, filterwidth,
+                                 anchorslist=None):
+    """
+    Calculate the strip background of a set of spectra in one go.
+
+    The smoothing and the SNIP algorithm are applied to all the spectra
+    at once instead of looping over them.
+
+    :param spectra: 2D array of shape [nspectra, nchannels]
+    :param snipwidth: width of the SNIP algorithm
+    :param filterwidth: width of the Savitsky-Golay smoothing
+    :param anchorslist: sorted list of channel indices used as anchors
+    :return: 2D array of shape [nspectra, nchannels] with the backgrounds
+    """
+    # obtain the smoothed spectra
+    background = SpecfitFuns.SavitskyGolay(spectra, filterwidth)
+    nChannels = background.shape[-1]
+    lastAnchor = 0
+    if anchorslist is None:
+        anchorslist = []
+    for anchor in anchorslist:
+        if (anchor > lastAnchor) and (anchor < nChannels):
+            background[:, lastAnchor:anchor] = \
+                    SpecfitFuns.snip1d(background[:, lastAnchor:anchor],
+                                       snipwidth,
+                                       0)
+            lastAnchor = anchor
+    if lastAnchor < nChannels:
+        background[:, lastAnchor:] = \
+                SpecfitFuns.snip1d(background[:, lastAnchor:],
+                                   snipwidth,
+                                   0)
+    return background
+
+def _fitRowBlock(data, iStart, iEnd, context, results=None,
+                 uncertainties=None):
+    """
+    Fit the rows iStart to iEnd - 1 of the map against the linear model
+    described by the context dictionnary.
+
+    If the output buffers are not supplied, they are allocated for the
+    rows of the block only. The output buffers are returned.
+    """
+    derivatives = context['derivatives']
+    nFree = derivatives.shape[1]
+    iXMin = context['iXMin']
+    iXMax = context['iXMax']
+    nColumns = data.shape[1]
+    jStep = min(context['jStep'], nColumns)
+    if results is None:
+        results = numpy.zeros((nFree, iEnd - iStart, nColumns),
+                              numpy.float32)
+        uncertainties = numpy.zeros((nFree, iEnd - iStart, nColumns),
+                                    numpy.float32)
+        offset = iStart
+    else:
+        offset = 0
+    #chunks of nColumns spectra
+    chunk = numpy.zeros((iXMax + 1 - iXMin, jStep), numpy.float)
+    for i in range(iStart, iEnd):
+        jStart = 0
+        while jStart < nColumns:
+            jEnd = min(jStart + jStep, nColumns)
+            chunk[:,:(jEnd - jStart)] = data[i, jStart:jEnd, iXMin:iXMax+1].T
+            if context['stripflag']:
+                # all the spectra of the chunk are processed at once
+                chunk[:, :(jEnd - jStart)] -= \
+                    getMultipleSpectraBackground(chunk[:, :(jEnd - jStart)].T,
+                                                 context['snipwidth'],
+                                                 context['stripfilterwidth'],
+                                                 context['anchorslist']).T
+
+            # perform the multiple fit to all the spectra in the chunk
+            if context['solver'] is not None:
+                parameters, sigmapar = \
+                    context['solver'].solve(chunk[:,:(jEnd - jStart)],
+                                            uncertainties=True)
+            else:
+                ddict=lstsq(derivatives, chunk[:,:(jEnd - jStart)],
+                            sigma_b=context['sigma_b'],
+                            weight=context['weight'],
+                            digested_output=True,
+                            svd=False)
+                parameters = ddict['parameters']
+                sigmapar = ddict['uncertainties']
+            results[:, i - offset, jStart:jEnd] = parameters
+            uncertainties[:, i - offset, jStart:jEnd] = sigmapar
+            jStart = jEnd
+    return results, uncertainties
+
+def _getBlockShape(data, nChannels, maxbytes=None):
+    """
+    Return the number of rows and columns of the blocks of spectra to be
+    read at once from the map in order not to exceed maxbytes.
+
+    If data is a chunked HDF5 dataset, the blocks are aligned with its
+    chunk grid. A block is never smaller than one chunk.
+    """
+    if maxbytes is None:
+        maxbytes = BLOCK_BYTES
+    nRows = data.shape[0]
+    nColumns = data.shape[1]
+    chunks = getattr(data, "chunks", None)
+    if not chunks:
+        # contiguous data are read row by row
+        chunks = (1, nColumns)
+    chunkRows = min(chunks[0], nRows)
+    chunkColumns = min(chunks[1], nColumns)
+    maxSpectra = max(1, int(maxbytes // (nChannels * data.dtype.itemsize)))
+    if maxSpectra >= (chunkRows * nColumns):
+        # complete rows of chunks
+        blockColumns = nColumns
+        blockRows = (maxSpectra // nColumns // chunkRows) * chunkRows
+    else:
+        blockRows = chunkRows
+        blockColumns = max(chunkColumns,
+                    (maxSpectra // chunkRows // chunkColumns) * chunkColumns)
+    return min(blockRows, nRows), min(blockColumns, nColumns)
+
+class _BlockReadError(object):
+    """
+    Wrapper of the exception raised while reading a block in the
+    background thread, to be raised again by the consumer.
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+def _iterBlocks(data, blockShape, iXMin, iXMax, mask=None):
+    """
+    Generator of (iStart, iEnd, jStart, jEnd, block) tuples covering the
+    map, block being data[iStart:iEnd, jStart:jEnd, iXMin:iXMax + 1].
+
+    The next block is read in a background thread while the current one
+    is being processed. If a 2D mask is given, the blocks without any
+    selected pixel are skipped.
+    """
+    nRows = data.shape[0]
+    nColumns = data.shape[1]
+    indices = []
+    for iStart in range(0, nRows, blockShape[0]):
+        iEnd = min(iStart + blockShape[0], nRows)
+        for jStart in range(0, nColumns, blockShape[1]):
+            jEnd = min(jStart + blockShape[1], nColumns)
+            if mask is not None:
+                if not mask[iStart:iEnd, jStart:jEnd].any():
+                    continue
+            indices.append((iStart, iEnd, jStart, jEnd))
+
+    blockQueue = queue.Queue(1)
+    stopEvent = threading.Event()
+
+    def _put(item):
+        while not stopEvent.is_set():
+            try:
+                blockQueue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read():
+        try:
+            for iStart, iEnd, jStart, jEnd in indices:
+                block = data[iStart:iEnd, jStart:jEnd, iXMin:iXMax + 1]
+                if not _put((iStart, iEnd, jStart, jEnd, block)):
+                    return
+            _put(None)
+        except Exception:
+            _put(_BlockReadError(sys.exc_info()[1]))
+
+    reader = threading.Thread(target=_read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item = blockQueue.get()
+            if item is None:
+                break
+            if isinstance(item, _BlockReadError):
+                raise item.exception
+            yield item
+    finally:
+        stopEvent.set()
+
+def _getMaskedSpectra(data, mask, iXMin, iXMax, dtype, blockShape):
+    """
+    Return the spectra of the pixels selected by the 2D mask, in the same
+    order as data[mask], only reading the blocks containing those pixels.
+    """
+    nSelected = int(mask.sum())
+    spectra = numpy.zeros((nSelected, iXMax + 1 - iXMin), dtype)
+    # position of each selected pixel in the output array
+    order = numpy.cumsum(mask.ravel()) - 1
+    order.shape = mask.shape
+    for iStart, iEnd, jStart, jEnd, block in _iterBlocks(data, blockShape,
+                                                         iXMin, iXMax,
+                                                         mask=mask):
+        blockMask = mask[iStart:iEnd, jStart:jEnd]
+        spectra[order[iStart:iEnd, jStart:jEnd][blockMask]] = \
+                                        numpy.asarray(block)[blockMask]
+    return spectra
+
+def _initWorkerProcess(context):
+    global _WORKER_CONTEXT
+    _WORKER_CONTEXT = context
+
+def _fitRowBlockInWorkerProcess(block):
+    return _fitRowBlock(block, 0, block.shape[0], _WORKER_CONTEXT)
+
 class FastXRFLinearFit(object):
     def __init__(self, mcafit=None):
         self._config = None
@@ -63,9 +286,65 @@ def setFitConfigurationFile(self, ffile):
         configuration.read(ffile)
         self.setFitConfiguration(configuration)
 
+    def _getWorkerPool(self, context, nworkers, executor):
+        if executor == "process":
+            # the workers receive the spectra already limited to the
+            # fitted channels
+            workerContext = dict(context,
+                                 iXMin=0,
+                                 iXMax=context['iXMax'] - context['iXMin'])
+            return Pool(nworkers,
+                        initializer=_initWorkerProcess,
+                        initargs=(workerContext,))
+        else:
+            return ThreadPool(nworkers)
+
+    def _fitRows(self, data, context, results, uncertainties,
+                 pool=None, executor="thread", nworkers=1):
+        """
+        Fit all the rows of data storing the output in the supplied buffers.
+
+        If a pool of workers is given, the rows are distributed among them.
+        Threads share the input data and write directly into the output
+        buffers. Processes receive the model in their initializer and one
+        block of spectra per task, the results being copied back into the
+        output buffers.
+        """
+        nRows = data.shape[0]
+        if (pool is None) or (nRows < 2):
+            _fitRowBlock(data, 0, nRows, context, results, uncertainties)
+            return
+        pending = []
+        for i in range(nRows):
+            if executor == "process":
+                block = numpy.array(data[i:i + 1, :,
+                                    context['iXMin']:context['iXMax'] + 1])
+                pending.append((i, pool.apply_async( \
+                                        _fitRowBlockInWorkerProcess,
+                                        (block,))))
+            else:
+                pending.append((i, pool.apply_async(_fitRowBlock,
+                                    (data, i, i + 1, context,
+                                     results, uncertainties))))
+            # limit the number of blocks waiting in memory
+            while len(pending) > (2 * nworkers):
+                self._storeRowBlock(pending.pop(0), results, uncertainties)
+        while len(pending):
+            self._storeRowBlock(pending.pop(0), results, uncertainties)
+
+    def _storeRowBlock(self, task, results, uncertainties):
+        i, asyncResult = task
+        blockResults, blockUncertainties = asyncResult.get()
+        if blockResults is not results:
+            # the block was fitted in another process
+            results[:, i:i + blockResults.shape[1]] = blockResults
+            uncertainties[:, i:i + blockResults.shape[1]] = blockUncertainties
+
     def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                            configuration=None, concentrations=False,
-                           ysum=None, weight=None, refit=True):
+                           ysum=None, weight=None, refit=True,
+                           nworkers=1, executor="thread",
+                           streaming=False, maxbytes=None):
         """
         This method performs the actual fit. The y keyword is the only mandatory input argument.
 
@@ -76,10 +355,17 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         :param weight: 0 Means no weight, 1 Use an average weight, 2 Individual weights (slow)
         :param concentrations: 0 Means no calculation, 1 Calculate them
         :param refit: if False, no check for negative results. Default is True.
+        :param nworkers: Number of workers used to fit blocks of rows in parallel. Default is 1.
+        :param executor: "thread" or "process" pool of workers. Default is "thread".
+        :param streaming: if True, y is read in blocks aligned with its HDF5 chunks (if any),
+                          the next block being read while the current one is fitted.
+        :param maxbytes: maximum size in bytes of the blocks read in streaming mode.
         :return: A dictionnary with the parameters, uncertainties, concentrations and names as keys.
         """
         if y is None:
             raise RuntimeError("y keyword argument is mandatory!")
+        if executor not in ["thread", "process"]:
+            raise ValueError("Unknown executor <%s>" % executor)
 
         #if concentrations:
         #    txt = "Fast concentration calculation not implemented yet"
@@ -166,14 +452,21 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                 totalSpectra = data.shape[0] * data.shape[1]
                 jStep = min(5000, data.shape[1])
                 ysum = numpy.zeros((data.shape[mcaIndex],), numpy.float)
-                for i in range(0, data.shape[0]):
-                    if i == 0:
-                        chunk = numpy.zeros((data.shape[0], jStep), numpy.float)
-                    jStart = 0
-                    while jStart < data.shape[1]:
-                        jEnd = min(jStart + jStep, data.shape[1])
-                        ysum += data[i, jStart:jEnd, :].sum(axis=0, dtype=numpy.float)
-                        jStart = jEnd
+                if streaming:
+                    nChannels = data.shape[mcaIndex]
+                    for item in _iterBlocks(data,
+                                    _getBlockShape(data, nChannels, maxbytes),
+                                    0, nChannels - 1):
+                        ysum += item[-1].sum(axis=(0, 1), dtype=numpy.float)
+                else:
+                    for i in range(0, data.shape[0]):
+                        if i == 0:
+                            chunk = numpy.zeros((data.shape[0], jStep), numpy.float)
+                        jStart = 0
+                        while jStart < data.shape[1]:
+                            jEnd = min(jStart + jStep, data.shape[1])
+                            ysum += data[i, jStart:jEnd, :].sum(axis=0, dtype=numpy.float)
+                            jStart = jEnd
                 firstSpectrum = ysum
             elif not concentrations:
                 # just one spectrum is enough for the setup
@@ -227,8 +520,8 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         #loop for anchors
         xdata = self._mcaTheory.xdata
 
+        anchorslist = []
         if config['fit']['stripflag']:
-            anchorslist = []
             if config['fit']['stripanchorsflag']:
                 if config['fit']['stripanchorslist'] is not None:
                     ravelled = numpy.ravel(xdata)
@@ -240,7 +533,7 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                             if index > 0:
                                 anchorslist.append(index)
             if len(anchorslist) == 0:
-                anchorlist = [0, self._mcaTheory.ydata.size - 1]
+                anchorslist = [0, self._mcaTheory.ydata.size - 1]
             anchorslist.sort()
 
         # find the indices to be used for selecting the appropriate data
@@ -286,53 +579,50 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
         else:
             SVD = True
             sigma_b = None
-        last_svd = None
-        for i in range(0, data.shape[0]):
-            #print(i)
-            #chunks of nColumns spectra
-            if i == 0:
-                chunk = numpy.zeros((dummySpectrum.shape[0],
-                                     jStep),
-                                     numpy.float)
-            jStart = 0
-            while jStart < data.shape[1]:
-                jEnd = min(jStart + jStep, data.shape[1])
-                chunk[:,:(jEnd - jStart)] = data[i, jStart:jEnd, iXMin:iXMax+1].T
-                if config['fit']['stripflag']:
-                    for k in range(jStep):
-                        # obtain the smoothed spectrum
-                        background=SpecfitFuns.SavitskyGolay(chunk[:, k],
-                                                config['fit']['stripfilterwidth'])
-                        lastAnchor = 0
-                        for anchor in anchorslist:
-                            if (anchor > lastAnchor) and (anchor < background.size):
-                                background[lastAnchor:anchor] =\
-                                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                                           config['fit']['snipwidth'],
-                                                           0)
-                                lastAnchor = anchor
-                        if lastAnchor < background.size:
-                            background[lastAnchor:] =\
-                                    SpecfitFuns.snip1d(background[lastAnchor:],
-                                                       config['fit']['snipwidth'],
-                                                       0)
-                        chunk[:, k] -= background
-
-                # perform the multiple fit to all the spectra in the chunk
-                #print("SHAPES")
-                #print(derivatives.shape)
-                #print(chunk[:,:(jEnd - jStart)].shape)
-                ddict=lstsq(derivatives, chunk[:,:(jEnd - jStart)],
-                            sigma_b=sigma_b,
-                            weight=weight,
-                            digested_output=True,
-                            svd=SVD,
-                            last_svd=last_svd)
-                last_svd = ddict.get('svd', None)
-                parameters = ddict['parameters']
-                results[:, i, jStart:jEnd] = parameters
-                uncertainties[:, i, jStart:jEnd] = ddict['uncertainties']
-                jStart = jEnd
+        if SVD:
+            # the pseudo-inverse of the model matrix does not depend on the
+            # data and can be shared by all the chunks
+            solver = LinearLeastSquaresSolver(derivatives,
+                                              sigma_b=sigma_b,
+                                              weight=weight)
+        else:
+            solver = None
+        context = {'derivatives': derivatives,
+                   'iXMin': iXMin,
+                   'iXMax': iXMax,
+                   'jStep': jStep,
+                   'stripflag': config['fit']['stripflag'],
+                   'snipwidth': config['fit']['snipwidth'],
+                   'stripfilterwidth': config['fit']['stripfilterwidth'],
+                   'anchorslist': anchorslist,
+                   'sigma_b': sigma_b,
+                   'weight': weight,
+                   'solver': solver}
+        if (nworkers > 1) and (nRows > 1):
+            pool = self._getWorkerPool(context, nworkers, executor)
+        else:
+            pool = None
+        try:
+            if streaming:
+                # read blocks following the layout of the data while
+                # the previous block is being fitted
+                blockShape = _getBlockShape(data, iXMax + 1 - iXMin, maxbytes)
+                blockContext = dict(context, iXMin=0, iXMax=iXMax - iXMin)
+                for iStart, iEnd, jStart, jEnd, block in \
+                            _iterBlocks(data, blockShape, iXMin, iXMax):
+                    self._fitRows(block, blockContext,
+                                  results[:, iStart:iEnd, jStart:jEnd],
+                                  uncertainties[:, iStart:iEnd, jStart:jEnd],
+                                  pool=pool,
+                                  executor=executor,
+                                  nworkers=nworkers)
+            else:
+                self._fitRows(data, context, results, uncertainties,
+                              pool=pool, executor=executor, nworkers=nworkers)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
         if DEBUG:
             t = time.time() - t0
             print("First fit elapsed = %f" % t)
@@ -403,59 +693,40 @@ def fitMultipleSpectra(self, x=None, y=None, xmin=None, xmax=None,
                 nFits += 1
                 A = derivatives[:, [i for i in range(nFree) if i not in badParameters]]
                 #assume we'll not have too many spectra
-                if data.dtype not in [numpy.float32, numpy.float64]:
-                    data
                 if data.dtype not in [numpy.float32, numpy.float64]:
                     if data.itemsize < 5:
                         data_dtype = numpy.float32
                     else:
-                        data_dtype = numpy.floa64
+                        data_dtype = numpy.float64
                 else:
                     data_dtype = data.dtype
-                try:
-                    if data.dtype != data_dtype:
-                        spectra = numpy.zeros((int(badMask.sum()), 1 + iXMax - iXMin),
-                                          data_dtype)
-                        spectra[:] = data[badMask, iXMin:iXMax+1]
-                    else:
-                        spectra = data[badMask, iXMin:iXMax+1]
-                    spectra.shape = badMask.sum(), -1
-                except TypeError:
-                    # in case of dynamic arrays, two dimensional indices are not
-                    # supported by h5py
-                    spectra = numpy.zeros((int(badMask.sum()), 1 + iXMax - iXMin),
-                                          data_dtype)
-                    selectedIndices = numpy.nonzero(badMask > 0)
-                    tmpData = numpy.zeros((1, 1 + iXMax - iXMin), data_dtype)
-                    oldDataRow = -1
-                    j = 0
-                    for i in range(len(selectedIndices[0])):
-                        j = selectedIndices[0][i]
-                        if j != oldDataRow:
-                            tmpData = data[j]
-                            olddataRow = j
-                        spectra[i] = tmpData[selectedIndices[1][i], iXMin:iXMax+1]
+                spectra = None
+                if not streaming:
+                    try:
+                        if data.dtype != data_dtype:
+                            spectra = numpy.zeros((int(badMask.sum()), 1 + iXMax - iXMin),
+                                              data_dtype)
+                            spectra[:] = data[badMask, iXMin:iXMax+1]
+                        else:
+                            spectra = data[badMask, iXMin:iXMax+1]
+                        spectra.shape = badMask.sum(), -1
+                    except TypeError:
+                        # in case of dynamic arrays, two dimensional indices are not
+                        # supported by h5py
+                        spectra = None
+                if spectra is None:
+                    # only read the blocks containing the pixels to refit
+                    spectra = _getMaskedSpectra(data, badMask, iXMin, iXMax,
+                                        data_dtype,
+                                        _getBlockShape(data, iXMax + 1 - iXMin,
+                                                       maxbytes))
                 spectra = spectra.T
                 #
                 if config['fit']['stripflag']:
-                    for k in range(spectra.shape[1]):
-                        # obtain the smoothed spectrum
-                        background=SpecfitFuns.SavitskyGolay(spectra[:, k],
-                                                config['fit']['stripfilterwidth'])
-                        lastAnchor = 0
-                        for anchor in anchorslist:
-                            if (anchor > lastAnchor) and (anchor < background.size):
-                                background[lastAnchor:anchor] =\
-                                        SpecfitFuns.snip1d(background[lastAnchor:anchor],
-                                                           config['fit']['snipwidth'],
-                                                           0)
-                                lastAnchor = anchor
-                        if lastAnchor < background.size:
-                            background[lastAnchor:] =\
-                                    SpecfitFuns.snip1d(background[lastAnchor:],
-                                                       config['fit']['snipwidth'],
-                                                       0)
-                    spectra[:, k] -= background
+                    spectra -= getMultipleSpectraBackground(spectra.T,
+                                            config['fit']['snipwidth'],
+                                            config['fit']['stripfilterwidth'],
+                                            anchorslist).T
                 ddict = lstsq(A, spectra,
                               sigma_b=sigma_b,
                               weight=weight,
@@ -655,7 +926,7 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
     longoptions = ['cfg=', 'outdir=', 'concentrations=', 'weight=', 'refit=',
                    'tif=', #'listfile=',
                    'filepattern=', 'begin=', 'end=', 'increment=',
-                   "outfileroot="]
+                   "outfileroot=", 'nworkers=']
     try:
         opts, args = getopt.getopt(
                      sys.argv[1:],
@@ -676,6 +947,7 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
     weight=0
     tif=0
     concentrations=0
+    nworkers=1
     for opt, arg in opts:
         if opt in ('--cfg'):
             configurationFile = arg
@@ -709,6 +981,8 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
             fileRoot = arg
         elif opt in ['--tif', '--tiff']:
             tif = int(arg)
+        elif opt in '--nworkers':
+            nworkers = int(arg)
     if filepattern is not None:
         if (begin is None) or (end is None):
             raise ValueError(\
@@ -760,7 +1034,8 @@ def getFileListFromPattern(pattern, begin, end, increment=None):
     result = fastFit.fitMultipleSpectra(y=dataStack,
                                          weight=weight,
                                          refit=refit,
-                                         concentrations=concentrations)
+                                         concentrations=concentrations,
+                                         nworkers=nworkers)
     print("Total Elapsed = % s " % (time.time() - t0))
     if outputDir is not None:
         if 'concentrations' in result:
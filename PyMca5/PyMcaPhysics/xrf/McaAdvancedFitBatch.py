@@ -33,7 +33,9 @@
 import sys
 import os
 import numpy
+import multiprocessing
 from . import ClassMcaTheory
+from PyMca5.PyMcaMath.fitting import Gefit
 from PyMca5.PyMcaCore import SpecFileLayer
 from PyMca5.PyMcaCore import EdfFileLayer
 from PyMca5.PyMcaIO import EdfFile
@@ -50,6 +52,11 @@
 from PyMca5.PyMcaIO import ConfigDict
 from . import ConcentrationsTool
 
+# starting point of the fit of each spectrum
+WARMSTART_NONE = 0      # full estimation of every spectrum
+WARMSTART_PREVIOUS = 1  # start from the fit of the previous spectrum
+WARMSTART_NEIGHBOUR = 2 # start from the fit of the spectrum in previous row
+
 
 class McaAdvancedFitBatch(object):
     def __init__(self,initdict,filelist=None,outputdir=None,
@@ -58,7 +65,8 @@ def __init__(self,initdict,filelist=None,outputdir=None,
                     concentrations=0, fitfiles=1, fitimages=1,
                     filebeginoffset = 0, fileendoffset=0,
                     mcaoffset=0, chunk = None,
-                    selection=None, lock=None):
+                    selection=None, lock=None, nworkers=1,
+                    warmstart=WARMSTART_NONE, warmstartthreshold=2.0):
         #for the time being the concentrations are bound to the .fit files
         #that is not necessary, but it will be correctly implemented in
         #future releases
@@ -99,6 +107,15 @@ def __init__(self,initdict,filelist=None,outputdir=None,
         self.mcaOffset = mcaoffset
         self.chunk     = chunk
         self.selection = selection
+        # number of worker processes used to fit the spectra
+        self.nWorkers  = max(1, int(nworkers))
+        self._pool     = None
+        self._pending  = []
+        # warm start is only possible when the spectra are fitted in order
+        self.warmStart = warmstart
+        self.warmStartThreshold = warmstartthreshold
+        self.warmStartStatistics = {}
+        self.__resetWarmStart()
 
 
     def setFileList(self,filelist=None):
@@ -156,6 +173,41 @@ def processList(self):
         self.counter =  0
         self.__row   = self.fileBeginOffset - 1
         self.__stack = None
+        self._pending = []
+        self.__resetWarmStart()
+        self.warmStartStatistics = {"estimate": 0,
+                                    "previous": 0,
+                                    "neighbour": 0,
+                                    "fallback": 0}
+        usedPool = (self.nWorkers > 1) and (not self.roiFit)
+        if usedPool:
+            self._pool = multiprocessing.Pool(self.nWorkers,
+                                initializer=_initWorker,
+                                initargs=(self.__configList,))
+        try:
+            self.__processFiles()
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+        if self.counter:
+            if not self.roiFit:
+                if self.fitFiles:
+                    self.listfile.write(']\n')
+                    self.listfile.close()
+            if self.__ncols is not None:
+                if self.__ncols:self.saveImage()
+            if self.warmStart and (not self.roiFit) and (not usedPool):
+                self.__log("Warm start: %d estimated, %d from previous, "
+                           "%d from neighbour, %d fallbacks" %
+                           (self.warmStartStatistics["estimate"],
+                            self.warmStartStatistics["previous"],
+                            self.warmStartStatistics["neighbour"],
+                            self.warmStartStatistics["fallback"]))
+        self.onEnd()
+
+    def __processFiles(self):
         for i in range(0+self.fileBeginOffset,
                        len(self._filelist)-self.fileEndOffset,
                        self.fileStep):
@@ -164,6 +216,7 @@ def processList(self):
                     if i != 0:
                         self.mcafit = ClassMcaTheory.McaTheory(self.__configList[i])
                         self.__currentConfig = i
+                        self.__resetWarmStart()
             self.mcafit.enableOptimizedLinearFit()
             inputfile   = self._filelist[i]
             self.__row += 1 #should be plus fileStep?
@@ -184,14 +237,8 @@ def processList(self):
                     break
             else:
                 self.__processOneFile()
-        if self.counter:
-            if not self.roiFit:
-                if self.fitFiles:
-                    self.listfile.write(']\n')
-                    self.listfile.close()
-            if self.__ncols is not None:
-                if self.__ncols:self.saveImage()
-        self.onEnd()
+            self.__flushPendingResults()
+        self.__flushPendingResults()
 
     def getFileHandle(self,inputfile):
         try:
@@ -222,6 +269,49 @@ def getFileHandle(self,inputfile):
             raise IOError("I do not know what to do with file %s" % inputfile)
 
 
+    def __resetWarmStart(self):
+        self._lastFit = None
+        self._rowFits = {}
+        self._previousRowFits = {}
+        self._warmStartRow = None
+
+    def __getWarmStartSeed(self):
+        """
+        Return the (parameters, chisq, origin) tuple the fit of the current
+        spectrum has to start from or None if a full estimation is needed.
+        """
+        if not self.warmStart:
+            return None
+        if self.mcafit.config['fit'].get("strategyflag", False):
+            # the configuration changes from one spectrum to the next
+            return None
+        if self.__row != self._warmStartRow:
+            if (self._warmStartRow is not None) and \
+               (self.__row == (self._warmStartRow + 1)):
+                self._previousRowFits = self._rowFits
+            else:
+                self._previousRowFits = {}
+            self._rowFits = {}
+            self._warmStartRow = self.__row
+        if self.warmStart == WARMSTART_NEIGHBOUR:
+            if self.__col in self._previousRowFits:
+                return self._previousRowFits[self.__col] + ("neighbour",)
+        if self._lastFit is not None:
+            return self._lastFit + ("previous",)
+        return None
+
+    def __updateWarmStart(self, seed, seeded):
+        if seeded:
+            self.warmStartStatistics[seed[2]] += 1
+        else:
+            self.warmStartStatistics["estimate"] += 1
+            if seed is not None:
+                self.warmStartStatistics["fallback"] += 1
+        self._lastFit = (numpy.array(self.mcafit.fittedpar, copy=True),
+                         self.mcafit.chisq)
+        if self.warmStart == WARMSTART_NEIGHBOUR:
+            self._rowFits[self.__col] = self._lastFit
+
     def onNewFile(self,ffile, filelist):
         self.__log(ffile)
 
@@ -343,6 +433,7 @@ def __processStack(self):
                 self.onMca(mca, numberofmca, filename=filename,
                                             key=key,
                                             info=infoDict)
+            self.__flushPendingResults()
 
     def __processOneFile(self):
         ffile=self.file
@@ -434,6 +525,7 @@ def __processOneFile(self):
                                                     key=key,
                                                     info=infoDict)
                             #print "remaining = ",(time.time()-e0) * (info['NbMca'] - i)
+                self.__flushPendingResults()
 
     def __getFitFile(self, filename, key):
         fitdir = self.os_path_join(self._outputdir,"FIT")
@@ -463,11 +555,154 @@ def os_path_join(self, a, b):
                                            a.decode('latin-1'))
         return outfile
 
+    def __getFitDirectoryFile(self, filename, key):
+        fitdir = self.os_path_join(self._outputdir,"FIT")
+        if not os.path.exists(fitdir):
+            try:
+                os.mkdir(fitdir)
+            except:
+                print("I could not create directory %s" % fitdir)
+                return None
+        fitdir = self.os_path_join(fitdir,filename+"_FITDIR")
+        if not os.path.exists(fitdir):
+            try:
+                os.mkdir(fitdir)
+            except:
+                print("I could not create directory %s" % fitdir)
+                return None
+        if not os.path.isdir(fitdir):
+            print("%s does not seem to be a valid directory" % fitdir)
+            return self.os_path_join(self._outputdir, filename)
+        outfile = filename +"_"+key+".fit"
+        return self.os_path_join(fitdir,  outfile)
+
+    def __storePendingResult(self):
+        task, filename, key, outfile, row, col = self._pending.pop(0)
+        result, concentrations, error, seeded = task.get()
+        if error is not None:
+            print(error)
+            return
+        self.__storeOneMcaResult(result, concentrations, filename, key,
+                                 outfile, row, col)
+
+    def __flushPendingResults(self):
+        while len(self._pending):
+            self.__storePendingResult()
+
+    def __storeOneMcaResult(self, result, concentrations,
+                            filename, key, outfile, row, col):
+        if self._concentrations:
+            self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
+            if len(self._concentrationsAsAscii) > 1:
+                text  = ""
+                text += "SOURCE: "+ filename +"\n"
+                text += "KEY: "+key+"\n"
+                text += self._concentrationsAsAscii + "\n"
+                f=open(self._concentrationsFile,"a")
+                f.write(text)
+                f.close()
+
+        #output options
+        # .FIT files
+        if self.fitFiles:
+            #python like output list
+            if not self.counter:
+                name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
+                name = self.os_path_join(self._outputdir,name)
+                try:
+                    os.remove(name)
+                except:
+                    pass
+                self.listfile=open(name,"w+")
+                self.listfile.write("fitfilelist = [")
+                self.listfile.write('\n'+outfile)
+            else:
+                self.listfile.write(',\n'+outfile)
+
+        #IMAGES
+        if self.fitImages:
+            #this only works with EDF
+            if self.__ncols is not None:
+                if not self.counter:
+                    imgdir = self.os_path_join(self._outputdir,"IMAGES")
+                    if not os.path.exists(imgdir):
+                        try:
+                            os.mkdir(imgdir)
+                        except:
+                            print("I could not create directory %s" %\
+                                  imgdir)
+                            return
+                    elif not os.path.isdir(imgdir):
+                        print("%s does not seem to be a valid directory" %\
+                              imgdir)
+                    self.imgDir = imgdir
+                    self.__peaks  = []
+                    self.__images = {}
+                    self.__sigmas = {}
+                    if not self.__stack:
+                        self.__nrows   = len(range(0,len(self._filelist),self.fileStep))
+                    for group in result['groups']:
+                        self.__peaks.append(group)
+                        self.__images[group]= numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float)
+                        self.__sigmas[group]= numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float)
+                    self.__images['chisq']  = numpy.zeros((self.__nrows,
+                                                           self.__ncols),
+                                                           numpy.float) - 1.
+                    if self._concentrations:
+                        layerlist = concentrations['layerlist']
+                        if 'mmolar' in concentrations:
+                            self.__conLabel = " mM"
+                            self.__conKey   = "mmolar"
+                        else:
+                            self.__conLabel = " mass fraction"
+                            self.__conKey   = "mass fraction"
+                        for group in concentrations['groups']:
+                            key = group+self.__conLabel
+                            self.__concentrationsKeys.append(key)
+                            self.__images[key] = numpy.zeros((self.__nrows,
+                                                              self.__ncols),
+                                                              numpy.float)
+                            if len(layerlist) > 1:
+                                for layer in layerlist:
+                                    key = group+" "+layer
+                                    self.__concentrationsKeys.append(key)
+                                    self.__images[key] = numpy.zeros((self.__nrows,
+                                                                self.__ncols),
+                                                                numpy.float)
+            for peak in self.__peaks:
+                try:
+                    self.__images[peak][row, col] = result[peak]['fitarea']
+                    self.__sigmas[peak][row, col] = result[peak]['sigmaarea']
+                except:
+                    pass
+            if self._concentrations:
+                layerlist = concentrations['layerlist']
+                for group in concentrations['groups']:
+                    self.__images[group+self.__conLabel][row, col] = \
+                                          concentrations[self.__conKey][group]
+                    if len(layerlist) > 1:
+                        for layer in layerlist:
+                            self.__images[group+" "+layer] [row, col] = \
+                                          concentrations[layer][self.__conKey][group]
+            try:
+                self.__images['chisq'][row, col] = result['chisq']
+            except:
+                print("Error on chisq row %d col %d" %\
+                      (row, col))
+                print("File = %s\n" % filename)
+                pass
+
+        #update counter
+        self.counter += 1
+
     def __processOneMca(self,x,y,filename,key,info=None):
         self._concentrationsAsAscii = ""
         if not self.roiFit:
             result = None
-            concentrationsdone = 0
             concentrations = None
             outfile=self.os_path_join(self._outputdir, filename)
             fitfile = self.__getFitFile(filename,key)
@@ -486,97 +721,30 @@ def __processOneMca(self,x,y,filename,key,info=None):
                         print("I could not delete existing concentrations file %s" %\
                               self._concentrationsFile)
             #print "self._concentrationsFile", self._concentrationsFile
+            if self.fitFiles:
+                outfile = self.__getFitDirectoryFile(filename, key)
+                if outfile is None:
+                    return
             if self.useExistingFiles and os.path.exists(fitfile):
-                useExistingResult = 1
                 try:
                     dict = ConfigDict.ConfigDict()
                     dict.read(fitfile)
                     result = dict['result']
                     if 'concentrations' in dict:
-                        concentrationsdone = 1
+                        concentrations = dict['concentrations']
                 except:
                     print("Error trying to use result file %s" % fitfile)
                     print("Please, consider deleting it.")
                     print(sys.exc_info())
                     return
-            else:
-                useExistingResult = 0
-                try:
-                    #I make sure I take the fit limits configuration
-                    self.mcafit.config['fit']['use_limit'] = 1
-                    self.mcafit.setData(x,y, time=info.get("McaLiveTime", None))
-                except:
-                    print("Error entering data of file with output = %s\n%s" %\
-                          (filename, sys.exc_info()[1]))
-                    # make sure the configuration is restored
-                    if self.mcafit.config['fit'].get("strategyflag", False):
-                        config = self.__configList[self.__currentConfig]
-                        print("Restoring fitconfiguration")
-                        self.mcafit = ClassMcaTheory.McaTheory(config)
-                        self.mcafit.enableOptimizedLinearFit()
-                    return
-                try:
-                    self.mcafit.estimate()
-                    if self.fitFiles:
-                        fitresult, result = self.mcafit.startfit(digest=1)
-                    elif self._concentrations and (self.mcafit._fluoRates is None):
-                        fitresult, result = self.mcafit.startfit(digest=1)
-                    elif self._concentrations:
-                        fitresult = self.mcafit.startfit(digest=0)
-                        try:
-                            fitresult0 = {}
-                            fitresult0['fitresult'] = fitresult
-                            fitresult0['result'] = self.mcafit.imagingDigestResult()
-                            fitresult0['result']['config'] = self.mcafit.config
-                            conf = self.mcafit.configure()
-                            tconf = self._tool.configure()
-                            if 'concentrations' in conf:
-                                tconf.update(conf['concentrations'])
-                            else:
-                                #what to do?
-                                pass
-                            concentrations = self._tool.processFitResult(config=tconf,
-                                            fitresult=fitresult0,
-                                            elementsfrommatrix=False,
-                                            fluorates = self.mcafit._fluoRates)
-                        except:
-                            print("error in concentrations")
-                            print(sys.exc_info()[0:-1])
-                        concentrationsdone = True
-                    else:
-                        #just images
-                        fitresult = self.mcafit.startfit(digest=0)
-                except:
-                    print("Error fitting file with output = %s: %s)" %\
-                          (filename, sys.exc_info()[1]))
-                    if self.mcafit.config['fit'].get("strategyflag", False):
-                        config = self.__configList[self.__currentConfig]
-                        print("Restoring fitconfiguration")
-                        self.mcafit = ClassMcaTheory.McaTheory(config)
-                        self.mcafit.enableOptimizedLinearFit()
-                    return
-            if self._concentrations:
-                if concentrationsdone == 0:
+                if self._concentrations and (concentrations is None):
                     if not ('concentrations' in result):
-                        if useExistingResult:
-                            fitresult0={}
-                            fitresult0['result'] = result
-                            conf = result['config']
-                        else:
-                            fitresult0={}
-                            if result is None:
-                                result = self.mcafit.digestresult()
-                            fitresult0['result']    = result
-                            fitresult0['fitresult'] = fitresult
-                            conf = self.mcafit.configure()
+                        fitresult0={}
+                        fitresult0['result'] = result
+                        conf = result['config']
                         tconf = self._tool.configure()
                         if 'concentrations' in conf:
                             tconf.update(conf['concentrations'])
-                        else:
-                            pass
-                            #print "Concentrations not calculated"
-                            #print "Is your fit configuration file correct?"
-                            #return
                         try:
                             concentrations = self._tool.processFitResult(config=tconf,
                                             fitresult=fitresult0,
@@ -584,156 +752,50 @@ def __processOneMca(self,x,y,filename,key,info=None):
                         except:
                             print("error in concentrations")
                             print(sys.exc_info()[0:-1])
-                            #return
-                self._concentrationsAsAscii=self._toolConversion.getConcentrationsAsAscii(concentrations)
-                if len(self._concentrationsAsAscii) > 1:
-                    text  = ""
-                    text += "SOURCE: "+ filename +"\n"
-                    text += "KEY: "+key+"\n"
-                    text += self._concentrationsAsAscii + "\n"
-                    f=open(self._concentrationsFile,"a")
-                    f.write(text)
-                    f.close()
-
-            #output options
-            # .FIT files
-            if self.fitFiles:
-                fitdir = self.os_path_join(self._outputdir,"FIT")
-                if not os.path.exists(fitdir):
-                    try:
-                        os.mkdir(fitdir)
-                    except:
-                        print("I could not create directory %s" % fitdir)
-                        return
-                fitdir = self.os_path_join(fitdir,filename+"_FITDIR")
-                if not os.path.exists(fitdir):
-                    try:
-                        os.mkdir(fitdir)
-                    except:
-                        print("I could not create directory %s" % fitdir)
-                        return
-                if not os.path.isdir(fitdir):
-                    print("%s does not seem to be a valid directory" % fitdir)
-                else:
-                    outfile = filename +"_"+key+".fit"
-                    outfile = self.os_path_join(fitdir,  outfile)
-                if not useExistingResult:
-                    result = self.mcafit.digestresult(outfile=outfile,
-                                                      info=info)
-                if concentrations is not None:
-                    try:
-                        f=ConfigDict.ConfigDict()
-                        f.read(outfile)
-                        f['concentrations'] = concentrations
-                        try:
-                            os.remove(outfile)
-                        except:
-                            print("error deleting fit file")
-                        f.write(outfile)
-                    except:
-                        print("Error writing concentrations to fit file")
-                        print(sys.exc_info())
-
-                #python like output list
-                if not self.counter:
-                    name = os.path.splitext(self._rootname)[0]+"_fitfilelist.py"
-                    name = self.os_path_join(self._outputdir,name)
-                    try:
-                        os.remove(name)
-                    except:
-                        pass
-                    self.listfile=open(name,"w+")
-                    self.listfile.write("fitfilelist = [")
-                    self.listfile.write('\n'+outfile)
-                else:
-                    self.listfile.write(',\n'+outfile)
+                        if self.fitFiles and (concentrations is not None):
+                            _writeConcentrationsToFitFile(outfile,
+                                                          concentrations)
+            elif self._pool is not None:
+                # the fit is performed by one of the worker processes
+                task = self._pool.apply_async(_fitOneMcaInWorker,
+                                (self.__currentConfig, x, y, filename, info,
+                                 self.fitFiles, self._concentrations, outfile))
+                self._pending.append((task, filename, key, outfile,
+                                      self.__row, self.__col))
+                # limit the number of spectra waiting to be stored
+                while len(self._pending) > (2 * self.nWorkers):
+                    self.__storePendingResult()
+                return
             else:
-                if not useExistingResult:
-                    if 0:
-                        #this is very slow and not needed just for imaging
-                        if result is None:
-                            result = self.mcafit.digestresult()
-                    else:
-                        if result is None:
-                            result = self.mcafit.imagingDigestResult()
-
-            #IMAGES
-            if self.fitImages:
-                #this only works with EDF
-                if self.__ncols is not None:
-                    if not self.counter:
-                        imgdir = self.os_path_join(self._outputdir,"IMAGES")
-                        if not os.path.exists(imgdir):
-                            try:
-                                os.mkdir(imgdir)
-                            except:
-                                print("I could not create directory %s" %\
-                                      imgdir)
-                                return
-                        elif not os.path.isdir(imgdir):
-                            print("%s does not seem to be a valid directory" %\
-                                  imgdir)
-                        self.imgDir = imgdir
-                        self.__peaks  = []
-                        self.__images = {}
-                        self.__sigmas = {}
-                        if not self.__stack:
-                            self.__nrows   = len(range(0,len(self._filelist),self.fileStep))
-                        for group in result['groups']:
-                            self.__peaks.append(group)
-                            self.__images[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                            self.__sigmas[group]= numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float)
-                        self.__images['chisq']  = numpy.zeros((self.__nrows,
-                                                               self.__ncols),
-                                                               numpy.float) - 1.
-                        if self._concentrations:
-                            layerlist = concentrations['layerlist']
-                            if 'mmolar' in concentrations:
-                                self.__conLabel = " mM"
-                                self.__conKey   = "mmolar"
-                            else:
-                                self.__conLabel = " mass fraction"
-                                self.__conKey   = "mass fraction"
-                            for group in concentrations['groups']:
-                                key = group+self.__conLabel
-                                self.__concentrationsKeys.append(key)
-                                self.__images[key] = numpy.zeros((self.__nrows,
-                                                                  self.__ncols),
-                                                                  numpy.float)
-                                if len(layerlist) > 1:
-                                    for layer in layerlist:
-                                        key = group+" "+layer
-                                        self.__concentrationsKeys.append(key)
-                                        self.__images[key] = numpy.zeros((self.__nrows,
-                                                                    self.__ncols),
-                                                                    numpy.float)
-                for peak in self.__peaks:
-                    try:
-                        self.__images[peak][self.__row, self.__col] = result[peak]['fitarea']
-                        self.__sigmas[peak][self.__row, self.__col] = result[peak]['sigmaarea']
-                    except:
-                        pass
                 if self._concentrations:
-                    layerlist = concentrations['layerlist']
-                    for group in concentrations['groups']:
-                        self.__images[group+self.__conLabel][self.__row, self.__col] = \
-                                              concentrations[self.__conKey][group]
-                        if len(layerlist) > 1:
-                            for layer in layerlist:
-                                self.__images[group+" "+layer] [self.__row, self.__col] = \
-                                              concentrations[layer][self.__conKey][group]
-                try:
-                    self.__images['chisq'][self.__row, self.__col] = result['chisq']
-                except:
-                    print("Error on chisq row %d col %d" %\
-                          (self.__row, self.__col))
-                    print("File = %s\n" % filename)
-                    pass
-
+                    tool = self._tool
+                else:
+                    tool = None
+                seed = self.__getWarmStartSeed()
+                result, concentrations, error, seeded = _fitOneMca(self.mcafit,
+                                                           x, y, filename,
+                                                           info=info,
+                                                           fitfiles=self.fitFiles,
+                                                           tool=tool,
+                                                           outfile=outfile,
+                                                           seed=seed,
+                                                           threshold=self.warmStartThreshold)
+                if error is not None:
+                    print(error)
+                    # do not propagate a failed fit
+                    self.__resetWarmStart()
+                    # make sure the configuration is restored
+                    if self.mcafit.config['fit'].get("strategyflag", False):
+                        config = self.__configList[self.__currentConfig]
+                        print("Restoring fitconfiguration")
+                        self.mcafit = ClassMcaTheory.McaTheory(config)
+                        self.mcafit.enableOptimizedLinearFit()
+                    return
+                if self.warmStart:
+                    self.__updateWarmStart(seed, seeded)
+            self.__storeOneMcaResult(result, concentrations, filename, key,
+                                     outfile, self.__row, self.__col)
+            return
         else:
                 dict=self.mcafit.roifit(x,y,width=self.roiWidth)
                 #this only works with EDF
@@ -894,15 +956,177 @@ def saveImage(self,ffile=None):
                         i=1
 
 
+def _fitOneMca(mcafit, x, y, filename, info=None, fitfiles=True,
+               tool=None, outfile=None, seed=None, threshold=None):
+    """
+    Fit one spectrum with the given McaTheory instance.
+
+    Returns a tuple (result, concentrations, error, seeded) where error is
+    None on success or the message to be reported otherwise.
+    If fitfiles is true the digested result is written to outfile.
+    Concentrations are only calculated when a ConcentrationsTool is given.
+    If seed is given, see _startFit, seeded tells if the estimation of the
+    spectrum was skipped.
+    """
+    if info is None:
+        info = {}
+    result = None
+    concentrations = None
+    concentrationsdone = False
+    seeded = False
+    try:
+        #I make sure I take the fit limits configuration
+        mcafit.config['fit']['use_limit'] = 1
+        mcafit.setData(x,y, time=info.get("McaLiveTime", None))
+    except:
+        return None, None, "Error entering data of file with output = %s\n%s" %\
+                           (filename, sys.exc_info()[1]), seeded
+    try:
+        fitresult, seeded = _startFit(mcafit, seed=seed, threshold=threshold)
+        if fitfiles:
+            result = mcafit.digestresult()
+        elif (tool is not None) and (mcafit._fluoRates is None):
+            result = mcafit.digestresult()
+        elif tool is not None:
+            try:
+                fitresult0 = {}
+                fitresult0['fitresult'] = fitresult
+                fitresult0['result'] = mcafit.imagingDigestResult()
+                fitresult0['result']['config'] = mcafit.config
+                conf = mcafit.configure()
+                tconf = tool.configure()
+                if 'concentrations' in conf:
+                    tconf.update(conf['concentrations'])
+                concentrations = tool.processFitResult(config=tconf,
+                                fitresult=fitresult0,
+                                elementsfrommatrix=False,
+                                fluorates = mcafit._fluoRates)
+            except:
+                print("error in concentrations")
+                print(sys.exc_info()[0:-1])
+            concentrationsdone = True
+    except:
+        return None, None, "Error fitting file with output = %s: %s)" %\
+                           (filename, sys.exc_info()[1]), seeded
+    if (tool is not None) and (not concentrationsdone):
+        if not ('concentrations' in result):
+            fitresult0={}
+            fitresult0['result']    = result
+            fitresult0['fitresult'] = fitresult
+            conf = mcafit.configure()
+            tconf = tool.configure()
+            if 'concentrations' in conf:
+                tconf.update(conf['concentrations'])
+            try:
+                concentrations = tool.processFitResult(config=tconf,
+                                fitresult=fitresult0,
+                                elementsfrommatrix=False)
+            except:
+                print("error in concentrations")
+                print(sys.exc_info()[0:-1])
+    if fitfiles:
+        result = mcafit.digestresult(outfile=outfile, info=info)
+        if concentrations is not None:
+            _writeConcentrationsToFitFile(outfile, concentrations)
+    elif result is None:
+        #digestresult is very slow and not needed just for imaging
+        result = mcafit.imagingDigestResult()
+    return result, concentrations, None, seeded
+
+def _startFit(mcafit, seed=None, threshold=None):
+    """
+    Fit the data entered in mcafit and return the tuple (fitresult, seeded).
+
+    seed is either None or a (parameters, chisq) tuple, as obtained from
+    the fit of a similar spectrum, used to start the fit without going
+    through the estimation of the spectrum. The full estimation is only
+    performed when the reduced chi square of that fit is larger than
+    threshold times the reduced chi square of the fit the seed comes from
+    (taken as 1.0 if smaller).
+    """
+    if seed is not None:
+        parameters, chisq = seed[0], seed[1]
+        if len(parameters) == len(mcafit.parameters):
+            parameters = numpy.array(parameters, dtype=numpy.float)
+            # a quoted parameter sitting at one of its limits does not move
+            # anymore, start slightly inside the allowed range
+            codes = numpy.array(mcafit.codes)
+            quoted = codes[0] == Gefit.CQUOTED
+            if quoted.any():
+                pmin = numpy.minimum(codes[1], codes[2])[quoted]
+                pmax = numpy.maximum(codes[1], codes[2])[quoted]
+                margin = 0.05 * (pmax - pmin)
+                parameters[quoted] = numpy.clip(parameters[quoted],
+                                                pmin + margin, pmax - margin)
+            mcafit.parameters = parameters
+            fitresult = mcafit.startfit(digest=0)
+            if threshold is None:
+                return fitresult, True
+            if mcafit.chisq <= (threshold * max(chisq, 1.0)):
+                return fitresult, True
+    mcafit.estimate()
+    return mcafit.startfit(digest=0), False
+
+def _writeConcentrationsToFitFile(outfile, concentrations):
+    try:
+        f=ConfigDict.ConfigDict()
+        f.read(outfile)
+        f['concentrations'] = concentrations
+        try:
+            os.remove(outfile)
+        except:
+            print("error deleting fit file")
+        f.write(outfile)
+    except:
+        print("Error writing concentrations to fit file")
+        print(sys.exc_info())
+
+# state of each worker process of the pool used by McaAdvancedFitBatch
+_WORKER_STATE = {}
+
+def _initWorker(configList):
+    _WORKER_STATE['configList'] = configList
+    _WORKER_STATE['mcafit'] = {}
+    _WORKER_STATE['tool'] = None
+
+def _getWorkerMcaTheory(configIndex):
+    mcafit = _WORKER_STATE['mcafit'].get(configIndex, None)
+    if mcafit is None:
+        mcafit = ClassMcaTheory.McaTheory(\
+                        _WORKER_STATE['configList'][configIndex])
+        mcafit.enableOptimizedLinearFit()
+        _WORKER_STATE['mcafit'][configIndex] = mcafit
+    return mcafit
+
+def _fitOneMcaInWorker(configIndex, x, y, filename, info,
+                       fitfiles, concentrations, outfile):
+    mcafit = _getWorkerMcaTheory(configIndex)
+    tool = None
+    if concentrations:
+        tool = _WORKER_STATE['tool']
+        if tool is None:
+            tool = ConcentrationsTool.ConcentrationsTool()
+            _WORKER_STATE['tool'] = tool
+    output = _fitOneMca(mcafit, x, y, filename, info=info,
+                        fitfiles=fitfiles, tool=tool, outfile=outfile)
+    if output[2] is not None:
+        # make sure the configuration is restored
+        if mcafit.config['fit'].get("strategyflag", False):
+            del _WORKER_STATE['mcafit'][configIndex]
+    return output
+
 if __name__ == "__main__":
     import getopt
     options     = 'f'
-    longoptions = ['cfg=','pkm=','outdir=','roifit=','roi=','roiwidth=']
+    longoptions = ['cfg=','pkm=','outdir=','roifit=','roi=','roiwidth=',
+                   'nworkers=','warmstart=']
     filelist = None
     outdir   = None
     cfg      = None
     roifit   = 0
     roiwidth = 250.
+    nworkers = 1
+    warmstart = WARMSTART_NONE
     opts, args = getopt.getopt(
                     sys.argv[1:],
                     options,
@@ -916,10 +1140,15 @@ def saveImage(self,ffile=None):
             roifit   = int(arg)
         elif opt in ('--roiwidth'):
             roiwidth = float(arg)
+        elif opt in ('--nworkers'):
+            nworkers = int(arg)
+        elif opt in ('--warmstart'):
+            warmstart = int(arg)
     filelist=args
     if len(filelist) == 0:
         print("No input files, run GUI")
         sys.exit(0)
 
-    b = McaAdvancedFitBatch(cfg,filelist,outdir,roifit,roiwidth)
+    b = McaAdvancedFitBatch(cfg,filelist,outdir,roifit,roiwidth,
+                            nworkers=nworkers, warmstart=warmstart)
     b.processList()
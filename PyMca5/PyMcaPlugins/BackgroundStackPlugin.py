@@ -58,12 +58,20 @@
     stackUpdated
     selectionMaskUpdated
 """
+import os
 from PyMca5 import StackPluginBase
 from PyMca5.PyMcaGui import SGWindow
 from PyMca5.PyMcaGui import SNIPWindow
 from PyMca5.PyMcaGui import PyMca_Icons as PyMca_Icons
+from PyMca5.PyMcaGui import PyMcaFileDialogs
+from PyMca5.PyMcaIO import ArraySave
 
 import numpy
+try:
+    import h5py
+    HDF5 = True
+except:
+    HDF5 = False
 
 DEBUG = 0
 
@@ -140,8 +148,7 @@ def replaceStackWithSavitzkyGolayFiltering(self):
             function = snipParametersDict['function']
             arguments = snipParametersDict['arguments']
             stack = self.getStackDataObject()
-            function(stack, *arguments)
-            self.setStack(stack)
+            self._applyStackFunction(stack, function, arguments)
 
     def subtract1DSnipBackground(self, smooth=False):
         activeCurve = self.getActiveCurve()
@@ -161,8 +168,7 @@ def subtract1DSnipBackground(self, smooth=False):
             function = snipParametersDict['function']
             arguments = snipParametersDict['arguments']
             stack = self.getStackDataObject()
-            function(stack, *arguments)
-            self.setStack(stack)
+            self._applyStackFunction(stack, function, arguments)
 
     def replaceWith1DSnipBackground(self):
         return self.subtract1DSnipBackground(smooth=True)
@@ -185,8 +191,54 @@ def subtract2DSnipBackground(self):
             function = snipParametersDict['function']
             arguments = snipParametersDict['arguments']
             stack = self.getStackDataObject()
-            function(stack, *arguments)
-            self.setStack(stack)
+            self._applyStackFunction(stack, function, arguments)
+
+    def _applyStackFunction(self, stack, function, arguments):
+        output = None
+        if not isinstance(stack.data, numpy.ndarray):
+            # dynamically loaded stack, the result goes to a new file
+            output = self._getOutputDataset(stack.data.shape)
+            if output is None:
+                # the user cancelled the file selection
+                return
+        function(stack, *arguments, output=output)
+        if output is not None:
+            output.file.flush()
+            stack.data = output
+        self.setStack(stack)
+
+    def _getOutputDataset(self, shape):
+        if not HDF5:
+            raise IOError("h5py needed to process dynamically loaded stacks")
+        filefilter = ['HDF5 Files (*.h5)']
+        filename = PyMcaFileDialogs.getFileList(parent=None,
+                                        filetypelist=filefilter,
+                                        message='Select output file',
+                                        mode='SAVE',
+                                        single=True,
+                                        getfilter=False,
+                                        currentfilter=filefilter[0])
+        if not len(filename):
+            return None
+        filename = filename[0]
+        if DEBUG:
+            print("file name = %s" % filename)
+        #for the time being overwriting
+        if os.path.exists(filename):
+            os.remove(filename)
+        hdf = h5py.File(filename, 'w')
+        nxEntry = hdf.require_group("entry_000")
+        nxEntry.attrs['NX_class'] = 'NXentry'.encode('utf-8')
+        nxEntry['title'] = numpy.string_("PyMca saved 3D Array".encode('utf-8'))
+        nxEntry['start_time'] = \
+                    numpy.string_(ArraySave.getDate().encode('utf-8'))
+        dataGroup = nxEntry.require_group('Data')
+        dataGroup.attrs['NX_class'] = 'NXdata'.encode('utf-8')
+        dataset = dataGroup.require_dataset("data",
+                                            shape=shape,
+                                            dtype=numpy.float32)
+        dataset.attrs['signal'] = numpy.int32(1)
+        return dataset
 
     def subtractActiveCurve(self):
         curve = self.getActiveCurve()
@@ -86,6 +86,25 @@
     HDF5 = False
 
 DEBUG = 0
+
+# approximate amount of memory used by each batch of frames
+BATCH_SIZE = 32 * 1024 * 1024
+
+def _getFramesPerBatch(frameShape, itemsize):
+    return max(1, int(BATCH_SIZE // (frameShape[0] * frameShape[1] * itemsize)))
+
+def _readFrames(data, mcaIndex, start, end, region=None):
+    """
+    Return the frames start to end of the stack as an array of shape
+    (nframes, d0, d1), optionally restricted to the given region.
+    """
+    if region is None:
+        region = (slice(None), slice(None))
+    if mcaIndex == 0:
+        return numpy.asarray(data[(slice(start, end),) + region])
+    else:
+        return numpy.asarray(data[region + (slice(start, end),)]).transpose(2, 0, 1)
+
 class ImageAlignmentStackPlugin(StackPluginBase.StackPluginBase):
     def __init__(self, stackWindow, **kw):
         StackPluginBase.DEBUG = DEBUG
@@ -465,7 +484,6 @@ def calculateShiftsFFT(self, stack, reference, offsets=None, widths=None, crop=F
             offsets = [0.0, 0.0]
         if widths is None:
             widths = [reference.shape[0], reference.shape[1]]
-        fft2Function = numpy.fft.fft2
         if 1:
             DTYPE = numpy.float32
         else:
@@ -484,37 +502,30 @@ def calculateShiftsFFT(self, stack, reference, offsets=None, widths=None, crop=F
         else:
             window = numpy.zeros((shape[0], shape[1]), dtype=DTYPE)
             window[apo[0]:shape[0] - apo[0], apo[1]:shape[1] - apo[1]] = 1
-        image2[:,:] = window * reference[offsets[0]:offsets[0]+widths[0],
-                                         offsets[1]:offsets[1]+widths[1]]
-        image2fft2 = fft2Function(image2)
+        image2[:,:] = reference[offsets[0]:offsets[0]+widths[0],
+                                offsets[1]:offsets[1]+widths[1]]
         mcaIndex = stack.info.get('McaIndex')
-        shifts = numpy.zeros((data.shape[mcaIndex], 2), numpy.float)
-        image1 = numpy.zeros(image2.shape, dtype=DTYPE)
-        total = float(data.shape[mcaIndex])
-        if mcaIndex == 0:
-            for i in range(data.shape[mcaIndex]):
-                image1[:,:] = window * data[i][offsets[0]:offsets[0]+widths[0],
-                                               offsets[1]:offsets[1]+widths[1]]
-
-                image1fft2 = fft2Function(image1)
-                shifts[i] = ImageRegistration.measure_offset_from_ffts(image2fft2,
-                                                                       image1fft2)
-                if DEBUG:
-                    print("Index = %d shift = %.4f, %.4f" % (i, shifts[i][0], shifts[i][1]))
-                self._progress = (100 * i) / total
-        elif mcaIndex in [2, -1]:
-            for i in range(data.shape[mcaIndex]):
-                image1[:,:] = window * data[:,:,i][offsets[0]:offsets[0]+widths[0],
-                                               offsets[1]:offsets[1]+widths[1]]
-
-                image1fft2 = fft2Function(image1)
-                shifts[i] = ImageRegistration.measure_offset_from_ffts(image2fft2,
-                                                                       image1fft2)
-                if DEBUG:
-                    print("Index = %d shift = %.4f, %.4f" % (i, shifts[i][0], shifts[i][1]))
-                self._progress = (100 * i) / total
-        else:
+        if mcaIndex not in [0, 2, -1]:
             raise IndexError("Only stacks of images or spectra supported. 1D index should be 0 or 2")
+        nFrames = data.shape[mcaIndex]
+        shifts = numpy.zeros((nFrames, 2), numpy.float)
+        region = (slice(offsets[0], offsets[0] + widths[0]),
+                  slice(offsets[1], offsets[1] + widths[1]))
+        # the FFT of the windowed reference is calculated once and the
+        # frames are read in batches processed by several threads
+        registration = ImageRegistration.FFTRegistration(image2, window)
+        step = _getFramesPerBatch(shape, 4)
+        images = numpy.zeros((step,) + shape, dtype=DTYPE)
+        total = float(nFrames)
+        for start in range(0, nFrames, step):
+            end = min(start + step, nFrames)
+            image1 = images[:end - start]
+            image1[:] = _readFrames(data, mcaIndex, start, end, region)
+            shifts[start:end] = registration.measureOffsets(image1)
+            if DEBUG:
+                for i in range(start, end):
+                    print("Index = %d shift = %.4f, %.4f" % (i, shifts[i][0], shifts[i][1]))
+            self._progress = (100 * end) / total
         return shifts
 
     def _shiftFromFile(self):
@@ -677,9 +688,10 @@ def shiftStack(self, stack, shifts, crop=False, filename=None):
                                                      shifts[:, 0],
                                                      shifts[:, 1])
         window = numpy.zeros(shape, numpy.float32)
-        window[d0_start:d0_end, d1_start:d1_end] = 1.0
+        window[int(d0_start):int(d0_end), int(d1_start):int(d1_end)] = 1.0
         self._progress = 0.0
-        total = float(data.shape[mcaIndex])
+        nFrames = data.shape[mcaIndex]
+        total = float(nFrames)
         if filename is not None:
             hdf = self.__hdf5
             dataGroup = hdf['/entry_000/Data']
@@ -687,30 +699,38 @@ def shiftStack(self, stack, shifts, crop=False, filename=None):
             attributes['interpretation'] = "image"
             attributes['signal'] = numpy.int32(1)
             outputStack = self.getHDF5BufferIntoGroup(dataGroup,
-                                                      shape=(data.shape[mcaIndex],
+                                                      shape=(nFrames,
                                                             shape[0],
                                                             shape[1]),
                                                       name="data",
                                                       dtype=numpy.float32,
-                                                      attributes=attributes)
-        for i in range(data.shape[mcaIndex]):
-            #tmpImage = ImageRegistration.shiftFFT(data[i], shifts[i])
-            if mcaIndex == 0:
-                tmpImage = ImageRegistration.shiftBilinear(data[i], shifts[i])
-                #tmpImage = ImageRegistration.shiftImage(data[i], -shifts[i], method="fft")
-                if filename is None:
-                    stack.data[i] = tmpImage * window
-                else:
-                    outputStack[i] = tmpImage * window
+                                                      attributes=attributes,
+                                                      chunks=(1,
+                                                              shape[0],
+                                                              shape[1]))
+            dtype = numpy.float32
+        else:
+            dtype = numpy.float64
+        # the frames of each batch are shifted in parallel into a
+        # buffer that is written at once
+        step = _getFramesPerBatch(shape, 16)
+        buffer = numpy.zeros((step, shape[0], shape[1]), dtype=dtype)
+        for start in range(0, nFrames, step):
+            end = min(start + step, nFrames)
+            shifted = ImageRegistration.shiftBilinearMultiple(\
+                                _readFrames(data, mcaIndex, start, end),
+                                shifts[start:end],
+                                output=buffer[:end - start],
+                                window=window)
+            if filename is not None:
+                outputStack[start:end] = shifted
+            elif mcaIndex == 0:
+                stack.data[start:end] = shifted
             else:
-                tmpImage = ImageRegistration.shiftBilinear(data[:,:,i], shifts[i])
-                if filename is None:
-                    stack.data[:, :, i] = tmpImage * window
-                else:
-                    outputStack[i] = tmpImage * window
+                stack.data[:, :, start:end] = shifted.transpose(1, 2, 0)
             if DEBUG:
-                print("Index %d bilinear shifted" % i)
-            self._progress = (100 * i) / total
+                print("Indices %d to %d bilinear shifted" % (start, end - 1))
+            self._progress = (100 * end) / total
 
     def initializeHDF5File(self, fname):
         #for the time being overwriting
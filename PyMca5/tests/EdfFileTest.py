@@ -116,6 +116,73 @@ def testEdfFileReadWrite(self):
         edf =None
         gc.collect()
 
+    def testEdfFileDataView(self):
+        self.assertTrue(self.fileClass is not None)
+        data = numpy.arange(10000).astype(numpy.int32)
+        data.shape = 100, 100
+        if sys.byteorder == "big":
+            otherByteOrder = "LowByteFirst"
+        else:
+            otherByteOrder = "HighByteFirst"
+        edf = self.fileClass(self.fname, 'wb+')
+        edf.WriteImage({'Title': "title"}, data)
+        edf.WriteImage({'Title': "title2"}, data.astype(numpy.float32),
+                       Append=1, ByteOrder=otherByteOrder)
+        edf = None
+
+        edf = self.fileClass(self.fname, 'rb')
+        for i in range(2):
+            view = edf.GetDataView(i)
+            self.assertTrue(isinstance(view, numpy.memmap))
+            readData = edf.GetData(i)
+            self.assertEqual(view.shape, readData.shape)
+            self.assertTrue(numpy.array_equal(view, readData))
+        self.assertEqual(edf.GetDataView(1)[20, 10], data[20, 10])
+        view = None
+        edf = None
+        gc.collect()
+
+    def testEdfStackMemoryMap(self):
+        self.assertTrue(self.fileClass is not None)
+        from PyMca5.PyMcaIO import EDFStack
+        tmpDir = tempfile.mkdtemp()
+        fileList = []
+        try:
+            for i in range(4):
+                fname = os.path.join(tmpDir, "image_%04d.edf" % i)
+                data = numpy.arange(200).astype(numpy.float32) + 1000 * i
+                data.shape = 10, 20
+                edf = self.fileClass(fname, 'wb+')
+                edf.WriteImage({'Title': "image %d" % i}, data)
+                edf = None
+                fileList.append(fname)
+            for imagestack in [False, True]:
+                stack = EDFStack.EDFStack(fileList, imagestack=imagestack)
+                virtual = EDFStack.EDFStack(fileList, imagestack=imagestack,
+                                            memmap=True)
+                self.assertTrue(isinstance(virtual.data,
+                                           EDFStack.VirtualEdfStack))
+                self.assertEqual(virtual.data.shape, stack.data.shape)
+                self.assertEqual(virtual.data.dtype, stack.data.dtype)
+                for key in ["McaIndex", "FileIndex", "NumberOfFiles"]:
+                    self.assertEqual(virtual.info.get(key),
+                                     stack.info.get(key))
+                self.assertTrue(numpy.array_equal(virtual.data[:],
+                                                  stack.data))
+                self.assertTrue(numpy.array_equal(virtual.data[1:3, 5],
+                                                  stack.data[1:3, 5]))
+                self.assertTrue(numpy.array_equal(virtual.data[:, 2, 7],
+                                                  stack.data[:, 2, 7]))
+                self.assertTrue(numpy.array_equal(virtual.data[2],
+                                                  stack.data[2]))
+                stack = None
+                virtual = None
+        finally:
+            gc.collect()
+            for fname in fileList:
+                os.remove(fname)
+            os.rmdir(tmpDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -125,6 +192,8 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testEdfFile("testEdfFileImport"))
         testSuite.addTest(testEdfFile("testEdfFileReadWrite"))
+        testSuite.addTest(testEdfFile("testEdfFileDataView"))
+        testSuite.addTest(testEdfFile("testEdfStackMemoryMap"))
     return testSuite
 
 def test(auto=False):
@@ -295,6 +295,30 @@ def testMaterialCrossSectionsCalculation(self):
                     self.assertTrue((100.0 * abs(yTest-yRef)/yRef) < 0.01)
                 energyIndex += 1
 
+    def testMaterialCrossSectionsEnergyArray(self):
+        if DEBUG:
+            print()
+            print("Testing Material Cross Sections on an energy array")
+        # energies below 1 keV, on grid points and on an absorption edge
+        gridEnergies = self._elements.getelementmassattcoef("Fe")['energy']
+        energies = numpy.concatenate(([0.6, 0.95, 1.0, 7.112, 7.5],
+                                      gridEnergies[20:30]))
+        compoundList = ['Fe', 'Si1O2', 'Water']
+        fractionList = [0.2, 0.5, 0.3]
+        data = self._elements.getMaterialMassAttenuationCoefficients(\
+                                compoundList, fractionList, energies)
+        self.assertEqual(len(data['total']), len(energies))
+        for i in range(len(energies)):
+            refData = self._elements.getMaterialMassAttenuationCoefficients(\
+                                compoundList, fractionList, energies[i])
+            for key in ['coherent', 'compton', 'photo', 'pair', 'total']:
+                self.assertEqual(refData[key][0], data[key][i])
+        # the output of a cached calculation can be modified by the caller
+        data['total'][0] = -1.0
+        cached = self._elements.getMaterialMassAttenuationCoefficients(\
+                                compoundList, fractionList, energies)
+        self.assertTrue(cached['total'][0] > 0.0)
+        self.assertEqual(cached['total'][1:], data['total'][1:])
 
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
@@ -307,6 +331,7 @@ def getSuite(auto=True):
         testSuite.addTest(testElements("testElementCrossSectionsReadout"))
         testSuite.addTest(testElements("testElementCrossSectionsCalculation"))
         testSuite.addTest(testElements("testMaterialCrossSectionsCalculation"))
+        testSuite.addTest(testElements("testMaterialCrossSectionsEnergyArray"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,178 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+try:
+    import h5py
+    HDF5 = True
+except:
+    HDF5 = False
+
+class testFastXRFLinearFit(unittest.TestCase):
+    def setUp(self):
+        from PyMca5 import PyMcaDataDir
+        from PyMca5.PyMcaIO import specfilewrapper
+        from PyMca5.PyMcaIO import ConfigDict
+        dataDir = PyMcaDataDir.PYMCA_DATA_DIR
+        sf = specfilewrapper.Specfile(os.path.join(dataDir,
+                                                   "XRFSpectrum.mca"))
+        spectrum = sf[0].mca(1)
+        sf = None
+        config = ConfigDict.ConfigDict()
+        config.read(os.path.join(dataDir, "McaTheory.cfg"))
+        config['peaks'] = {'Ca':'K', 'Fe':'K', 'Cu':'K', 'Zn':'K'}
+        config['fit']['energy'] = [17.5]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyscatter'] = [1]
+        config['fit']['xmin'] = 100
+        config['fit']['xmax'] = 1000
+        config['fit']['stripflag'] = 1
+        config['fit']['stripalgorithm'] = 1
+        self.config = config
+        numpy.random.seed(1)
+        scale = numpy.linspace(0.5, 1.5, 7 * 9).reshape(7, 9, 1)
+        self.data = numpy.random.poisson(scale * spectrum).\
+                                            astype(numpy.float32)
+        self._tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpDir)
+
+    def _fit(self, data, **kw):
+        from PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit import FastXRFLinearFit
+        fastFit = FastXRFLinearFit()
+        fastFit.setFitConfiguration(self.config)
+        return fastFit.fitMultipleSpectra(y=data, **kw)
+
+    def _assertSameResult(self, result, reference):
+        self.assertEqual(result['names'], reference['names'])
+        for key in ['parameters', 'uncertainties']:
+            self.assertTrue(numpy.array_equal(result[key], reference[key]),
+                            "Different %s" % key)
+
+    def testMultipleSpectraBackground(self):
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+        from PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit import \
+                                            getMultipleSpectraBackground
+        spectra = self.data.reshape(-1, self.data.shape[-1]).\
+                                            astype(numpy.float64)
+        nChannels = spectra.shape[-1]
+        snipWidth = 30
+        filterWidth = 5
+        for anchorsList in [None, [0, nChannels - 1], [250, 600]]:
+            background = getMultipleSpectraBackground(spectra,
+                                                      snipWidth,
+                                                      filterWidth,
+                                                      anchorsList)
+            self.assertEqual(background.shape, spectra.shape)
+            for i in range(spectra.shape[0]):
+                # the calculation done spectrum by spectrum
+                reference = SpecfitFuns.SavitskyGolay(spectra[i],
+                                                      filterWidth)
+                lastAnchor = 0
+                for anchor in (anchorsList or []):
+                    if (anchor > lastAnchor) and (anchor < nChannels):
+                        reference[lastAnchor:anchor] = \
+                            SpecfitFuns.snip1d(reference[lastAnchor:anchor],
+                                               snipWidth, 0)
+                        lastAnchor = anchor
+                if lastAnchor < nChannels:
+                    reference[lastAnchor:] = \
+                            SpecfitFuns.snip1d(reference[lastAnchor:],
+                                               snipWidth, 0)
+                self.assertTrue(numpy.array_equal(background[i], reference),
+                                "Different background for spectrum %d" % i)
+
+    def testParallelFit(self):
+        for weight in [0, 1, 2]:
+            reference = self._fit(self.data, weight=weight)
+            for executor in ["thread", "process"]:
+                result = self._fit(self.data, weight=weight,
+                                   nworkers=3, executor=executor)
+                self._assertSameResult(result, reference)
+
+    @unittest.skipIf(not HDF5, "h5py not available")
+    def testStreamingFit(self):
+        fileName = os.path.join(self._tmpDir, "map.h5")
+        h5 = h5py.File(fileName, "w")
+        try:
+            h5.create_dataset("contiguous", data=self.data)
+            h5.create_dataset("chunked", data=self.data,
+                              chunks=(2, 3, self.data.shape[-1]))
+            for weight in [0, 1]:
+                reference = self._fit(self.data, weight=weight)
+                for name in ["contiguous", "chunked"]:
+                    # blocks smaller than a row and of several rows
+                    for nSpectra in [2, 20]:
+                        maxbytes = nSpectra * self.data.shape[-1] * \
+                                   self.data.dtype.itemsize
+                        result = self._fit(h5[name], weight=weight,
+                                           streaming=True,
+                                           maxbytes=maxbytes)
+                        self._assertSameResult(result, reference)
+        finally:
+            h5.close()
+
+    def testStreamingReadError(self):
+        from PyMca5.PyMcaPhysics.xrf import FastXRFLinearFit
+        class FailingData(object):
+            shape = self.data.shape
+            dtype = self.data.dtype
+            def __getitem__(self, item):
+                raise IOError("Cannot read block")
+        blocks = FastXRFLinearFit._iterBlocks(FailingData(), (1, 9), 0, 10)
+        self.assertRaises(IOError, list, blocks)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testFastXRFLinearFit))
+    else:
+        # use a predefined order
+        testSuite.addTest(\
+            testFastXRFLinearFit("testMultipleSpectraBackground"))
+        testSuite.addTest(testFastXRFLinearFit("testParallelFit"))
+        testSuite.addTest(testFastXRFLinearFit("testStreamingFit"))
+        testSuite.addTest(testFastXRFLinearFit("testStreamingReadError"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -70,6 +70,95 @@ def testGefitLeastSquares(self):
         for i in range(len(originalParameters)):
             self.assertTrue(abs(fittedpar[i] - originalParameters[i]) < 0.01)
 
+    def testGefitConstrainedLeastSquares(self):
+        self.testGefitImport()
+        x = numpy.arange(500.)
+        originalParameters = numpy.array([10.5, 2, 1000.0, 200., 100],
+                                         numpy.float)
+        fitFunction = self.gaussianPlusLinearBackground
+        y = fitFunction(originalParameters, x)
+
+        # positive slope, quoted height and width tied to the position
+        constraints = [[self.gefit.CFREE, self.gefit.CPOSITIVE,
+                        self.gefit.CQUOTED, self.gefit.CFREE,
+                        self.gefit.CFACTOR],
+                       [0, 0, 500., 0, 3],
+                       [0, 0, 2000., 0, 0.5]]
+        startingParameters = [0.0 ,1.0,900.0, 180., 75.]
+        fittedpar, chisq, sigmapar =self.gefit.LeastSquaresFit(fitFunction,
+                                                     startingParameters,
+                                                     xdata=x,
+                                                     ydata=y,
+                                                     constrains=constraints,
+                                                     deltachi=1.0e-6)
+        for i in range(len(originalParameters)):
+            self.assertTrue(abs(fittedpar[i] - originalParameters[i]) < 0.01)
+        self.assertEqual(fittedpar[4], 0.5 * fittedpar[3])
+        self.assertEqual(sigmapar[4], 0.5 * sigmapar[3])
+
+        # linear fit with the quadratic term fixed to zero
+        fitFunction = lambda param, t: param[0] + param[1] * t + \
+                                       param[2] * t * t
+        y = fitFunction([10.5, 2., 0.0], x)
+        constraints = [[self.gefit.CFREE, self.gefit.CFREE,
+                        self.gefit.CFIXED], [0, 0, 0], [0, 0, 0]]
+        fittedpar, chisq, sigmapar =self.gefit.LeastSquaresFit(fitFunction,
+                                                     [0.0, 0.0, 0.0],
+                                                     xdata=x,
+                                                     ydata=y,
+                                                     constrains=constraints,
+                                                     linear=1)
+        self.assertTrue(abs(fittedpar[0] - 10.5) < 1.0e-6)
+        self.assertTrue(abs(fittedpar[1] - 2.0) < 1.0e-6)
+        self.assertEqual(fittedpar[2], 0.0)
+
+    def testGefitBatchLeastSquares(self):
+        self.testGefitImport()
+        x = numpy.arange(500.)
+        numpy.random.seed(10)
+        nfits = 10
+        originalParameters = numpy.array([10.5, 2, 1000.0, 200., 100],
+                                         numpy.float)
+        originalParameters = originalParameters * \
+                             (1.0 + 0.05 * numpy.random.randn(nfits, 5))
+        fitFunction = self.gaussianPlusLinearBackground
+        y = numpy.array([fitFunction(p, x) for p in originalParameters])
+        y = numpy.random.poisson(y).astype(numpy.float)
+
+        def batchFunction(param, t):
+            # the same function evaluated for a stack of parameters
+            return fitFunction(param.T[:, :, None], t[None, :])
+
+        startingParameters = [0.0 ,1.0,900.0, 180., 90]
+        constraints = [[self.gefit.CFREE, self.gefit.CPOSITIVE,
+                        self.gefit.CQUOTED, self.gefit.CFREE,
+                        self.gefit.CFREE],
+                       [0, 0, 500., 0, 0],
+                       [0, 0, 2000., 0, 0]]
+        fittedpar, chisq, sigmapar = self.gefit.BatchLeastSquaresFit(\
+                                                    batchFunction,
+                                                    startingParameters,
+                                                    xdata=x,
+                                                    ydata=y,
+                                                    constrains=constraints,
+                                                    weightflag=1,
+                                                    deltachi=1.0e-8)
+        self.assertEqual(fittedpar.shape, (nfits, 5))
+        for i in range(nfits):
+            result = self.gefit.LeastSquaresFit(fitFunction,
+                                                startingParameters,
+                                                xdata=x,
+                                                ydata=y[i],
+                                                constrains=constraints,
+                                                weightflag=1,
+                                                deltachi=1.0e-8)
+            for j in range(5):
+                self.assertTrue(abs(fittedpar[i, j] - result[0][j]) < \
+                                0.01 * result[2][j])
+                self.assertTrue(abs(sigmapar[i, j] - result[2][j]) < \
+                                0.01 * result[2][j])
+            self.assertTrue(abs(chisq[i] - result[1]) < 1.0e-6 * result[1])
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -79,6 +168,8 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testGefit("testGefitImport"))
         testSuite.addTest(testGefit("testGefitLeastSquares"))
+        testSuite.addTest(testGefit("testGefitConstrainedLeastSquares"))
+        testSuite.addTest(testGefit("testGefitBatchLeastSquares"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,113 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testImageRegistration(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(0)
+        from PyMca5.PyMcaMath import ImageRegistration
+        reference = numpy.zeros((64, 80))
+        reference[20:30, 30:45] = 1.0
+        reference += 0.1 * numpy.random.random(reference.shape)
+        self.reference = reference
+        self.shifts = numpy.random.uniform(-5, 5, (20, 2))
+        self.images = numpy.array([ImageRegistration.shiftFFT(reference, shift)\
+                                   for shift in self.shifts])
+
+    def testImageRegistrationBatchOffsets(self):
+        from PyMca5.PyMcaMath import ImageRegistration
+        fft2 = numpy.fft.fft2
+        referenceFFT = fft2(self.reference)
+        expected = numpy.array([ImageRegistration.measure_offset_from_ffts(\
+                                    referenceFFT, fft2(image)) \
+                                for image in self.images])
+        offsets = ImageRegistration.measure_offsets_from_ffts(referenceFFT,
+                                                        fft2(self.images))
+        self.assertTrue(numpy.allclose(offsets, expected))
+        # real FFTs of the images
+        rfft2 = numpy.fft.rfft2
+        offsets = ImageRegistration.measure_offsets_from_ffts(\
+                                                rfft2(self.reference),
+                                                rfft2(self.images),
+                                                shape=self.reference.shape)
+        self.assertTrue(numpy.allclose(offsets, expected))
+        # the engine with a window and several threads
+        window = numpy.zeros(self.reference.shape, numpy.float32)
+        window[5:-5, 5:-5] = 1
+        expected = numpy.array([ImageRegistration.measure_offset(\
+                                    window * self.reference, window * image) \
+                                for image in self.images])
+        for nthreads in [1, 3]:
+            registration = ImageRegistration.FFTRegistration(self.reference,
+                                                    window=window,
+                                                    nthreads=nthreads,
+                                                    framesPerTask=3)
+            offsets = registration.measureOffsets(self.images)
+            self.assertTrue(numpy.allclose(offsets, expected))
+
+    def testImageRegistrationShiftMultiple(self):
+        from PyMca5.PyMcaMath import ImageRegistration
+        shifts = numpy.vstack((self.shifts,
+                               [[0.0, 0.0], [-3.0, 4.0], [70.0, 1.0]]))
+        images = numpy.vstack((self.images, self.images[:3]))
+        window = numpy.zeros(self.reference.shape, numpy.float32)
+        window[6:-6, 6:-6] = 1
+        for nthreads in [1, 3]:
+            shifted = ImageRegistration.shiftBilinearMultiple(images,
+                                                             shifts,
+                                                             window=window,
+                                                             nthreads=nthreads)
+            for i in range(images.shape[0]):
+                expected = ImageRegistration.shiftBilinear(images[i],
+                                                           shifts[i])
+                self.assertTrue(numpy.allclose(shifted[i], expected * window))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testImageRegistration))
+    else:
+        # use a predefined order
+        testSuite.addTest(\
+            testImageRegistration("testImageRegistrationBatchOffsets"))
+        testSuite.addTest(\
+            testImageRegistration("testImageRegistrationShiftMultiple"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,108 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2016 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testLinalg(unittest.TestCase):
+    def setUp(self):
+        # straight line plus a parabolic term sampled at 100 points
+        x = numpy.arange(100.)
+        self.modelMatrix = numpy.ones((x.size, 3), numpy.float64)
+        self.modelMatrix[:, 1] = x
+        self.modelMatrix[:, 2] = x * x
+        self.expected = numpy.array([[10.0, 20.0, 30.0, 40.0],
+                                     [1.0, -1.0, 0.5, 0.0],
+                                     [0.01, 0.02, 0.0, -0.01]])
+        self.data = numpy.dot(self.modelMatrix, self.expected)
+
+    def testLinalgImport(self):
+        from PyMca5.PyMcaMath import linalg
+
+    def testLinalgSolverUnweighted(self):
+        from PyMca5.PyMcaMath.linalg import lstsq, LinearLeastSquaresSolver
+        solver = LinearLeastSquaresSolver(self.modelMatrix, weight=0)
+        parameters, sigmapar = solver.solve(self.data, uncertainties=True)
+        self.assertTrue(numpy.allclose(parameters, self.expected))
+        lstsqParameters, lstsqSigma = lstsq(self.modelMatrix, self.data,
+                                            weight=0, uncertainties=True)
+        self.assertTrue(numpy.allclose(parameters, lstsqParameters))
+        self.assertTrue(numpy.allclose(sigmapar, lstsqSigma))
+
+        # one dimensional input
+        parameters = solver.solve(self.data[:, 1])
+        self.assertTrue(parameters.shape == (3,))
+        self.assertTrue(numpy.allclose(parameters, self.expected[:, 1]))
+
+    def testLinalgSolverWeighted(self):
+        from PyMca5.PyMcaMath.linalg import lstsq, LinearLeastSquaresSolver
+        sigma = 1.0 + numpy.arange(self.data.shape[0]) / 10.
+        solver = LinearLeastSquaresSolver(self.modelMatrix,
+                                          sigma_b=sigma,
+                                          weight=1)
+        parameters, sigmapar = solver.solve(self.data, uncertainties=True)
+        lstsqParameters, lstsqSigma = lstsq(self.modelMatrix, self.data,
+                                            sigma_b=sigma,
+                                            weight=1, uncertainties=True)
+        self.assertTrue(numpy.allclose(parameters, lstsqParameters))
+        self.assertTrue(numpy.allclose(sigmapar, lstsqSigma))
+
+        # statistical weights depend on the data
+        self.assertRaises(ValueError, LinearLeastSquaresSolver,
+                          self.modelMatrix, weight=1)
+
+    def testLinalgSolverFloat32(self):
+        from PyMca5.PyMcaMath.linalg import LinearLeastSquaresSolver
+        solver = LinearLeastSquaresSolver(self.modelMatrix)
+        parameters = solver.solve(self.data.astype(numpy.float32))
+        self.assertTrue(parameters.dtype == numpy.float32)
+        self.assertTrue(numpy.allclose(parameters, self.expected,
+                                       rtol=1.0e-3, atol=1.0e-3))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testLinalg))
+    else:
+        # use a predefined order
+        testSuite.addTest(testLinalg("testLinalgImport"))
+        testSuite.addTest(testLinalg("testLinalgSolverUnweighted"))
+        testSuite.addTest(testLinalg("testLinalgSolverWeighted"))
+        testSuite.addTest(testLinalg("testLinalgSolverFloat32"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,211 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+class testMcaAdvancedFitBatch(unittest.TestCase):
+    def setUp(self):
+        from PyMca5 import PyMcaDataDir
+        from PyMca5.PyMcaIO import ConfigDict
+        from PyMca5.PyMcaIO import EdfFile
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        self._tmpDir = tempfile.mkdtemp()
+        dataDir = PyMcaDataDir.PYMCA_DATA_DIR
+        config = ConfigDict.ConfigDict()
+        config.read(os.path.join(dataDir, "McaTheory.cfg"))
+        config['peaks'] = {'Ca':'K', 'Fe':'K', 'Cu':'K', 'Zn':'K'}
+        config['fit']['energy'] = [17.5]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyscatter'] = [1]
+        config['fit']['xmin'] = 100
+        config['fit']['xmax'] = 1000
+        config['fit']['use_limit'] = 1
+        config['fit']['continuum'] = 1
+        config['attenuators']['Matrix'] = [1, 'Water', 1.0, 0.1,
+                                           45.0, 45.0, 0, 90.0]
+        self.configFile = os.path.join(self._tmpDir, "fit.cfg")
+        config.write(self.configFile)
+
+        # a small map of spectra with increasing peak areas
+        x = numpy.arange(2048.)
+        mcaFit = ClassMcaTheory.McaTheory()
+        mcaFit.configure(config)
+        mcaFit.setData(x, x)
+        mcaFit.estimate()
+        parameters = numpy.array(mcaFit.parameters)
+        nglobal = mcaFit.NGLOBAL
+        parameters[mcaFit.PARAMETERS.index('Constant')] = 20.
+        parameters[nglobal:] = numpy.linspace(3000., 15000.,
+                                              len(parameters) - nglobal)
+        numpy.random.seed(1)
+        self.nRows = 3
+        self.nColumns = 4
+        self.fileList = []
+        for row in range(self.nRows):
+            spectra = []
+            for column in range(self.nColumns):
+                p = parameters.copy()
+                p[nglobal:] *= 0.8 + 0.1 * column + 0.05 * row
+                spectra.append(numpy.random.poisson(mcaFit.mcatheory(p, x)))
+            fileName = os.path.join(self._tmpDir, "row_%02d.edf" % row)
+            edf = EdfFile.EdfFile(fileName, "wb")
+            edf.WriteImage({}, numpy.array(spectra).astype(numpy.float64))
+            edf = None
+            self.fileList.append(fileName)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpDir)
+
+    def _processList(self, name, **kw):
+        from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+        outputDir = os.path.join(self._tmpDir, name)
+        os.mkdir(outputDir)
+        batch = McaAdvancedFitBatch.McaAdvancedFitBatch(self.configFile,
+                                                        self.fileList,
+                                                        outputDir, **kw)
+        batch.processList()
+        return batch
+
+    def testWarmStartStatistics(self):
+        nSpectra = self.nRows * self.nColumns
+        # nothing is counted without warm start
+        batch = self._processList("default", fitfiles=0)
+        self.assertEqual(batch.warmStartStatistics,
+                         {"estimate": 0, "previous": 0,
+                          "neighbour": 0, "fallback": 0})
+
+        batch = self._processList("previous", fitfiles=0, warmstart=1)
+        self.assertEqual(batch.warmStartStatistics,
+                         {"estimate": 1, "previous": nSpectra - 1,
+                          "neighbour": 0, "fallback": 0})
+
+        # the first row has no neighbour
+        batch = self._processList("neighbour", fitfiles=0, warmstart=2)
+        self.assertEqual(batch.warmStartStatistics,
+                         {"estimate": 1, "previous": self.nColumns - 1,
+                          "neighbour": nSpectra - self.nColumns,
+                          "fallback": 0})
+
+        # a zero threshold rejects every warm start
+        batch = self._processList("fallback", fitfiles=0, warmstart=1,
+                                  warmstartthreshold=0.0)
+        self.assertEqual(batch.warmStartStatistics,
+                         {"estimate": nSpectra, "previous": 0,
+                          "neighbour": 0, "fallback": nSpectra - 1})
+
+        # the spectra fitted by worker processes are not seeded
+        batch = self._processList("workers", fitfiles=0, warmstart=1,
+                                  nworkers=2)
+        self.assertEqual(batch.warmStartStatistics,
+                         {"estimate": 0, "previous": 0,
+                          "neighbour": 0, "fallback": 0})
+
+    def _readImages(self, name):
+        from PyMca5.PyMcaIO import EdfFile
+        imagesDir = os.path.join(self._tmpDir, name, "IMAGES")
+        images = {}
+        for fileName in os.listdir(imagesDir):
+            if fileName.endswith(".edf"):
+                edf = EdfFile.EdfFile(os.path.join(imagesDir, fileName), "rb")
+                images[fileName] = edf.GetData(0)
+                edf = None
+        return images
+
+    def testWarmStartResults(self):
+        self._processList("cold", fitfiles=0)
+        cold = self._readImages("cold")
+        # the group areas and the chisq image
+        self.assertEqual(len(cold), 5)
+        for warmstart in [1, 2]:
+            name = "warm%d" % warmstart
+            self._processList(name, fitfiles=0, warmstart=warmstart)
+            warm = self._readImages(name)
+            self.assertEqual(sorted(cold.keys()), sorted(warm.keys()))
+            for key in cold:
+                self.assertTrue(numpy.allclose(warm[key], cold[key],
+                                               rtol=1.0e-3, atol=0.0),
+                                "%s differs using warm start %d" % \
+                                (key, warmstart))
+
+    def _readOutput(self, name):
+        outputDir = os.path.join(self._tmpDir, name)
+        output = {}
+        for root, dirs, files in os.walk(outputDir):
+            for fileName in files:
+                fullName = os.path.join(root, fileName)
+                f = open(fullName, "rb")
+                content = f.read()
+                f.close()
+                # the list of fit files contains the output directory
+                content = content.replace(outputDir.encode(), b"")
+                output[os.path.relpath(fullName, outputDir)] = content
+        return output
+
+    def testWorkerProcesses(self):
+        self._processList("serial", concentrations=1)
+        self._processList("pool", concentrations=1, nworkers=2)
+        serial = self._readOutput("serial")
+        pool = self._readOutput("pool")
+        self.assertEqual(sorted(serial.keys()), sorted(pool.keys()))
+        extensions = [os.path.splitext(key)[1] for key in serial]
+        for extension in [".fit", ".edf", ".txt"]:
+            self.assertTrue(extension in extensions)
+        for key in serial:
+            self.assertEqual(serial[key], pool[key],
+                             "%s differs using worker processes" % key)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(\
+                                            testMcaAdvancedFitBatch))
+    else:
+        # use a predefined order
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testWarmStartStatistics"))
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testWarmStartResults"))
+        testSuite.addTest(\
+            testMcaAdvancedFitBatch("testWorkerProcesses"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,321 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2016 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+class testMcaTheory(unittest.TestCase):
+    def setUp(self):
+        from PyMca5 import PyMcaDataDir
+        from PyMca5.PyMcaIO import specfilewrapper
+        from PyMca5.PyMcaIO import ConfigDict
+        dataDir = PyMcaDataDir.PYMCA_DATA_DIR
+        sf = specfilewrapper.Specfile(os.path.join(dataDir,
+                                                   "XRFSpectrum.mca"))
+        self.y = sf[0].mca(1)
+        self.x = numpy.arange(self.y.size).astype(numpy.float64)
+        sf = None
+        config = ConfigDict.ConfigDict()
+        config.read(os.path.join(dataDir, "McaTheory.cfg"))
+        config['peaks'] = {'Ca':'K', 'Fe':'K', 'Cu':'K', 'Zn':'K'}
+        config['fit']['energy'] = [17.5]
+        config['fit']['energyweight'] = [1.0]
+        config['fit']['energyflag'] = [1]
+        config['fit']['energyscatter'] = [1]
+        config['fit']['xmin'] = 100
+        config['fit']['xmax'] = 1000
+        config['fit']['use_limit'] = 1
+        config['attenuators']['Matrix'] = [1, 'Water', 1.0, 0.1,
+                                           45.0, 45.0, 0, 90.0]
+        self.config = config
+        self._tmpDir = None
+
+    def tearDown(self):
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        ClassMcaTheory.setConfigurationCacheDirectory(None)
+        ClassMcaTheory.clearConfigurationCache()
+        if self._tmpDir is not None:
+            shutil.rmtree(self._tmpDir)
+
+    def _fit(self):
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        mcaFit = ClassMcaTheory.McaTheory()
+        mcaFit.configure(self.config)
+        mcaFit.setData(self.x, self.y)
+        mcaFit.estimate()
+        fitResult, result = mcaFit.startfit(digest=1)
+        return mcaFit, result
+
+    def _assertSameResult(self, result, reference):
+        self.assertEqual(result['groups'], reference['groups'])
+        for group in reference['groups']:
+            self.assertEqual(result[group]['fitarea'],
+                             reference[group]['fitarea'])
+        self.assertEqual(result['chisq'], reference['chisq'])
+
+    def testConfigurationHash(self):
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaIO import ConfigDict
+        key = ClassMcaTheory.getConfigurationHash(self.config)
+        # independent of the container types and of the keys order
+        other = ConfigDict.ConfigDict()
+        for section in reversed(list(self.config.keys())):
+            other[section] = self.config[section]
+        other['fit'] = dict(self.config['fit'])
+        other['fit']['energy'] = numpy.array([17.5])
+        self.assertEqual(ClassMcaTheory.getConfigurationHash(other), key)
+        other['fit']['energy'] = [17.4]
+        self.assertNotEqual(ClassMcaTheory.getConfigurationHash(other), key)
+        self.assertNotEqual(ClassMcaTheory.getConfigurationHash(\
+                                self.config, attenuatorsflag=0), key)
+
+    def testConfigurationHashGlobalMaterials(self):
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaPhysics.xrf import Elements
+        # a material registered outside the configuration
+        Elements.Material["TestMatrix"] = {"Comment": "Test matrix",
+                                           "CompoundList": ["Water"],
+                                           "CompoundFraction": [1.0],
+                                           "Density": 1.0,
+                                           "Thickness": 0.1}
+        self.config['attenuators']['Matrix'][1] = "TestMatrix"
+        try:
+            key = ClassMcaTheory.getConfigurationHash(self.config)
+            Elements.Material["TestMatrix"]["CompoundList"] = ["Fe"]
+            self.assertNotEqual(ClassMcaTheory.getConfigurationHash(\
+                                                    self.config), key)
+            Elements.Material["TestMatrix"]["CompoundList"] = ["Water"]
+            self.assertEqual(ClassMcaTheory.getConfigurationHash(\
+                                                    self.config), key)
+            # the materials the material is made of are also considered
+            water = Elements.Material["Water"]
+            Elements.Material["Water"] = {"Comment": "Heavy water",
+                                          "CompoundList": ["D2O"],
+                                          "CompoundFraction": [1.0],
+                                          "Density": 1.1,
+                                          "Thickness": 0.1}
+            try:
+                self.assertNotEqual(ClassMcaTheory.getConfigurationHash(\
+                                                    self.config), key)
+            finally:
+                Elements.Material["Water"] = water
+        finally:
+            del Elements.Material["TestMatrix"]
+
+    def testConfigurationCache(self):
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        cacheSize = ClassMcaTheory.CONFIGURATION_CACHE_SIZE
+        try:
+            ClassMcaTheory.CONFIGURATION_CACHE_SIZE = 0
+            referenceFit, reference = self._fit()
+        finally:
+            ClassMcaTheory.CONFIGURATION_CACHE_SIZE = cacheSize
+        ClassMcaTheory.clearConfigurationCache()
+        firstFit, result = self._fit()
+        self._assertSameResult(result, reference)
+        # second instance configured from the cache
+        secondFit, result = self._fit()
+        self._assertSameResult(result, reference)
+        self.assertEqual(secondFit.config, referenceFit.config)
+        self.assertTrue(secondFit.PEAKSW is not firstFit.PEAKSW)
+
+        # configured from the files written to disk
+        self._tmpDir = tempfile.mkdtemp()
+        ClassMcaTheory.setConfigurationCacheDirectory(self._tmpDir)
+        ClassMcaTheory.clearConfigurationCache()
+        self._fit()
+        self.assertTrue(len(os.listdir(self._tmpDir)) > 0)
+        ClassMcaTheory.clearConfigurationCache()
+        thirdFit, result = self._fit()
+        self._assertSameResult(result, reference)
+
+    def testWindowedEvaluation(self):
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        self.config['fit']['xmin'] = 10
+        self.config['fit']['xmax'] = 4000
+        for hypermet, escape in [(1, 0), (1, 1), (15, 1)]:
+            self.config['fit']['hypermetflag'] = hypermet
+            self.config['fit']['escapeflag'] = escape
+            mcaFit = ClassMcaTheory.McaTheory()
+            mcaFit.configure(self.config)
+            mcaFit.setData(self.x, self.y)
+            mcaFit.estimate()
+            parameters = numpy.array(mcaFit.parameters)
+            x = mcaFit.xdata
+            nglobal = mcaFit.NGLOBAL
+            parameters[nglobal:] = 1000. * numpy.arange(1,
+                                                len(parameters) - nglobal + 1)
+            reference = mcaFit.mcatheory(parameters, x)
+            matrix = mcaFit.getPeakMatrixContribution(parameters)
+            derivatives = [mcaFit.analyticalDerivative(parameters, i, x)
+                           for i in range(nglobal, len(parameters))]
+            # the peak matrix is given for unit areas (the model uses a
+            # tabulated exponential, hence the tolerance)
+            peaks = mcaFit.mcatheory(parameters, x, continuum=0, summing=0)
+            delta = numpy.dot(matrix, parameters[nglobal:]) - peaks[:, 0]
+            self.assertTrue(abs(delta).max() < 1.0e-3 * abs(peaks).max())
+
+            mcaFit.enableWindowedEvaluation()
+            scale = abs(reference).max()
+            delta = abs(mcaFit.mcatheory(parameters, x) - reference).max()
+            self.assertTrue(delta < 1.0e-10 * scale,
+                            "Windowed model differs by %g" % delta)
+            self.assertTrue(numpy.allclose(\
+                mcaFit.getPeakMatrixContribution(parameters), matrix,
+                rtol=1.0e-10, atol=1.0e-12 * abs(matrix).max()))
+            for i in range(nglobal, len(parameters)):
+                derivative = mcaFit.analyticalDerivative(parameters, i, x)
+                delta = abs(derivative - derivatives[i - nglobal]).max()
+                self.assertTrue(delta <= \
+                                1.0e-10 * abs(derivatives[i - nglobal]).max())
+
+    def testWarmStartFit(self):
+        from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+        from PyMca5.PyMcaPhysics.xrf import McaAdvancedFitBatch
+        self.config['fit']['continuum'] = 1
+        mcaFit = ClassMcaTheory.McaTheory()
+        mcaFit.configure(self.config)
+        mcaFit.setData(self.x, self.y)
+        mcaFit.estimate()
+        parameters = numpy.array(mcaFit.parameters)
+        nglobal = mcaFit.NGLOBAL
+        parameters[mcaFit.PARAMETERS.index('Constant')] = 20.
+        parameters[nglobal:] = numpy.linspace(3000., 15000.,
+                                              len(parameters) - nglobal)
+        def spectrum(scale):
+            p = parameters.copy()
+            p[nglobal:] *= scale
+            return numpy.random.poisson(mcaFit.mcatheory(p, self.x))
+        numpy.random.seed(1)
+        mcaFit.setData(self.x, spectrum(0.8))
+        mcaFit.estimate()
+        fitResult = mcaFit.startfit()
+        seed = (fitResult[0], fitResult[1])
+
+        # the fit started from the previous one reaches the same minimum
+        y = spectrum(1.2)
+        mcaFit.setData(self.x, y)
+        fitResult, seeded = McaAdvancedFitBatch._startFit(mcaFit, seed,
+                                                          threshold=2.0)
+        self.assertTrue(seeded)
+        warm = mcaFit.mcatheory(fitResult[0], mcaFit.xdata)
+        mcaFit.setData(self.x, y)
+        mcaFit.estimate()
+        reference = mcaFit.startfit()
+        full = mcaFit.mcatheory(reference[0], mcaFit.xdata)
+        self.assertTrue(abs(warm - full).max() < 0.01 * full.max())
+        self.assertTrue(abs(fitResult[1] - reference[1]) < \
+                        0.05 * reference[1])
+
+        # the estimation is performed when the chi square degrades
+        fitResult, seeded = McaAdvancedFitBatch._startFit(mcaFit, seed,
+                                                          threshold=0.5)
+        self.assertFalse(seeded)
+        self.assertEqual(fitResult[1], reference[1])
+
+    def testLazyDigestResult(self):
+        import copy
+        import pickle
+        mcaFit, result = self._fit()
+        reference = copy.deepcopy(result)
+        self.assertEqual(type(reference), dict)
+        self.assertEqual(list(reference.keys()), list(result.keys()))
+
+        # only the requested values are calculated
+        result = mcaFit.digestresult()
+        for key in ['yfit', 'continuum', 'pileup']:
+            self.assertTrue(result.isLazy(key))
+        for group in result['groups']:
+            self.assertEqual(result[group]['fitarea'],
+                             reference[group]['fitarea'])
+            self.assertEqual(result[group]['sigmaarea'],
+                             reference[group]['sigmaarea'])
+            self.assertTrue(result[group].isLazy('mcaarea'))
+        group = result['groups'][0]
+        peak = result[group]['peaks'][0]
+        self.assertEqual(result[group][peak], reference[group][peak])
+        self.assertFalse(result[group].isLazy('mcaarea'))
+        self.assertTrue(result.isLazy('yfit'))
+        self.assertTrue(numpy.allclose(result['yfit'], reference['yfit']))
+        self.assertEqual(pickle.loads(pickle.dumps(result))[group],
+                         reference[group])
+
+        # pending values are calculated before changing the configuration
+        result = mcaFit.digestresult()
+        self.config['peaks'] = {'Fe':'K'}
+        mcaFit.configure(self.config)
+        self.assertFalse(result.isLazy('yfit'))
+        for group in reference['groups']:
+            self.assertEqual(result[group]['mcaarea'],
+                             reference[group]['mcaarea'])
+        self.assertTrue(numpy.allclose(result['yfit'], reference['yfit']))
+
+    def testLazyDigestResultAfterRefit(self):
+        import copy
+        mcaFit, result = self._fit()
+        reference = copy.deepcopy(result)
+        result = mcaFit.digestresult()
+        # fitting another spectrum does not change the pending values
+        mcaFit.setData(self.x, self.y[::-1].copy())
+        mcaFit.estimate()
+        mcaFit.startfit()
+        for group in reference['groups']:
+            for key in reference[group]:
+                self.assertEqual(result[group][key], reference[group][key])
+        for key in ['yfit', 'continuum', 'pileup']:
+            self.assertTrue(numpy.array_equal(result[key], reference[key]))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testMcaTheory))
+    else:
+        # use a predefined order
+        testSuite.addTest(testMcaTheory("testConfigurationHash"))
+        testSuite.addTest(\
+            testMcaTheory("testConfigurationHashGlobalMaterials"))
+        testSuite.addTest(testMcaTheory("testConfigurationCache"))
+        testSuite.addTest(testMcaTheory("testWindowedEvaluation"))
+        testSuite.addTest(testMcaTheory("testWarmStartFit"))
+        testSuite.addTest(testMcaTheory("testLazyDigestResult"))
+        testSuite.addTest(testMcaTheory("testLazyDigestResultAfterRefit"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,124 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import os
+import tempfile
+import unittest
+import numpy
+try:
+    import h5py
+    HDF5 = True
+except:
+    HDF5 = False
+
+class testNNMAModule(unittest.TestCase):
+    def setUp(self):
+        # three non negative components without noise
+        numpy.random.seed(0)
+        self.shape = 30, 20, 100
+        r, c, N = self.shape
+        x = numpy.linspace(0.0, 1.0, N)
+        self.components = numpy.array([numpy.exp(-(x - m) ** 2 / 0.003) \
+                                       for m in [0.2, 0.45, 0.7]])
+        abundances = numpy.random.random((r * c, 3)) * [100., 50., 20.]
+        self.data = numpy.dot(abundances, self.components).reshape(r, c, N)
+
+    def _checkResult(self, result):
+        images, values, vectors = result
+        r, c, N = self.shape
+        self.assertEqual(images.shape, (3, r, c))
+        self.assertEqual(vectors.shape, (3, N))
+        # normalized images and components sorted by intensity
+        self.assertTrue(numpy.allclose(images.max(axis=-1).max(axis=-1), 1.0))
+        self.assertTrue(values[0] >= values[1] >= values[2])
+        self.assertTrue(abs(values.sum() - 100.) < 1.0)
+        reconstructed = numpy.dot(images.reshape(3, -1).T, vectors)
+        delta = abs(reconstructed - self.data.reshape(-1, N)).max()
+        self.assertTrue(delta < 0.1 * self.data.max())
+        # the spectral components are recovered
+        vectors = vectors / numpy.sqrt((vectors * vectors).sum(axis=1)\
+                                                         .reshape(-1, 1))
+        components = self.components / \
+            numpy.sqrt((self.components * self.components).sum(axis=1)\
+                                                         .reshape(-1, 1))
+        products = numpy.dot(vectors, components.T)
+        self.assertTrue(numpy.all(products.max(axis=1) > 0.95))
+
+    def testNNMAModuleMiniBatch(self):
+        from PyMca5.PyMcaMath.mva import NNMAModule
+        r, c, N = self.shape
+        # one block and several blocks of rows
+        for blocksize in [None, 4 * c * N * 8]:
+            numpy.random.seed(1)
+            result = NNMAModule.nnma(self.data, 3, function="MiniBatch",
+                                     blocksize=blocksize)
+            self._checkResult(result)
+
+    def testNNMAModuleMiniBatchHDF5(self):
+        if not HDF5:
+            return
+        from PyMca5.PyMcaMath.mva import NNMAModule
+        r, c, N = self.shape
+        fd, fname = tempfile.mkstemp(suffix=".h5")
+        os.close(fd)
+        try:
+            h5 = h5py.File(fname, "w")
+            h5["data"] = self.data
+            h5.flush()
+            numpy.random.seed(1)
+            result = NNMAModule.nnma(h5["data"], 3, function="MiniBatch",
+                                     blocksize=4 * c * N * 8)
+            h5.close()
+            numpy.random.seed(1)
+            expected = NNMAModule.nnma(self.data, 3, function="MiniBatch",
+                                       blocksize=4 * c * N * 8)
+            for i in range(3):
+                self.assertTrue(numpy.allclose(result[i], expected[i]))
+        finally:
+            os.remove(fname)
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testNNMAModule))
+    else:
+        # use a predefined order
+        testSuite.addTest(testNNMAModule("testNNMAModuleMiniBatch"))
+        testSuite.addTest(testNNMAModule("testNNMAModuleMiniBatchHDF5"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
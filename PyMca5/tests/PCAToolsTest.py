@@ -30,9 +30,16 @@
 __contact__ = "sole@esrf.fr"
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import os
+import tempfile
 import unittest
 import numpy
 import numpy.linalg
+try:
+    import h5py
+    HDF5 = True
+except:
+    HDF5 = False
 try:
     import mdp
     MDP = True
@@ -90,6 +97,47 @@ def testPCAToolsCovariance(self):
             self.assertTrue(numpy.allclose(numpyAvg, pymcaAvg))
             self.assertTrue(nData == nSpectra)
 
+    def testPCAToolsThreadedCovariance(self):
+        from PyMca5.PyMcaMath.mva import PCATools
+        numpy.random.seed(1)
+        x = numpy.random.random((15, 12, 40)).astype(numpy.float32)
+        mask = numpy.ones((15, 12), numpy.uint8)
+        mask[3:5, 2:9] = 0
+        x[4, 5, 7] = numpy.nan
+        weights = numpy.linspace(0.0, 1.0, 40)
+
+        # expected values from the used pixels
+        tmpArray = x.reshape(-1, 40)[mask.reshape(-1) > 0] * weights
+        numpyCov = numpy.cov(tmpArray.T)
+        numpyAvg = tmpArray.mean(axis=0)
+
+        # use small blocks to have several blocks per thread
+        blockSize = PCATools.BLOCK_SIZE
+        PCATools.BLOCK_SIZE = 5 * 40 * 8
+        try:
+            for data in [x, x.reshape(-1, 40)]:
+                for nthreads in [1, 3]:
+                    for dtype in [numpy.float64, numpy.float32]:
+                        pymcaCov, pymcaAvg, nData = \
+                            PCATools.getCovarianceMatrix(data,
+                                                         index=-1,
+                                                         dtype=dtype,
+                                                         force=True,
+                                                         weights=weights,
+                                                         spatial_mask=mask,
+                                                         nthreads=nthreads)
+                        if dtype == numpy.float64:
+                            tolerance = 1.0e-10
+                        else:
+                            tolerance = 1.0e-4
+                        delta = abs(numpyCov - pymcaCov).max()
+                        self.assertTrue(delta < \
+                                        tolerance * abs(numpyCov).max())
+                        self.assertTrue(numpy.allclose(numpyAvg, pymcaAvg))
+                        self.assertEqual(nData, mask.sum())
+        finally:
+            PCATools.BLOCK_SIZE = blockSize
+
     def testPCAToolsPCA(self):
         from PyMca5.PyMcaMath.mva.PCATools import numpyPCA
         x = numpy.array([[0.0,  2.0,  3.0],
@@ -131,6 +179,87 @@ def testPCAToolsPCA(self):
             self.assertTrue(numpy.allclose(eigenvalues, numpyEigenvalues))
             self.assertTrue(numpy.allclose(eigenvectors, numpyEigenvectors))
 
+    def testRandomizedPCA(self):
+        from PyMca5.PyMcaMath.mva.PCAModule import randomizedPCA
+        # a stack of 4 components with a clear spectral gap plus noise
+        numpy.random.seed(0)
+        r, c, N = 30, 20, 100
+        x = numpy.linspace(0.0, 1.0, N)
+        components = numpy.array([numpy.exp(-(x - m) ** 2 / 0.002) \
+                                  for m in [0.2, 0.4, 0.6, 0.8]])
+        abundances = numpy.random.random((r * c, 4)) * [100., 50., 20., 5.]
+        data = numpy.dot(abundances, components) + \
+               numpy.random.normal(0.0, 0.5, (r * c, N))
+        data.shape = r, c, N
+        mask = numpy.ones((r, c), numpy.uint8)
+        mask[:3] = 0
+        weights = numpy.ones(N)
+        weights[:10] = 0
+
+        for binning, spatialMask, spectralMask in [(1, None, None),
+                                                   (2, None, None),
+                                                   (1, mask, weights)]:
+            # expected result from the covariance of the used pixels
+            tmpData = data.reshape(r * c, N)[:, ::binning]
+            if spatialMask is not None:
+                tmpData = tmpData[spatialMask.reshape(-1) > 0]
+            if spectralMask is not None:
+                tmpData = tmpData * spectralMask
+            evalues, evectors = numpy.linalg.eigh(numpy.cov(tmpData.T))
+            evalues = evalues[::-1][:4]
+            evectors = evectors[:, ::-1][:, :4].T
+            ddict = randomizedPCA(data, ncomponents=4, binning=binning,
+                                  legacy=False, index=-1,
+                                  mask=spatialMask,
+                                  spectral_mask=spectralMask)
+            self.assertTrue(numpy.allclose(ddict["eigenvalues"], evalues,
+                                           rtol=1.0e-4))
+            # the eigenvectors can be multiplied by -1
+            products = (ddict["eigenvectors"] * evectors).sum(axis=1)
+            self.assertTrue(numpy.allclose(abs(products), 1.0, atol=1.0e-4))
+            self.assertTrue(numpy.allclose(ddict["variance"],
+                                           numpy.cov(tmpData.T).trace()))
+            self.assertEqual(ddict["pixels"], tmpData.shape[0])
+            # the images are the projections of the sampled data
+            images = numpy.dot(ddict["eigenvectors"],
+                               data.reshape(r * c, N)[:, ::binning].T)
+            self.assertEqual(ddict["scores"].shape, (4, r, c))
+            self.assertTrue(numpy.allclose(ddict["scores"].reshape(4, -1),
+                                           images, rtol=1.0e-4, atol=1.0e-2))
+
+        # the blocks are sized on the spectra as read, not as sampled
+        from PyMca5.PyMcaMath.mva.PCAModule import _getPCAPixelBlocks
+        blocks = list(_getPCAPixelBlocks(data, -1, r * c, N // 4, 4,
+                                         blocksize=2 * c * N * 8))
+        self.assertEqual(len(blocks), r // 2)
+        self.assertEqual(blocks[1][0], 2 * c)
+        self.assertEqual(blocks[1][1].shape, (2 * c, N // 4))
+        self.assertTrue(numpy.allclose(blocks[1][1],
+                        data[2:4].reshape(2 * c, N)[:, ::4]))
+
+        # spectra along the first axis
+        images, eigenvalues, eigenvectors = randomizedPCA( \
+                                 numpy.transpose(data, (2, 0, 1)).copy(),
+                                 ncomponents=4, index=0)
+        self.assertEqual(images.shape, (4, r, c))
+        evalues = numpy.linalg.eigvalsh(numpy.cov(data.reshape(-1, N).T))
+        self.assertTrue(numpy.allclose(eigenvalues, evalues[::-1][:4],
+                                       rtol=1.0e-4))
+
+        if HDF5:
+            fd, fname = tempfile.mkstemp(suffix=".h5")
+            os.close(fd)
+            try:
+                h5 = h5py.File(fname, "w")
+                h5["data"] = data
+                h5.flush()
+                result = randomizedPCA(h5["data"], ncomponents=4, index=-1)
+                h5.close()
+                self.assertTrue(numpy.allclose(result[1], evalues[::-1][:4],
+                                               rtol=1.0e-4))
+            finally:
+                os.remove(fname)
+
     if MDP:
         def testPCAToolsMDP(self):
             from PyMca5.PyMcaMath.mva.PCATools import getCovarianceMatrix, numpyPCA
@@ -175,7 +304,9 @@ def getSuite(auto=True):
         # use a predefined order
         testSuite.addTest(testPCATools("testPCAToolsImport"))
         testSuite.addTest(testPCATools("testPCAToolsCovariance"))
+        testSuite.addTest(testPCATools("testPCAToolsThreadedCovariance"))
         testSuite.addTest(testPCATools("testPCAToolsPCA"))
+        testSuite.addTest(testPCATools("testRandomizedPCA"))
         if MDP:
             testSuite.addTest(testPCATools("testPCAToolsMDP"))
     return testSuite
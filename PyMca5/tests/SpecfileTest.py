@@ -143,6 +143,65 @@ def testSpecfileReadingCompatibleWithUserLocale(self):
                     (datacol[1], data[0][1]))
         gc.collect()
 
+    def testSpecfileIndexFile(self):
+        #"""Test the scan index file is used and extended"""
+        self.testSpecfileImport()
+        oldValue = os.environ.get("SPECFILE_INDEX_DIR", None)
+        indexDir = tempfile.mkdtemp()
+        os.environ["SPECFILE_INDEX_DIR"] = indexDir
+        try:
+            self._sf = self.specfileClass.Specfile(self.fname)
+            self.assertEqual(self._sf.scanno(), 2)
+            self._sf = None
+            gc.collect()
+            indexFiles = os.listdir(indexDir)
+            self.assertEqual(len(indexFiles), 1,
+                             'Expected one index file, got %s' % indexFiles)
+
+            # reopen from the index
+            self._sf = self.specfileClass.Specfile(self.fname)
+            self.assertEqual(self._sf.list(), "10,20")
+            self._scan = self._sf.select('20.1')
+            self.assertEqual(self._scan.alllabels(),
+                             ['First', 'Second', 'Third'])
+            self.assertEqual(self._scan.data()[0].tolist(), [1.3, 2.5, 3.7])
+            self._scan = None
+            self._sf = None
+            gc.collect()
+
+            # append a scan and reopen
+            text  = "#S 30  Undefined command 2\n"
+            text += "#N 2\n"
+            text += "#L Alpha  Beta\n"
+            text += "1  2\n"
+            text += "3  4\n"
+            text += "\n"
+            f = open(self.fname, "ab")
+            if sys.version < '3.0':
+                f.write(text)
+            else:
+                f.write(bytes(text, 'utf-8'))
+            f.close()
+            self._sf = self.specfileClass.Specfile(self.fname)
+            self.assertEqual(self._sf.scanno(), 3)
+            self.assertEqual(self._sf.list(), "10,20,30")
+            self._scan = self._sf.select('30.1')
+            self.assertEqual(self._scan.alllabels(), ['Alpha', 'Beta'])
+            self.assertEqual(self._scan.data()[1].tolist(), [2., 4.])
+            self._scan = self._sf.select('20.1')
+            self.assertEqual(self._scan.data()[0].tolist(), [1.3, 2.5, 3.7])
+        finally:
+            if oldValue is None:
+                del os.environ["SPECFILE_INDEX_DIR"]
+            else:
+                os.environ["SPECFILE_INDEX_DIR"] = oldValue
+            self._scan = None
+            self._sf = None
+            gc.collect()
+            for fname in os.listdir(indexDir):
+                os.remove(os.path.join(indexDir, fname))
+            os.rmdir(indexDir)
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -154,6 +213,7 @@ def getSuite(auto=True):
         testSuite.addTest(testSpecfile("testSpecfileReading"))
         testSuite.addTest(\
             testSpecfile("testSpecfileReadingCompatibleWithUserLocale"))
+        testSuite.addTest(testSpecfile("testSpecfileIndexFile"))
     return testSuite
 
 def test(auto=False):
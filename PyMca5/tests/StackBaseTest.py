@@ -31,8 +31,16 @@
 __license__ = "MIT"
 __copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
 import unittest
+import os
+import tempfile
 import numpy
 
+try:
+    import h5py
+    HDF5 = True
+except:
+    HDF5 = False
+
 class DummyArray(object):
     def __init__(self, data):
         """
@@ -200,6 +208,57 @@ def testStackBaseStack2DDataHandling(self):
         dummyArray = None
         referenceData = None
 
+    def testStackBaseCumulativeSum(self):
+        from PyMca5.PyMcaCore import StackBase
+        numpy.random.seed(5)
+        referenceData = numpy.random.randint(0, 100, (20, 30, 200)).\
+                                                astype(numpy.uint16)
+        fileNames = [None]
+        if HDF5:
+            fd, fileName = tempfile.mkstemp(suffix=".h5")
+            os.close(fd)
+            fileNames.append(fileName)
+        for mcaIndex in [0, 2]:
+            for fileName in fileNames:
+                data = numpy.ascontiguousarray(\
+                                numpy.rollaxis(referenceData, 2, mcaIndex))
+                stackBase = StackBase.StackBase()
+                stackBase.setStack(data, mcaindex=mcaIndex)
+                reference = stackBase.calculateROIImages(20, 150, imiddle=60)
+                stackBase.setCumulativeSum(True, filename=fileName)
+                imageDict = stackBase.calculateROIImages(20, 150, imiddle=60)
+                for key in ['ROI', 'Left', 'Middle', 'Right', 'Background']:
+                    self.assertTrue(numpy.allclose(imageDict[key],
+                                                   reference[key]),
+                                    "Incorrect %s image from cumulative sum" %\
+                                    key)
+                # the position of the extrema is not calculated
+                for key in ['Maximum', 'Minimum']:
+                    self.assertFalse(key in imageDict,
+                                     "Unexpected %s image" % key)
+                stackBase.updateROIImages()
+                images, names = stackBase.getStackROIImagesAndNames()
+                self.assertEqual(len(images), 5)
+                self.assertEqual(len(names), 5)
+                self.assertEqual(names[-1], "ICR Background")
+                # unless explicitly requested
+                stackBase.setCumulativeSum(True, filename=fileName,
+                                           minmax=True)
+                imageDict = stackBase.calculateROIImages(20, 150, imiddle=60)
+                for key in ['ROI', 'Maximum', 'Minimum']:
+                    self.assertTrue(numpy.allclose(imageDict[key],
+                                                   reference[key]),
+                                    "Incorrect %s image from cumulative sum" %\
+                                    key)
+                # the sum is rebuilt when the stack is modified
+                data[:, :, :] = 1
+                stackBase.stackUpdated()
+                imageDict = stackBase.calculateROIImages(20, 150)
+                self.assertTrue(numpy.allclose(imageDict['ROI'], 130))
+                stackBase.setCumulativeSum(False)
+        if HDF5:
+            os.remove(fileNames[-1])
+
 def getSuite(auto=True):
     testSuite = unittest.TestSuite()
     if auto:
@@ -210,6 +269,7 @@ def getSuite(auto=True):
         testSuite.addTest(testStackBase("testStackBaseImport"))
         testSuite.addTest(testStackBase("testStackBaseStack1DDataHandling"))
         testSuite.addTest(testStackBase("testStackBaseStack2DDataHandling"))
+        testSuite.addTest(testStackBase("testStackBaseCumulativeSum"))
     return testSuite
 
 def test(auto=False):
@@ -0,0 +1,148 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import tempfile
+import numpy
+
+try:
+    import h5py
+    HDF5 = True
+except:
+    HDF5 = False
+
+class testStackFilterTools(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(0)
+        x = numpy.arange(300.)
+        peak = 100 * numpy.exp(-((x - 150.) / 20.) ** 2) + 10
+        self.stack = numpy.random.poisson(peak, (6, 5, x.size)).\
+                                                    astype(numpy.float64)
+        self._fileName = None
+
+    def tearDown(self):
+        if self._fileName is not None:
+            os.remove(self._fileName)
+            self._fileName = None
+
+    def _snipReference(self, width, roi_min, roi_max):
+        from PyMca5.PyMcaMath import SNIPModule
+        spectra = self.stack.reshape(-1, self.stack.shape[-1])
+        result = numpy.zeros(spectra.shape, numpy.float64)
+        for i in range(spectra.shape[0]):
+            spectrum = spectra[i, roi_min:roi_max]
+            result[i, roi_min:roi_max] = spectrum - \
+                                         SNIPModule.snip1d(spectrum, width, 1)
+        result.shape = self.stack.shape
+        return result
+
+    def testSavitzkyGolayStack(self):
+        from PyMca5.PyMcaMath import SGModule
+        for order in [0, 1]:
+            reference = numpy.zeros(self.stack.shape, numpy.float64)
+            for i in range(self.stack.shape[0]):
+                for j in range(self.stack.shape[1]):
+                    reference[i, j] = SGModule.getSavitzkyGolay(\
+                        self.stack[i, j], npoints=5, degree=2, order=order)
+            data = self.stack.copy()
+            SGModule.replaceStackWithSavitzkyGolay(data, 5, 2, order,
+                                                   nthreads=2)
+            # getSavitzkyGolay does not fill the borders of derivatives
+            self.assertTrue(numpy.allclose(data[:, :, 5:-5],
+                                           reference[:, :, 5:-5]))
+            # spectra along the first axis
+            data = numpy.ascontiguousarray(numpy.rollaxis(self.stack, 2, 0))
+            class Stack(object):
+                pass
+            stack = Stack()
+            stack.data = data
+            stack.info = {'McaIndex': 0}
+            SGModule.replaceStackWithSavitzkyGolay(stack, 5, 2, order)
+            self.assertTrue(numpy.allclose(numpy.rollaxis(data, 0, 3)[:, :, 5:-5],
+                                           reference[:, :, 5:-5]))
+
+    def testSnip1DStack(self):
+        from PyMca5.PyMcaMath import SNIPModule
+        data = self.stack.copy()
+        SNIPModule.subtractSnip1DBackgroundFromStack(data, 30, 20, 280, 1,
+                                                     nthreads=2)
+        self.assertTrue(numpy.allclose(data,
+                                       self._snipReference(30, 20, 280)))
+
+    @unittest.skipIf(not HDF5, "h5py not available")
+    def testSnip1DStackHDF5(self):
+        from PyMca5.PyMcaMath import SNIPModule
+        from PyMca5.PyMcaMath import StackFilterTools
+        fd, self._fileName = tempfile.mkstemp(suffix=".h5")
+        os.close(fd)
+        h5 = h5py.File(self._fileName, "w")
+        try:
+            h5["input"] = self.stack
+            output = h5.create_dataset("output", shape=self.stack.shape,
+                                       dtype=numpy.float64)
+            # force several blocks
+            self.assertTrue(len(StackFilterTools.getBlockSlices(\
+                                self.stack.shape, 0, blocksize=1000)) > 1)
+            blockSize = StackFilterTools.BLOCK_SIZE
+            StackFilterTools.BLOCK_SIZE = 1000
+            try:
+                SNIPModule.subtractSnip1DBackgroundFromStack(h5["input"],
+                                                             30, None, None, 1,
+                                                             output=output,
+                                                             nthreads=2)
+            finally:
+                StackFilterTools.BLOCK_SIZE = blockSize
+            self.assertTrue(numpy.allclose(output[()],
+                                           self._snipReference(30, 0, 300)))
+            # the input is untouched
+            self.assertTrue(numpy.allclose(h5["input"][()], self.stack))
+        finally:
+            h5.close()
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testStackFilterTools))
+    else:
+        # use a predefined order
+        testSuite.addTest(testStackFilterTools("testSavitzkyGolayStack"))
+        testSuite.addTest(testStackFilterTools("testSnip1DStack"))
+        testSuite.addTest(testStackFilterTools("testSnip1DStackHDF5"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
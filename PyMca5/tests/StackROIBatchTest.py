@@ -0,0 +1,112 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import numpy
+
+class testStackROIBatch(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(10)
+        self.data = numpy.random.randint(0, 1000, (20, 30, 256)).\
+                                                    astype(numpy.uint16)
+
+    def testStackROIBatchImport(self):
+        from PyMca5.PyMcaCore import StackROIBatch
+
+    def testCalculateROIImages(self):
+        from PyMca5.PyMcaCore import StackROIBatch
+        roiList = [(10, 50), (40, 200, 100), (0, 256)]
+        for mcaIndex in [0, 1, 2]:
+            data = numpy.ascontiguousarray(numpy.rollaxis(self.data, 2,
+                                                          mcaIndex))
+            # force the use of several blocks
+            result = StackROIBatch.calculateROIImages(data, roiList,
+                                                      mcaIndex=mcaIndex,
+                                                      blocksize=10000)
+            for roi, ddict in zip(roiList, result):
+                i1, i2 = roi[0], roi[1]
+                if len(roi) > 2:
+                    imiddle = roi[2]
+                else:
+                    imiddle = (i1 + i2) // 2
+                spectra = self.data[:, :, i1:i2]
+                self.assertEqual(ddict['Left'].dtype, data.dtype)
+                self.assertTrue(numpy.allclose(ddict['ROI'],
+                                    spectra.sum(axis=-1, dtype=numpy.float64)))
+                self.assertTrue(numpy.all(ddict['Left'] == spectra[:, :, 0]))
+                self.assertTrue(numpy.all(ddict['Right'] == spectra[:, :, -1]))
+                self.assertTrue(numpy.all(ddict['Middle'] == \
+                                          self.data[:, :, imiddle]))
+                self.assertTrue(numpy.all(ddict['Maximum'] == \
+                                          spectra.argmax(axis=-1) + i1))
+                self.assertTrue(numpy.all(ddict['Minimum'] == \
+                                          spectra.argmin(axis=-1) + i1))
+
+    def testBatchROIMultipleSpectra(self):
+        from PyMca5.PyMcaCore import StackROIBatch
+        config = {"ROI": {"roilist": ["A", "B"],
+                          "roidict": {"A": {"type": "Channel",
+                                            "from": 10, "to": 50},
+                                      "B": {"type": "Channel",
+                                            "from": 100, "to": 120}}}}
+        instance = StackROIBatch.StackROIBatch()
+        result = instance.batchROIMultipleSpectra(y=self.data,
+                                                  configuration=config,
+                                                  xAtMinMax=True)
+        self.assertEqual(result['names'][0], "ROI A")
+        self.assertEqual(result['names'][3], "ROI B Net")
+        images = result['images']
+        self.assertEqual(images.shape, (8, 20, 30))
+        spectra = self.data[:, :, 100:121].astype(numpy.float64)
+        self.assertTrue(numpy.allclose(images[1], spectra.sum(axis=-1)))
+        net = spectra.sum(axis=-1) - \
+              0.5 * (spectra[:, :, 0] + spectra[:, :, -1]) * 22
+        self.assertTrue(numpy.allclose(images[3], net))
+        self.assertTrue(numpy.all(images[5] == spectra.argmax(axis=-1) + 100))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testStackROIBatch))
+    else:
+        # use a predefined order
+        testSuite.addTest(testStackROIBatch("testStackROIBatchImport"))
+        testSuite.addTest(testStackROIBatch("testCalculateROIImages"))
+        testSuite.addTest(testStackROIBatch("testBatchROIMultipleSpectra"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
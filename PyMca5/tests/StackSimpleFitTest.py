@@ -0,0 +1,131 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import shutil
+import tempfile
+import numpy
+
+class testStackSimpleFit(unittest.TestCase):
+    def setUp(self):
+        from PyMca5.PyMcaMath.fitting import SpecfitFuns
+        self.x = numpy.arange(200.)
+        self.nRows = 8
+        self.nColumns = 10
+        self.stack = numpy.zeros((self.nRows, self.nColumns, self.x.size))
+        self.heights = numpy.zeros((self.nRows, self.nColumns))
+        for row in range(self.nRows):
+            for column in range(self.nColumns):
+                height = 100. + 5 * row + column
+                self.heights[row, column] = height
+                self.stack[row, column] = SpecfitFuns.gauss(\
+                    [height, 80. + row, 20. + 0.5 * column], self.x)
+        self.mask = numpy.ones((self.nRows, self.nColumns), numpy.uint8)
+        self.mask[2, 3] = 0
+        self._tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpDir)
+
+    def _fitStack(self, policy, nworkers, seedfromneighbors=None):
+        from PyMca5.PyMcaMath.fitting import SimpleFitModule
+        from PyMca5.PyMcaMath.fitting import SpecfitFunctions
+        from PyMca5.PyMcaMath.fitting import StackSimpleFit
+        fit = SimpleFitModule.SimpleFit()
+        fit.importFunctions(SpecfitFunctions)
+        fit.setFitFunction("Gaussians")
+        fit._fitConfiguration['fit']['function_estimation_policy'] = policy
+        fit._fitConfiguration['fit']['background_estimation_policy'] = policy
+        stackFit = StackSimpleFit.StackSimpleFit(fit=fit, nworkers=nworkers,
+                                    seedfromneighbors=seedfromneighbors)
+        stackFit.setOutputDirectory(self._tmpDir)
+        stackFit.setOutputFileBaseName("fit%d" % nworkers)
+        stackFit.setData(self.x, self.stack)
+        stackFit.processStack(mask=self.mask)
+        return stackFit._images
+
+    def _checkImages(self, images):
+        for key in ["Height", "Position", "FWHM", "chisq"]:
+            self.assertTrue(key in images, "Missing %s image" % key)
+        heights = images["Height"]
+        self.assertEqual(heights[2, 3], 0.0)
+        self.assertTrue(numpy.allclose(heights[self.mask > 0],
+                                       self.heights[self.mask > 0],
+                                       rtol=1.0e-4))
+
+    def testStackSimpleFitSerial(self):
+        for policy in ["Estimate always", "Estimate once"]:
+            self._checkImages(self._fitStack(policy, 1))
+
+    def testStackSimpleFitPool(self):
+        for policy in ["Estimate always", "Estimate once"]:
+            serial = self._fitStack(policy, 1)
+            pool = self._fitStack(policy, 2)
+            self._checkImages(pool)
+            for key in serial:
+                self.assertTrue(numpy.allclose(serial[key], pool[key],
+                                               rtol=1.0e-4, atol=1.0e-6),
+                                "Different %s image" % key)
+
+    def testStackSimpleFitDeadPixel(self):
+        # a pixel with a single spike cannot be fitted with the peak of
+        # its neighbors and must not be used as starting point
+        self.stack[4, 5] = 0.0
+        self.stack[4, 5, 190] = 50.
+        good = self.mask > 0
+        good[4, 5] = False
+        for policy in ["Estimate once", "Use configuration"]:
+            for nworkers, seed in [(1, None), (1, True), (2, None)]:
+                heights = self._fitStack(policy, nworkers, seed)["Height"]
+                self.assertTrue(numpy.allclose(heights[good],
+                                               self.heights[good],
+                                               rtol=1.0e-4),
+                                "Wrong heights with %s and %d workers" % \
+                                (policy, nworkers))
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testStackSimpleFit))
+    else:
+        # use a predefined order
+        testSuite.addTest(testStackSimpleFit("testStackSimpleFitSerial"))
+        testSuite.addTest(testStackSimpleFit("testStackSimpleFitPool"))
+        testSuite.addTest(testStackSimpleFit("testStackSimpleFitDeadPixel"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,265 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2015 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+import unittest
+import os
+import shutil
+import tempfile
+import numpy
+
+class testXAS(unittest.TestCase):
+    def setUp(self):
+        self._setSpectra(numpy.linspace(7000., 7600., 600))
+        self._tmpDir = None
+
+    def _setSpectra(self, energy):
+        # synthetic K edges with different edge energies
+        self.energy = energy
+        numpy.random.seed(100)
+        nSpectra = 6
+        e0 = 7112. + numpy.random.normal(0, 1, nSpectra)
+        k = numpy.sqrt(numpy.clip(self.energy - 7112., 0, None) * 0.2625)
+        edge = 0.5 + 0.5 * numpy.tanh((self.energy[None, :] - e0[:, None]) / 2.)
+        self.mu = edge * (1 + 0.05 * numpy.sin(4.0 * k) * \
+                              numpy.exp(-0.01 * k * k)) - \
+                  0.0001 * (self.energy - 7000.) + \
+                  numpy.random.normal(0, 0.002, (nSpectra, self.energy.size))
+
+    def tearDown(self):
+        if self._tmpDir is not None:
+            shutil.rmtree(self._tmpDir)
+            self._tmpDir = None
+
+    def _compareWithSingleSpectrum(self, configuration):
+        from PyMca5.PyMcaPhysics.xas import XASClass
+        analyzer = XASClass.XASClass()
+        if configuration is not None:
+            analyzer.setConfiguration(configuration)
+        batch = analyzer.processMultipleSpectra(self.energy, self.mu)
+        self.assertTrue(numpy.allclose(batch["Energy"], self.energy))
+        for i in range(self.mu.shape[0]):
+            analyzer.setSpectrum(self.energy, self.mu[i])
+            ddict = analyzer.processSpectrum()
+            for key in ["Edge", "Jump", "NormalizedPlotMin",
+                        "NormalizedPlotMax", "KMax"]:
+                self.assertTrue(abs(ddict[key] - batch[key][i]) < 1.0e-6,
+                                "Different %s" % key)
+            for key in ["Mu", "NormalizedMu", "NormalizedBackground",
+                        "NormalizedSignal", "PostEdgeB", "KnotsX", "KnotsY"]:
+                self.assertTrue(numpy.allclose(ddict[key], batch[key][i],
+                                               atol=1.0e-6),
+                                "Different %s" % key)
+            # EXAFS within the fitted range
+            idx = (ddict["EXAFSKValues"] >= ddict["KMin"]) & \
+                  (ddict["EXAFSKValues"] <= ddict["KMax"])
+            self.assertTrue(numpy.allclose(ddict["EXAFSNormalized"][idx],
+                                           batch["EXAFSNormalized"][i][idx],
+                                           atol=1.0e-6))
+            self.assertTrue(numpy.allclose(ddict["FT"]["FTRadius"],
+                                           batch["FT"]["FTRadius"]))
+            for key in ["FTIntensity", "FTReal", "FTImaginary"]:
+                self.assertTrue(numpy.allclose(ddict["FT"][key],
+                                               batch["FT"][key][i],
+                                               atol=1.0e-6),
+                                "Different FT %s" % key)
+
+    def testXASImport(self):
+        from PyMca5.PyMcaPhysics.xas import XASClass
+
+    def testXASMultipleSpectraDefault(self):
+        self._compareWithSingleSpectrum(None)
+
+    def testXASMultipleSpectraConfiguration(self):
+        configuration = {}
+        configuration["Normalization"] = {"E0Method": "Auto - 9pt SG",
+                                        "JumpNormalizationMethod": "Constant",
+                                        "PreEdge": {"Polynomial": "Victoreen"},
+                                        "PostEdge": {"Polynomial": "Parabolic"}}
+        configuration["EXAFS"] = {"KWeight": 2,
+                                  "KMax": 10.0,
+                                  "Knots": {"Number": 2,
+                                            "Values": [5.0, 8.0],
+                                            "Orders": [3, 3, 3]}}
+        configuration["FT"] = {"Window": "Hanning",
+                               "WindowRange": [3.0, 9.0]}
+        self._compareWithSingleSpectrum(configuration)
+
+    def testXASMultipleSpectraInterpolated(self):
+        # a non equidistant energy grid needs the edge to be searched on
+        # interpolated data, where the 3 point derivative has ties
+        configuration = {}
+        configuration["Normalization"] = {"E0Method": "Auto - 3pt SG"}
+        for seed in [2, 15]:
+            numpy.random.seed(seed)
+            self._setSpectra(numpy.sort(numpy.random.uniform(7000., 7600.,
+                                                             400)))
+            self._compareWithSingleSpectrum(configuration)
+
+    def testXASStackBatch(self):
+        import h5py
+        from PyMca5.PyMcaPhysics.xas import XASClass
+        from PyMca5.PyMcaPhysics.xas import XASStackBatch
+        data = self.mu.astype(numpy.float32)
+        data.shape = 2, 3, self.energy.size
+        mask = numpy.ones((2, 3), numpy.uint8)
+        mask[1, 1] = 0
+        self._tmpDir = tempfile.mkdtemp()
+        batch = XASStackBatch.XASStackBatch()
+        result = batch.processMultipleSpectra(self.energy, data, mask=mask,
+                                              directory=self._tmpDir,
+                                              name="xas")
+        self.assertEqual(result["names"], ["Jump", "Edge"])
+        analyzer = XASClass.XASClass()
+        h5 = h5py.File(os.path.join(self._tmpDir, "xas.h5"), "r")
+        try:
+            signal = h5["xas_analysis/FT/Intensity"][()]
+            for i in range(2):
+                for j in range(3):
+                    if mask[i, j]:
+                        analyzer.setSpectrum(self.energy, data[i, j])
+                        ddict = analyzer.processSpectrum()
+                        self.assertTrue(abs(result["images"][1, i, j] - \
+                                            ddict["Edge"]) < 1.0e-2)
+                        self.assertTrue(numpy.allclose(signal[i, j],
+                                        ddict["FT"]["FTIntensity"],
+                                        atol=1.0e-5))
+                    else:
+                        self.assertEqual(result["images"][1, i, j], 0)
+                        self.assertTrue(numpy.all(signal[i, j] == 0))
+        finally:
+            h5.close()
+
+    def testXASStackBatchChunks(self):
+        import h5py
+        from PyMca5.PyMcaPhysics.xas import XASClass
+        from PyMca5.PyMcaPhysics.xas import XASStackBatch
+        nRows, nColumns = 5, 4
+        nChannels = self.energy.size
+        # different intensities in each pixel to detect misplaced columns
+        scale = 1.0 + 0.1 * numpy.arange(nRows * nColumns)
+        data = self.mu[numpy.arange(nRows * nColumns) % self.mu.shape[0]] * \
+               scale[:, None]
+        data = data.astype(numpy.float32)
+        data.shape = nRows, nColumns, nChannels
+        mask = numpy.ones((nRows, nColumns), numpy.uint8)
+        mask[0, 1] = 0
+        mask[2, :] = 0
+        mask[3, 3] = 0
+        self._tmpDir = tempfile.mkdtemp()
+        batch = XASStackBatch.XASStackBatch()
+        # buffers of two rows of spectra and chunks of one spectrum
+        oldBufferSize = XASStackBatch.BUFFER_SIZE
+        oldChunkSize = XASStackBatch.CHUNK_SIZE
+        XASStackBatch.BUFFER_SIZE = 2 * nColumns * nChannels * 4
+        XASStackBatch.CHUNK_SIZE = nChannels * 4
+        try:
+            result = batch.processMultipleSpectra(self.energy, data,
+                                                  mask=mask,
+                                                  directory=self._tmpDir,
+                                                  name="xas")
+        finally:
+            XASStackBatch.BUFFER_SIZE = oldBufferSize
+            XASStackBatch.CHUNK_SIZE = oldChunkSize
+
+        # reference calculated row by row
+        analyzer = XASClass.XASClass()
+        analyzer.setSpectrum(self.energy, data[0, 0])
+        ddict = analyzer.processSpectrum()
+        normalizedIdx = (ddict["NormalizedEnergy"] >= \
+                                            ddict["NormalizedPlotMin"]) & \
+                        (ddict["NormalizedEnergy"] <= \
+                                            ddict["NormalizedPlotMax"])
+        exafsIdx = (ddict["EXAFSKValues"] >= ddict["KMin"]) & \
+                   (ddict["EXAFSKValues"] <= ddict["KMax"])
+        h5 = h5py.File(os.path.join(self._tmpDir, "xas.h5"), "r")
+        try:
+            self.assertEqual(h5["xas_analysis/spectrum/mu"].chunks,
+                             (1, 1, nChannels))
+            for i in range(nRows):
+                if not mask[i].any():
+                    for path in ["spectrum/mu", "normalized/mu",
+                                 "exafs/signal", "FT/Intensity",
+                                 "FT/Imaginary"]:
+                        self.assertTrue(numpy.all(\
+                            h5["xas_analysis/" + path][i] == 0))
+                    self.assertTrue(numpy.all(result["images"][:, i] == 0))
+                    continue
+                ddict = analyzer.processMultipleSpectra(self.energy, data[i])
+                expected = {"spectrum/mu": ddict["Mu"],
+                            "normalized/mu": \
+                                    ddict["NormalizedMu"][:, normalizedIdx],
+                            "exafs/signal": \
+                                    ddict["EXAFSNormalized"][:, exafsIdx],
+                            "FT/Intensity": ddict["FT"]["FTIntensity"],
+                            "FT/Imaginary": ddict["FT"]["FTImaginary"]}
+                for path in expected:
+                    signal = h5["xas_analysis/" + path][i]
+                    for j in range(nColumns):
+                        if mask[i, j]:
+                            self.assertTrue(numpy.allclose(signal[j],
+                                            expected[path][j],
+                                            rtol=1.0e-5, atol=1.0e-5),
+                                            "Different %s" % path)
+                        else:
+                            self.assertTrue(numpy.all(signal[j] == 0))
+                for j in range(nColumns):
+                    if mask[i, j]:
+                        self.assertTrue(abs(result["images"][0, i, j] - \
+                                            ddict["Jump"][j]) < 1.0e-4)
+                        self.assertTrue(abs(result["images"][1, i, j] - \
+                                            ddict["Edge"][j]) < 1.0e-2)
+                    else:
+                        self.assertTrue(numpy.all(\
+                                            result["images"][:, i, j] == 0))
+        finally:
+            h5.close()
+
+def getSuite(auto=True):
+    testSuite = unittest.TestSuite()
+    if auto:
+        testSuite.addTest(\
+            unittest.TestLoader().loadTestsFromTestCase(testXAS))
+    else:
+        # use a predefined order
+        testSuite.addTest(testXAS("testXASImport"))
+        testSuite.addTest(testXAS("testXASMultipleSpectraDefault"))
+        testSuite.addTest(testXAS("testXASMultipleSpectraConfiguration"))
+        testSuite.addTest(testXAS("testXASMultipleSpectraInterpolated"))
+        testSuite.addTest(testXAS("testXASStackBatch"))
+        testSuite.addTest(testXAS("testXASStackBatchChunks"))
+    return testSuite
+
+def test(auto=False):
+    unittest.TextTestRunner(verbosity=2).run(getSuite(auto=auto))
+
+if __name__ == '__main__':
+    test()
@@ -40,7 +40,17 @@
 from PyMca5.tests.ConfigDictTest import test as testConfigDict
 from PyMca5.tests.EdfFileTest import test as testEdfFile
 from PyMca5.tests.ElementsTest import test as testElements
+from PyMca5.tests.FastXRFLinearFitTest import test as testFastXRFLinearFit
 from PyMca5.tests.GefitTest import test as testGefit
+from PyMca5.tests.ImageRegistrationTest import test as testImageRegistration
+from PyMca5.tests.LinalgTest import test as testLinalg
+from PyMca5.tests.McaAdvancedFitBatchTest import test as testMcaAdvancedFitBatch
+from PyMca5.tests.McaTheoryTest import test as testMcaTheory
+from PyMca5.tests.NNMAModuleTest import test as testNNMAModule
 from PyMca5.tests.PCAToolsTest import test as testPCATools
 from PyMca5.tests.SpecfileTest import test as testSpecfile
+from PyMca5.tests.StackFilterToolsTest import test as testStackFilterTools
+from PyMca5.tests.StackROIBatchTest import test as testStackROIBatch
+from PyMca5.tests.StackSimpleFitTest import test as testStackSimpleFit
 from PyMca5.tests.specfilewrapperTest import test as testSpecfilewrapper
+from PyMca5.tests.XASTest import test as testXAS
@@ -0,0 +1,347 @@
+#/*##########################################################################
+#
+# The PyMca X-Ray Fluorescence Toolkit
+#
+# Copyright (c) 2004-2016 European Synchrotron Radiation Facility
+#
+# This file is part of the PyMca X-ray Fluorescence Toolkit developed at
+# the ESRF by the Software group.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#############################################################################*/
+__author__ = "V. Armando Sole - ESRF Data Analysis"
+__contact__ = "sole@esrf.fr"
+__license__ = "MIT"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__doc__ = """
+Throughput benchmarks of the XRF analysis hot paths.
+
+The benchmarks run on a synthetic map built from the XRFSpectrum.mca
+spectrum distributed with PyMca and are fitted with a configuration
+derived from McaTheory.cfg. The results, in spectra per second, are
+written to a JSON file together with the resident memory used in order
+to compare different PyMca versions or machines.
+
+Each benchmark runs in its own process, so that its peak resident
+memory is not hidden by the one of the previous benchmarks.
+
+Usage:
+
+    python -m PyMca5.tests.benchmarks.XRFBenchmarks --rows=100 --columns=100
+           --output=benchmarks.json
+
+"""
+import os
+import sys
+import time
+import json
+import platform
+import multiprocessing
+import numpy
+try:
+    import resource
+except ImportError:
+    # not available under windows
+    resource = None
+
+import PyMca5
+from PyMca5 import PyMcaDataDir
+from PyMca5.PyMcaIO import ConfigDict
+from PyMca5.PyMcaIO import specfilewrapper as specfile
+
+DEBUG = 0
+
+BENCHMARKS = ["FastXRFLinearFit",
+              "McaTheory",
+              "ROIImages",
+              "Covariance",
+              "SNIP"]
+
+def getPeakMemory():
+    """
+    Return the peak resident set size of the process in megabytes or
+    None if it cannot be obtained.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes
+        return peak / (1024. * 1024.)
+    # kilobytes
+    return peak / 1024.
+
+def getSpectrum():
+    """
+    Return the XRFSpectrum.mca spectrum as a float64 array.
+    """
+    sf = specfile.Specfile(os.path.join(PyMcaDataDir.PYMCA_DATA_DIR,
+                                        "XRFSpectrum.mca"))
+    y = numpy.array(sf[0].mca(1), dtype=numpy.float64)
+    sf = None
+    return y
+
+def getFitConfiguration():
+    """
+    Return the McaTheory.cfg configuration adapted to XRFSpectrum.mca
+    """
+    config = ConfigDict.ConfigDict()
+    config.read(os.path.join(PyMcaDataDir.PYMCA_DATA_DIR, "McaTheory.cfg"))
+    config['peaks'] = {'Ar': 'K', 'Ca': 'K', 'Fe': 'K',
+                       'Co': 'K', 'Cu': 'K', 'Zn': 'K'}
+    config['fit']['energy'] = [17.5]
+    config['fit']['energyweight'] = [1.0]
+    config['fit']['energyflag'] = [1]
+    config['fit']['energyscatter'] = [1]
+    config['fit']['xmin'] = 100
+    config['fit']['xmax'] = 1000
+    config['fit']['use_limit'] = 1
+    config['fit']['stripflag'] = 1
+    config['fit']['stripalgorithm'] = 1
+    return config
+
+def getSyntheticStack(nrows=50, ncolumns=50, spectrum=None, seed=0,
+                      dtype=numpy.float32):
+    """
+    Return a (nrows, ncolumns, nchannels) map of Poisson distributed
+    spectra whose intensity varies linearly across the map.
+    """
+    if spectrum is None:
+        spectrum = getSpectrum()
+    numpy.random.seed(seed)
+    scale = numpy.linspace(0.5, 1.5, nrows * ncolumns)
+    stack = numpy.zeros((nrows, ncolumns, spectrum.size), dtype=dtype)
+    for i in range(nrows):
+        mean = numpy.outer(scale[i * ncolumns:(i + 1) * ncolumns], spectrum)
+        stack[i] = numpy.random.poisson(mean)
+    return stack
+
+def _timeIt(function, repeat=1):
+    """
+    Call function repeat times and return the list of elapsed times.
+    """
+    elapsed = []
+    for i in range(max(1, repeat)):
+        t0 = time.time()
+        function()
+        elapsed.append(time.time() - t0)
+    return elapsed
+
+def _getResult(name, nSpectra, elapsed, **kw):
+    best = min(elapsed)
+    result = {"name": name,
+              "spectra": nSpectra,
+              "repeat": len(elapsed),
+              "elapsed": elapsed,
+              "best": best,
+              "mean": sum(elapsed) / len(elapsed),
+              "spectra_per_second": nSpectra / best if best > 0 else None,
+              "peak_rss_mb": getPeakMemory()}
+    result.update(kw)
+    if DEBUG:
+        print("%s: %.1f spectra/s" % (name, result["spectra_per_second"]))
+    return result
+
+def _runBenchmark(name, nrows, ncolumns, repeat, nspectra):
+    """
+    Build the synthetic map and run the given benchmark on it.
+
+    The peak resident memory before running the benchmark is reported as
+    setup_rss_mb.
+    """
+    config = getFitConfiguration()
+    stack = getSyntheticStack(nrows, ncolumns)
+    setupMemory = getPeakMemory()
+    if name == "FastXRFLinearFit":
+        result = benchmarkFastXRFLinearFit(stack, config, repeat=repeat)
+    elif name == "McaTheory":
+        result = benchmarkMcaTheory(stack, config, repeat=repeat,
+                                    nspectra=nspectra)
+    elif name == "ROIImages":
+        result = benchmarkROIImages(stack, repeat=repeat)
+    elif name == "Covariance":
+        result = benchmarkCovariance(stack, repeat=repeat)
+    elif name == "SNIP":
+        result = benchmarkSNIP(stack, repeat=repeat)
+    result["setup_rss_mb"] = setupMemory
+    return result
+
+def _runBenchmarkInProcess(name, nrows, ncolumns, repeat, nspectra):
+    """
+    Run the benchmark in a new process and return its result.
+    """
+    if hasattr(multiprocessing, "get_context"):
+        # a forked process would start with the memory of this one
+        context = multiprocessing.get_context("spawn")
+    else:
+        context = multiprocessing
+    pool = context.Pool(1)
+    try:
+        result = pool.apply(_runBenchmark,
+                            (name, nrows, ncolumns, repeat, nspectra))
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+def benchmarkFastXRFLinearFit(stack, config, repeat=1):
+    from PyMca5.PyMcaPhysics.xrf.FastXRFLinearFit import FastXRFLinearFit
+    fit = FastXRFLinearFit()
+    fit.setFitConfiguration(config)
+    def run():
+        fit.fitMultipleSpectra(y=stack, weight=0, refit=1)
+    elapsed = _timeIt(run, repeat)
+    return _getResult("FastXRFLinearFit.fitMultipleSpectra",
+                      stack.shape[0] * stack.shape[1], elapsed)
+
+def benchmarkMcaTheory(stack, config, repeat=1, nspectra=10):
+    from PyMca5.PyMcaPhysics.xrf import ClassMcaTheory
+    spectra = stack.reshape(-1, stack.shape[-1])[:nspectra]
+    x = numpy.arange(stack.shape[-1]).astype(numpy.float64)
+    mcaFit = ClassMcaTheory.McaTheory()
+    mcaFit.setConfiguration(config)
+    def run():
+        for y in spectra:
+            mcaFit.setData(x, y,
+                           xmin=config['fit']['xmin'],
+                           xmax=config['fit']['xmax'])
+            mcaFit.estimate()
+            mcaFit.startfit(digest=0)
+    elapsed = _timeIt(run, repeat)
+    return _getResult("McaTheory.startfit", spectra.shape[0], elapsed)
+
+def benchmarkROIImages(stack, repeat=1):
+    from PyMca5.PyMcaCore import StackBase
+    stackBase = StackBase.StackBase()
+    stackBase.setStack(stack, mcaindex=2)
+    i0 = int(0.25 * stack.shape[-1])
+    i1 = int(0.75 * stack.shape[-1])
+    def run():
+        stackBase.calculateROIImages(i0, i1)
+    elapsed = _timeIt(run, repeat)
+    return _getResult("StackBase.calculateROIImages",
+                      stack.shape[0] * stack.shape[1], elapsed)
+
+def benchmarkCovariance(stack, repeat=1):
+    from PyMca5.PyMcaMath.mva import PCATools
+    def run():
+        PCATools.getCovarianceMatrix(stack, index=-1, force=True)
+    elapsed = _timeIt(run, repeat)
+    return _getResult("PCATools.getCovarianceMatrix",
+                      stack.shape[0] * stack.shape[1], elapsed)
+
+def benchmarkSNIP(stack, repeat=1, width=24):
+    from PyMca5.PyMcaMath.fitting import SpecfitFuns
+    spectra = stack.reshape(-1, stack.shape[-1]).astype(numpy.float64)
+    def run():
+        SpecfitFuns.snip1d(spectra, width, 0)
+    elapsed = _timeIt(run, repeat)
+    return _getResult("SpecfitFuns.snip1d", spectra.shape[0], elapsed,
+                      width=width)
+
+def getEnvironment():
+    return {"pymca": PyMca5.version(),
+            "numpy": numpy.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "processor": platform.processor()}
+
+def runBenchmarks(nrows=50, ncolumns=50, repeat=3, benchmarks=None,
+                  nspectra=10, output=None, isolated=True):
+    """
+    Run the selected benchmarks on a synthetic map of nrows x ncolumns
+    spectra and return a dictionary with the results. If output is given,
+    the dictionary is also written to that file in JSON format.
+
+    If isolated is True, each benchmark runs in a new process and its
+    peak_rss_mb is the peak resident memory of that process. Otherwise
+    it is the peak of the current process up to the end of the benchmark.
+    """
+    if benchmarks is None:
+        benchmarks = BENCHMARKS
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError("Unknown benchmark <%s>" % name)
+    results = []
+    for name in benchmarks:
+        if isolated:
+            result = _runBenchmarkInProcess(name, nrows, ncolumns,
+                                            repeat, nspectra)
+        else:
+            result = _runBenchmark(name, nrows, ncolumns, repeat, nspectra)
+        results.append(result)
+    ddict = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+             "environment": getEnvironment(),
+             "shape": [nrows, ncolumns, getSpectrum().size],
+             "dtype": str(numpy.dtype(numpy.float32)),
+             "isolated": isolated,
+             "results": results}
+    if output is not None:
+        fd = open(output, "w")
+        try:
+            json.dump(ddict, fd, indent=2, sort_keys=True)
+        finally:
+            fd.close()
+    return ddict
+
+def main():
+    import getopt
+    options = ''
+    longoptions = ['rows=', 'columns=', 'repeat=', 'benchmarks=',
+                   'nspectra=', 'output=', 'isolated=']
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], options, longoptions)
+    except:
+        print(sys.exc_info()[1])
+        sys.exit(1)
+    nrows = 50
+    ncolumns = 50
+    repeat = 3
+    nspectra = 10
+    benchmarks = None
+    output = None
+    isolated = True
+    for opt, arg in opts:
+        if opt == '--rows':
+            nrows = int(arg)
+        elif opt == '--columns':
+            ncolumns = int(arg)
+        elif opt == '--repeat':
+            repeat = int(arg)
+        elif opt == '--nspectra':
+            nspectra = int(arg)
+        elif opt == '--benchmarks':
+            benchmarks = [x.strip() for x in arg.split(",") if len(x.strip())]
+        elif opt == '--output':
+            output = arg
+        elif opt == '--isolated':
+            isolated = bool(int(arg))
+    ddict = runBenchmarks(nrows=nrows, ncolumns=ncolumns, repeat=repeat,
+                          benchmarks=benchmarks, nspectra=nspectra,
+                          output=output, isolated=isolated)
+    for result in ddict["results"]:
+        print("%-40s %12.1f spectra/s" % (result["name"],
+                                          result["spectra_per_second"]))
+    if output is not None:
+        print("Results written to %s" % output)
+
+if __name__ == "__main__":
+    main()
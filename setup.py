@@ -165,6 +165,7 @@ def use_fisx():
 # The following is not supported by python-2.3:
 #package_data = {'PyMca': ['attdata/*', 'HTML/*.*', 'HTML/IMAGES/*', 'HTML/PyMCA_files/*']}
 packages = ['PyMca5','PyMca5.PyMcaPlugins', 'PyMca5.tests',
+            'PyMca5.tests.benchmarks',
             'PyMca5.PyMca',
             'PyMca5.PyMcaCore',
             'PyMca5.PyMcaPhysics',